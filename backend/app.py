@@ -1,27 +1,151 @@
-from flask import Flask, request, jsonify, redirect, session
+from flask import Flask, request, jsonify, redirect, session, Response, g, send_file
 from flask_cors import CORS
 from functools import wraps
 import requests
-from data_handlers import TextHandler, ImageHandler, AudioHandler
-import chromadb
+from data_handlers import TextHandler, ImageHandler, AudioHandler, CompressedIndexRegistry
 from users.user_management import init_db, User
 from dotenv import load_dotenv
 import os
+import io
 import random
 import base64
 import hashlib
-from helpers.youtube import get_youtube_title
+import time
+import threading
+from helpers.youtube import is_youtube_url
+from helpers.link_enrichment import LinkEnricher, item_metadata
+from helpers.web_ingest import WebIngestor
+from helpers.blob_store import BlobStore
+from helpers.storage_gc import StorageGC
+from helpers.perceptual_hash import NearDuplicateIndex
+from helpers.tag_index import TagIndex, parse_tags
+from helpers.suggest_index import SuggestIndex
+from helpers import item_fields
+from helpers.index_residency import IndexResidencyManager
+from helpers.hnsw_params import HNSW_SETTINGS, ExactSearch
+from helpers.logs import get_logger
+from helpers import metrics
+from helpers.metrics import timed
+from helpers.profiling import RequestProfiler
+from helpers.query_cache import QueryResultCache, normalize_query
+from helpers import write_events
+from helpers import library_io
+from helpers import reindex
+from helpers import similar
+from helpers import streaming
+from helpers import admission
+from helpers import shards
+from helpers.clusters import LibraryClusters
+from helpers.change_feed import ChangeFeed, SSE_KEEPALIVE, SSE_MIMETYPE, sse_page, wants_sse
+
+logger = get_logger("app")
 
 load_dotenv()
 
-# Initialize ChromaDB client
-chroma_path = "OrbitDB"
-client = chromadb.PersistentClient(path=chroma_path)
+# Track per-collection residency so idle users' vector indexes can be evicted
+# under ORBIT_INDEX_MEMORY_BUDGET_MB and reloaded on demand (local shards only;
+# Chroma servers manage their own memory).
+residency = IndexResidencyManager()
+
+# Initialize ChromaDB: each user's collections live on one shard, a local
+# directory or a Chroma server (ORBIT_CHROMA_SHARDS; by default the single
+# directory ORBIT_CHROMA_PATH). The client routes every collection to its shard.
+shard_router = shards.ShardRouter(wrap=lambda shard, shard_client: residency.wrap(shard_client)
+                                  if shard.local else shard_client)
+client = shard_router.client()
+prewarm_on_auth = os.getenv("ORBIT_PREWARM_ON_AUTH", "false").lower() in ("1", "true", "yes")
+
+# ORBIT_COMPRESSED_INDEX (int8, binary or pca) serves searches from compressed
+# vectors with exact re-ranking against memory-mapped full-precision copies.
+compressed_mode = os.getenv("ORBIT_COMPRESSED_INDEX")
+def _compressed_registry(kind, folder):
+    if not compressed_mode:
+        return None
+    return CompressedIndexRegistry(os.path.join("data", "vectors", folder), compressed_mode,
+                                   space=HNSW_SETTINGS.space(kind))
+
+# Collections get HNSW parameters per modality and size tier (ORBIT_HNSW_CONFIG);
+# those small enough are searched by exact scan of vectors cached in memory.
+exact_search = ExactSearch()
+write_events.subscribe(exact_search.on_write)
+
+# Image and audio files are stored once, content-addressed, however many users
+# save them (see helpers/blob_store.py for migrating per-user folders).
+blob_store = BlobStore()
+
+# New images are perceptually hashed and near duplicates of a user's existing
+# images reuse their embedding (ORBIT_NEAR_DUPLICATE_POLICY: link, skip or off).
+near_duplicates = None
+if os.getenv("ORBIT_NEAR_DUPLICATE_POLICY", "link").lower() != "off":
+    near_duplicates = NearDuplicateIndex()
+    write_events.subscribe(near_duplicates.on_write)
+
+# Initialize handlers. ORBIT_STUB_ENCODERS swaps the models for deterministic
+# stubs so storage and index costs can be measured without inference.
+if os.getenv("ORBIT_STUB_ENCODERS", "false").lower() in ("1", "true", "yes"):
+    from helpers.stub_encoders import StubTextEmbedding, StubImageEmbedding, StubAudioEmbedder
+    encoder_specs = {kind: {"model": "stub"} for kind in ("text", "image", "audio")}
+    text_handler = TextHandler(client, embedding_model=StubTextEmbedding(),
+                               compressed_index=_compressed_registry("text", "texts"),
+                               exact_search=exact_search)
+    image_handler = ImageHandler(client, embedding_function=StubImageEmbedding(),
+                                 compressed_index=_compressed_registry("image", "images"), blob_store=blob_store,
+                                 near_duplicates=near_duplicates, exact_search=exact_search)
+    audio_handler = AudioHandler(client, embedder=StubAudioEmbedder(),
+                                 compressed_index=_compressed_registry("audio", "audio"), blob_store=blob_store,
+                                 exact_search=exact_search)
+else:
+    # Encoders promoted by a completed re-index job (see helpers/reindex.py)
+    # replace the defaults so restarts keep serving the upgraded models.
+    encoder_specs = reindex.load_encoder_specs()
+    def _encoder(kind):
+        return reindex.build_encoder(kind, encoder_specs[kind]) if kind in encoder_specs else None
+    text_handler = TextHandler(client, embedding_model=_encoder("text"),
+                               compressed_index=_compressed_registry("text", "texts"),
+                               exact_search=exact_search)
+    image_handler = ImageHandler(client, embedding_function=_encoder("image"),
+                                 compressed_index=_compressed_registry("image", "images"), blob_store=blob_store,
+                                 near_duplicates=near_duplicates, exact_search=exact_search)
+    audio_handler = AudioHandler(client, embedder=_encoder("audio"),
+                                 compressed_index=_compressed_registry("audio", "audio"), blob_store=blob_store,
+                                 exact_search=exact_search)
+
+HANDLERS = {'text': text_handler, 'image': image_handler, 'audio': audio_handler}
+
+# Embedding space of each modality's encoder; stored vectors are only compared
+# within one space (see helpers/similar.py).
+EMBEDDING_SPACES = {kind: similar.embedding_space(kind, encoder_specs.get(kind)) for kind in HANDLERS}
+
+def _collection_for(kind, user_id):
+    return HANDLERS[kind]._get_user_collection(str(user_id))
+
+def _folder_for(kind, user_id):
+    return str(HANDLERS[kind]._get_user_folder(str(user_id)))
+
+# Tag postings per user for facet counts, autocomplete and tag-filtered listings.
+tag_index = TagIndex(collection_for=_collection_for)
+write_events.subscribe(tag_index.on_write)
+
+# Search-as-you-type completions from titles, tags, channels and past searches.
+suggest_index = SuggestIndex(collection_for=_collection_for)
+write_events.subscribe(suggest_index.on_write)
+
+# Per-user log of adds, updates and deletes behind /api/changes, so clients sync incrementally.
+change_feed = ChangeFeed()
+write_events.subscribe(change_feed.on_write)
 
-# Initialize handlers
-text_handler = TextHandler(client)
-image_handler = ImageHandler(client)
-audio_handler = AudioHandler(client)
+# Libraries grouped by k-means in the background (helpers/clusters.py) for /api/clusters.
+library_clusters = LibraryClusters(collection_for=_collection_for,
+                                   list_users=lambda: {user for name in client.list_collections()
+                                                       if (user := shards.user_of(name))})
+write_events.subscribe(library_clusters.on_write)
+library_clusters.start()
+
+# Items saved before created_at/type existed get them once, in the background.
+item_fields.start_backfill(client)
+
+# YouTube links are enriched with title/channel/duration off the request path.
+link_enricher = LinkEnricher(text_handler)
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True,resources={
@@ -38,6 +162,99 @@ app.secret_key = os.getenv("SESSION_SECRET")
 # Initialize database
 init_db(app)
 
+RESIDENT_COLLECTIONS = metrics.REGISTRY.gauge(
+    "orbit_index_resident_collections", "Collections whose vector segment is loaded in memory.")
+RESIDENT_BYTES = metrics.REGISTRY.gauge(
+    "orbit_index_resident_bytes", "Estimated size of resident vector segments.")
+
+def _collect_residency():
+    stats = residency.stats()
+    RESIDENT_COLLECTIONS.set(stats["resident_collections"])
+    RESIDENT_BYTES.set(stats["resident_bytes_estimate"])
+
+metrics.REGISTRY.add_collector(_collect_residency)
+# Heartbeat every shard per scrape: orbit_shard_up, orbit_shard_heartbeat_seconds, orbit_shard_users.
+metrics.REGISTRY.add_collector(shard_router.health)
+
+# Opt-in per-request cProfile capture (X-Orbit-Profile header or ORBIT_PROFILE_SAMPLE_RATE).
+profiler = RequestProfiler()
+profiler.init_app(app)
+
+# Encoder concurrency limits with bounded, per-user fair queues; searches are
+# admitted ahead of ingestion and overflow is answered with 503 + Retry-After.
+admission_control = admission.AdmissionController()
+
+# Other links are fetched and indexed in the background, embedding under an ingestion slot.
+web_ingestor = WebIngestor(text_handler, admission_control=admission_control)
+
+# Serialized /api/search responses, invalidated by every add/update/delete.
+search_cache = QueryResultCache("search")
+write_events.subscribe(search_cache.on_write)
+# Serialized /api/similar neighbour lists; the LRU keeps frequently viewed items.
+similar_cache = QueryResultCache(
+    "similar", max_bytes=int(float(os.getenv("ORBIT_SIMILAR_CACHE_MB", "16")) * 1024 * 1024))
+write_events.subscribe(similar_cache.on_write)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        metrics.REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    # Runs even when a view raises, so the in-flight gauge cannot leak.
+    if g.pop('request_started', None) is not None:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+
+def _json_response(payload):
+    with timed("json_serialize"):
+        return jsonify(payload)
+
+def _overloaded_response(e):
+    response = jsonify({'status': 'error', 'message': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+def _encode_image_file(path):
+    """
+    Read an image file and return it as a base64 data URI.
+
+    Args:
+        path (str): Path to the image on disk.
+
+    Returns:
+        str: Data URI, or None if the file does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with timed("media_read", model="image"):
+        with open(path, "rb") as f:
+            img_bytes = f.read()
+    # Determine the file extension for the MIME type.
+    ext = os.path.splitext(path)[1][1:]  # remove the leading dot
+    with timed("media_encode", model="image"):
+        base64_str = base64.b64encode(img_bytes).decode("utf-8")
+    return f"data:image/{ext};base64,{base64_str}"
+
+def _attach_image_data(image_results):
+    """
+    Add a 'data' field mirroring the nested 'uris' lists of an image result,
+    with each file read and converted to a base64 data URI.
+    """
+    if image_results and "uris" in image_results:
+        image_results["data"] = [[_encode_image_file(uri) for uri in uri_list]
+                                 for uri_list in image_results["uris"]]
+    return image_results
+
 def verify_google_token(token):
     try:
         response = requests.get(
@@ -47,7 +264,7 @@ def verify_google_token(token):
             return response.json()
         return None
     except Exception as e:
-        print(f"Token verification error: {e}")
+        logger.warning("Token verification error", extra={"error": str(e)})
         return None
 
 # ------------------------------------------------------------------------------
@@ -66,6 +283,18 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# ------------------------------------------------------------------------------
+# Admin-only endpoints are authorized with a shared token from the environment.
+# ------------------------------------------------------------------------------
+def require_admin(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        admin_token = os.getenv('ORBIT_ADMIN_TOKEN')
+        if not admin_token or request.headers.get('X-Orbit-Admin-Token') != admin_token:
+            return jsonify({'error': 'Admin token required'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 # ------------------------------------------------------------------------------
 # New Login endpoint:
 # This endpoint receives a POST with the Google token, validates it,
@@ -101,7 +330,7 @@ def login():
             }
         })
     except Exception as e:
-        print(f"Error logging in: {e}")
+        logger.error("Error logging in", extra={"error": str(e)})
         return jsonify({'error': str(e)}), 500
 
 # ------------------------------------------------------------------------------
@@ -110,6 +339,14 @@ def login():
 @app.route('/api/auth', methods=['GET'])
 @require_auth
 def auth():
+    if prewarm_on_auth:
+        # Load the user's vector indexes now so their first search is not a cold load.
+        user_id = str(request.user.id)
+        residency.prewarm([
+            text_handler._get_user_collection(user_id),
+            image_handler._get_user_collection(user_id),
+            audio_handler._get_user_collection(user_id),
+        ])
     return jsonify({
         'status': 'authenticated',
         'user': {
@@ -125,63 +362,80 @@ def auth():
 @require_auth
 def save_content():
     try:
-        data = request.get_json()
-        print(f"DATAET TPYE: {data}")
+        with timed("decode", model="request"):
+            data = request.get_json()
         if not data:
             return jsonify({'error': 'No data provided'}), 400
 
         request_content = data.get('content')
         request_tags = data.get('tags')
 
+        # Each save holds a slot of its modality's encoder, behind any waiting searches.
         if request_content.get('type') == 'text':
-            text_handler.add_text(
-                user_id=request.user.id,  # Using authenticated user's ID from the session.
-                content=request_content.get('data'),
-                meta={
-                    'tags': request_tags,
-                    'email': request.user.email,
-                    'type': 'text'
-                }
-            )
-        elif request_content.get('type') == 'image':
-            image_handler.add_image(
-                user_id=request.user.id,
-                image_data=request_content.get('data'),
-                meta={
-                    'tags': request_tags,
-                    'email': request.user.email,
-                    'type': 'image'
-                }
-            )
-        elif request_content.get('type') == 'audio':
-            audio_handler.add_audio(
-                user_id=request.user.id,
-                audio_path=request_content.get('path'),
-                metadata={
-                    'tags': request_tags,
-                    'email': request.user.email,
-                    'type': 'audio'
-                }
-            )
-        elif request_content.get('type') == 'link':
-            link_url = request_content.get('data')
-            # Check if the link is a YouTube URL.
-            if "youtube.com" in link_url or "youtu.be" in link_url:
-                try:
-                    video_title = get_youtube_title(link_url)
-                except Exception as e:
-                    print(f"Error extracting YouTube title: {e}")
-                    video_title = link_url  # Fallback to the URL if title extraction fails.
+            with admission_control.slot('text', admission.INGEST, request.user.id):
                 text_handler.add_text(
+                    user_id=request.user.id,  # Using authenticated user's ID from the session.
+                    content=request_content.get('data'),
+                    meta={
+                        'tags': request_tags,
+                        'email': request.user.email,
+                        'type': 'text'
+                    }
+                )
+        elif request_content.get('type') == 'image':
+            with admission_control.slot('image', admission.INGEST, request.user.id):
+                image_handler.add_image(
                     user_id=request.user.id,
-                    content=video_title,
+                    image_data=request_content.get('data'),
                     meta={
                         'tags': request_tags,
                         'email': request.user.email,
-                        'type': 'youtube_video',
-                        'youtube_url': link_url
+                        'type': 'image'
                     }
                 )
+        elif request_content.get('type') == 'audio':
+            with admission_control.slot('audio', admission.INGEST, request.user.id):
+                audio_handler.add_audio(
+                    user_id=request.user.id,
+                    audio_path=request_content.get('path'),
+                    metadata={
+                        'tags': request_tags,
+                        'email': request.user.email,
+                        'type': 'audio'
+                    }
+                )
+        elif request_content.get('type') == 'link':
+            link_url = request_content.get('data')
+            # Check if the link is a YouTube URL.
+            if is_youtube_url(link_url):
+                # Known videos are saved with their metadata; new ones are indexed
+                # with the URL now and upgraded in place once the fetch finishes.
+                cached = link_enricher.lookup(link_url)
+                meta = {
+                    'tags': request_tags,
+                    'email': request.user.email,
+                    'type': 'youtube_video',
+                    'youtube_url': link_url,
+                    'enrichment': 'pending'
+                }
+                if cached:
+                    meta.update(item_metadata(cached))
+                with admission_control.slot('text', admission.INGEST, request.user.id):
+                    item_id = text_handler.add_text(
+                        user_id=request.user.id,
+                        content=cached['title'] if cached else link_url,
+                        meta=meta
+                    )
+                if item_id and not cached:
+                    link_enricher.enrich(request.user.id, item_id, link_url)
+            elif link_url and link_url.startswith(('http://', 'https://')):
+                # Other pages are fetched, chunked and indexed in the background.
+                web_ingestor.submit(request.user.id, link_url, meta={
+                    'tags': request_tags,
+                    'email': request.user.email
+                })
+            else:
+                return jsonify({'error': 'Unsupported link'}), 400
         else:
             return jsonify({'error': 'Unsupported content type'}), 400
 
@@ -190,8 +444,10 @@ def save_content():
             'message': 'Content saved successfully'
         })
 
+    except admission.Overloaded as e:
+        return _overloaded_response(e)
     except Exception as e:
-        print(f"Error saving content: {e}")
+        logger.error("Error saving content", extra={"error": str(e)})
         return jsonify({
             'status': 'error',
             'message': str(e)
@@ -201,82 +457,450 @@ def save_content():
 # Search Content Endpoint: now requires a logged-in user.
 # ------------------------------------------------------------------------------
 
+def _item_filters(args=None):
+    """
+    Read the 'since', 'until' and 'item_types' query parameters.
+
+    Times may be epoch seconds, ISO 8601 or relative ("24h", "7d"); relative
+    values are rounded down to the minute so cached results can be reused.
+
+    Args:
+        args (Mapping, optional): Query parameters; defaults to the current Flask request's.
+
+    Raises:
+        ValueError: If a time value cannot be parsed.
+    """
+    args = request.args if args is None else args
+    since = item_fields.parse_time(args.get('since'), granularity=60)
+    until = item_fields.parse_time(args.get('until'))
+    item_types = sorted({item_fields.normalize_type('', t) for t in args.get('item_types', '').split(',')
+                         if t.strip()})
+    return {
+        'since': since,
+        'until': until,
+        'item_types': item_types,
+    }
+
+def _search_params(args, user_id):
+    """
+    Parse the /api/search query parameters.
+
+    Shared by the Flask view and the ASGI front end (see asgi.py).
+
+    Args:
+        args (Mapping): Query parameters.
+        user_id (str): The searching user.
+
+    Returns:
+        dict: 'query', 'types', 'n_results', 'where' and the result 'cache_key'.
+
+    Raises:
+        ValueError: If the query is missing or a filter cannot be parsed.
+    """
+    query = args.get('query')
+    if not query:
+        raise ValueError('No query provided')
+
+    # Determine which content types to search (default: all)
+    types_param = args.get('types')
+    if types_param:
+        types = [t.strip().lower() for t in types_param.split(',')]
+    else:
+        types = ['text', 'image', 'audio']
+
+    try:
+        n_results = min(max(int(args.get('n_results', '5')), 1), 100)
+    except ValueError:
+        n_results = 5
+
+    # Tag, time-range and item-type filters are pushed down into the
+    # collection query as a where clause.
+    filters = _item_filters(args)
+    tags = sorted(parse_tags(args.get('tags', '')))
+    where = item_fields.build_where(tags, **filters)
+    types = item_fields.kinds_for_types(types, filters['item_types'])
+
+    # Identical searches are served from the cache until the user writes
+    # to one of the searched modalities.
+    cache_key = (str(user_id), normalize_query(query), tuple(sorted(set(types))), n_results,
+                 tuple(tags), filters['since'], filters['until'], tuple(filters['item_types']))
+    return {'query': query, 'types': types, 'n_results': n_results, 'where': where, 'cache_key': cache_key}
+
+def _admitted_search(kind, user_id, query, n_results, where, attach_media=True):
+    """_search_kind() holding a search slot of the modality's encoder; raises admission.Overloaded."""
+    with admission_control.slot(kind, admission.SEARCH, user_id):
+        return _search_kind(kind, user_id, query, n_results, where, attach_media)
+
+def _search_kind(kind, user_id, query, n_results, where, attach_media=True):
+    """Run one modality's search; image results get their files attached as data URIs unless attach_media is off."""
+    if kind == 'text':
+        return text_handler.search_texts(user_id=user_id, query=query, n_results=n_results, where=where)
+    if kind == 'image':
+        results = image_handler.search_images(user_id=user_id, query=query, n_results=n_results, where=where)
+        return _attach_image_data(results) if attach_media else results
+    return audio_handler.retrieve_audio(user_id=user_id, query=query, n_results=n_results, where=where)
+
+def _search_failed(result):
+    """
+    Whether a _search_kind() result stands for a failed search.
+
+    The text and image handlers log the error and return an empty list or dict;
+    a successful search always returns Chroma's query dict, even with no matches.
+    """
+    return not (isinstance(result, dict) and 'ids' in result)
+
 @app.route('/api/search', methods=['GET'])
 @require_auth
 def search_content():
     try:
-        query = request.args.get('query')
-        if not query:
-            return jsonify({'error': 'No query provided'}), 400
-
-        # Determine which content types to search (default: all)
-        types_param = request.args.get('types')
-        if types_param:
-            types = [t.strip().lower() for t in types_param.split(',')]
-        else:
-            types = ['text', 'image', 'audio']
+        try:
+            params = _search_params(request.args, request.user.id)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        suggest_index.record_query(request.user.id, params['query'])
 
-        results = {}
+        if streaming.wants_stream(request.args, request.headers.get('Accept')):
+            # NDJSON, one line per result as each modality's search returns (not cached).
+            user_id = request.user.id
+            return Response(streaming.search_stream(
+                [kind for kind in ('text', 'image', 'audio') if kind in params['types']],
+                lambda kind: _admitted_search(kind, user_id, params['query'], params['n_results'], params['where'],
+                                              attach_media=False),
+                on_error=lambda kind, e: logger.error("Error searching content", extra={"kind": kind, "error": str(e)}),
+            ), mimetype=streaming.NDJSON_MIMETYPE)
 
-        # Search text items if requested
-        if 'text' in types:
-            text_results = text_handler.search_texts(
-                user_id=request.user.id,
-                query=query
-            )
-            results['text'] = text_results
+        cached = search_cache.get(params['cache_key'], request.user.id)
+        if cached is not None:
+            return Response(cached, mimetype='application/json')
+        versions = search_cache.versions(request.user.id, params['types'])
 
-        # Search image items if requested
-        if 'image' in types:
-            image_results = image_handler.search_images(
-                user_id=request.user.id,
-                query=query
-            )
-            # Process the image search results:
-            # The returned 'uris' field is a list of lists; for each URI, read the file
-            # and convert its contents into a base64-encoded data URI.
-            if image_results and "uris" in image_results:
-                data_result = []  # this will mirror the structure of image_results["uris"]
-                for uri_list in image_results["uris"]:
-                    base64_images = []
-                    for uri in uri_list:
-                        if uri and os.path.exists(uri):
-                            with open(uri, "rb") as f:
-                                img_bytes = f.read()
-                            # Determine the file extension for the MIME type.
-                            ext = os.path.splitext(uri)[1][1:]  # remove the leading dot
-                            base64_str = base64.b64encode(img_bytes).decode("utf-8")
-                            base64_image = f"data:image/{ext};base64,{base64_str}"
-                            base64_images.append(base64_image)
-                        else:
-                            base64_images.append(None)
-                    data_result.append(base64_images)
-                # Add the base64-encoded image data to the result under a new key.
-                image_results["data"] = data_result
-
-            results['image'] = image_results
-
-        # Search audio items if requested
-        if 'audio' in types:
-            # Assuming your AudioHandler implements a similar method.
-            audio_results = audio_handler.retrieve_audio(
-                user_id=request.user.id,
-                query=query
-            )
-            results['audio'] = audio_results
+        results = {}
+        for kind in ('text', 'image', 'audio'):
+            if kind in params['types']:
+                results[kind] = _admitted_search(kind, request.user.id, params['query'], params['n_results'],
+                                                 params['where'])
 
-        print(f"Searching for: {query}")
-        print(f"Types: {types}")
-        print(results)
-        return jsonify({"results": results})
+        logger.debug("Search completed", extra={"types": params['types'], "query_length": len(params['query'])})
+        response = _json_response({"results": results})
+        if not any(_search_failed(result) for result in results.values()):
+            # A failed modality comes back empty; caching it would serve the gap until the next write.
+            body = response.get_data()
+            search_cache.put(params['cache_key'], versions, body, len(body))
+        return response
 
+    except admission.Overloaded as e:
+        return _overloaded_response(e)
     except Exception as e:
-        print(f"Error searching content: {e}")
+        logger.error("Error searching content", extra={"error": str(e)})
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 500
 
+@app.route('/api/suggest', methods=['GET'])
+@require_auth
+def suggest():
+    """
+    Completions for a partly typed query ('prefix'), from the user's titles,
+    tags, YouTube channels and past searches; 'limit' caps them (default 8).
+    No model runs, so this is cheap enough to call on every keystroke.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', '8')), 1), 16)
+    except ValueError:
+        limit = 8
+    return jsonify({'suggestions': suggest_index.suggest(request.user.id, request.args.get('prefix', ''), limit)})
+
+@app.route('/api/similar/<kind>/<item_id>', methods=['GET'])
+@require_auth
+def similar_items(kind, item_id):
+    """
+    Items nearest to an existing one, found with its stored embedding.
+
+    'kinds' lists the modalities to search (default: the item's own); only
+    modalities whose encoder shares the item's embedding space are allowed.
+    'n_results' and the tag, time and type filters behave as in /api/search.
+    """
+    if kind not in HANDLERS:
+        return jsonify({'error': f'Unknown kind: {kind}'}), 404
+    kinds = sorted({k.strip().lower() for k in request.args.get('kinds', kind).split(',') if k.strip()})
+    incompatible = [k for k in kinds if EMBEDDING_SPACES.get(k) != EMBEDDING_SPACES[kind]]
+    if incompatible:
+        return jsonify({'error': f'{", ".join(incompatible)} items are not in the same embedding space as {kind}'}), 400
+    try:
+        n_results = min(max(int(request.args.get('n_results', '10')), 1), 100)
+    except ValueError:
+        n_results = 10
+    try:
+        filters = _item_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    tags = sorted(parse_tags(request.args.get('tags', '')))
+    where = item_fields.build_where(tags, **filters)
+    kinds = item_fields.kinds_for_types(kinds, filters['item_types'])
+
+    user_id = str(request.user.id)
+    cache_key = (user_id, 'similar', kind, item_id, tuple(kinds), n_results, tuple(tags),
+                 filters['since'], filters['until'], tuple(filters['item_types']))
+    cached = similar_cache.get(cache_key, user_id)
+    if cached is not None:
+        return Response(cached, mimetype='application/json')
+    versions = similar_cache.versions(user_id, set(kinds) | {kind})
+
+    try:
+        vector = similar.stored_embedding(HANDLERS[kind]._get_user_collection(user_id), item_id)
+        if vector is None:
+            return jsonify({'error': 'Item not found'}), 404
+        results = {}
+        for target in kinds:
+            results[target] = similar.neighbours(HANDLERS[target], target, user_id, vector, n_results,
+                                                 where=where, exclude=[item_id] if target == kind else [])
+        if 'image' in results:
+            _attach_image_data(results['image'])
+    except Exception as e:
+        logger.error("Error finding similar items", extra={"kind": kind, "item_id": item_id, "error": str(e)})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    response = _json_response({"item": {"kind": kind, "id": item_id}, "results": results})
+    body = response.get_data()
+    similar_cache.put(cache_key, versions, body, len(body))
+    return response
+
+@app.route('/api/duplicates', methods=['GET'])
+@require_auth
+def duplicate_images():
+    """
+    Near-duplicate groups among the current user's images, largest first.
+    'unhashed' counts images saved before hashes were stored; see
+    `python -m helpers.perceptual_hash report --backfill`.
+    """
+    if near_duplicates is None:
+        return jsonify({'error': 'Near-duplicate detection is disabled'}), 404
+    user_id = str(request.user.id)
+    return jsonify(near_duplicates.groups(user_id, _collection_for('image', user_id)))
+
+@app.route('/api/admin/admission', methods=['GET'])
+@require_admin
+def admission_status():
+    return jsonify(admission_control.stats())
+
+@app.route('/api/admin/shards', methods=['GET'])
+@require_admin
+def shard_status():
+    return jsonify({'shards': shard_router.health(), 'rebalance': shard_router.move_status})
+
+@app.route('/api/admin/shards/move', methods=['POST'])
+@require_admin
+def move_user_shard():
+    data = request.get_json(silent=True) or {}
+    user_id, target = data.get('user_id'), data.get('shard')
+    if not user_id or target not in shard_router.shards:
+        return jsonify({'error': f"user_id and shard (one of {', '.join(shard_router.shards)}) are required"}), 400
+    try:
+        return jsonify(shard_router.move_user(user_id, target))
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+
+@app.route('/api/admin/shards/rebalance', methods=['POST'])
+@require_admin
+def rebalance_shards():
+    data = request.get_json(silent=True) or {}
+    if data.get('dry_run'):
+        return jsonify(shard_router.rebalance(limit=data.get('limit'), dry_run=True))
+    if not shard_router.start_rebalance(limit=data.get('limit')):
+        return jsonify({'error': 'A rebalance is already running', 'rebalance': shard_router.move_status}), 409
+    return jsonify(shard_router.move_status), 202
+
+@app.route('/api/admin/residency', methods=['GET'])
+@require_admin
+def index_residency():
+    residency.evict_idle()
+    return jsonify(residency.stats())
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@require_admin
+def list_profiles():
+    return jsonify({'profiles': profiler.list_profiles()})
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@require_admin
+def download_profile(profile_id):
+    if request.args.get('format') == 'text':
+        try:
+            report = profiler.render_text(
+                profile_id,
+                sort=request.args.get('sort', 'cumulative'),
+                limit=int(request.args.get('limit', '50'))
+            )
+        except (KeyError, ValueError):
+            return jsonify({'error': 'Invalid sort or limit'}), 400
+        if report is None:
+            return jsonify({'error': 'Profile not found'}), 404
+        return Response(report, mimetype='text/plain')
+
+    path = profiler.profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=f'{profile_id}.prof')
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+# ------------------------------------------------------------------------------
+# Library export/import: Parquet or Arrow IPC streams of all three collections,
+# including stored embeddings so an import never re-embeds.
+# ------------------------------------------------------------------------------
+def _mirror_compressed(kind, ids, embeddings):
+    handler = HANDLERS[kind]
+    if handler.compressed_index is not None and len(ids):
+        handler.compressed_index.for_user(request.user.id).add(ids, embeddings)
+
+@app.route('/api/export', methods=['GET'])
+@require_auth
+def export_library():
+    file_format = request.args.get('format', 'parquet')
+    if file_format not in ('parquet', 'arrow'):
+        return jsonify({'error': 'Unsupported format'}), 400
+    include_media = request.args.get('media', 'false').lower() in ('1', 'true', 'yes')
+    batches = library_io.export_record_batches(
+        _collection_for, str(request.user.id), include_media=include_media
+    )
+    extension = 'parquet' if file_format == 'parquet' else 'arrows'
+    return Response(
+        library_io.stream_export(batches, file_format),
+        mimetype='application/vnd.apache.parquet' if file_format == 'parquet'
+        else 'application/vnd.apache.arrow.stream',
+        headers={'Content-Disposition': f'attachment; filename=orbit-library.{extension}'}
+    )
+
+@app.route('/api/import', methods=['POST'])
+@require_auth
+def import_library():
+    try:
+        upload = request.files.get('file')
+        # Parquet needs a seekable source; uploaded files are spooled by Werkzeug.
+        source = upload.stream if upload else io.BytesIO(request.get_data())
+        counts = library_io.import_record_batches(
+            library_io.read_batches(source),
+            _collection_for,
+            _folder_for,
+            str(request.user.id),
+            on_vectors=_mirror_compressed,
+            blob_store=blob_store
+        )
+        return jsonify({'status': 'success', 'imported': counts})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logger.error("Error importing library", extra={"error": str(e)})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# ------------------------------------------------------------------------------
+# Re-embedding after an encoder upgrade. One job runs at a time; an interrupted
+# job resumes from its checkpoint when the server starts.
+# ------------------------------------------------------------------------------
+def _on_reindex_swap(kind, mapping):
+    search_cache.clear()
+    similar_cache.clear()
+    space = similar.embedding_space(kind, reindex.load_encoder_specs().get(kind))
+    if space != EMBEDDING_SPACES[kind]:
+        # Centroids from the old encoder mean nothing in the new space; the next sweep refits.
+        library_clusters.invalidate(kind)
+    EMBEDDING_SPACES[kind] = space
+    logger.info("Re-indexed collections swapped in", extra={"kind": kind, "collections": len(mapping)})
+
+reindex_job = reindex.ReindexJob.resume(client, HANDLERS, on_swap=_on_reindex_swap)
+if reindex_job is not None:
+    logger.info("Resuming re-index job", extra={"kind": reindex_job.kind})
+    reindex_job.start()
+
+@app.route('/api/admin/reindex', methods=['GET'])
+@require_admin
+def reindex_status():
+    if reindex_job is None:
+        return jsonify({'status': 'idle'})
+    return jsonify(reindex_job.status())
+
+@app.route('/api/admin/reindex', methods=['POST'])
+@require_admin
+def start_reindex():
+    global reindex_job
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    # A rebuild keeps the encoder and stored embeddings, re-creating the collections with the current HNSW settings.
+    spec = None if data.get('rebuild') else data.get('spec')
+    if kind not in HANDLERS or not (isinstance(spec, dict) or data.get('rebuild')):
+        return jsonify({'error': 'kind (text, image or audio) and spec (or rebuild) are required'}), 400
+    if reindex_job is not None and reindex_job.is_running():
+        return jsonify({'error': 'A re-index job is already running', 'job': reindex_job.status()}), 409
+    reindex_job = reindex.ReindexJob(client, kind, HANDLERS[kind], spec, on_swap=_on_reindex_swap).start()
+    return jsonify(reindex_job.status()), 202
+
+# ------------------------------------------------------------------------------
+# Storage garbage collection. A pass reports (and with repair, fixes) files and
+# records that have drifted apart. ORBIT_GC_INTERVAL_S > 0 schedules passes,
+# repairing when ORBIT_GC_REPAIR is set; an interrupted pass resumes on start.
+# ------------------------------------------------------------------------------
+def _delete_item(kind, user_id, item_id):
+    deletes = {'text': text_handler.delete_text, 'image': image_handler.delete_image,
+               'audio': audio_handler.delete_audio}
+    deletes[kind](user_id, item_id)
+
+gc_options = {
+    'blob_store': blob_store,
+    'folders': {kind: str(handler.base_folder) for kind, handler in HANDLERS.items()},
+    'delete_item': _delete_item,
+}
+storage_gc = StorageGC.resume(client, **gc_options)
+if storage_gc is not None:
+    logger.info("Resuming storage GC pass", extra={"repair": storage_gc.repair})
+    storage_gc.start()
+
+gc_interval = float(os.getenv("ORBIT_GC_INTERVAL_S", "0"))
+gc_repair = os.getenv("ORBIT_GC_REPAIR", "false").lower() in ("1", "true", "yes")
+def _schedule_gc():
+    global storage_gc
+    while True:
+        time.sleep(gc_interval)
+        if storage_gc is None or not storage_gc.is_running():
+            storage_gc = StorageGC(client, repair=gc_repair, **gc_options).start()
+
+if gc_interval > 0:
+    threading.Thread(target=_schedule_gc, name="storage-gc-scheduler", daemon=True).start()
+
+@app.route('/api/admin/gc', methods=['GET'])
+@require_admin
+def gc_status():
+    if storage_gc is None:
+        return jsonify(StorageGC.last_report() or {'status': 'idle'})
+    return jsonify(storage_gc.status())
+
+@app.route('/api/admin/gc', methods=['POST'])
+@require_admin
+def start_gc():
+    global storage_gc
+    data = request.get_json(silent=True) or {}
+    if storage_gc is not None and storage_gc.is_running():
+        return jsonify({'error': 'A storage GC pass is already running', 'gc': storage_gc.status()}), 409
+    storage_gc = StorageGC(client, repair=bool(data.get('repair')), **gc_options).start()
+    return jsonify(storage_gc.status()), 202
+
+@app.route('/api/tags', methods=['GET'])
+@require_auth
+def list_tags():
+    """
+    Tag facet counts for the current user, most used first. 'prefix' narrows
+    the list for autocomplete; 'limit' caps it (default 20, max 200).
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', '20')), 1), 200)
+    except ValueError:
+        limit = 20
+    tags = tag_index.counts(str(request.user.id), prefix=request.args.get('prefix', ''), limit=limit)
+    return jsonify({'tags': tags})
+
 @app.route('/')
 def home():
     return jsonify({'status': 'Server is running'})
@@ -300,7 +924,11 @@ def random_items():
     Return a paginated JSON response with all the user's stored items
     (text, image, and audio) in a stable random order. Use 'page' and 
     'page_size' query parameters for pagination. If the requested page is 
-    beyond the total number of pages, return the last page.
+    beyond the total number of pages, return the last page. A comma-separated
+    'tags' parameter restricts the listing to items carrying all those tags;
+    'since', 'until' and 'item_types' filter by creation time and item type.
+    With 'stream=1' (or Accept: application/x-ndjson) the page is streamed as
+    NDJSON, see helpers/streaming.py.
     """
     try:
         # Get pagination parameters; default to page=1, page_size=5.
@@ -313,10 +941,33 @@ def random_items():
 
         user_id = str(request.user.id)
         all_items = []
+        # Read before the collections, so changes made while the page is built are replayed, not lost.
+        cursor = change_feed.head(user_id)
+
+        # With a tag filter only the posted items are fetched, instead of
+        # reading whole collections; time and type filters become a where clause.
+        tags = parse_tags(request.args.get('tags', ''))
+        tagged = tag_index.postings(user_id, tags) if tags else None
+        try:
+            filters = _item_filters()
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        where = item_fields.build_where(**filters)
+        kinds = item_fields.kinds_for_types(['text', 'image', 'audio'], filters['item_types'])
+
+        def _get_items(collection, kind):
+            if kind not in kinds or (tagged is not None and not tagged[kind]):
+                return {"ids": []}
+            kwargs = {"include": ["metadatas", "documents", "uris"]}
+            if where:
+                kwargs["where"] = where
+            if tagged is not None:
+                kwargs["ids"] = sorted(tagged[kind])
+            return collection.get(**kwargs)
 
         # --- TEXT ITEMS ---
         text_collection = text_handler._get_user_collection(user_id)
-        text_data = text_collection.get(include=["metadatas", "documents", "uris"])
+        text_data = _get_items(text_collection, "text")
         text_ids = text_data.get("ids", [])
         if text_ids:
             for idx, item_id in enumerate(text_ids):
@@ -330,33 +981,25 @@ def random_items():
 
         # --- IMAGE ITEMS ---
         image_collection = image_handler._get_user_collection(user_id)
-        image_data = image_collection.get(include=["metadatas", "documents", "uris"])
+        image_data = _get_items(image_collection, "image")
         image_ids = image_data.get("ids", [])
         if image_ids:
             for idx, item_id in enumerate(image_ids):
                 metadata = image_data.get("metadatas", [])[idx]
-                file_path = metadata.get("file_path")
-                base64_image = None
-                if file_path and os.path.exists(file_path):
-                    with open(file_path, "rb") as f:
-                        img_bytes = f.read()
-                    ext = os.path.splitext(file_path)[1][1:]  # remove the dot
-                    base64_str = base64.b64encode(img_bytes).decode("utf-8")
-                    base64_image = f"data:image/{ext};base64,{base64_str}"
+                # The image data is only read for items on the requested page.
                 item = {
                     "id": item_id,
                     "document": None,
                     "metadata": metadata,
                     "type": "image",
-                    "data": base64_image,  # Include the base64-encoded image data.
-                    "uri": file_path
+                    "uri": metadata.get("file_path")
                 }
                 all_items.append(item)
 
         # --- AUDIO ITEMS ---
         try:
             audio_collection = audio_handler._get_user_collection(user_id)
-            audio_data = audio_collection.get(include=["metadatas", "documents", "uris"])
+            audio_data = _get_items(audio_collection, "audio")
             audio_ids = audio_data.get("ids", [])
             if audio_ids:
                 for idx, item_id in enumerate(audio_ids):
@@ -370,7 +1013,7 @@ def random_items():
                     }
                     all_items.append(item)
         except Exception as e:
-            print(f"Audio retrieval error: {e}")
+            logger.warning("Audio retrieval error", extra={"error": str(e)})
 
         # --- Create a stable random ordering ---
         # Use a seed based on the user_id so that the order is the same across subsequent calls.
@@ -389,23 +1032,264 @@ def random_items():
         start = (page - 1) * page_size
         end = start + page_size
         page_items = all_items[start:end]
-
-        return jsonify({
+        page_fields = {
             "status": "success",
             "total_count": total_count,
             "page": page,
             "page_size": page_size,
             "is_last_page": (page == last_page),
-            "items": page_items
-        })
+            "cursor": cursor,
+        }
+
+        if streaming.wants_stream(request.args, request.headers.get('Accept')):
+            return Response(streaming.page_stream(page_fields, page_items), mimetype=streaming.NDJSON_MIMETYPE)
+
+        for item in page_items:
+            if item["type"] == "image":
+                # Include the base64-encoded image data.
+                item["data"] = _encode_image_file(item["uri"])
+        return _json_response({**page_fields, "items": page_items})
 
     except Exception as e:
-        print(f"Error retrieving random items: {e}")
+        logger.error("Error retrieving random items", extra={"error": str(e)})
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
+# ------------------------------------------------------------------------------
+# Change feed: what changed in the user's library after a cursor, see
+# helpers/change_feed.py.
+# ------------------------------------------------------------------------------
+CHANGES_MAX_WAIT_S = float(os.getenv("ORBIT_CHANGES_MAX_WAIT_S", "30"))
+CHANGES_KEEPALIVE_S = float(os.getenv("ORBIT_CHANGES_KEEPALIVE_S", "15"))
+
+def _change_params(args, last_event_id=None):
+    """
+    Parse the /api/changes query parameters.
+
+    Shared by the Flask view and the ASGI front end (see asgi.py).
+
+    Args:
+        args (Mapping): Query parameters.
+        last_event_id (str, optional): Last-Event-ID header of a reconnecting event stream;
+            it takes precedence over 'since'.
+
+    Returns:
+        dict: 'since' (None without a cursor), 'limit', 'wait' seconds and 'media'.
+
+    Raises:
+        ValueError: If a parameter is not a number.
+    """
+    since = last_event_id or args.get('since')
+    try:
+        return {
+            'since': int(since) if since not in (None, '') else None,
+            'limit': max(1, min(int(args.get('limit', '500')), 5000)),
+            'wait': max(0.0, min(float(args.get('wait', '0')), CHANGES_MAX_WAIT_S)),
+            'media': args.get('media', '1').lower() not in ('0', 'false', 'no'),
+        }
+    except ValueError:
+        raise ValueError("'since' and 'limit' must be integers and 'wait' a number of seconds") from None
+
+def _stored_items(user_id, kind, ids, media=True):
+    """Read items by id, shaped as /api/populate lists them; returns ``{id: item}`` for those that exist."""
+    if not ids:
+        return {}
+    found = _collection_for(kind, user_id).get(ids=list(ids), include=["metadatas", "documents"])
+    items = {}
+    for item_id, document, metadata in zip(found['ids'], found['documents'], found['metadatas']):
+        item = {"id": item_id, "document": None if kind == "image" else document, "metadata": metadata,
+                "type": kind}
+        if kind != "text":
+            item["uri"] = metadata.get("file_path")
+        if kind == "image" and media:
+            item["data"] = _encode_image_file(item["uri"])
+        items[item_id] = item
+    return items
+
+def _changes_page(user_id, since, limit=500, media=True):
+    """
+    The user's changes after ``since``, each add or update carrying the item as /api/populate lists it.
+
+    The item is read from its collection, so it reflects the latest state; ``item`` is None
+    if it has been deleted since (its delete follows later in the feed).
+    """
+    page = change_feed.changes(user_id, since, limit)
+    wanted = {}
+    for change in page['changes']:
+        if change['action'] != 'delete':
+            wanted.setdefault(change['kind'], []).append(change['id'])
+    current = {kind: _stored_items(user_id, kind, ids, media) for kind, ids in wanted.items()}
+    for change in page['changes']:
+        if change['action'] != 'delete':
+            change['item'] = current[change['kind']].get(change['id'])
+    return page
+
+def _change_stream(user_id, since, limit, media):
+    """Server-Sent Events: catch up from ``since``, then one event per change until the client leaves."""
+    cursor = since
+    while True:
+        page = _changes_page(user_id, cursor, limit, media)
+        yield from sse_page(page)
+        if page['reset']:
+            return  # the client reloads the library and reconnects with the new cursor
+        cursor = page['cursor']
+        if not page['more'] and not change_feed.wait(user_id, cursor, CHANGES_KEEPALIVE_S):
+            yield SSE_KEEPALIVE
+
+@app.route('/api/changes', methods=['GET'])
+@require_auth
+def list_changes():
+    """
+    Return the changes to the user's library after the 'since' cursor, oldest
+    first, with the cursor to pass next time. 'wait' (seconds, up to
+    ORBIT_CHANGES_MAX_WAIT_S) holds the request until there is a change;
+    'limit' caps the entries per response ('more' says whether to ask again);
+    'media=0' leaves image data out. With Accept: text/event-stream (or
+    'stream=sse') the changes are streamed as Server-Sent Events instead.
+    """
+    user_id = str(request.user.id)
+    try:
+        params = _change_params(request.args, request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    try:
+        if wants_sse(request.args, request.headers.get('Accept')):
+            response = Response(_change_stream(user_id, params['since'], params['limit'], params['media']),
+                                mimetype=SSE_MIMETYPE)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        page = _changes_page(user_id, params['since'], params['limit'], params['media'])
+        if params['wait'] and not page['reset'] and not page['changes'] \
+                and change_feed.wait(user_id, params['since'], params['wait']):
+            page = _changes_page(user_id, params['since'], params['limit'], params['media'])
+        return _json_response({'status': 'success', **page})
+    except Exception as e:
+        logger.error("Error listing changes", extra={"error": str(e)})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+# ------------------------------------------------------------------------------
+# Browsing by cluster. The groups are precomputed in the background (see
+# helpers/clusters.py); their items are listed as /api/populate lists them.
+# ------------------------------------------------------------------------------
+def _cluster_kinds(args):
+    types = args.get('type', '')
+    kinds = [t.strip().lower() for t in types.split(',') if t.strip()] or list(HANDLERS)
+    if any(kind not in HANDLERS for kind in kinds):
+        raise ValueError('type must be text, image or audio')
+    return kinds
+
+def _query_embedding(kind, user_id, query):
+    """Embed a text query into a modality's space, holding one of its encoder's search slots."""
+    with admission_control.slot(kind, admission.SEARCH, user_id):
+        if kind == 'text':
+            return text_handler.embedding_model([query])[0]
+        if kind == 'image':
+            return image_handler.embedding_function([query])[0]
+        return audio_handler.embedder._encode_text(query)
+
+@app.route('/api/clusters', methods=['GET'])
+@require_auth
+def list_clusters():
+    """
+    Return the user's library grouped by similarity: a page of clusters,
+    largest first, each with its label, size and the 'per_cluster' items
+    nearest its centroid. 'type' (comma-separated) limits the modalities. With
+    'query' the clusters of each modality are ranked by how close their
+    centroids are to it, so a search can start from the nearest groups.
+    """
+    user_id = str(request.user.id)
+    try:
+        kinds = _cluster_kinds(request.args)
+        page = max(int(request.args.get('page', '1')), 1)
+        page_size = min(max(int(request.args.get('page_size', '10')), 1), 50)
+        per_cluster = min(max(int(request.args.get('per_cluster', '4')), 0), 20)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    try:
+        clusters = library_clusters.clusters(user_id, kinds)
+        query = request.args.get('query', '').strip()
+        if query:
+            # Distances are only comparable within one encoder's space, so modalities are interleaved by rank.
+            rank = {}
+            for kind in sorted({cluster['kind'] for cluster in clusters}):
+                nearest = library_clusters.nearest_clusters(user_id, kind, _query_embedding(kind, user_id, query))
+                for position, (cluster, distance) in enumerate(nearest):
+                    rank[(kind, cluster)] = (position, distance)
+            for cluster in clusters:
+                cluster['distance'] = rank.get((cluster['kind'], cluster['cluster']), (None, None))[1]
+            clusters.sort(key=lambda cluster: (rank.get((cluster['kind'], cluster['cluster']), (len(rank),))[0],
+                                               kinds.index(cluster['kind'])))
+        total_count = len(clusters)
+        clusters = clusters[(page - 1) * page_size:page * page_size]
+        previews = library_clusters.previews(
+            user_id, [(cluster['kind'], cluster['cluster']) for cluster in clusters], per_cluster)
+        wanted = {}
+        for cluster in clusters:
+            wanted.setdefault(cluster['kind'], []).extend(previews.get((cluster['kind'], cluster['cluster']), []))
+        stored = {kind: _stored_items(user_id, kind, ids) for kind, ids in wanted.items()}
+        for cluster in clusters:
+            cluster['items'] = [stored[cluster['kind']][item_id]
+                                for item_id in previews.get((cluster['kind'], cluster['cluster']), [])
+                                if item_id in stored[cluster['kind']]]
+        return _json_response({'status': 'success', 'clusters': clusters, 'total_count': total_count,
+                               'page': page, 'page_size': page_size,
+                               'fitted_at': library_clusters.fitted_at(user_id)})
+    except admission.Overloaded as e:
+        return _overloaded_response(e)
+    except Exception as e:
+        logger.error("Error listing clusters", extra={"error": str(e)})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/clusters/<kind>/<int:cluster_id>', methods=['GET'])
+@require_auth
+def cluster_items(kind, cluster_id):
+    """
+    Return a page of one cluster's items, nearest its centroid first. Use
+    'page' and 'page_size' (default 20) for pagination.
+    """
+    user_id = str(request.user.id)
+    try:
+        page = max(int(request.args.get('page', '1')), 1)
+        page_size = min(max(int(request.args.get('page_size', '20')), 1), 100)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'page and page_size must be integers'}), 400
+    if kind not in HANDLERS:
+        return jsonify({'status': 'error', 'message': 'Unknown cluster'}), 404
+    cluster = next((cluster for cluster in library_clusters.clusters(user_id, [kind])
+                    if cluster['cluster'] == cluster_id), None)
+    if cluster is None:
+        return jsonify({'status': 'error', 'message': 'Unknown cluster'}), 404
+    try:
+        ids = library_clusters.members(user_id, kind, cluster_id, (page - 1) * page_size, page_size)
+        stored = _stored_items(user_id, kind, ids)
+        return _json_response({'status': 'success', 'cluster': cluster,
+                               'items': [stored[item_id] for item_id in ids if item_id in stored],
+                               'total_count': cluster['size'], 'page': page, 'page_size': page_size})
+    except Exception as e:
+        logger.error("Error listing cluster items", extra={"error": str(e)})
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/admin/clusters', methods=['GET'])
+@require_admin
+def cluster_status():
+    return jsonify(library_clusters.run_status)
+
+@app.route('/api/admin/clusters', methods=['POST'])
+@require_admin
+def start_clustering():
+    """Refit clusters now, for one user and/or modality if 'user_id' / 'kind' are given."""
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    if kind is not None and kind not in HANDLERS:
+        return jsonify({'error': 'kind must be text, image or audio'}), 400
+    users = [str(data['user_id'])] if data.get('user_id') else None
+    if not library_clusters.start_sweep(users, [kind] if kind else list(HANDLERS)):
+        return jsonify({'error': 'A clustering sweep is already running', 'job': library_clusters.run_status}), 409
+    return jsonify(library_clusters.run_status), 202
+
 if __name__ == '__main__':
-    print("Server starting on http://localhost:3030")
+    logger.info("Server starting on http://localhost:3030")
     app.run(host='0.0.0.0', port=3030, debug=True)
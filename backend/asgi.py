@@ -0,0 +1,455 @@
+"""
+ASGI front end for Orbit.
+
+Serves the same /api/* contract as app.py from an event loop, so slow clients
+and slow upstreams no longer pin a server thread each:
+
+- /api/login, /api/auth, /api/search, /api/suggest and /api/changes are
+  async handlers. The Google token check uses a shared async HTTP client,
+  database lookups run on the default thread pool, and the per-modality encoder
+  passes of a search run concurrently on a bounded inference pool
+  (ORBIT_ASGI_INFERENCE_THREADS), after waiting for admission
+  (helpers/admission.py) on the event loop. Change-feed long-polls and event
+  streams wait on the event loop too, so idle clients hold no thread.
+- Every other route is served by the Flask app itself through a bridge that
+  reads the request body and writes the response on the event loop and only
+  borrows a thread (ORBIT_ASGI_THREADS) while the view runs, so uploads and
+  downloads from slow clients cost a coroutine, not a thread.
+
+Sessions are Flask's signed cookies, read and written with the Flask app's own
+serializer and cookie settings, so a client logged in through either server
+stays logged in on the other. Handlers, caches and metrics are the ones app.py
+creates. Run from the backend directory:
+
+    python -m asgi                      # uvicorn on :3030, uvloop when installed
+    uvicorn asgi:api --port 3030 --loop uvloop
+"""
+import argparse
+import asyncio
+import io
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+import app as orbit
+from helpers import admission, metrics, streaming
+from helpers.change_feed import SSE_KEEPALIVE, SSE_MIMETYPE, sse_page, wants_sse
+from helpers.logs import get_logger
+from users.user_management import User
+
+logger = get_logger("asgi")
+
+flask_app = orbit.app
+
+# Views bridged to Flask run here; inference for the async search endpoint has its own pool
+# so a burst of searches cannot starve the other routes (and vice versa).
+FLASK_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("ORBIT_ASGI_THREADS", "32")),
+                                    thread_name_prefix="asgi-flask")
+INFERENCE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("ORBIT_ASGI_INFERENCE_THREADS", "4")),
+                                        thread_name_prefix="asgi-inference")
+
+# Bridged responses with a Content-Length up to this size are collected in the view's
+# thread and sent in one piece; larger or unsized ones are streamed chunk by chunk.
+BUFFERED_RESPONSE_BYTES = 1024 * 1024
+
+# Mirrors the Flask-CORS configuration in app.py for the natively served routes;
+# bridged routes get their headers (and preflight answers) from Flask-CORS itself.
+CORS_ORIGINS = re.compile(r"chrome-extension://.*|http://localhost:5173")
+
+http_client = None
+
+
+@asynccontextmanager
+async def lifespan(_):
+    global http_client
+    http_client = httpx.AsyncClient(timeout=10.0)
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+api = FastAPI(title="Orbit", lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+
+# ------------------------------------------------------------------------------
+# Flask-compatible sessions.
+# ------------------------------------------------------------------------------
+def load_session(request):
+    """Decode the Flask session cookie of a request; an absent or invalid cookie is an empty session."""
+    cookie = request.cookies.get(flask_app.config["SESSION_COOKIE_NAME"])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if not cookie or serializer is None:
+        return {}
+    try:
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        return dict(serializer.loads(cookie, max_age=max_age))
+    except Exception:
+        return {}
+
+
+def save_session(response, data):
+    """Set a Flask session cookie holding ``data`` on a response, with the Flask app's cookie settings."""
+    config = flask_app.config
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    expires = None
+    if data.get("_permanent"):
+        expires = int(time.time() + flask_app.permanent_session_lifetime.total_seconds())
+    response.set_cookie(
+        config["SESSION_COOKIE_NAME"], serializer.dumps(data), expires=expires,
+        path=config["SESSION_COOKIE_PATH"] or config["APPLICATION_ROOT"] or "/",
+        domain=config["SESSION_COOKIE_DOMAIN"] or None, secure=config["SESSION_COOKIE_SECURE"],
+        httponly=config["SESSION_COOKIE_HTTPONLY"], samesite=config["SESSION_COOKIE_SAMESITE"],
+    )
+
+
+def _in_app_context(fn, *args):
+    with flask_app.app_context():
+        return fn(*args)
+
+
+def _lookup_user(user_id):
+    user = User.query.get(user_id)
+    return (str(user.id), user.email) if user else None
+
+
+def _login_user(email):
+    user, _ = User.get_or_create(email)
+    return str(user.id), user.email
+
+
+async def session_user(request):
+    """
+    Resolve the logged-in user of a request, like app.require_auth.
+
+    Returns:
+        tuple: ``((user_id, email), None)``, or ``(None, error_response)`` for a 401.
+    """
+    data = load_session(request)
+    if "user_id" not in data:
+        return None, JSONResponse({"error": "User not logged in"}, status_code=401)
+    user = await asyncio.to_thread(_in_app_context, _lookup_user, data["user_id"])
+    if user is None:
+        return None, JSONResponse({"error": "Invalid session or user not found"}, status_code=401)
+    return user, None
+
+
+# ------------------------------------------------------------------------------
+# Request metrics and CORS for the natively served routes.
+# ------------------------------------------------------------------------------
+def native(rule):
+    """Record request metrics under ``rule`` (as the Flask hooks do) and add CORS headers."""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request: Request):
+            started = time.perf_counter()
+            metrics.REQUESTS_IN_FLIGHT.inc()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                origin = request.headers.get("origin")
+                if origin and CORS_ORIGINS.fullmatch(origin):
+                    response.headers["Access-Control-Allow-Origin"] = origin
+                    response.headers["Access-Control-Allow-Credentials"] = "true"
+                    response.headers["Vary"] = "Origin"
+                return response
+            finally:
+                metrics.REQUESTS_IN_FLIGHT.dec()
+                metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=rule, method=request.method)
+                metrics.REQUESTS_TOTAL.inc(endpoint=rule, method=request.method, status=status)
+        return wrapper
+    return decorator
+
+
+# ------------------------------------------------------------------------------
+# Async endpoints.
+# ------------------------------------------------------------------------------
+async def verify_google_token(token):
+    """Async counterpart of app.verify_google_token."""
+    try:
+        response = await http_client.get("https://www.googleapis.com/oauth2/v3/tokeninfo",
+                                         params={"access_token": token})
+        if response.status_code == 200:
+            return response.json()
+        return None
+    except Exception as e:
+        logger.warning("Token verification error", extra={"error": str(e)})
+        return None
+
+
+@api.post("/api/login")
+@native("/api/login")
+async def login(request: Request):
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data or "token" not in data:
+            return JSONResponse({"error": "No token provided"}, status_code=400)
+
+        token_info = await verify_google_token(data["token"])
+        if not token_info:
+            return JSONResponse({"error": "Invalid token"}, status_code=401)
+
+        email = token_info.get("email")
+        if not email:
+            return JSONResponse({"error": "Email not found in token"}, status_code=401)
+
+        user_id, email = await asyncio.to_thread(_in_app_context, _login_user, email)
+        response = JSONResponse({"status": "success", "user": {"id": user_id, "email": email}})
+        save_session(response, {**load_session(request), "user_id": user_id, "email": email})
+        return response
+    except Exception as e:
+        logger.error("Error logging in", extra={"error": str(e)})
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@api.get("/api/auth")
+@native("/api/auth")
+async def auth(request: Request):
+    user, error = await session_user(request)
+    if error is not None:
+        return error
+    user_id, email = user
+    if orbit.prewarm_on_auth:
+        await asyncio.to_thread(orbit.residency.prewarm,
+                                [orbit.HANDLERS[kind]._get_user_collection(user_id) for kind in orbit.HANDLERS])
+    return JSONResponse({"status": "authenticated", "user": {"id": user_id, "email": email}})
+
+
+def _serialize(payload):
+    # Flask's JSON provider, so bodies are byte-identical to the Flask views' (and share the cache).
+    with flask_app.app_context():
+        return orbit._json_response(payload).get_data()
+
+
+@api.get("/api/search")
+@native("/api/search")
+async def search(request: Request):
+    user, error = await session_user(request)
+    if error is not None:
+        return error
+    user_id = user[0]
+    try:
+        try:
+            params = orbit._search_params(request.query_params, user_id)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        await asyncio.to_thread(orbit.suggest_index.record_query, user_id, params["query"])
+
+        kinds = [kind for kind in ("text", "image", "audio") if kind in params["types"]]
+        if streaming.wants_stream(request.query_params, request.headers.get("accept")):
+            # NDJSON lines are produced (searches run, image files read) on the inference pool.
+            lines = streaming.search_stream(
+                kinds,
+                lambda kind: orbit._admitted_search(kind, user_id, params["query"], params["n_results"],
+                                                    params["where"], attach_media=False),
+                on_error=lambda kind, e: logger.error("Error searching content", extra={"kind": kind, "error": str(e)}),
+            )
+            return StreamingResponse(_stream(lines, INFERENCE_EXECUTOR), media_type=streaming.NDJSON_MIMETYPE)
+
+        cached = orbit.search_cache.get(params["cache_key"], user_id)
+        if cached is not None:
+            return Response(cached, media_type="application/json")
+        versions = orbit.search_cache.versions(user_id, params["types"])
+
+        # The modalities use different encoders, so their searches run side by side, each
+        # waiting for its encoder's admission slot on the event loop rather than in a thread.
+        loop = asyncio.get_running_loop()
+
+        async def run(kind):
+            async with orbit.admission_control.slot_async(kind, admission.SEARCH, user_id):
+                return await loop.run_in_executor(INFERENCE_EXECUTOR, orbit._search_kind, kind, user_id,
+                                                  params["query"], params["n_results"], params["where"])
+
+        found = await asyncio.gather(*(run(kind) for kind in kinds))
+        body = await loop.run_in_executor(INFERENCE_EXECUTOR, _serialize, {"results": dict(zip(kinds, found))})
+        if not any(orbit._search_failed(result) for result in found):
+            orbit.search_cache.put(params["cache_key"], versions, body, len(body))
+        return Response(body, media_type="application/json")
+    except admission.Overloaded as e:
+        return JSONResponse({"status": "error", "message": str(e), "retry_after": e.retry_after}, status_code=503,
+                            headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        logger.error("Error searching content", extra={"error": str(e)})
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+@api.get("/api/suggest")
+@native("/api/suggest")
+async def suggest(request: Request):
+    user, error = await session_user(request)
+    if error is not None:
+        return error
+    try:
+        limit = min(max(int(request.query_params.get("limit", "8")), 1), 16)
+    except ValueError:
+        limit = 8
+    prefix = request.query_params.get("prefix", "")
+    if orbit.suggest_index.is_loaded(user[0]):
+        # An in-memory trie walk; cheaper than a hop to a thread.
+        suggestions = orbit.suggest_index.suggest(user[0], prefix, limit)
+    else:
+        suggestions = await asyncio.to_thread(orbit.suggest_index.suggest, user[0], prefix, limit)
+    return JSONResponse({"suggestions": suggestions})
+
+
+@api.get("/api/changes")
+@native("/api/changes")
+async def changes(request: Request):
+    # Long-polls and event streams wait on the event loop; only reading the feed borrows a thread.
+    user, error = await session_user(request)
+    if error is not None:
+        return error
+    user_id = user[0]
+    try:
+        params = orbit._change_params(request.query_params, request.headers.get("last-event-id"))
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    feed = orbit.change_feed
+
+    def read(since):
+        return orbit._changes_page(user_id, since, params["limit"], params["media"])
+
+    if wants_sse(request.query_params, request.headers.get("accept")):
+        async def events():
+            cursor = params["since"]
+            while True:
+                page = await asyncio.to_thread(read, cursor)
+                for event in sse_page(page):
+                    yield event
+                if page["reset"]:
+                    return
+                cursor = page["cursor"]
+                if not page["more"] and not await feed.wait_async(user_id, cursor, orbit.CHANGES_KEEPALIVE_S):
+                    yield SSE_KEEPALIVE
+
+        return StreamingResponse(events(), media_type=SSE_MIMETYPE,
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    try:
+        page = await asyncio.to_thread(read, params["since"])
+        if params["wait"] and not page["reset"] and not page["changes"] \
+                and await feed.wait_async(user_id, params["since"], params["wait"]):
+            page = await asyncio.to_thread(read, params["since"])
+        return Response(await asyncio.to_thread(_serialize, {"status": "success", **page}),
+                        media_type="application/json")
+    except Exception as e:
+        logger.error("Error listing changes", extra={"error": str(e)})
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+# ------------------------------------------------------------------------------
+# Bridge to the Flask app for every other route.
+# ------------------------------------------------------------------------------
+def _wsgi_environ(scope, body):
+    """Build a PEP 3333 environ for an ASGI HTTP scope whose body has already been read."""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_flask(environ):
+    """Run the Flask app on one request; returns status, headers and either the body or the open iterable."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = status, headers
+
+    iterable = flask_app(environ, start_response)
+    length = next((value for name, value in started["headers"] if name.lower() == "content-length"), None)
+    if length is not None and int(length) <= BUFFERED_RESPONSE_BYTES:
+        try:
+            return started["status"], started["headers"], b"".join(iterable), None
+        finally:
+            getattr(iterable, "close", lambda: None)()
+    return started["status"], started["headers"], None, iterable
+
+
+async def _stream(iterable, executor=FLASK_EXECUTOR):
+    """Iterate a blocking iterable of byte chunks on ``executor``, yielding them to the event loop."""
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                yield chunk
+    finally:
+        close = getattr(iterable, "close", None)
+        if close is not None:
+            await loop.run_in_executor(executor, close)
+
+
+@api.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"],
+               include_in_schema=False)
+async def flask_bridge(request: Request):
+    body = await request.body()
+    loop = asyncio.get_running_loop()
+    status, headers, content, iterable = await loop.run_in_executor(
+        FLASK_EXECUTOR, _run_flask, _wsgi_environ(request.scope, body))
+    status_code = int(status.split(" ", 1)[0])
+    if iterable is None:
+        response = Response(content, status_code=status_code)
+    else:
+        response = StreamingResponse(_stream(iterable), status_code=status_code)
+    # Response() adds its own content-length/type; Flask's headers replace them wholesale.
+    response.raw_headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=3030)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    logger.info("ASGI server starting", extra={"host": args.host, "port": args.port, "loop": loop})
+    uvicorn.run(api, host=args.host, port=args.port, loop=loop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Recall-vs-memory benchmark for the compressed index modes.
+
+For every text, image and audio collection in a Chroma directory (or for a
+synthetic clustered corpus), builds a CompressedVectorIndex in each mode and
+reports recall@k against exact brute-force search, resident bytes compared to
+float32, and query latency. Run from the backend directory:
+
+    python -m benchmarks.bench_compressed_recall --chroma-path OrbitDB --k 10
+    python -m benchmarks.bench_compressed_recall --synthetic 50000
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from data_handlers.CompressedIndex import MODES, CompressedVectorIndex
+from benchmarks.run_benchmarks import percentile
+
+KINDS = {"text_collection_": "text", "image_collection_": "image", "audio_collection_": "audio"}
+
+
+def load_collections(chroma_path, user=None, batch_size=2000):
+    """Yield (kind, name, ids, vectors) for every handler collection in a Chroma directory."""
+    import chromadb
+
+    client = chromadb.PersistentClient(path=chroma_path)
+    # Chroma 0.6 lists collection names (which raise on .name); older versions
+    # return Collection objects.
+    for name in sorted(c if isinstance(c, str) else c.name for c in client.list_collections()):
+        kind = next((k for prefix, k in KINDS.items() if name.startswith(prefix)), None)
+        if kind is None or (user and not name.endswith(f"_{user}")):
+            continue
+        collection = client.get_collection(name)
+        ids, vectors, offset = [], [], 0
+        while True:
+            batch = collection.get(offset=offset, limit=batch_size, include=["embeddings"])
+            if not batch["ids"]:
+                break
+            ids.extend(batch["ids"])
+            vectors.extend(batch["embeddings"])
+            offset += len(batch["ids"])
+        if ids:
+            yield kind, name, ids, np.asarray(vectors, dtype=np.float32)
+
+
+def synthetic_collections(n, seed=0):
+    """Clustered unit vectors with the dimensions of the three production encoders."""
+    rng = np.random.default_rng(seed)
+    for kind, dimension in (("text", 768), ("image", 512), ("audio", 512)):
+        centers = rng.standard_normal((max(8, n // 500), dimension)).astype(np.float32)
+        assignment = rng.integers(0, len(centers), size=n)
+        vectors = centers[assignment] + 0.6 * rng.standard_normal((n, dimension)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        yield kind, f"synthetic_{kind}", [f"{kind}-{i}" for i in range(n)], vectors
+
+
+def evaluate(ids, vectors, mode, k, n_queries, oversample, reduced_dim, seed=0):
+    """Measure recall@k, memory and latency of one mode on one collection."""
+    folder = tempfile.mkdtemp(prefix="orbit-compressed-")
+    try:
+        index = CompressedVectorIndex(folder, mode=mode, oversample=oversample, reduced_dim=reduced_dim)
+        started = time.perf_counter()
+        for start in range(0, len(ids), 10000):
+            index.add(ids[start:start + 10000], vectors[start:start + 10000])
+        if mode == "pca":
+            index.rebuild()
+        build_seconds = time.perf_counter() - started
+
+        rng = np.random.default_rng(seed)
+        query_rows = rng.choice(len(ids), size=min(n_queries, len(ids)), replace=False)
+        norms_sq = (vectors ** 2).sum(axis=1)
+        recalls, latencies = [], []
+        for row in query_rows:
+            query = vectors[row]
+            exact = norms_sq - 2 * vectors @ query
+            exact[row] = np.inf
+            truth = {ids[i] for i in np.argsort(exact)[:k]}
+            started = time.perf_counter()
+            found, _ = index.search(query, k, exclude=[ids[row]])
+            latencies.append(time.perf_counter() - started)
+            recalls.append(len(truth.intersection(found)) / k)
+
+        latencies.sort()
+        return {
+            "mode": mode,
+            f"recall@{k}": float(np.mean(recalls)),
+            "resident_bytes": index.memory_bytes(),
+            "float32_bytes": int(vectors.nbytes),
+            "compression": vectors.nbytes / max(index.memory_bytes(), 1),
+            "build_s": build_seconds,
+            "query_p50_ms": percentile(latencies, 0.50) * 1000,
+            "query_p95_ms": percentile(latencies, 0.95) * 1000,
+        }
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chroma-path", help="Chroma persistent directory to read collections from.")
+    parser.add_argument("--user", help="Only benchmark this user's collections.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use N synthetic vectors per modality instead.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--oversample", type=int, default=8)
+    parser.add_argument("--reduced-dim", type=int, default=128)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        collections = synthetic_collections(args.synthetic)
+    elif args.chroma_path:
+        collections = load_collections(args.chroma_path, args.user)
+    else:
+        parser.error("either --chroma-path or --synthetic is required")
+
+    report = []
+    for kind, name, ids, vectors in collections:
+        report.append({
+            "kind": kind,
+            "collection": name,
+            "count": len(ids),
+            "dimension": int(vectors.shape[1]),
+            "modes": [
+                evaluate(ids, vectors, mode.strip(), args.k, args.queries, args.oversample, args.reduced_dim)
+                for mode in args.modes.split(",")
+            ],
+        })
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
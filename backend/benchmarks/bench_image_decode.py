@@ -0,0 +1,136 @@
+"""
+CPU time, peak memory and fidelity of the reduced-resolution image decode path.
+
+Decodes a corpus of large photos with Chroma's ImageLoader (full resolution)
+and with ReducedImageLoader, each followed by the CLIP preprocessing resize and
+centre crop so both produce the 224x224 input the encoder actually sees. Each
+loader runs in a fresh process so its peak RSS can be compared. Fidelity is the
+mean absolute pixel difference (0-255) between the two paths' model inputs.
+Without --corpus, synthetic photo-like JPEGs are generated. Run from the
+backend directory:
+
+    python -m benchmarks.bench_image_decode --count 16 --megapixels 48
+    python -m benchmarks.bench_image_decode --corpus ~/Pictures
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.run_benchmarks import peak_rss_bytes
+
+EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def synthetic_photos(folder, count, megapixels, seed=0):
+    """Write JPEGs with smooth colour fields plus sensor-like noise (noise defeats trivial compression)."""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    paths = []
+    for index in range(count):
+        field = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)).resize((width, height), Image.BICUBIC)
+        noise = rng.integers(-12, 13, (height, width, 1), dtype=np.int16)
+        pixels = np.clip(np.asarray(field, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(folder, f"photo_{index}.jpg")
+        Image.fromarray(pixels).save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def corpus_photos(folder, limit):
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(EXTENSIONS))
+    return sorted(paths)[:limit]
+
+
+def clip_input(pixels, size=224):
+    """OpenCLIP preprocessing up to the tensor: short side to ``size`` (bicubic), then centre crop."""
+    image = Image.fromarray(pixels).convert("RGB")
+    scale = size / min(image.size)
+    image = image.resize((max(size, round(image.width * scale)), max(size, round(image.height * scale))),
+                         Image.BICUBIC)
+    left, top = (image.width - size) // 2, (image.height - size) // 2
+    return np.asarray(image.crop((left, top, left + size, top + size)), dtype=np.int16)
+
+
+def _make_loader(name, workers):
+    if name == "full":
+        from chromadb.utils.data_loaders import ImageLoader
+        return ImageLoader(max_workers=workers)
+    from helpers.image_decode import ReducedImageLoader
+    return ReducedImageLoader(max_workers=workers)
+
+
+def run_loader(name, paths, batch_size, workers, inputs_path):
+    """Decode every path in batches in this process; returns timings and saves the model inputs."""
+    loader = _make_loader(name, workers)
+    baseline_rss = peak_rss_bytes()
+    started, cpu_started = time.perf_counter(), time.process_time()
+    inputs = []
+    for offset in range(0, len(paths), batch_size):
+        inputs.extend(clip_input(pixels) for pixels in loader(paths[offset:offset + batch_size]))
+    result = {
+        "wall_seconds": time.perf_counter() - started,
+        "cpu_seconds": time.process_time() - cpu_started,
+        "peak_rss_mb": peak_rss_bytes() / 2 ** 20,
+        "rss_growth_mb": (peak_rss_bytes() - baseline_rss) / 2 ** 20,
+    }
+    np.save(inputs_path, np.stack(inputs))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="Folder of real photos to decode instead of synthetic ones.")
+    parser.add_argument("--count", type=int, default=16, help="Number of photos (synthetic, or a cap on --corpus).")
+    parser.add_argument("--megapixels", type=float, default=24.0, help="Size of the synthetic photos.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="orbit-decode-bench-")
+    try:
+        if args.corpus:
+            paths = corpus_photos(args.corpus, args.count)
+        else:
+            paths = synthetic_photos(workdir, args.count, args.megapixels)
+        report = {
+            "images": len(paths),
+            "mean_megapixels": float(np.mean([np.prod(Image.open(path).size) for path in paths]) / 1e6),
+            "batch_size": args.batch_size,
+            "workers": args.workers,
+            "loaders": {},
+        }
+        # spawn gives each loader a clean process, so ru_maxrss reflects only its own decoding.
+        context = multiprocessing.get_context("spawn")
+        inputs = {}
+        for name in ("full", "reduced"):
+            inputs[name] = os.path.join(workdir, f"{name}.npy")
+            with context.Pool(1) as pool:
+                report["loaders"][name] = pool.apply(
+                    run_loader, (name, paths, args.batch_size, args.workers, inputs[name]))
+        full, reduced = report["loaders"]["full"], report["loaders"]["reduced"]
+        report["cpu_speedup"] = full["cpu_seconds"] / max(reduced["cpu_seconds"], 1e-9)
+        report["mean_abs_pixel_diff"] = float(np.mean(np.abs(np.load(inputs["full"]) - np.load(inputs["reduced"]))))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
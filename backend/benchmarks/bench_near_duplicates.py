@@ -0,0 +1,131 @@
+"""
+Lookup cost of the perceptual-hash near-duplicate index.
+
+Builds a MultiIndexHashTable over N random 64-bit hashes (a fraction of them
+planted near copies of others), then times radius queries against it and
+against a brute-force numpy scan, checking that both return the same matches.
+It also hashes a synthetic image re-encoded as JPEG and resized, to show the
+distances a real near duplicate produces. Run from the backend directory:
+
+    python -m benchmarks.bench_near_duplicates --images 100000 --threshold 6
+"""
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from benchmarks.run_benchmarks import percentile
+from helpers.perceptual_hash import MultiIndexHashTable, dhash, hamming, phash
+
+
+def _random_hashes(rng, n):
+    return rng.integers(0, np.iinfo(np.uint64).max, size=n, dtype=np.uint64, endpoint=True)
+
+
+def synthetic_hashes(n, planted_fraction, max_flips, seed=0):
+    """Random hashes where ``planted_fraction`` of them are near copies of earlier ones."""
+    rng = np.random.default_rng(seed)
+    hashes = [int(value) for value in _random_hashes(rng, n)]
+    for row in rng.choice(np.arange(1, n), size=int(n * planted_fraction), replace=False):
+        source = hashes[int(rng.integers(0, row))]
+        flips = rng.choice(64, size=int(rng.integers(0, max_flips + 1)), replace=False)
+        hashes[row] = source ^ sum(1 << int(bit) for bit in flips)
+    return hashes
+
+
+def brute_force(array, value, threshold):
+    distances = np.bitwise_count(array ^ np.uint64(value))
+    return sorted((int(distances[row]), row) for row in np.nonzero(distances <= threshold)[0])
+
+
+def time_lookups(hashes, threshold, n_queries, seed=1):
+    started = time.perf_counter()
+    table = MultiIndexHashTable()
+    for row, value in enumerate(hashes):
+        table.add(row, value)
+    build_seconds = time.perf_counter() - started
+    array = np.array(hashes, dtype=np.uint64)
+
+    rng = np.random.default_rng(seed)
+    # Half the queries perturb stored hashes (hits), half are fresh random hashes (misses).
+    queries = []
+    for index in range(n_queries):
+        if index % 2:
+            queries.append(int(_random_hashes(rng, 1)[0]))
+        else:
+            flips = rng.choice(64, size=int(rng.integers(0, threshold + 1)), replace=False)
+            queries.append(hashes[int(rng.integers(0, len(hashes)))] ^ sum(1 << int(bit) for bit in flips))
+
+    index_latencies, scan_latencies, mismatches, matches = [], [], 0, 0
+    for query in queries:
+        started = time.perf_counter()
+        found = table.query(query, threshold)
+        index_latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        expected = brute_force(array, query, threshold)
+        scan_latencies.append(time.perf_counter() - started)
+        matches += len(found)
+        mismatches += found != expected
+    index_latencies.sort()
+    scan_latencies.sort()
+    return {
+        "images": len(hashes),
+        "threshold": threshold,
+        "queries": n_queries,
+        "build_seconds": build_seconds,
+        "matches": matches,
+        "mismatches_vs_scan": mismatches,
+        "index_ms": {name: percentile(index_latencies, q) * 1000 for name, q in (("p50", 0.5), ("p99", 0.99))},
+        "scan_ms": {name: percentile(scan_latencies, q) * 1000 for name, q in (("p50", 0.5), ("p99", 0.99))},
+    }
+
+
+def reencode_distances():
+    """Hash distances between a synthetic image and re-encoded/resized copies of it."""
+    image = Image.new("RGB", (640, 400), "white")
+    draw = ImageDraw.Draw(image)
+    for index in range(12):
+        draw.rectangle((index * 50, 40 + index * 20, index * 50 + 80, 200 + index * 12), fill=(index * 20, 90, 200))
+        draw.text((20, 300 + index * 6), f"line {index}", fill="black")
+    variants = {}
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=70)
+    variants["jpeg_q70"] = Image.open(io.BytesIO(buffer.getvalue()))
+    variants["half_size"] = image.resize((320, 200))
+    variants["different"] = image.transpose(Image.FLIP_LEFT_RIGHT)
+    result = {}
+    for name, fn in (("phash", phash), ("dhash", dhash)):
+        started = time.perf_counter()
+        reference = fn(image)
+        result[name] = {"hash_ms": (time.perf_counter() - started) * 1000}
+        result[name].update({variant: hamming(reference, fn(copy)) for variant, copy in variants.items()})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=100000)
+    parser.add_argument("--threshold", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--planted", type=float, default=0.05, help="Fraction of hashes that are near copies.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    report = {
+        "lookups": time_lookups(synthetic_hashes(args.images, args.planted, args.threshold), args.threshold,
+                                args.queries),
+        "reencode_distances": reencode_distances(),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
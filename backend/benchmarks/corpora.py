@@ -0,0 +1,141 @@
+import base64
+import io
+import math
+import os
+import random
+import struct
+import wave
+
+WORDS = (
+    "orbit vector memory semantic image audio lecture notes research paper dataset "
+    "model training gradient neural network embedding search query result music "
+    "video tutorial recipe travel photo screenshot meeting project deadline budget "
+    "design prototype feedback review article blog podcast interview history "
+    "science physics chemistry biology language grammar poem story chapter"
+).split()
+
+
+def user_weights(n_users, distribution="uniform", zipf_s=1.1):
+    """
+    Return the share of items owned by each synthetic user.
+
+    Args:
+        n_users (int): Number of users.
+        distribution (str): "uniform" or "zipf" (a few heavy users, a long tail).
+        zipf_s (float): Zipf exponent when distribution is "zipf".
+
+    Returns:
+        List[float]: Weights summing to 1.
+    """
+    if distribution == "zipf":
+        raw = [1.0 / (rank ** zipf_s) for rank in range(1, n_users + 1)]
+    elif distribution == "uniform":
+        raw = [1.0] * n_users
+    else:
+        raise ValueError(f"Unknown user distribution: {distribution}")
+    total = sum(raw)
+    return [weight / total for weight in raw]
+
+
+def assign_users(rng, n_items, user_ids, weights):
+    """Assign each of ``n_items`` items to a user according to ``weights``."""
+    return rng.choices(user_ids, weights=weights, k=n_items)
+
+
+def make_text(rng, min_words=20, max_words=200):
+    """Generate a pseudo-sentence of random vocabulary words."""
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_query(rng):
+    """Generate a short search query."""
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def make_image_data_uri(rng, size=256, file_format="png"):
+    """
+    Generate a random image and return it as a data URI, as the extension sends it.
+
+    Args:
+        rng (random.Random): Source of randomness.
+        size (int): Width and height in pixels.
+        file_format (str): "png" or "jpeg".
+
+    Returns:
+        str: data:image/<format>;base64,... URI.
+    """
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (size, size), rng.randbytes(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG" if file_format == "jpeg" else "PNG")
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:image/{file_format};base64,{encoded}"
+
+
+def write_audio_file(rng, folder, seconds=2.0, sample_rate=16000):
+    """
+    Write a mono 16-bit WAV of a few random sine tones.
+
+    Args:
+        rng (random.Random): Source of randomness.
+        folder (str): Directory to write into.
+        seconds (float): Clip length.
+        sample_rate (int): Sample rate of the clip.
+
+    Returns:
+        str: Path to the written file.
+    """
+    os.makedirs(folder, exist_ok=True)
+    frequencies = [rng.uniform(110.0, 1760.0) for _ in range(3)]
+    n_samples = int(seconds * sample_rate)
+    frames = bytearray()
+    for i in range(n_samples):
+        t = i / sample_rate
+        value = sum(math.sin(2 * math.pi * f * t) for f in frequencies) / len(frequencies)
+        frames += struct.pack("<h", int(value * 32767 * 0.8))
+    path = os.path.join(folder, f"clip_{rng.getrandbits(64):016x}.wav")
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(bytes(frames))
+    return path
+
+
+def build_corpus(seed, n_users, n_texts, n_images, n_audio, audio_folder,
+                 distribution="uniform", image_size=256):
+    """
+    Build a reproducible synthetic corpus.
+
+    Args:
+        seed (int): Seed; the same seed always yields the same corpus.
+        n_users (int): Number of users.
+        n_texts (int): Number of text items.
+        n_images (int): Number of image items.
+        n_audio (int): Number of audio clips.
+        audio_folder (str): Where generated WAV files are written.
+        distribution (str): Per-user item distribution ("uniform" or "zipf").
+        image_size (int): Edge length of generated images.
+
+    Returns:
+        dict: {"users": [...], "items": [{"kind", "user", "payload"}, ...], "queries": [...]}
+    """
+    rng = random.Random(seed)
+    users = [f"bench-user-{index:04d}" for index in range(n_users)]
+    weights = user_weights(n_users, distribution)
+
+    items = []
+    for user in assign_users(rng, n_texts, users, weights):
+        items.append({"kind": "text", "user": user, "payload": make_text(rng)})
+    for user in assign_users(rng, n_images, users, weights):
+        file_format = rng.choice(("png", "jpeg"))
+        items.append({"kind": "image", "user": user,
+                      "payload": make_image_data_uri(rng, image_size, file_format)})
+    for user in assign_users(rng, n_audio, users, weights):
+        items.append({"kind": "audio", "user": user,
+                      "payload": write_audio_file(rng, audio_folder)})
+    rng.shuffle(items)
+
+    queries = [make_query(rng) for _ in range(max(1, n_texts // 2))]
+    return {"users": users, "items": items, "queries": queries}
@@ -0,0 +1,185 @@
+"""
+Local HTTP stand-ins for the remote services Orbit talks to.
+
+    python -m benchmarks.http_fixtures --port 8765 --delay 0.5
+
+serves, on 127.0.0.1:
+
+    /oembed?url=<youtube url>   YouTube-style oEmbed JSON (title, author_name, duration)
+    /pages/<slug>?paragraphs=N  HTML article with ETag/Last-Modified, answers 304 to
+                                matching conditional requests
+    /large?bytes=N              HTML body of N bytes (for size caps)
+    /binary                     application/octet-stream body
+
+Point the backend at it with ORBIT_YOUTUBE_OEMBED_URL=http://127.0.0.1:8765/oembed,
+and set ORBIT_WEB_ALLOWED_NETWORKS=127.0.0.1/32 so webpage ingestion may fetch
+/pages (loopback addresses are refused otherwise).
+Responses are derived from the request, so they are deterministic, and every
+request is counted per path so callers can check caching and coalescing.
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from helpers.youtube import normalize_video_id
+
+
+class FixtureServer:
+    """Threaded fixture server; use as a context manager or call start()/stop()."""
+
+    def __init__(self, port=0, delay=0.0):
+        """
+        Args:
+            port (int): Port to bind on 127.0.0.1; 0 picks a free one.
+            delay (float): Seconds to sleep before answering, to simulate a slow upstream.
+        """
+        self.delay = delay
+        self.requests = Counter()
+        self.pages = {}
+        self.max_concurrent = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, path):
+        with self._lock:
+            self.requests[path] += 1
+
+    def set_page(self, slug, html):
+        """Serve fixed HTML at /pages/<slug>, e.g. to simulate an edit."""
+        self.pages[slug] = html
+
+    def _enter(self):
+        with self._lock:
+            self._active += 1
+            self.max_concurrent = max(self.max_concurrent, self._active)
+
+    def _leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def _handler_class(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                fixture._count(parsed.path)
+                fixture._enter()
+                try:
+                    if fixture.delay:
+                        time.sleep(fixture.delay)
+                    if parsed.path == "/oembed":
+                        self._oembed(query)
+                    elif parsed.path.startswith("/pages/"):
+                        self._page(parsed.path[len("/pages/"):], query)
+                    elif parsed.path == "/large":
+                        size = int(query.get("bytes", ["4194304"])[0])
+                        self._send(200, "text/html; charset=utf-8", b"<p>" + b"x" * size + b"</p>")
+                    elif parsed.path == "/binary":
+                        self._send(200, "application/octet-stream", b"\x00" * 1024)
+                    else:
+                        self._send(404, "application/json", b'{"error": "not found"}')
+                finally:
+                    fixture._leave()
+
+            def _page(self, slug, query):
+                html = fixture.pages.get(slug)
+                if html is None:
+                    paragraphs = int(query.get("paragraphs", ["12"])[0])
+                    html = _article(slug, paragraphs)
+                body = html.encode("utf-8")
+                etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send(304, "text/html; charset=utf-8", b"", {"ETag": etag})
+                    return
+                self._send(200, "text/html; charset=utf-8", body,
+                           {"ETag": etag, "Last-Modified": formatdate(0, usegmt=True)})
+
+            def _oembed(self, query):
+                video_id = normalize_video_id(query.get("url", [""])[0])
+                if not video_id:
+                    self._send(404, "application/json", b'{"error": "unknown video"}')
+                    return
+                digest = int(hashlib.sha256(video_id.encode()).hexdigest(), 16)
+                body = json.dumps({
+                    "type": "video",
+                    "title": f"Fixture video {video_id}",
+                    "author_name": f"Channel {digest % 97}",
+                    "duration": 60 + digest % 3600,
+                }).encode()
+                self._send(200, "application/json", body)
+
+            def _send(self, status, content_type, body, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _article(slug, paragraphs):
+    digest = hashlib.sha256(slug.encode()).hexdigest()
+    words = [digest[i:i + 5] for i in range(0, len(digest), 5)]
+    body = "".join(
+        f"<p>Paragraph {index} of {slug}. " + " ".join(words[(index + j) % len(words)] for j in range(60)) + "</p>"
+        for index in range(paragraphs)
+    )
+    return (f"<html><head><title>Fixture page {slug}</title><script>var tracking = 1;</script></head>"
+            f"<body><nav>Home | About</nav><article><h1>{slug}</h1>{body}</article>"
+            f"<footer>Copyright</footer></body></html>")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before each response.")
+    args = parser.parse_args(argv)
+
+    server = FixtureServer(args.port, args.delay)
+    print(f"Serving fixtures on {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Reproducible throughput/latency benchmark for Orbit.
+
+Generates a synthetic corpus, drives the data handlers and/or the Flask
+endpoints concurrently, and prints a JSON report with p50/p95/p99 latency,
+throughput and peak RSS per operation. Run from the backend directory:
+
+    python -m benchmarks.run_benchmarks --users 20 --texts 500 --images 100 \\
+        --audio 20 --concurrency 8 --stub-encoders --output bench.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from benchmarks.corpora import build_corpus
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class LatencyRecorder:
+    """Thread-safe collection of per-operation latencies and phase wall times."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(list)
+        self._errors = defaultdict(int)
+        self._wall = defaultdict(float)
+
+    def record(self, op, seconds, ok=True):
+        with self._lock:
+            self._latencies[op].append(seconds)
+            if not ok:
+                self._errors[op] += 1
+
+    def add_wall_time(self, ops, seconds):
+        with self._lock:
+            for op in ops:
+                self._wall[op] += seconds
+
+    def summary(self):
+        report = {}
+        for op, values in sorted(self._latencies.items()):
+            values = sorted(values)
+            wall = self._wall.get(op) or sum(values)
+            report[op] = {
+                "count": len(values),
+                "errors": self._errors.get(op, 0),
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "mean_ms": sum(values) / len(values) * 1000,
+                "throughput_per_s": len(values) / wall if wall else 0.0,
+            }
+        return report
+
+
+def _run_phase(recorder, tasks, concurrency):
+    """Run ``(op, callable)`` tasks on a thread pool and record each latency."""
+    def run(task):
+        op, fn = task
+        started = time.perf_counter()
+        ok = True
+        try:
+            ok = fn() is not False
+        except Exception:
+            ok = False
+        recorder.record(op, time.perf_counter() - started, ok)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, tasks))
+    recorder.add_wall_time({op for op, _ in tasks}, time.perf_counter() - started)
+
+
+def _search_plan(corpus, n_searches, seed):
+    rng = random.Random(seed + 1)
+    return [(rng.choice(corpus["users"]), rng.choice(corpus["queries"])) for _ in range(n_searches)]
+
+
+def run_handlers(corpus, args, workdir, recorder):
+    """Benchmark TextHandler, ImageHandler and AudioHandler directly."""
+    import chromadb
+    from data_handlers import TextHandler, ImageHandler, AudioHandler
+
+    client = chromadb.PersistentClient(path=os.path.join(workdir, "OrbitDB"))
+    data_dir = os.path.join(workdir, "data")
+    if args.stub_encoders:
+        from helpers.stub_encoders import StubTextEmbedding, StubImageEmbedding, StubAudioEmbedder
+        text = TextHandler(client, os.path.join(data_dir, "texts"), embedding_model=StubTextEmbedding())
+        image = ImageHandler(client, os.path.join(data_dir, "images"), embedding_function=StubImageEmbedding())
+        audio = AudioHandler(client, os.path.join(data_dir, "audio"), embedder=StubAudioEmbedder())
+    else:
+        text = TextHandler(client, os.path.join(data_dir, "texts"))
+        image = ImageHandler(client, os.path.join(data_dir, "images"))
+        audio = AudioHandler(client, os.path.join(data_dir, "audio"))
+
+    add = {
+        "text": lambda item: text.add_text(item["user"], item["payload"]) is not None,
+        "image": lambda item: image.add_image(item["user"], item["payload"]) is not None,
+        "audio": lambda item: audio.add_audio(item["user"], item["payload"]) is not None,
+    }
+    tasks = [(f"handler.add_{item['kind']}", lambda item=item: add[item["kind"]](item))
+             for item in corpus["items"]]
+    _run_phase(recorder, tasks, args.concurrency)
+
+    tasks = []
+    for user, query in _search_plan(corpus, args.searches, args.seed):
+        tasks.append(("handler.search_texts", lambda u=user, q=query: text.search_texts(u, q)))
+        tasks.append(("handler.search_images", lambda u=user, q=query: image.search_images(u, q)))
+        if args.audio:
+            tasks.append(("handler.retrieve_audio", lambda u=user, q=query: audio.retrieve_audio(u, q)))
+    _run_phase(recorder, tasks, args.concurrency)
+
+
+def run_endpoints(corpus, args, workdir, recorder):
+    """Benchmark /api/save, /api/search and /api/populate through the Flask test client."""
+    os.environ["ORBIT_CHROMA_PATH"] = os.path.join(workdir, "OrbitDB")
+    os.environ["ORBIT_DATABASE_URI"] = "sqlite:///" + os.path.join(workdir, "orbit.db")
+    os.environ["ORBIT_STUB_ENCODERS"] = "1" if args.stub_encoders else "0"
+    os.environ.setdefault("SESSION_SECRET", "benchmark-secret")
+    # The handlers store files relative to the working directory.
+    os.chdir(workdir)
+
+    import app as orbit_app
+    from users.user_management import User
+
+    with orbit_app.app.app_context():
+        user_ids = {name: User.get_or_create(f"{name}@bench.local")[0].id for name in corpus["users"]}
+
+    local = threading.local()
+
+    def client_for(user):
+        clients = getattr(local, "clients", None)
+        if clients is None:
+            clients = local.clients = {}
+        if user not in clients:
+            test_client = orbit_app.app.test_client()
+            with test_client.session_transaction() as flask_session:
+                flask_session["user_id"] = user_ids[user]
+            clients[user] = test_client
+        return clients[user]
+
+    def save(item):
+        if item["kind"] == "audio":
+            content = {"type": "audio", "path": item["payload"]}
+        else:
+            content = {"type": item["kind"], "data": item["payload"]}
+        response = client_for(item["user"]).post("/api/save", json={"content": content, "tags": ["bench"]})
+        return response.status_code == 200
+
+    def get(user, path):
+        return client_for(user).get(path).status_code == 200
+
+    tasks = [("endpoint.save_" + item["kind"], lambda item=item: save(item)) for item in corpus["items"]]
+    _run_phase(recorder, tasks, args.concurrency)
+
+    types = "text,image,audio" if args.audio else "text,image"
+    tasks = []
+    for user, query in _search_plan(corpus, args.searches, args.seed):
+        path = "/api/search?" + urlencode({"query": query, "types": types})
+        tasks.append(("endpoint.search", lambda u=user, p=path: get(u, p)))
+    for index, user in enumerate(corpus["users"] * args.populate_pages):
+        path = f"/api/populate?page={index % args.populate_pages + 1}&page_size={args.page_size}"
+        tasks.append(("endpoint.populate", lambda u=user, p=path: get(u, p)))
+    _run_phase(recorder, tasks, args.concurrency)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="uniform")
+    parser.add_argument("--texts", type=int, default=200)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--audio", type=int, default=0)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--searches", type=int, default=100)
+    parser.add_argument("--populate-pages", type=int, default=3)
+    parser.add_argument("--page-size", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--target", choices=("handlers", "endpoints", "both"), default="both")
+    parser.add_argument("--stub-encoders", action="store_true",
+                        help="Use deterministic stub encoders instead of the real models.")
+    parser.add_argument("--workdir", help="Directory for the throwaway databases (default: a temp dir).")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.output:
+        # Endpoint mode changes the working directory, so pin the path first.
+        args.output = os.path.abspath(args.output)
+    sys.path.insert(0, BACKEND_DIR)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="orbit-bench-"))
+
+    corpus = build_corpus(
+        seed=args.seed,
+        n_users=args.users,
+        n_texts=args.texts,
+        n_images=args.images,
+        n_audio=args.audio,
+        audio_folder=os.path.join(workdir, "corpus_audio"),
+        distribution=args.distribution,
+        image_size=args.image_size,
+    )
+
+    recorder = LatencyRecorder()
+    started = time.perf_counter()
+    if args.target in ("handlers", "both"):
+        run_handlers(corpus, args, os.path.join(workdir, "handlers"), recorder)
+    if args.target in ("endpoints", "both"):
+        endpoints_dir = os.path.join(workdir, "endpoints")
+        os.makedirs(endpoints_dir, exist_ok=True)
+        run_endpoints(corpus, args, endpoints_dir, recorder)
+
+    report = {
+        "commit": _git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "workdir")},
+        "workdir": workdir,
+        "elapsed_s": time.perf_counter() - started,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "operations": recorder.summary(),
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
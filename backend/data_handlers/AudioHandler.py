@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import os
 import hashlib
+import json
+from datetime import datetime
 from pathlib import Path
 from typing import List, Optional, Dict, Any, Sequence, Union
 from dataclasses import dataclass
@@ -11,6 +13,18 @@ import torchaudio
 from chromadb.api.types import Document, Embedding, EmbeddingFunction, URI
 from transformers import ClapModel, ClapProcessor
 
+from helpers.logs import get_logger
+from helpers.metrics import timed, ITEMS_TOTAL
+from helpers import write_events
+from helpers.collection_aliases import ALIASES
+from helpers.hnsw_params import HNSW_SETTINGS, ExactSearch
+from helpers.tag_index import tag_fields
+from helpers.item_fields import item_fields
+from helpers.blob_store import BlobStore
+from data_handlers.CompressedIndex import CompressedIndexRegistry, query_result
+
+logger = get_logger("handlers.audio")
+
 class AudioProcessingError(Exception):
     """Custom exception for audio processing errors."""
     pass
@@ -19,6 +33,28 @@ class FileOperationError(Exception):
     """Custom exception for file operation errors."""
     pass
 
+def _sanitize_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Make metadata storable in ChromaDB: None becomes "" and non-scalar values are JSON-encoded.
+    Each tag also gets a boolean ``tag__<tag>`` field so searches can filter on tags.
+
+    Args:
+        metadata: Metadata dictionary.
+
+    Returns:
+        Sanitized metadata dictionary.
+    """
+    sanitized = {}
+    for key, value in metadata.items():
+        if value is None:
+            sanitized[key] = ""
+        elif isinstance(value, (str, int, float, bool)):
+            sanitized[key] = value
+        else:
+            sanitized[key] = json.dumps(value, ensure_ascii=False)
+    sanitized.update(tag_fields(metadata.get('tags')))
+    return sanitized
+
 @dataclass
 class AudioMetadata:
     """Data class for audio file metadata."""
@@ -57,7 +93,8 @@ class AudioLoader:
             return None
 
         try:
-            waveform, sample_rate = torchaudio.load(uri)
+            with timed("media_read", model="audio"):
+                waveform, sample_rate = torchaudio.load(uri)
             
             # Process audio to standard format
             processed_waveform = self._standardize_audio(waveform, sample_rate)
@@ -109,7 +146,7 @@ class AudioLoader:
             try:
                 results.append(self._load_audio(uri))
             except AudioProcessingError as e:
-                print(f"Warning: {str(e)}")
+                logger.warning("Audio load failed", extra={"error": str(e)})
                 results.append(None)
         return results
 
@@ -186,15 +223,16 @@ class CLAPEmbedder(EmbeddingFunction):
             List of embeddings.
         """
         embeddings = []
-        for item in inputs:
-            if isinstance(item, dict) and 'waveform' in item:
-                embeddings.append(self._encode_audio(item['waveform']))
-            elif isinstance(item, str):
-                embeddings.append(self._encode_text(item))
-            elif item is None:
-                embeddings.append(None)
-            else:
-                raise ValueError(f"Unsupported input type: {type(item)}")
+        with timed("embed", model="clap"):
+            for item in inputs:
+                if isinstance(item, dict) and 'waveform' in item:
+                    embeddings.append(self._encode_audio(item['waveform']))
+                elif isinstance(item, str):
+                    embeddings.append(self._encode_text(item))
+                elif item is None:
+                    embeddings.append(None)
+                else:
+                    raise ValueError(f"Unsupported input type: {type(item)}")
         return embeddings
 
 class AudioHandler:
@@ -204,7 +242,11 @@ class AudioHandler:
         self, 
         client: Any,
         base_folder: Union[str, Path] = 'data/audio',
-        target_sample_rate: int = 48000
+        target_sample_rate: int = 48000,
+        embedder: Optional[EmbeddingFunction] = None,
+        compressed_index: Optional[CompressedIndexRegistry] = None,
+        blob_store: Optional[BlobStore] = None,
+        exact_search: Optional[ExactSearch] = None
     ) -> None:
         """
         Initialize the audio library.
@@ -213,6 +255,13 @@ class AudioHandler:
             client: ChromaDB client instance.
             base_folder: Base directory for storing audio files.
             target_sample_rate: Target sample rate for audio processing.
+            embedder: Embedding function to use instead of CLAP.
+            compressed_index: When set, searches run against compressed vectors
+                with exact re-ranking.
+            blob_store: When set, audio files are stored once in the shared
+                content-addressed store instead of per-user folders.
+            exact_search: When set, collections below the exact-search threshold
+                are searched by exhaustive scan.
         """
         self.client = client
         self.base_folder = Path(base_folder)
@@ -221,7 +270,10 @@ class AudioHandler:
         self._ensure_base_folder()
         
         self.audio_loader = AudioLoader(target_sample_rate=target_sample_rate)
-        self.embedder = CLAPEmbedder()
+        self.embedder = embedder or CLAPEmbedder()
+        self.compressed_index = compressed_index
+        self.blob_store = blob_store
+        self.exact_search = exact_search
 
     def _ensure_base_folder(self) -> None:
         """Create base folder if it doesn't exist."""
@@ -238,7 +290,9 @@ class AudioHandler:
             Unique file ID.
         """
         with open(file_path, 'rb') as f:
-            return hashlib.sha256(f.read()).hexdigest()
+            data = f.read()
+        with timed("hash", model="audio"):
+            return hashlib.sha256(data).hexdigest()
 
     def _get_user_folder(self, user_id: str) -> Path:
         """
@@ -265,64 +319,110 @@ class AudioHandler:
             ChromaDB collection.
         """
         return self.client.get_or_create_collection(
-            name=f'audio_collection_{user_id}',
+            name=ALIASES.resolve(f'audio_collection_{user_id}'),
             embedding_function=self.embedder,
-            data_loader=self.audio_loader
+            data_loader=self.audio_loader,
+            metadata=HNSW_SETTINGS.collection_metadata('audio')
         )
 
-    def add_audio(self, user_id: str, audio_path: Union[str, Path]) -> Optional[str]:
+    @write_events.gated('audio')
+    def add_audio(
+        self,
+        user_id: str,
+        audio_path: Union[str, Path],
+        metadata: Optional[Dict[str, Any]] = None
+    ) -> Optional[str]:
         """
         Add an audio file to a user's collection.
 
         Args:
             user_id: User identifier.
             audio_path: Path to the audio file.
+            metadata: Additional metadata (tags, email, type) to store with the file.
 
         Returns:
             File ID if successful, None otherwise.
         """
+        new_reference = False
         try:
             audio_path = Path(audio_path)
             file_id = self._generate_file_id(audio_path)
-            user_folder = self._get_user_folder(user_id)
-            
-            # Create destination path with original extension
-            destination = user_folder / f"{file_id}{audio_path.suffix}"
-            
-            if not destination.exists():
-                destination.write_bytes(audio_path.read_bytes())
+
+            # Ids are content hashes and Chroma ignores an add for an existing id,
+            # so saving the same file again changes nothing and publishes nothing.
+            if self._get_user_collection(user_id).get(ids=[file_id], include=[])['ids']:
+                logger.info("Audio already saved", extra={"item_id": file_id, "user_id": user_id})
+                return file_id
+
+            if self.blob_store is not None:
+                # Identical files saved by any user share one blob.
+                new_reference = self.blob_store.lookup(user_id, 'audio', file_id) is None
+                with timed("file_write", model="audio"):
+                    _, blob_path = self.blob_store.store_file(user_id, 'audio', file_id, audio_path)
+                destination = Path(blob_path)
+            else:
+                user_folder = self._get_user_folder(user_id)
+
+                # Create destination path with original extension
+                destination = user_folder / f"{file_id}{audio_path.suffix}"
+
+                if not destination.exists():
+                    with timed("file_write", model="audio"):
+                        destination.write_bytes(audio_path.read_bytes())
 
             # Process audio file
-            waveform, sample_rate = torchaudio.load(str(destination))
+            with timed("media_read", model="audio"):
+                waveform, sample_rate = torchaudio.load(str(destination))
             processed_audio = self.audio_loader._standardize_audio(waveform, sample_rate)
             
             # Create metadata
-            metadata = AudioMetadata(
+            audio_metadata = AudioMetadata(
                 uri=str(destination),
                 user_id=user_id,
                 original_sample_rate=sample_rate,
                 target_sample_rate=self.target_sample_rate,
                 duration=len(processed_audio) / self.target_sample_rate
-            )
+            ).__dict__
+            audio_metadata['timestamp'] = datetime.now().isoformat()
+            if metadata:
+                audio_metadata.update(metadata)
+            audio_metadata.update(item_fields('audio', audio_metadata))
+            stored_metadata = _sanitize_metadata(audio_metadata)
 
             # Add to collection
             collection = self._get_user_collection(user_id)
-            collection.add(
-                ids=[file_id],
-                uris=[str(destination)],
-                metadatas=[metadata.__dict__]
-            )
-
+            embeddings = None
+            if self.compressed_index is not None:
+                # The waveform is already loaded, so embed it here rather than
+                # letting Chroma reload it through the data loader.
+                embeddings = [self.embedder._encode_audio(processed_audio)]
+            with timed("collection_add", model="audio"):
+                collection.add(
+                    ids=[file_id],
+                    uris=[str(destination)],
+                    metadatas=[stored_metadata],
+                    embeddings=embeddings
+                )
+            if embeddings is not None:
+                self.compressed_index.for_user(user_id, collection).add([file_id], embeddings)
+
+            ITEMS_TOTAL.inc(kind="audio", action="add")
+            write_events.publish("audio", "add", user_id, file_id, stored_metadata)
+            logger.info("Audio added", extra={"item_id": file_id, "user_id": user_id})
             return file_id
             
         except Exception as e:
+            if new_reference:
+                # Drop the reference taken above so the blob can be freed.
+                self.blob_store.release(user_id, 'audio', file_id)
             raise FileOperationError(f"Failed to add audio file: {str(e)}")
 
     def retrieve_audio(
         self, 
         user_id: str, 
         query: str, 
-        n_results: int = 5
+        n_results: int = 5,
+        where: Optional[Dict[str, Any]] = None
     ) -> List[Dict[str, Any]]:
         """
         Search for audio files using text query.
@@ -331,19 +431,32 @@ class AudioHandler:
             user_id: User identifier.
             query: Text query.
             n_results: Maximum number of results.
+            where: Chroma metadata filter applied before the vector search.
 
         Returns:
             List of matching audio files with metadata.
         """
         try:
             collection = self._get_user_collection(user_id)
-            return collection.query(
-                query_texts=[query],
-                n_results=n_results
-            )
+            if self.exact_search is not None and self.exact_search.covers('audio', user_id, collection):
+                ids, distances = self.exact_search.search('audio', user_id, collection,
+                                                          self.embedder._encode_text(query), n_results, where)
+                return query_result(collection, ids, distances, ['metadatas', 'uris'])
+            if self.compressed_index is not None:
+                index = self.compressed_index.for_user(user_id, collection)
+                allowed = collection.get(where=where, include=[])['ids'] if where else None
+                ids, distances = index.search(self.embedder._encode_text(query), n_results, allowed=allowed)
+                return query_result(collection, ids, distances, ['metadatas', 'uris'])
+            with timed("collection_query", model="audio"):
+                return collection.query(
+                    query_texts=[query],
+                    n_results=n_results,
+                    where=where
+                )
         except Exception as e:
             raise AudioProcessingError(f"Failed to retrieve audio files: {str(e)}")
 
+    @write_events.gated('audio')
     def delete_audio(self, user_id: str, file_id: str) -> None:
         """
         Delete an audio file from a user's collection.
@@ -354,15 +467,28 @@ class AudioHandler:
         """
         try:
             collection = self._get_user_collection(user_id)
-            metadata = collection.get(ids=[file_id])
-            
-            if metadata:
-                file_path = Path(metadata[0].get('uri'))
-                if file_path.exists():
-                    file_path.unlink()
+            in_blob_store = self.blob_store is not None and self.blob_store.lookup(user_id, 'audio', file_id)
+            if not in_blob_store:
+                result = collection.get(ids=[file_id], include=['metadatas', 'uris'])
+                if result['ids']:
+                    uri = (result.get('uris') or [None])[0] or (result['metadatas'][0] or {}).get('uri')
+                    file_path = Path(uri) if uri else None
+                    # Files inside the blob store may be shared with other users.
+                    shared = (self.blob_store is not None and file_path is not None
+                              and self.blob_store.contains(file_path))
+                    if file_path is not None and not shared and file_path.exists():
+                        file_path.unlink()
 
             collection.delete(ids=[file_id])
-            
+            if in_blob_store:
+                # The blob is only removed once no other item references it.
+                self.blob_store.release(user_id, 'audio', file_id)
+            if self.compressed_index is not None:
+                self.compressed_index.for_user(user_id).remove([file_id])
+            ITEMS_TOTAL.inc(kind="audio", action="delete")
+            write_events.publish("audio", "delete", user_id, file_id)
+            logger.info("Audio deleted", extra={"item_id": file_id, "user_id": user_id})
+
         except Exception as e:
             raise FileOperationError(f"Failed to delete audio file: {str(e)}")
 
@@ -384,13 +510,18 @@ class AudioHandler:
             List of matching audio files with metadata.
         """
         try:
-            # Load and process query audio
-            waveform, sample_rate = torchaudio.load(str(query_audio_path))
-            processed_audio = self.audio_loader._standardize_audio(waveform, sample_rate)
-            
-            # Generate embedding and search
             collection = self._get_user_collection(user_id)
-            query_embedding = self.embedder._encode_audio(processed_audio)
+
+            # A file the user already saved has its embedding stored under its
+            # content hash; reuse it instead of decoding and re-encoding the audio.
+            stored = collection.get(ids=[self._generate_file_id(query_audio_path)], include=['embeddings'])
+            if stored['ids'] and stored['embeddings'] is not None and len(stored['embeddings']):
+                query_embedding = stored['embeddings'][0]
+            else:
+                # Load and process query audio
+                waveform, sample_rate = torchaudio.load(str(query_audio_path))
+                processed_audio = self.audio_loader._standardize_audio(waveform, sample_rate)
+                query_embedding = self.embedder._encode_audio(processed_audio)
             
             return collection.query(
                 query_embeddings=[query_embedding],
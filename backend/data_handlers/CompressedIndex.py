@@ -0,0 +1,487 @@
+from __future__ import annotations
+
+import os
+import shutil
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from helpers.metrics import timed
+
+MODES = ("int8", "binary", "pca")
+SCAN_CHUNK = 65536
+PCA_FIT_SIZE = 1024
+
+
+class _GrowableArray:
+    """Row-appendable numpy array with amortized O(1) appends."""
+
+    def __init__(self, width: Optional[int], dtype: Any) -> None:
+        self.width = width
+        self.dtype = dtype
+        self._data = np.empty((0,) if width is None else (0, width), dtype=dtype)
+        self.size = 0
+
+    def append(self, rows: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=self.dtype)
+        needed = self.size + len(rows)
+        if needed > len(self._data):
+            capacity = max(needed, 2 * len(self._data), 64)
+            grown = np.empty((capacity,) + self._data.shape[1:], dtype=self.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = rows
+        self.size = needed
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._data[:self.size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._data[:self.size].nbytes
+
+
+class CompressedVectorIndex:
+    """
+    Two-stage vector index for one user's collection of one modality.
+
+    Full-precision float32 vectors are appended to ``vectors.f32`` and only ever
+    read through a memory map. What stays resident is a compact code per vector:
+
+    - ``int8``: symmetric per-vector int8 quantization (4x smaller).
+    - ``binary``: sign bits, scored by Hamming distance (32x smaller).
+    - ``pca``: projection onto the top ``reduced_dim`` principal components.
+
+    A search scans the codes to pick ``k * oversample`` candidates and re-ranks
+    them exactly against the memory-mapped float32 vectors, so the returned
+    distances are identical to an exhaustive search over those candidates.
+    Distances follow Chroma's conventions (squared L2, inner product or cosine).
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        mode: str = "int8",
+        reduced_dim: int = 128,
+        oversample: int = 8,
+        space: str = "l2"
+    ) -> None:
+        """
+        Args:
+            folder: Directory holding this index's files.
+            mode: Stage-one representation, one of MODES.
+            reduced_dim: Target dimension in ``pca`` mode.
+            oversample: Candidates re-ranked per requested result.
+            space: Distance function, "l2", "ip" or "cosine".
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unsupported compressed index mode: {mode}")
+        self.folder = folder
+        self.mode = mode
+        self.reduced_dim = reduced_dim
+        self.oversample = oversample
+        self.space = space
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._vectors_path = os.path.join(folder, "vectors.f32")
+        self._ids_path = os.path.join(folder, "ids.log")
+        self._pca_path = os.path.join(folder, "pca.npz")
+
+        self.dimension: Optional[int] = None
+        self._ids: List[Optional[str]] = []
+        self._positions: Dict[str, int] = {}
+        self._full: Optional[np.memmap] = None
+        self._norms = _GrowableArray(None, np.float32)
+        self._codes: Optional[_GrowableArray] = None
+        self._scales = _GrowableArray(None, np.float32)
+        self._pca_mean: Optional[np.ndarray] = None
+        self._pca_components: Optional[np.ndarray] = None
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def _load(self) -> None:
+        if os.path.exists(self._pca_path):
+            with np.load(self._pca_path) as pca:
+                self._pca_mean = pca["mean"]
+                self._pca_components = pca["components"]
+
+        if not os.path.exists(self._ids_path):
+            return
+        positions: List[Optional[str]] = []
+        with open(self._ids_path, "rb") as f:
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            # A crash mid-append can leave a partial last line; drop it so the
+            # next logged id does not run into it.
+            os.truncate(self._ids_path, complete)
+        for line in data[:complete].decode("utf-8").splitlines():
+            if line.startswith("#dim "):
+                self.dimension = int(line[5:])
+            elif line.startswith("+"):
+                positions.append(line[1:])
+            elif line.startswith("-"):
+                position = int(line[1:])
+                if position < len(positions):
+                    positions[position] = None
+        if self.dimension is None:
+            return
+        self._truncate_vectors(len(positions))
+        if not positions:
+            return
+
+        self._remap(len(positions))
+        self._ids = positions
+        self._positions = {item_id: index for index, item_id in enumerate(positions) if item_id is not None}
+        for start in range(0, len(positions), SCAN_CHUNK):
+            self._append_codes(np.asarray(self._full[start:start + SCAN_CHUNK]))
+
+    def _remap(self, rows: int) -> None:
+        self._full = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dimension))
+
+    def _truncate_vectors(self, rows: int) -> None:
+        """Drop vector rows past ``rows``, left behind by an add whose ids were never logged."""
+        size = rows * self.dimension * 4
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) > size:
+            os.truncate(self._vectors_path, size)
+
+    def _log(self, line: str) -> None:
+        with open(self._ids_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    # ------------------------------------------------------------------
+    # Encoding
+    # ------------------------------------------------------------------
+    def _append_codes(self, vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._norms.append(np.linalg.norm(vectors, axis=1))
+        if self.mode == "int8":
+            scales = np.abs(vectors).max(axis=1)
+            scales[scales == 0] = 1.0
+            if self._codes is None:
+                self._codes = _GrowableArray(self.dimension, np.int8)
+            self._codes.append(np.round(vectors / scales[:, None] * 127).astype(np.int8))
+            self._scales.append(scales)
+        elif self.mode == "binary":
+            if self._codes is None:
+                self._codes = _GrowableArray((self.dimension + 7) // 8, np.uint8)
+            self._codes.append(np.packbits(vectors > 0, axis=1))
+        elif self._pca_components is not None:
+            if self._codes is None:
+                self._codes = _GrowableArray(len(self._pca_components), np.float32)
+            self._codes.append((vectors - self._pca_mean) @ self._pca_components.T)
+
+    def _fit_pca(self) -> None:
+        """Fit the projection on (a sample of) the stored vectors and re-encode everything."""
+        alive = np.flatnonzero(np.array([item_id is not None for item_id in self._ids]))
+        if len(alive) == 0:
+            return
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(alive, size=min(len(alive), 20000), replace=False))
+        data = np.asarray(self._full[sample], dtype=np.float32)
+        mean = data.mean(axis=0)
+        _, _, vt = np.linalg.svd(data - mean, full_matrices=False)
+        self._pca_mean = mean.astype(np.float32)
+        self._pca_components = vt[:min(self.reduced_dim, vt.shape[0])].astype(np.float32)
+        np.savez(self._pca_path, mean=self._pca_mean, components=self._pca_components)
+
+        self._codes = None
+        self._norms = _GrowableArray(None, np.float32)
+        for start in range(0, len(self._ids), SCAN_CHUNK):
+            self._append_codes(np.asarray(self._full[start:start + SCAN_CHUNK]))
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add(self, ids: Sequence[str], embeddings: Iterable[Sequence[float]]) -> None:
+        """
+        Append vectors. Ids already present are replaced.
+
+        Args:
+            ids: Item identifiers.
+            embeddings: Full-precision vectors, one per id.
+        """
+        vectors = np.asarray([np.asarray(e, dtype=np.float32) for e in embeddings], dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                self._log(f"#dim {self.dimension}")
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Expected {self.dimension}-d vectors, got {vectors.shape[1]}-d")
+            self.remove([item_id for item_id in ids if item_id in self._positions])
+
+            # Vectors are written before their ids are logged, so a failure in
+            # between leaves unreferenced trailing rows. Cut them off first so
+            # row N of vectors.f32 is always the N-th logged id.
+            self._truncate_vectors(len(self._ids))
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            for item_id in ids:
+                self._positions[item_id] = len(self._ids)
+                self._ids.append(item_id)
+            self._log("\n".join(f"+{item_id}" for item_id in ids))
+            self._remap(len(self._ids))
+            self._append_codes(vectors)
+
+            if self.mode == "pca" and self._pca_components is None and len(self._positions) >= PCA_FIT_SIZE:
+                self._fit_pca()
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """Tombstone vectors; their space is reclaimed by rebuild()."""
+        with self._lock:
+            for item_id in ids:
+                position = self._positions.pop(item_id, None)
+                if position is not None:
+                    self._ids[position] = None
+                    self._log(f"-{position}")
+
+    def rebuild(self) -> None:
+        """Compact away deleted vectors and, in ``pca`` mode, refit the projection."""
+        with self._lock:
+            if self.dimension is None:
+                return
+            alive = [(index, item_id) for index, item_id in enumerate(self._ids) if item_id is not None]
+            tmp_vectors = self._vectors_path + ".tmp"
+            tmp_ids = self._ids_path + ".tmp"
+            with open(tmp_vectors, "wb") as vf, open(tmp_ids, "w", encoding="utf-8") as idf:
+                idf.write(f"#dim {self.dimension}\n")
+                for start in range(0, len(alive), SCAN_CHUNK):
+                    chunk = alive[start:start + SCAN_CHUNK]
+                    vf.write(np.asarray(self._full[[index for index, _ in chunk]], dtype=np.float32).tobytes())
+                    idf.writelines(f"+{item_id}\n" for _, item_id in chunk)
+            self._full = None
+            os.replace(tmp_vectors, self._vectors_path)
+            os.replace(tmp_ids, self._ids_path)
+            if self.mode == "pca" and os.path.exists(self._pca_path):
+                os.remove(self._pca_path)
+
+            self._ids, self._positions = [], {}
+            self._norms = _GrowableArray(None, np.float32)
+            self._scales = _GrowableArray(None, np.float32)
+            self._codes, self._pca_mean, self._pca_components = None, None, None
+            self._load()
+            if self.mode == "pca" and self._ids:
+                self._fit_pca()
+
+    def backfill(self, collection: Any, batch_size: int = 1000) -> int:
+        """
+        Load vectors already stored in a Chroma collection, without re-embedding.
+
+        Args:
+            collection: ChromaDB collection to copy embeddings from.
+            batch_size: Rows fetched per request.
+
+        Returns:
+            Number of vectors added.
+        """
+        added = 0
+        offset = 0
+        while True:
+            batch = collection.get(offset=offset, limit=batch_size, include=["embeddings"])
+            ids = batch.get("ids") or []
+            if not ids:
+                return added
+            missing = [(item_id, embedding) for item_id, embedding in zip(ids, batch["embeddings"])
+                       if item_id not in self._positions]
+            if missing:
+                self.add([item_id for item_id, _ in missing], [embedding for _, embedding in missing])
+                added += len(missing)
+            offset += len(ids)
+
+    def get(self, ids: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Return the full-precision vectors for ``ids`` (None where unknown)."""
+        with self._lock:
+            return [
+                np.array(self._full[self._positions[item_id]]) if item_id in self._positions else None
+                for item_id in ids
+            ]
+
+    def memory_bytes(self) -> int:
+        """Bytes held in RAM for stage-one scoring (codes, scales, norms, projection)."""
+        total = self._norms.nbytes + self._scales.nbytes
+        if self._codes is not None:
+            total += self._codes.nbytes
+        if self._pca_components is not None:
+            total += self._pca_components.nbytes + self._pca_mean.nbytes
+        return total
+
+    def search(
+        self,
+        query: Sequence[float],
+        k: int = 5,
+        exclude: Optional[Iterable[str]] = None,
+        allowed: Optional[Iterable[str]] = None
+    ) -> Tuple[List[str], List[float]]:
+        """
+        Find the ``k`` nearest vectors to ``query``.
+
+        Args:
+            query: Full-precision query vector.
+            k: Number of results.
+            exclude: Ids to leave out of the results.
+            allowed: If given, only these ids are candidates (e.g. a metadata pre-filter).
+
+        Returns:
+            (ids, distances) sorted by increasing distance.
+        """
+        q = np.asarray(query, dtype=np.float32)
+        with self._lock:
+            if not self._positions:
+                return [], []
+            alive = np.array([item_id is not None for item_id in self._ids])
+            if allowed is not None:
+                permitted = np.zeros(len(self._ids), dtype=bool)
+                permitted[[self._positions[i] for i in allowed if i in self._positions]] = True
+                alive &= permitted
+            for item_id in exclude or ():
+                position = self._positions.get(item_id)
+                if position is not None:
+                    alive[position] = False
+            n_alive = int(alive.sum())
+            if n_alive == 0:
+                return [], []
+
+            with timed("compressed_scan", model=self.mode):
+                approx = self._approximate_distances(q)
+            approx[~alive] = np.inf
+            n_candidates = min(n_alive, max(k * self.oversample, k))
+            candidates = np.argpartition(approx, n_candidates - 1)[:n_candidates]
+            candidates = np.sort(candidates)  # sequential reads from the memory map
+
+            with timed("compressed_rerank", model=self.mode):
+                exact = self._exact_distances(np.asarray(self._full[candidates], dtype=np.float32), q)
+            order = np.argsort(exact)[:k]
+            return [self._ids[candidates[i]] for i in order], [float(exact[i]) for i in order]
+
+    def _approximate_distances(self, q: np.ndarray) -> np.ndarray:
+        norms = self._norms.view
+        if self.mode == "pca" and self._codes is None:
+            # Not enough vectors to fit a projection yet; scan the memory map exactly.
+            dots = np.concatenate([
+                np.asarray(self._full[start:start + SCAN_CHUNK]) @ q
+                for start in range(0, len(self._ids), SCAN_CHUNK)
+            ])
+        elif self.mode == "int8":
+            codes, scales = self._codes.view, self._scales.view
+            dots = np.concatenate([
+                (codes[start:start + SCAN_CHUNK].astype(np.float32) @ q) * (scales[start:start + SCAN_CHUNK] / 127)
+                for start in range(0, len(codes), SCAN_CHUNK)
+            ])
+        elif self.mode == "binary":
+            query_bits = np.packbits(q > 0)
+            hamming = _popcount(np.bitwise_xor(self._codes.view, query_bits)).sum(axis=1)
+            dots = norms * np.linalg.norm(q) * np.cos(np.pi * hamming / self.dimension)
+        else:
+            projected = self._pca_components @ q
+            dots = self._codes.view @ projected + float(self._pca_mean @ q)
+        return self._distance_from_dots(dots, norms, q)
+
+    def _exact_distances(self, vectors: np.ndarray, q: np.ndarray) -> np.ndarray:
+        return self._distance_from_dots(vectors @ q, np.linalg.norm(vectors, axis=1), q)
+
+    def _distance_from_dots(self, dots: np.ndarray, norms: np.ndarray, q: np.ndarray) -> np.ndarray:
+        if self.space == "ip":
+            return (1.0 - dots).astype(np.float64)
+        q_norm = float(np.linalg.norm(q))
+        if self.space == "cosine":
+            denominator = np.maximum(norms * q_norm, 1e-12)
+            return (1.0 - dots / denominator).astype(np.float64)
+        return (norms.astype(np.float64) ** 2 + q_norm ** 2 - 2 * dots).astype(np.float64)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values]
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class CompressedIndexRegistry:
+    """Lazily opens one CompressedVectorIndex per user for a handler."""
+
+    def __init__(self, base_folder: str, mode: str, **options: Any) -> None:
+        """
+        Args:
+            base_folder: Directory under which each user gets a sub-folder.
+            mode: Stage-one representation, one of MODES.
+            **options: Passed through to CompressedVectorIndex.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unsupported compressed index mode: {mode}")
+        self.base_folder = base_folder
+        self.mode = mode
+        self.options = options
+        self._indexes: Dict[str, CompressedVectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def for_user(self, user_id: str, collection: Any = None) -> CompressedVectorIndex:
+        """
+        Return the user's index, opening it on first use.
+
+        Args:
+            user_id: User identifier.
+            collection: The user's Chroma collection; when given and the index is
+                opened empty, vectors already in the collection are backfilled.
+
+        Returns:
+            The user's CompressedVectorIndex.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                index = CompressedVectorIndex(os.path.join(self.base_folder, user_id), self.mode, **self.options)
+                if collection is not None and len(index) == 0 and collection.count() > 0:
+                    index.backfill(collection)
+                self._indexes[user_id] = index
+            return index
+
+    def reset(self) -> None:
+        """Drop every user's index so it is rebuilt from the collections on next use."""
+        with self._lock:
+            self._indexes.clear()
+            shutil.rmtree(self.base_folder, ignore_errors=True)
+
+
+def query_result(
+    collection: Any,
+    ids: List[str],
+    distances: List[float],
+    include: Sequence[str]
+) -> Dict[str, Any]:
+    """
+    Fetch stored fields for ``ids`` and shape them like ``collection.query()`` output.
+
+    Args:
+        collection: ChromaDB collection holding the items.
+        ids: Ranked item ids.
+        distances: Distances matching ``ids``.
+        include: Fields to fetch ("documents", "metadatas", "uris").
+
+    Returns:
+        Dict with single-query nested lists, as returned by Chroma.
+    """
+    fields = [field for field in include if field != "distances"]
+    result: Dict[str, Any] = {"ids": [list(ids)], "distances": [list(distances)]}
+    if not ids:
+        for field in fields:
+            result[field] = [[]]
+        return result
+    fetched = collection.get(ids=list(ids), include=fields)
+    order = {item_id: index for index, item_id in enumerate(fetched["ids"])}
+    for field in fields:
+        values = fetched.get(field) or []
+        result[field] = [[values[order[item_id]] if item_id in order and values else None for item_id in ids]]
+    return result
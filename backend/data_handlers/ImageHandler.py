@@ -6,19 +6,66 @@ import tempfile
 import shutil
 from datetime import datetime
 from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
-from chromadb.utils.data_loaders import ImageLoader
+from helpers.logs import get_logger
+from helpers.metrics import timed, ITEMS_TOTAL
+from helpers import write_events
+from helpers.collection_aliases import ALIASES
+from helpers.hnsw_params import HNSW_SETTINGS
+from helpers.tag_index import tag_fields
+from helpers.item_fields import item_fields
+from helpers.blob_store import TEMP_PREFIX
+from helpers.perceptual_hash import HASH_FIELD, NEAR_DUPLICATES
+from helpers.image_decode import ReducedImageLoader
+from data_handlers.CompressedIndex import query_result
+
+logger = get_logger("handlers.image")
+
+
+class TimedOpenCLIPEmbeddingFunction(OpenCLIPEmbeddingFunction):
+    """OpenCLIP embedding function that records its forward-pass latency."""
+
+    def __call__(self, input):
+        with timed("embed", model="openclip"):
+            return super().__call__(input)
+
 
 class ImageHandler:
-    def __init__(self, client, base_folder='data/images'):
+    def __init__(self, client, base_folder='data/images', embedding_function=None, data_loader=None,
+                 compressed_index=None, blob_store=None, near_duplicates=None, near_duplicate_policy=None,
+                 exact_search=None):
         """
         Initialize the ImageHandler with a ChromaDB client and a base folder for storing images.
         Each user will have a separate subdirectory in this folder.
+
+        Args:
+            client: ChromaDB client.
+            base_folder (str): Folder for the per-user image files.
+            embedding_function (optional): Embedding function to use instead of OpenCLIP.
+            data_loader (optional): Loader that turns URIs into images; defaults to
+                ReducedImageLoader, which decodes at the encoder's input size.
+            compressed_index (CompressedIndexRegistry, optional): When set, searches
+                run against compressed vectors with exact re-ranking.
+            blob_store (BlobStore, optional): When set, image files are stored once in
+                the shared content-addressed store instead of per-user folders.
+            near_duplicates (NearDuplicateIndex, optional): When set, new images are
+                perceptually hashed and checked against the user's library first.
+            near_duplicate_policy (str, optional): What to do with a near duplicate:
+                "link" stores it with the existing item's embedding instead of running
+                the encoder, "skip" returns the existing item's id without storing it
+                (ORBIT_NEAR_DUPLICATE_POLICY, default "link").
+            exact_search (ExactSearch, optional): When set, collections below the
+                exact-search threshold are searched by exhaustive scan.
         """
         self.client = client
         self.base_folder = base_folder
         os.makedirs(self.base_folder, exist_ok=True)
-        self.embedding_function = OpenCLIPEmbeddingFunction()
-        self.data_loader = ImageLoader()
+        self.embedding_function = embedding_function or TimedOpenCLIPEmbeddingFunction()
+        self.data_loader = data_loader or ReducedImageLoader()
+        self.compressed_index = compressed_index
+        self.blob_store = blob_store
+        self.near_duplicates = near_duplicates
+        self.exact_search = exact_search
+        self.near_duplicate_policy = near_duplicate_policy or os.getenv("ORBIT_NEAR_DUPLICATE_POLICY", "link")
 
     def _generate_id(self, image_bytes):
         """
@@ -30,7 +77,8 @@ class ImageHandler:
         Returns:
             str: Unique ID.
         """
-        return hashlib.sha256(image_bytes).hexdigest()
+        with timed("hash", model="image"):
+            return hashlib.sha256(image_bytes).hexdigest()
 
     def _get_user_folder(self, user_id):
         """
@@ -57,14 +105,16 @@ class ImageHandler:
             The user's ChromaDB collection.
         """
         return self.client.get_or_create_collection(
-            name=f'image_collection_{user_id}',
+            name=ALIASES.resolve(f'image_collection_{user_id}'),
             embedding_function=self.embedding_function,
-            data_loader=self.data_loader
+            data_loader=self.data_loader,
+            metadata=HNSW_SETTINGS.collection_metadata('image')
         )
 
     def _sanitize_metadata(self, metadata):
         """
         Sanitize metadata by replacing None values with empty strings and serializing unsupported types.
+        Each tag also gets a boolean ``tag__<tag>`` field so searches can filter on tags.
 
         Args:
             metadata (dict): The metadata dictionary.
@@ -82,17 +132,19 @@ class ImageHandler:
                 try:
                     sanitized[key] = json.dumps(value, ensure_ascii=False)
                 except Exception as e:
-                    print(f"Failed to serialize metadata key '{key}': {e}")
+                    logger.warning("Failed to serialize metadata", extra={"key": key, "error": str(e)})
                     sanitized[key] = ""
+        sanitized.update(tag_fields(metadata.get('tags')))
         return sanitized
 
+    @write_events.gated('image')
     def add_image(self, user_id, image_data, meta=None, source_url=None, title=None):
         """
         Add an image (provided as a data URI) for a specific user to the ChromaDB collection.
 
-        This method decodes the data URI, writes the image bytes to a temporary file,
-        moves the file to a user-specific permanent folder, builds metadata, and then adds
-        the image to the ChromaDB collection using the file's permanent path.
+        This method decodes the data URI, stores the image bytes (in the shared blob
+        store, or via a temporary file moved into the user's folder), builds metadata,
+        and then adds the image to the ChromaDB collection using the file's permanent path.
 
         Args:
             user_id (str): Unique identifier for the user.
@@ -104,6 +156,7 @@ class ImageHandler:
         Returns:
             str: The unique ID of the added image, or None if an error occurs.
         """
+        new_reference = False
         try:
             # Verify that the image_data is a valid data URI.
             if not image_data.startswith("data:image"):
@@ -117,7 +170,8 @@ class ImageHandler:
 
             # Decode the base64-encoded image data.
             try:
-                image_bytes = base64.b64decode(encoded)
+                with timed("decode", model="image"):
+                    image_bytes = base64.b64decode(encoded)
             except Exception as e:
                 raise ValueError("Error decoding base64 image data.") from e
 
@@ -130,22 +184,58 @@ class ImageHandler:
             # Generate a unique ID for the image based on its bytes.
             unique_id = self._generate_id(image_bytes)
 
-            # Write the image bytes to a temporary file.
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_format}") as temp_file:
-                temp_file.write(image_bytes)
-                temp_file_path = temp_file.name
-
-            # Prepare the permanent destination path.
-            user_folder = self._get_user_folder(user_id)
-            permanent_file_name = f"{unique_id}.{file_format}"
-            permanent_path = os.path.join(user_folder, permanent_file_name)
-
-            # Move the temporary file to the permanent location.
-            if not os.path.exists(permanent_path):
-                shutil.move(temp_file_path, permanent_path)
+            # Ids are content hashes and Chroma ignores an add for an existing id,
+            # so saving the same image again changes nothing and publishes nothing.
+            if self._get_user_collection(user_id).get(ids=[unique_id], include=[])['ids']:
+                logger.info("Image already saved", extra={"item_id": unique_id, "user_id": user_id})
+                return unique_id
+
+            # Near duplicates (re-encoded or resized copies) reuse the existing
+            # item instead of another encoder pass.
+            image_hash, duplicate_of, linked_embedding = None, None, None
+            if self.near_duplicates is not None:
+                with timed("hash", model="phash"):
+                    image_hash = self.near_duplicates.hash(image_bytes)
+                match = self.near_duplicates.find(user_id, self._get_user_collection(user_id), image_hash)
+                if match is not None and match[0] != unique_id:
+                    duplicate_of = match[0]
+                    if self.near_duplicate_policy == "skip":
+                        NEAR_DUPLICATES.inc(action="skipped")
+                        logger.info("Near-duplicate image skipped", extra={
+                            "user_id": user_id, "duplicate_of": duplicate_of, "distance": match[1]})
+                        return duplicate_of
+                    stored = self._get_user_collection(user_id).get(ids=[duplicate_of], include=['embeddings'])
+                    if stored['ids'] and stored['embeddings'] is not None and len(stored['embeddings']):
+                        linked_embedding = stored['embeddings'][:1]
+                        NEAR_DUPLICATES.inc(action="linked")
+
+            if self.blob_store is not None:
+                # Identical bytes saved by any user share one file.
+                new_reference = self.blob_store.lookup(user_id, 'image', unique_id) is None
+                with timed("file_write", model="image"):
+                    _, permanent_path = self.blob_store.store_bytes(
+                        user_id, 'image', unique_id, image_bytes, f".{file_format}")
             else:
-                # If the file already exists, remove the temporary file.
-                os.remove(temp_file_path)
+                # Prepare the permanent destination path.
+                user_folder = self._get_user_folder(user_id)
+                permanent_file_name = f"{unique_id}.{file_format}"
+                permanent_path = os.path.join(user_folder, permanent_file_name)
+
+                # Write the image bytes to a temporary file next to it, so the move is a
+                # rename and a failure never leaves a partial file under the final name.
+                with tempfile.NamedTemporaryFile(delete=False, dir=user_folder, prefix=TEMP_PREFIX,
+                                                 suffix=f".{file_format}") as temp_file:
+                    temp_file_path = temp_file.name
+                try:
+                    if not os.path.exists(permanent_path):
+                        with timed("file_write", model="image"):
+                            with open(temp_file_path, 'wb') as f:
+                                f.write(image_bytes)
+                        shutil.move(temp_file_path, permanent_path)
+                finally:
+                    # Left over if the file already existed or the write failed.
+                    if os.path.exists(temp_file_path):
+                        os.remove(temp_file_path)
 
             # Build the metadata dictionary.
             metadata = {
@@ -158,25 +248,42 @@ class ImageHandler:
             }
             if meta:
                 metadata.update(meta)
+            metadata.update(item_fields('image', metadata))
+            if image_hash is not None:
+                metadata[HASH_FIELD] = image_hash
+            if duplicate_of is not None:
+                metadata['duplicate_of'] = duplicate_of
 
             metadata = self._sanitize_metadata(metadata)
-            print(metadata)
+            logger.debug("Image metadata", extra={"metadata": metadata})
 
             # Add the image to the user's ChromaDB collection.
             user_collection = self._get_user_collection(user_id)
-            user_collection.add(
-                ids=[unique_id],
-                uris=[permanent_path],  # Use the permanent file path as the URI.
-                metadatas=[metadata]
-            )
-
-            print(f"Image {unique_id} added successfully for user {user_id}.")
+            embeddings = linked_embedding
+            if embeddings is None and self.compressed_index is not None:
+                embeddings = self.embedding_function(self.data_loader([permanent_path]))
+            with timed("collection_add", model="image"):
+                user_collection.add(
+                    ids=[unique_id],
+                    uris=[permanent_path],  # Use the permanent file path as the URI.
+                    metadatas=[metadata],
+                    embeddings=embeddings
+                )
+            if embeddings is not None and self.compressed_index is not None:
+                self.compressed_index.for_user(user_id, user_collection).add([unique_id], embeddings)
+
+            ITEMS_TOTAL.inc(kind="image", action="add")
+            write_events.publish("image", "add", user_id, unique_id, metadata)
+            logger.info("Image added", extra={"item_id": unique_id, "user_id": user_id})
             return unique_id
         except Exception as e:
-            print(f"Failed to add image for user {user_id}: {e}")
+            if new_reference:
+                # Drop the reference taken above so the blob can be freed.
+                self.blob_store.release(user_id, 'image', unique_id)
+            logger.error("Failed to add image", extra={"user_id": user_id, "error": str(e)})
             return None
 
-    def search_images(self, user_id, query, n_results=5):
+    def search_images(self, user_id, query, n_results=5, where=None):
         """
         Retrieve images for a specific user using a query.
 
@@ -184,22 +291,35 @@ class ImageHandler:
             user_id (str): Unique identifier for the user.
             query (str): Query text to search the user's images.
             n_results (int, optional): Number of results to return (default: 5).
+            where (dict, optional): Chroma metadata filter applied before the vector search.
 
         Returns:
             dict: Query results containing matching images and metadata.
         """
         try:
             user_collection = self._get_user_collection(user_id)
-            results = user_collection.query(
-                query_texts=[query],
-                n_results=n_results,
-                include=['uris', 'metadatas', 'distances']
-            )
+            if self.exact_search is not None and self.exact_search.covers('image', user_id, user_collection):
+                ids, distances = self.exact_search.search('image', user_id, user_collection,
+                                                          self.embedding_function([query])[0], n_results, where)
+                return query_result(user_collection, ids, distances, ['uris', 'metadatas'])
+            if self.compressed_index is not None:
+                index = self.compressed_index.for_user(user_id, user_collection)
+                allowed = user_collection.get(where=where, include=[])['ids'] if where else None
+                ids, distances = index.search(self.embedding_function([query])[0], n_results, allowed=allowed)
+                return query_result(user_collection, ids, distances, ['uris', 'metadatas'])
+            with timed("collection_query", model="image"):
+                results = user_collection.query(
+                    query_texts=[query],
+                    n_results=n_results,
+                    where=where,
+                    include=['uris', 'metadatas', 'distances']
+                )
             return results
         except Exception as e:
-            print(f"Failed to search images for user {user_id}: {e}")
+            logger.error("Failed to search images", extra={"user_id": user_id, "error": str(e)})
             return {}
 
+    @write_events.gated('image')
     def delete_image(self, user_id, image_id):
         """
         Delete an image for a specific user.
@@ -213,18 +333,29 @@ class ImageHandler:
         """
         try:
             user_collection = self._get_user_collection(user_id)
-            # Retrieve the metadata for the image.
-            result = user_collection.get(ids=[image_id])
-            if result and 'metadatas' in result and result['metadatas']:
-                metadata = result['metadatas'][0]
-                file_path = metadata.get('file_path')
-                if file_path and os.path.exists(file_path):
-                    os.remove(file_path)
+            in_blob_store = self.blob_store is not None and self.blob_store.lookup(user_id, 'image', image_id)
+            if not in_blob_store:
+                # Retrieve the metadata for the image.
+                result = user_collection.get(ids=[image_id])
+                if result and 'metadatas' in result and result['metadatas']:
+                    metadata = result['metadatas'][0]
+                    file_path = metadata.get('file_path')
+                    # Files inside the blob store may be shared with other users.
+                    shared = self.blob_store is not None and file_path and self.blob_store.contains(file_path)
+                    if file_path and not shared and os.path.exists(file_path):
+                        os.remove(file_path)
 
             # Delete the image from the ChromaDB collection.
             user_collection.delete(ids=[image_id])
-            print(f"Image {image_id} deleted successfully for user {user_id}.")
+            if in_blob_store:
+                # The blob is only removed once no other item references it.
+                self.blob_store.release(user_id, 'image', image_id)
+            if self.compressed_index is not None:
+                self.compressed_index.for_user(user_id).remove([image_id])
+            ITEMS_TOTAL.inc(kind="image", action="delete")
+            write_events.publish("image", "delete", user_id, image_id)
+            logger.info("Image deleted", extra={"item_id": image_id, "user_id": user_id})
             return True
         except Exception as e:
-            print(f"Failed to delete image {image_id} for user {user_id}: {e}")
+            logger.error("Failed to delete image", extra={"item_id": image_id, "user_id": user_id, "error": str(e)})
             return False
@@ -7,11 +7,22 @@ from data_handlers import *
 from chromadb import PersistentClient
 import torch
 import numpy as np
+from helpers.logs import get_logger
+from helpers.metrics import timed, ITEMS_TOTAL
+from helpers import write_events
+from helpers.collection_aliases import ALIASES
+from helpers.hnsw_params import HNSW_SETTINGS
+from helpers.tag_index import retag_metadata, tag_fields
+from helpers.item_fields import item_fields
+from data_handlers.CompressedIndex import query_result
+
+logger = get_logger("handlers.text")
 
 class MPNetEmbedding:
-    def __init__(self):
+    def __init__(self, model_name="all-mpnet-base-v2"):
         from sentence_transformers import SentenceTransformer
-        self.embedding_model = SentenceTransformer("all-mpnet-base-v2")
+        self.model_name = model_name
+        self.embedding_model = SentenceTransformer(model_name)
 
     def __call__(self, input):
         """
@@ -21,10 +32,10 @@ class MPNetEmbedding:
             input (str or List[str]): Text or list of texts to encode.
             
         Returns:
-            List[List[float]]: List of normalized embedding vectors
+            List[np.ndarray]: List of normalized float32 embedding vectors
         """
         if not input:
-            print("Input is empty!")
+            logger.warning("Embedding requested for empty input")
             return []  # Return empty list for empty input
 
         # Ensure input is a list
@@ -35,31 +46,41 @@ class MPNetEmbedding:
             self.embedding_model.to('cuda')
         
         # Get embeddings
-        embeddings = self.embedding_model.encode(input, convert_to_numpy=True)
-        print(f"Raw embedding shape: {embeddings.shape}")
+        with timed("embed", model="mpnet"):
+            embeddings = self.embedding_model.encode(input, convert_to_numpy=True)
+        logger.debug("Encoded texts", extra={"shape": list(embeddings.shape)})
         
-        # Normalize each embedding and convert to list
-        normalized = []
-        for emb in embeddings:
-            norm = np.linalg.norm(emb)
-            if norm > 0:
-                normalized.append((emb / norm).tolist())
-            else:
-                normalized.append(emb.tolist())
-            
-        return normalized
+        # Normalize all rows at once and hand Chroma float32 arrays directly,
+        # instead of round-tripping every vector through a Python list.
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return list(embeddings / norms)
 
 class TextHandler:
     client: PersistentClient
 
-    def __init__(self, client, base_folder='data/texts'):
+    def __init__(self, client, base_folder='data/texts', embedding_model=None, compressed_index=None,
+                 exact_search=None):
         """
         Initialize the TextHandler with ChromaDB client and a base folder for storing text data.
         Each user will have a separate subdirectory in this folder.
+
+        Args:
+            client: ChromaDB client.
+            base_folder (str): Folder for the per-user text JSON files.
+            embedding_model (optional): Embedding function to use instead of MPNet,
+                e.g. a deterministic stub for benchmarks.
+            compressed_index (CompressedIndexRegistry, optional): When set, searches
+                run against compressed vectors with exact re-ranking.
+            exact_search (ExactSearch, optional): When set, collections below the
+                exact-search threshold are searched by exhaustive scan.
         """
         self.client: PersistentClient = client
         self.base_folder = base_folder
-        self.embedding_model = MPNetEmbedding()
+        self.embedding_model = embedding_model or MPNetEmbedding()
+        self.compressed_index = compressed_index
+        self.exact_search = exact_search
         os.makedirs(self.base_folder, exist_ok=True)
 
     def _generate_id(self, text_content):
@@ -72,7 +93,8 @@ class TextHandler:
         Returns:
             str: Unique ID.
         """
-        return hashlib.sha256(text_content.encode('utf-8')).hexdigest()
+        with timed("hash", model="text"):
+            return hashlib.sha256(text_content.encode('utf-8')).hexdigest()
 
     def _get_user_folder(self, user_id):
         """
@@ -99,9 +121,11 @@ class TextHandler:
             ChromaDB collection for the user.
         """
         return self.client.get_or_create_collection(
-            name=f'text_collection_{user_id}',
-            embedding_function=self.embedding_model
+            name=ALIASES.resolve(f'text_collection_{user_id}'),
+            embedding_function=self.embedding_model,
+            metadata=HNSW_SETTINGS.collection_metadata('text')
         )
+    @write_events.gated('text')
     def add_text(self, user_id, content, source_url=None, title=None, meta=None):
         """
         Add text content for a specific user to the ChromaDB collection.
@@ -118,6 +142,13 @@ class TextHandler:
             # Generate a unique ID for the text
             unique_id = self._generate_id(content)
 
+            # Ids are content hashes and Chroma ignores an add for an existing id,
+            # so saving the same text again changes nothing and publishes nothing.
+            user_collection = self._get_user_collection(user_id)
+            if user_collection.get(ids=[unique_id], include=[])['ids']:
+                logger.info("Text already saved", extra={"item_id": unique_id, "user_id": user_id})
+                return unique_id
+
             # Save text metadata and content to file
             user_folder = self._get_user_folder(user_id)
             file_path = os.path.join(user_folder, f"{unique_id}.json")
@@ -133,37 +164,118 @@ class TextHandler:
             # Merge additional metadata
             if meta:
                 metadata.update(meta)
+            metadata.update(item_fields('text', metadata))
 
             # Sanitize metadata to replace None values
             metadata = self._sanitize_metadata(metadata)
 
-            print(metadata)
+            logger.debug("Text metadata", extra={"metadata": metadata})
             if not os.path.exists(file_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump({
-                        'content': content,
-                        'metadata': metadata
-                    }, f, ensure_ascii=False, indent=2)
-
-            # Add the text to the user's collection
-            user_collection = self._get_user_collection(user_id)
-            user_collection.add(
-                ids=[unique_id],
-                documents=[content],
-                metadatas=metadata
-            )
+                with timed("file_write", model="text"):
+                    with open(file_path, 'w', encoding='utf-8') as f:
+                        json.dump({
+                            'content': content,
+                            'metadata': metadata
+                        }, f, ensure_ascii=False, indent=2)
+
+            # Add the text to the user's collection. In compressed mode the
+            # embedding is computed once and shared with the sidecar index.
+            embeddings = self.embedding_model([content]) if self.compressed_index is not None else None
+            with timed("collection_add", model="text"):
+                user_collection.add(
+                    ids=[unique_id],
+                    documents=[content],
+                    metadatas=metadata,
+                    embeddings=embeddings
+                )
+            if embeddings is not None:
+                self.compressed_index.for_user(user_id, user_collection).add([unique_id], embeddings)
 
-            print(f"Text {unique_id} added successfully for user {user_id}.")
+            ITEMS_TOTAL.inc(kind="text", action="add")
+            write_events.publish("text", "add", user_id, unique_id, metadata)
+            logger.info("Text added", extra={"item_id": unique_id, "user_id": user_id})
             return unique_id
         except Exception as e:
-            print(f"Failed to add text for user {user_id}: {e}")
+            logger.error("Failed to add text", extra={"user_id": user_id, "error": str(e)})
             return None
 
+    @write_events.gated('text')
+    def add_texts(self, user_id, contents, metas=None, ids=None):
+        """
+        Add several texts for a user with one embedding call and one collection write.
+
+        Texts whose id is already in the collection are skipped.
+
+        Args:
+            user_id (str): Unique identifier for the user.
+            contents (List[str]): Text contents to store.
+            metas (List[dict], optional): Per-text metadata, merged over the defaults
+                (``title``, ``source_url`` and any other fields).
+            ids (List[str], optional): Ids to store the texts under (sha256 hex digests).
+                Defaults to each text's content hash.
+
+        Returns:
+            List[str]: Ids of all given texts, in order, including skipped duplicates.
+        """
+        metas = metas or [{} for _ in contents]
+        if ids is None:
+            ids = [self._generate_id(content) for content in contents]
+        try:
+            user_collection = self._get_user_collection(user_id)
+            existing = set(user_collection.get(ids=ids, include=[])['ids']) if ids else set()
+            user_folder = self._get_user_folder(user_id)
+
+            new_ids, new_contents, new_metadatas = [], [], []
+            for unique_id, content, meta in zip(ids, contents, metas):
+                if unique_id in existing or unique_id in new_ids:
+                    continue
+                file_path = os.path.join(user_folder, f"{unique_id}.json")
+                metadata = {
+                    'user_id': user_id,
+                    'source_url': None,
+                    'title': 'Untitled',
+                    'timestamp': datetime.now().isoformat(),
+                    'file_path': file_path
+                }
+                metadata.update(meta)
+                metadata.update(item_fields('text', metadata))
+                metadata = self._sanitize_metadata(metadata)
+                if not os.path.exists(file_path):
+                    with timed("file_write", model="text"):
+                        with open(file_path, 'w', encoding='utf-8') as f:
+                            json.dump({'content': content, 'metadata': metadata}, f, ensure_ascii=False, indent=2)
+                new_ids.append(unique_id)
+                new_contents.append(content)
+                new_metadatas.append(metadata)
+
+            if new_ids:
+                embeddings = self.embedding_model(new_contents)
+                with timed("collection_add", model="text"):
+                    user_collection.add(
+                        ids=new_ids,
+                        documents=new_contents,
+                        metadatas=new_metadatas,
+                        embeddings=embeddings
+                    )
+                if self.compressed_index is not None:
+                    self.compressed_index.for_user(user_id, user_collection).add(new_ids, embeddings)
+
+            ITEMS_TOTAL.inc(len(new_ids), kind="text", action="add")
+            for unique_id, metadata in zip(new_ids, new_metadatas):
+                write_events.publish("text", "add", user_id, unique_id, metadata)
+            logger.info("Texts added", extra={"user_id": user_id, "added": len(new_ids),
+                                              "skipped": len(ids) - len(new_ids)})
+            return ids
+        except Exception as e:
+            logger.error("Failed to add texts", extra={"user_id": user_id, "error": str(e)})
+            return []
+
     def _sanitize_metadata(self, metadata):
         """
         Sanitize metadata by:
         - Replacing None values with an empty string.
         - Serializing unsupported types (e.g., lists, dicts, objects) into JSON strings.
+        - Adding a boolean ``tag__<tag>`` field per tag so searches can filter on tags.
 
         Args:
             metadata (dict): Metadata dictionary to sanitize.
@@ -182,11 +294,12 @@ class TextHandler:
                     # Serialize unsupported types to JSON strings
                     sanitized_metadata[key] = json.dumps(value, ensure_ascii=False)
                 except Exception as e:
-                    print(f"Failed to serialize metadata key '{key}' with value '{value}': {e}")
+                    logger.warning("Failed to serialize metadata", extra={"key": key, "error": str(e)})
                     sanitized_metadata[key] = ""  # Fallback to empty string if serialization fails
+        sanitized_metadata.update(tag_fields(metadata.get('tags')))
         return sanitized_metadata
 
-    def search_texts(self, user_id, query, n_results=5):
+    def search_texts(self, user_id, query, n_results=5, where=None):
         """
         Retrieve texts for a specific user using a query.
 
@@ -194,22 +307,35 @@ class TextHandler:
             user_id (str): Unique identifier for the user.
             query (str): Query text to search the user's texts.
             n_results (int): Number of results to return (default: 5).
+            where (dict, optional): Chroma metadata filter applied before the vector search.
 
         Returns:
             List[Dict]: Matching texts with metadata.
         """
         try:
             user_collection = self._get_user_collection(user_id)
-            results = user_collection.query(
-                query_texts=[query],
-                n_results=n_results,
-                include=['documents', 'metadatas', 'distances']
-            )
+            if self.exact_search is not None and self.exact_search.covers('text', user_id, user_collection):
+                ids, distances = self.exact_search.search('text', user_id, user_collection,
+                                                          self.embedding_model([query])[0], n_results, where)
+                return query_result(user_collection, ids, distances, ['documents', 'metadatas'])
+            if self.compressed_index is not None:
+                index = self.compressed_index.for_user(user_id, user_collection)
+                allowed = user_collection.get(where=where, include=[])['ids'] if where else None
+                ids, distances = index.search(self.embedding_model([query])[0], n_results, allowed=allowed)
+                return query_result(user_collection, ids, distances, ['documents', 'metadatas'])
+            with timed("collection_query", model="text"):
+                results = user_collection.query(
+                    query_texts=[query],
+                    n_results=n_results,
+                    where=where,
+                    include=['documents', 'metadatas', 'distances']
+                )
             return results
         except Exception as e:
-            print(f"Failed to retrieve texts for user {user_id}: {e}")
+            logger.error("Failed to retrieve texts", extra={"user_id": user_id, "error": str(e)})
             return []
 
+    @write_events.gated('text')
     def delete_text(self, user_id, text_id):
         """
         Delete a text entry for a specific user.
@@ -229,10 +355,15 @@ class TextHandler:
 
             # Delete from the user's collection
             user_collection.delete(ids=[text_id])
-            print(f"Text {text_id} deleted successfully for user {user_id}.")
+            if self.compressed_index is not None:
+                self.compressed_index.for_user(user_id).remove([text_id])
+            ITEMS_TOTAL.inc(kind="text", action="delete")
+            write_events.publish("text", "delete", user_id, text_id)
+            logger.info("Text deleted", extra={"item_id": text_id, "user_id": user_id})
         except Exception as e:
-            print(f"Failed to delete text {text_id} for user {user_id}: {e}")
+            logger.error("Failed to delete text", extra={"item_id": text_id, "user_id": user_id, "error": str(e)})
 
+    @write_events.gated('text')
     def update_text(self, user_id, text_id, new_content=None, new_metadata=None):
         """
         Update a text entry for a specific user.
@@ -255,6 +386,9 @@ class TextHandler:
 
             if new_metadata:
                 current_metadata.update(new_metadata)
+                current_metadata = self._sanitize_metadata(current_metadata)
+                if 'tags' in new_metadata:
+                    retag_metadata(current_metadata)
 
             if new_content or new_metadata:
                 # Update the stored file
@@ -270,12 +404,20 @@ class TextHandler:
                         f.truncate()
 
                 # Update the collection
+                embeddings = None
+                if new_content and self.compressed_index is not None:
+                    embeddings = self.embedding_model([new_content])
                 user_collection.update(
                     ids=[text_id],
                     documents=[new_content] if new_content else None,
-                    metadatas=[current_metadata] if new_metadata else None
+                    metadatas=[current_metadata] if new_metadata else None,
+                    embeddings=embeddings
                 )
+                if embeddings is not None:
+                    self.compressed_index.for_user(user_id, user_collection).add([text_id], embeddings)
 
-            print(f"Text {text_id} updated successfully for user {user_id}.")
+            ITEMS_TOTAL.inc(kind="text", action="update")
+            write_events.publish("text", "update", user_id, text_id, current_metadata)
+            logger.info("Text updated", extra={"item_id": text_id, "user_id": user_id})
         except Exception as e:
-            print(f"Failed to update text {text_id} for user {user_id}: {e}")
\ No newline at end of file
+            logger.error("Failed to update text", extra={"item_id": text_id, "user_id": user_id, "error": str(e)})
\ No newline at end of file
@@ -1,3 +1,4 @@
 from .AudioHandler import AudioHandler
 from .TextHandler import TextHandler
-from .ImageHandler import ImageHandler
\ No newline at end of file
+from .ImageHandler import ImageHandler
+from .CompressedIndex import CompressedVectorIndex, CompressedIndexRegistry
@@ -0,0 +1,303 @@
+"""
+Admission control for the in-process encoders.
+
+Every save and search runs a model (MPNet for text, OpenCLIP for images, CLAP
+for audio) on the request thread, so under a burst all requests share a few
+cores and latency grows without bound. Each modality's model gets a gate:
+
+- at most ``limit`` requests run the model at once (ORBIT_ADMISSION_LIMIT_TEXT,
+  _IMAGE, _AUDIO; default 2);
+- up to ``queue_size`` more wait (ORBIT_ADMISSION_QUEUE, default 32), and at
+  most ``user_queue`` of those from one user (ORBIT_ADMISSION_USER_QUEUE,
+  default 8). Anything beyond that is rejected at once;
+- waiters are served searches first, then ingestion, and round-robin across
+  users within each class, so one user's bulk import cannot starve the rest.
+  When the limit is above one, ingestion never takes the last slot, which keeps
+  it free for searches;
+- a waiter that is not admitted before its deadline gives up
+  (ORBIT_ADMISSION_SEARCH_TIMEOUT_S, default 5; ORBIT_ADMISSION_INGEST_TIMEOUT_S,
+  default 30).
+
+A rejection raises Overloaded, which the endpoints turn into ``503`` with a
+``Retry-After`` estimated from the queue depth and recent service times.
+ORBIT_ADMISSION=off admits everything. Queue depths, slots in use, waits and
+rejections are exported as ``orbit_admission_*`` metrics.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
+from helpers.item_fields import KINDS
+from helpers.metrics import REGISTRY
+
+SEARCH = "search"
+INGEST = "ingest"
+PRIORITIES = (SEARCH, INGEST)
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "orbit_admission_queue_depth",
+    "Requests waiting for an encoder slot.",
+    ("kind", "priority"),
+)
+SLOTS_IN_USE = REGISTRY.gauge(
+    "orbit_admission_slots_in_use",
+    "Requests currently running an encoder.",
+    ("kind",),
+)
+WAIT_SECONDS = REGISTRY.histogram(
+    "orbit_admission_wait_seconds",
+    "Time admitted requests waited for an encoder slot.",
+    ("kind", "priority"),
+)
+REJECTIONS = REGISTRY.counter(
+    "orbit_admission_rejections_total",
+    "Requests turned away or abandoned while queued, by reason (queue_full, user_queue_full, deadline, cancelled).",
+    ("kind", "priority", "reason"),
+)
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted; ``retry_after`` is a hint in whole seconds."""
+
+    def __init__(self, kind, reason, retry_after):
+        super().__init__(f"{kind} encoder is overloaded ({reason})")
+        self.kind = kind
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("user_id", "priority", "future", "enqueued")
+
+    def __init__(self, user_id, priority):
+        self.user_id = user_id
+        self.priority = priority
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class ModelGate:
+    """
+    Concurrency limit plus bounded, prioritized, per-user fair wait queue for one encoder.
+
+    Args:
+        kind (str): Modality whose encoder this gate guards.
+        limit (int): Requests that may run the encoder at once.
+        queue_size (int): Requests that may wait, across all users.
+        user_queue (int): Requests that may wait per user.
+    """
+
+    def __init__(self, kind, limit, queue_size, user_queue):
+        self.kind = kind
+        self.limit = max(1, limit)
+        self.queue_size = queue_size
+        self.user_queue = user_queue
+        self.in_use = {priority: 0 for priority in PRIORITIES}
+        # priority -> user -> waiters in arrival order; users are served round-robin.
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._depth = {priority: 0 for priority in PRIORITIES}
+        self._user_depth = {}
+        self._service_seconds = 1.0
+        self._lock = threading.Lock()
+
+    def _can_run(self, priority):
+        running = sum(self.in_use.values())
+        if running >= self.limit:
+            return False
+        # Ingestion leaves the last slot to searches.
+        return priority == SEARCH or self.limit == 1 or self.in_use[INGEST] < self.limit - 1
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up, from queue depth and recent service times."""
+        waiting = sum(self._depth.values())
+        return max(1, min(60, math.ceil(self._service_seconds * (waiting + 1) / self.limit)))
+
+    def request(self, user_id, priority):
+        """
+        Ask for a slot.
+
+        Returns:
+            _Waiter: Its future resolves once the slot is granted.
+
+        Raises:
+            Overloaded: If the wait queue (or the user's share of it) is full.
+        """
+        waiter = _Waiter(user_id, priority)
+        with self._lock:
+            ahead = sum(self._depth[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+            if not ahead and self._can_run(priority):
+                self._grant(waiter)
+                return waiter
+            reason = None
+            if sum(self._depth.values()) >= self.queue_size:
+                reason = "queue_full"
+            elif self._user_depth.get(user_id, 0) >= self.user_queue:
+                reason = "user_queue_full"
+            if reason is not None:
+                REJECTIONS.inc(kind=self.kind, priority=priority, reason=reason)
+                raise Overloaded(self.kind, reason, self.retry_after())
+            self._queues[priority].setdefault(user_id, deque()).append(waiter)
+            self._depth[priority] += 1
+            self._user_depth[user_id] = self._user_depth.get(user_id, 0) + 1
+            QUEUE_DEPTH.set(self._depth[priority], kind=self.kind, priority=priority)
+        return waiter
+
+    def _grant(self, waiter):
+        self.in_use[waiter.priority] += 1
+        SLOTS_IN_USE.set(sum(self.in_use.values()), kind=self.kind)
+        WAIT_SECONDS.observe(time.perf_counter() - waiter.enqueued, kind=self.kind, priority=waiter.priority)
+        waiter.future.set_result(True)
+
+    def _unqueue(self, waiter):
+        users = self._queues[waiter.priority]
+        queue = users.get(waiter.user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del users[waiter.user_id]
+        self._depth[waiter.priority] -= 1
+        self._user_depth[waiter.user_id] -= 1
+        if not self._user_depth[waiter.user_id]:
+            del self._user_depth[waiter.user_id]
+        QUEUE_DEPTH.set(self._depth[waiter.priority], kind=self.kind, priority=waiter.priority)
+
+    def _dispatch(self):
+        for priority in PRIORITIES:
+            users = self._queues[priority]
+            while users and self._can_run(priority):
+                user_id, queue = next(iter(users.items()))
+                waiter = queue[0]
+                self._unqueue(waiter)
+                if user_id in users:
+                    users.move_to_end(user_id)
+                self._grant(waiter)
+            if users:
+                # Lower priorities wait until every waiting search has run.
+                return
+
+    def cancel(self, waiter, reason="deadline"):
+        """
+        Give up on a queued request, after its deadline or because its client went away.
+
+        Returns:
+            bool: True if it was withdrawn; False if it was granted meanwhile (the caller then holds a slot).
+        """
+        with self._lock:
+            if waiter.future.done():
+                return False
+            self._unqueue(waiter)
+            waiter.future.cancel()
+            REJECTIONS.inc(kind=self.kind, priority=waiter.priority, reason=reason)
+            return True
+
+    def release(self, priority, seconds=None):
+        """Return a slot after running for ``seconds`` (None if it went unused) and admit the next waiter(s)."""
+        with self._lock:
+            self.in_use[priority] -= 1
+            SLOTS_IN_USE.set(sum(self.in_use.values()), kind=self.kind)
+            if seconds is not None:
+                self._service_seconds = 0.8 * self._service_seconds + 0.2 * seconds
+            self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_use": dict(self.in_use),
+                "waiting": dict(self._depth),
+                "waiting_users": len(self._user_depth),
+                "queue_size": self.queue_size,
+                "user_queue": self.user_queue,
+                "service_seconds_ewma": round(self._service_seconds, 4),
+                "retry_after": self.retry_after(),
+            }
+
+
+class AdmissionController:
+    """
+    One ModelGate per modality, with the deadlines of each priority class.
+
+    Args:
+        enabled (bool, optional): False admits everything (ORBIT_ADMISSION, default on).
+        limits (dict, optional): kind -> concurrent requests (ORBIT_ADMISSION_LIMIT_<KIND>, default 2).
+        queue_size (int, optional): Waiting requests per modality (ORBIT_ADMISSION_QUEUE, default 32).
+        user_queue (int, optional): Waiting requests per modality and user (ORBIT_ADMISSION_USER_QUEUE, default 8).
+        timeouts (dict, optional): priority -> seconds a request may wait
+            (ORBIT_ADMISSION_SEARCH_TIMEOUT_S 5, ORBIT_ADMISSION_INGEST_TIMEOUT_S 30).
+    """
+
+    def __init__(self, enabled=None, limits=None, queue_size=None, user_queue=None, timeouts=None):
+        if enabled is None:
+            enabled = os.getenv("ORBIT_ADMISSION", "on").lower() not in ("0", "off", "false", "no")
+        self.enabled = enabled
+        limits = limits or {}
+        queue_size = int(queue_size or os.getenv("ORBIT_ADMISSION_QUEUE", "32"))
+        user_queue = int(user_queue or os.getenv("ORBIT_ADMISSION_USER_QUEUE", "8"))
+        self.gates = {
+            kind: ModelGate(kind, int(limits.get(kind) or os.getenv(f"ORBIT_ADMISSION_LIMIT_{kind.upper()}", "2")),
+                            queue_size, user_queue)
+            for kind in KINDS
+        }
+        timeouts = timeouts or {}
+        self.timeouts = {
+            priority: float(timeouts.get(priority) or os.getenv(f"ORBIT_ADMISSION_{priority.upper()}_TIMEOUT_S",
+                                                                "5" if priority == SEARCH else "30"))
+            for priority in PRIORITIES
+        }
+
+    @contextmanager
+    def slot(self, kind, priority, user_id):
+        """
+        Hold one of ``kind``'s encoder slots for the body of a ``with`` block, waiting if needed.
+
+        Raises:
+            Overloaded: If the queue is full or the deadline passes first.
+        """
+        if not self.enabled:
+            yield
+            return
+        gate = self.gates[kind]
+        waiter = gate.request(str(user_id), priority)
+        try:
+            waiter.future.result(timeout=self.timeouts[priority])
+        except TimeoutError:
+            if gate.cancel(waiter):
+                raise Overloaded(kind, "deadline", gate.retry_after()) from None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            gate.release(priority, time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def slot_async(self, kind, priority, user_id):
+        """Async counterpart of slot(): waits on the event loop instead of blocking a thread."""
+        if not self.enabled:
+            yield
+            return
+        gate = self.gates[kind]
+        waiter = gate.request(str(user_id), priority)
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter.future)), self.timeouts[priority])
+        except asyncio.TimeoutError:
+            if gate.cancel(waiter):
+                raise Overloaded(kind, "deadline", gate.retry_after()) from None
+        except asyncio.CancelledError:
+            # The client went away while queued; a slot granted in the meantime is handed straight back.
+            if not gate.cancel(waiter, reason="cancelled"):
+                gate.release(priority)
+            raise
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            gate.release(priority, time.perf_counter() - started)
+
+    def stats(self):
+        return {"enabled": self.enabled, "timeouts": self.timeouts,
+                "gates": {kind: gate.stats() for kind, gate in self.gates.items()}}
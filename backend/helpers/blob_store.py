@@ -0,0 +1,439 @@
+"""
+Content-addressed media storage shared by all users.
+
+Image and audio bytes are stored once under ``<root>/<ab>/<cd>/<sha256><ext>``
+no matter how many users save them. A sqlite table records one reference per
+(user, kind, item); a blob is deleted when its last reference is released.
+
+Files saved before the blob store existed live in per-user folders
+(``data/images/<user>/`` and ``data/audio/<user>/``). The migration moves them
+into the store, deduplicating across users, and repoints the items' paths;
+the checker reports (and optionally repairs) disagreements between the
+reference table and the files on disk:
+
+    python -m helpers.blob_store migrate [--chroma-path OrbitDB] [--keep-originals]
+    python -m helpers.blob_store check [--verify] [--repair]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from helpers.collection_aliases import ALIASES
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("blob_store")
+
+BLOB_KINDS = {"image": "image_collection_", "audio": "audio_collection_"}
+# Metadata field holding the media path, per kind.
+PATH_FIELDS = {"image": "file_path", "audio": "uri"}
+TMP_DIR = "tmp"
+# Prefix of in-progress media writes, so stray ones can be recognised and collected.
+TEMP_PREFIX = ".orbit-tmp-"
+
+BLOB_WRITES = REGISTRY.counter(
+    "orbit_blob_writes_total",
+    "Media stored in the blob store, by outcome (new or deduplicated).",
+    ("outcome",),
+)
+
+
+def _sha256_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """Deduplicated media files with per-item reference counts."""
+
+    def __init__(self, root=None, db_path=None):
+        """
+        Args:
+            root (str, optional): Blob directory (ORBIT_BLOB_ROOT, default "data/blobs").
+            db_path (str, optional): Reference database (ORBIT_BLOB_DB, default "blob_store.db").
+        """
+        self.root = root or os.getenv("ORBIT_BLOB_ROOT", "data/blobs")
+        self.db_path = db_path or os.getenv("ORBIT_BLOB_DB", "blob_store.db")
+        os.makedirs(os.path.join(self.root, TMP_DIR), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " digest TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, created_at INTEGER);"
+            "CREATE TABLE IF NOT EXISTS blob_refs ("
+            " user_id TEXT, kind TEXT, item_id TEXT, digest TEXT NOT NULL, created_at INTEGER,"
+            " PRIMARY KEY (user_id, kind, item_id));"
+            "CREATE INDEX IF NOT EXISTS blob_refs_by_digest ON blob_refs (digest);"
+        )
+        # Reference tables created before references were timestamped.
+        if "created_at" not in {row[1] for row in self._conn.execute("PRAGMA table_info(blob_refs)")}:
+            self._conn.execute("ALTER TABLE blob_refs ADD COLUMN created_at INTEGER")
+        self._conn.commit()
+
+    def path_for(self, digest, extension=""):
+        """Fan-out location of a blob: ``<root>/<ab>/<cd>/<digest><extension>``."""
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}{extension}")
+
+    def contains(self, path):
+        """Whether a path lies inside the blob store."""
+        root = os.path.abspath(self.root)
+        return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+    def store_bytes(self, user_id, kind, item_id, data, extension=""):
+        """
+        Store media bytes and reference them from an item.
+
+        Args:
+            user_id (str): Owner of the item.
+            kind (str): "image" or "audio".
+            item_id (str): Item identifier.
+            data (bytes): Media content.
+            extension (str): File extension including the dot, e.g. ".png".
+
+        Returns:
+            Tuple[str, str]: The blob's SHA-256 digest and path.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        while True:
+            tmp_path = None
+            if not self._known(digest):
+                tmp_path = self._tmp_path()
+                try:
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                except OSError:
+                    os.remove(tmp_path)
+                    raise
+            result = self._commit(user_id, kind, item_id, digest, extension, tmp_path, len(data))
+            if result is not None:
+                return result
+
+    def store_file(self, user_id, kind, item_id, source_path, extension=None, move=False):
+        """
+        Store a media file and reference it from an item.
+
+        Args:
+            user_id (str): Owner of the item.
+            kind (str): "image" or "audio".
+            item_id (str): Item identifier.
+            source_path (str): File to store.
+            extension (str, optional): Extension to use; defaults to the source's.
+            move (bool): Move the source into the store (or delete it if the
+                content is already stored) instead of copying it.
+
+        Returns:
+            Tuple[str, str]: The blob's SHA-256 digest and path.
+        """
+        extension = os.path.splitext(str(source_path))[1] if extension is None else extension
+        digest = _sha256_file(source_path)
+        size = os.path.getsize(source_path)
+        while True:
+            tmp_path = None
+            if not self._known(digest):
+                tmp_path = self._tmp_path()
+                try:
+                    if not move:
+                        shutil.copyfile(source_path, tmp_path)
+                    else:
+                        os.replace(source_path, tmp_path)
+                except OSError:
+                    # The source may be on another filesystem.
+                    shutil.copyfile(source_path, tmp_path)
+            result = self._commit(user_id, kind, item_id, digest, extension, tmp_path, size)
+            if result is not None:
+                break
+        if move and os.path.exists(source_path) and os.path.abspath(source_path) != os.path.abspath(result[1]):
+            os.remove(source_path)
+        return result
+
+    def reference(self, user_id, kind, item_id, digest):
+        """
+        Reference a blob that is already stored from an item, without its bytes.
+
+        Returns:
+            Tuple[str, str] or None: The digest and path, or None if no such blob is stored.
+        """
+        return self._commit(user_id, kind, item_id, digest, "", None, 0)
+
+    def _tmp_path(self):
+        fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=os.path.join(self.root, TMP_DIR))
+        os.close(fd)
+        return tmp_path
+
+    def _known(self, digest):
+        with self._lock:
+            return self._existing_path(digest) is not None
+
+    def _existing_path(self, digest):
+        row = self._conn.execute("SELECT path FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row and os.path.exists(row[0]) else None
+
+    def _commit(self, user_id, kind, item_id, digest, extension, tmp_path, size):
+        """
+        Publish a written temp file (or reuse the existing blob) and record the reference.
+
+        Returns None if the blob was freed between the caller's check and now,
+        in which case the caller writes it again.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            path = self._existing_path(digest)
+            if path is None:
+                if tmp_path is None:
+                    return None
+                path = self.path_for(digest, extension)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                self._conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                                   (digest, path, size, int(time.time())))
+                BLOB_WRITES.inc(outcome="new")
+            else:
+                if tmp_path is not None:
+                    os.remove(tmp_path)
+                BLOB_WRITES.inc(outcome="deduplicated")
+            previous = self._conn.execute(
+                "SELECT digest FROM blob_refs WHERE user_id = ? AND kind = ? AND item_id = ?",
+                (user_id, kind, item_id)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO blob_refs VALUES (?, ?, ?, ?, ?)",
+                               (user_id, kind, item_id, digest, int(time.time())))
+            if previous and previous[0] != digest:
+                self._free_if_unreferenced(previous[0])
+            self._conn.commit()
+            return digest, path
+
+    def release(self, user_id, kind, item_id):
+        """
+        Drop an item's reference, deleting the blob when no references remain.
+
+        Args:
+            user_id (str): Owner of the item.
+            kind (str): "image" or "audio".
+            item_id (str): Item identifier.
+
+        Returns:
+            bool: True if the item referenced a blob.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest FROM blob_refs WHERE user_id = ? AND kind = ? AND item_id = ?",
+                (user_id, kind, item_id)).fetchone()
+            if row is None:
+                return False
+            self._conn.execute("DELETE FROM blob_refs WHERE user_id = ? AND kind = ? AND item_id = ?",
+                               (user_id, kind, item_id))
+            self._free_if_unreferenced(row[0])
+            self._conn.commit()
+            return True
+
+    def _free_if_unreferenced(self, digest):
+        if self.refcount(digest):
+            return False
+        row = self._conn.execute("SELECT path FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        self._conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        if row and os.path.exists(row[0]):
+            os.remove(row[0])
+        logger.debug("Blob freed", extra={"digest": digest})
+        return True
+
+    def refcount(self, digest):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM blob_refs WHERE digest = ?", (digest,)).fetchone()[0]
+
+    def lookup(self, user_id, kind, item_id):
+        """Return ``(digest, path)`` for an item's blob, or None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT b.digest, b.path FROM blob_refs r JOIN blobs b ON b.digest = r.digest"
+                " WHERE r.user_id = ? AND r.kind = ? AND r.item_id = ?",
+                (str(user_id), kind, item_id)).fetchone()
+
+    def refs_for(self, user_id):
+        """
+        Return ``(kind, item_id, digest, created_at)`` for every reference a user holds.
+
+        ``created_at`` is when the reference was taken (None for references
+        recorded before it was tracked).
+        """
+        with self._lock:
+            return self._conn.execute("SELECT kind, item_id, digest, created_at FROM blob_refs WHERE user_id = ?",
+                                      (str(user_id),)).fetchall()
+
+    def stats(self):
+        """Blob count, bytes on disk and references."""
+        with self._lock:
+            blobs, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            refs = self._conn.execute("SELECT COUNT(*) FROM blob_refs").fetchone()[0]
+        return {"blobs": blobs, "bytes": size, "references": refs}
+
+    def check(self, verify=False, repair=False):
+        """
+        Compare the reference tables with the files under the root.
+
+        Args:
+            verify (bool): Re-hash every blob and report content mismatches.
+            repair (bool): Delete orphaned files and unreferenced blobs, and drop
+                missing blobs together with the references to them.
+
+        Returns:
+            dict: Lists of ``missing`` blobs (recorded, file gone), ``orphaned``
+            files (on disk, not recorded), ``unreferenced`` blobs, ``dangling``
+            references and ``corrupt`` blobs.
+        """
+        report = {"missing": [], "orphaned": [], "unreferenced": [], "dangling": [], "corrupt": []}
+        with self._lock:
+            blobs = dict(self._conn.execute("SELECT digest, path FROM blobs"))
+            referenced = {digest for (digest,) in self._conn.execute("SELECT DISTINCT digest FROM blob_refs")}
+            for digest, path in blobs.items():
+                if not os.path.exists(path):
+                    report["missing"].append(digest)
+                elif verify and _sha256_file(path) != digest:
+                    report["corrupt"].append(digest)
+                if digest not in referenced:
+                    report["unreferenced"].append(digest)
+            report["dangling"] = sorted(referenced - set(blobs))
+            known = {os.path.abspath(path) for path in blobs.values()}
+            tmp_root = os.path.abspath(os.path.join(self.root, TMP_DIR))
+            for directory, _, files in os.walk(self.root):
+                if os.path.abspath(directory) == tmp_root:
+                    continue
+                for name in files:
+                    path = os.path.abspath(os.path.join(directory, name))
+                    if path not in known:
+                        report["orphaned"].append(path)
+
+            if repair:
+                for path in report["orphaned"]:
+                    os.remove(path)
+                for digest in report["unreferenced"]:
+                    self._free_if_unreferenced(digest)
+                self._conn.executemany("DELETE FROM blob_refs WHERE digest = ?",
+                                       [(digest,) for digest in report["dangling"] + report["missing"]])
+                self._conn.executemany("DELETE FROM blobs WHERE digest = ?",
+                                       [(digest,) for digest in report["missing"]])
+                self._conn.commit()
+        logger.info("Blob store checked", extra={key: len(value) for key, value in report.items()})
+        return report
+
+
+def migrate_collection(collection, kind, store, user_id, batch_size=500, keep_originals=False, moved=None):
+    """
+    Move one collection's media from per-user folders into the blob store.
+
+    Args:
+        collection: Chroma collection holding image or audio items.
+        kind (str): "image" or "audio".
+        store (BlobStore): Destination store.
+        user_id (str): Owner of the collection.
+        batch_size (int): Items read and updated per page.
+        keep_originals (bool): Copy instead of moving the per-user files.
+        moved (dict, optional): Original path -> blob path, shared across calls so
+            files referenced by several items are only moved once.
+
+    Returns:
+        int: Number of items repointed at a blob.
+    """
+    moved = {} if moved is None else moved
+    field = PATH_FIELDS[kind]
+    migrated, offset = 0, 0
+    while True:
+        page = collection.get(offset=offset, limit=batch_size, include=["metadatas", "uris"])
+        if not page["ids"]:
+            return migrated
+        offset += len(page["ids"])
+        ids, uris, metadatas = [], [], []
+        for item_id, uri, metadata in zip(page["ids"], page["uris"] or [None] * len(page["ids"]),
+                                          page["metadatas"]):
+            metadata = metadata or {}
+            source = uri or metadata.get(field) or metadata.get("file_path") or metadata.get("uri")
+            if not source or store.contains(source):
+                continue
+            source = os.path.abspath(source)
+            if source in moved:
+                # Already moved for another item; only the reference is missing.
+                _, path = store.store_file(user_id, kind, item_id, moved[source])
+            elif os.path.exists(source):
+                _, path = store.store_file(user_id, kind, item_id, source, move=not keep_originals)
+                moved[source] = path
+            else:
+                logger.warning("Media file missing, item left as is",
+                               extra={"kind": kind, "item_id": item_id, "path": source})
+                continue
+            ids.append(item_id)
+            uris.append(path)
+            metadatas.append({field: path})
+        if ids:
+            # Chroma does not re-embed when only URIs and metadata change.
+            collection.update(ids=ids, uris=uris, metadatas=metadatas)
+            migrated += len(ids)
+
+
+def migrate_all(client, store, batch_size=500, keep_originals=False):
+    """
+    Migrate every user's image and audio collection into the blob store.
+
+    Run it while no re-index job is in progress: shadow collections copy the
+    paths they see and are skipped here.
+
+    Args:
+        client: Chroma client.
+        store (BlobStore): Destination store.
+        batch_size (int): Items per page.
+        keep_originals (bool): Leave the per-user files in place.
+
+    Returns:
+        dict: Items migrated per kind.
+    """
+    counts = {kind: 0 for kind in BLOB_KINDS}
+    moved = {}
+    aliases = ALIASES.items()
+    logical_names = {physical: logical for logical, physical in aliases.items()}
+    for entry in client.list_collections():
+        # Chroma 0.6 lists collection names (which raise on .name); older versions
+        # return Collection objects.
+        name = entry if isinstance(entry, str) else entry.name
+        if name in aliases:
+            continue  # replaced by the collection its alias points at
+        logical = logical_names.get(name, name)
+        kind = next((k for k, prefix in BLOB_KINDS.items() if logical.startswith(prefix)), None)
+        if kind is None or (name == logical and "__v" in name):
+            continue  # not media, or a re-index shadow that is still being built
+        user_id = logical[len(BLOB_KINDS[kind]):]
+        counts[kind] += migrate_collection(client.get_collection(name), kind, store, user_id,
+                                           batch_size, keep_originals, moved)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("migrate", "check"))
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--keep-originals", action="store_true", help="Copy rather than move per-user files.")
+    parser.add_argument("--verify", action="store_true", help="Re-hash blobs while checking.")
+    parser.add_argument("--repair", action="store_true", help="Fix what the check finds.")
+    args = parser.parse_args(argv)
+
+    store = BlobStore()
+    if args.command == "migrate":
+        import chromadb
+
+        client = chromadb.PersistentClient(path=args.chroma_path)
+        counts = migrate_all(client, store, args.batch_size, args.keep_originals)
+        logger.info("Blob migration finished", extra={"migrated": counts, **store.stats()})
+    else:
+        report = store.check(verify=args.verify, repair=args.repair)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
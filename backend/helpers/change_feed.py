@@ -0,0 +1,241 @@
+"""
+Per-user change feed for incremental sync.
+
+Every add, update and delete published on the write-event stream is appended
+to a sqlite log (ORBIT_CHANGE_FEED_PATH) under an increasing sequence number.
+A client loads the library once, keeps the ``cursor`` that came with it (see
+/api/populate) and from then on asks /api/changes for what happened after its
+cursor, so keeping a local cache current costs O(changes) rather than a full
+re-download. Three ways to ask:
+
+- ``GET /api/changes?since=<seq>`` returns the changes after ``since`` at once;
+- ``&wait=<seconds>`` long-polls: with nothing new yet, the request is held
+  until a change arrives or the wait runs out;
+- ``Accept: text/event-stream`` (or ``&stream=sse``) keeps a Server-Sent Events
+  stream open, one ``change`` event per item with the sequence number as its
+  ``id``, so EventSource reconnects resume from ``Last-Event-ID``.
+
+Sequence numbers come from one counter shared by all users, so a user's
+numbers increase but have gaps. Entries older than
+ORBIT_CHANGE_FEED_RETENTION_DAYS (default 30) are pruned; a client whose cursor
+predates its user's pruned entries (or that has no cursor) gets ``reset``
+and reloads the library. Waiters are woken in-process, by the writes this
+process makes.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from helpers.item_fields import KINDS
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("change_feed")
+
+SSE_MIMETYPE = "text/event-stream"
+SSE_KEEPALIVE = b": keep-alive\n\n"
+# Entries are pruned once per this many appends.
+PRUNE_EVERY = 1000
+
+APPENDS = REGISTRY.counter(
+    "orbit_change_feed_appends_total",
+    "Changes appended to the feed.",
+    ("kind", "action"),
+)
+WAITERS = REGISTRY.gauge(
+    "orbit_change_feed_waiters",
+    "Long-poll requests and event streams waiting for changes.",
+)
+
+
+def wants_sse(args, accept=""):
+    """Whether a request asked for an event stream, via ``stream=sse`` or the Accept header."""
+    return args.get("stream", "").lower() == "sse" or SSE_MIMETYPE in (accept or "")
+
+
+def sse_event(event, data, event_id=None):
+    """Encode one Server-Sent Event."""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n".encode("utf-8")
+
+
+def sse_page(page):
+    """Encode one changes() result as SSE events: a ``reset``, or one ``change`` per entry."""
+    if page["reset"]:
+        return [sse_event("reset", {"cursor": page["cursor"]}, page["cursor"])]
+    return [sse_event("change", change, change["seq"]) for change in page["changes"]]
+
+
+class ChangeFeed:
+    """Append-only log of item changes per user, persisted in sqlite."""
+
+    def __init__(self, path=None, retention_days=None):
+        """
+        Args:
+            path (str, optional): Database file (ORBIT_CHANGE_FEED_PATH, default "change_feed.db").
+            retention_days (float, optional): Age after which entries are pruned
+                (ORBIT_CHANGE_FEED_RETENTION_DAYS, default 30).
+        """
+        self.path = path or os.getenv("ORBIT_CHANGE_FEED_PATH", "change_feed.db")
+        if retention_days is None:
+            retention_days = float(os.getenv("ORBIT_CHANGE_FEED_RETENTION_DAYS", "30"))
+        self.retention_seconds = retention_days * 86400
+        self._lock = threading.RLock()
+        self._heads = {}  # user -> last sequence number
+        self._waiters = {}  # user -> set of wake-up callbacks
+        self._appended = 0
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, kind TEXT NOT NULL,"
+            " action TEXT NOT NULL, item_id TEXT NOT NULL, metadata TEXT, ts REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS changes_by_user ON changes (user_id, seq);"
+            "CREATE TABLE IF NOT EXISTS change_floors (user_id TEXT PRIMARY KEY, seq INTEGER NOT NULL);"
+        )
+        self._conn.commit()
+
+    def append(self, user_id, kind, action, item_id, metadata=None):
+        """
+        Record one change and wake the user's waiters.
+
+        Returns:
+            int: The change's sequence number.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO changes (user_id, kind, action, item_id, metadata, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, kind, action, item_id, json.dumps(metadata, default=str) if metadata is not None else None,
+                 time.time()),
+            )
+            self._conn.commit()
+            seq = self._heads[user_id] = cursor.lastrowid
+            self._appended += 1
+            if self._appended % PRUNE_EVERY == 0:
+                self.prune()
+            waiters = list(self._waiters.get(user_id, ()))
+        APPENDS.inc(kind=kind, action=action)
+        for wake in waiters:
+            wake()
+        return seq
+
+    def on_write(self, event):
+        """write_events subscriber appending every change."""
+        if event.kind in KINDS:
+            self.append(event.user_id, event.kind, event.action, event.item_id, event.metadata)
+
+    def head(self, user_id):
+        """The user's latest sequence number (0 if they have none); a cursor that is up to date."""
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self._heads:
+                row = self._conn.execute("SELECT MAX(seq) FROM changes WHERE user_id = ?", (user_id,)).fetchone()
+                floor = self._floor(user_id)
+                self._heads[user_id] = max(row[0] or 0, floor)
+            return self._heads[user_id]
+
+    def _floor(self, user_id):
+        row = self._conn.execute("SELECT seq FROM change_floors WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def changes(self, user_id, since, limit=500):
+        """
+        The user's changes after a cursor.
+
+        Several changes to one item within the result collapse into the latest, since a
+        client only needs the item's current state.
+
+        Args:
+            user_id (str): Owner.
+            since (int or None): Cursor from an earlier response or /api/populate; None has none.
+            limit (int): Log entries read at most; ``more`` is set when there are further ones.
+
+        Returns:
+            dict: ``changes`` (``seq``, ``kind``, ``action``, ``id``, ``metadata``, ``ts`` each,
+            oldest first), the new ``cursor``, ``more``, and ``reset`` when the cursor is
+            missing or too old to catch up from, in which case ``changes`` is empty.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            head = self.head(user_id)
+            if since is None or since < self._floor(user_id) or since > head:
+                return {"changes": [], "cursor": head, "more": False, "reset": True}
+            rows = self._conn.execute(
+                "SELECT seq, kind, action, item_id, metadata, ts FROM changes"
+                " WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, since, limit + 1),
+            ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        latest = {}
+        for seq, kind, action, item_id, metadata, ts in rows:
+            latest.pop((kind, item_id), None)
+            latest[(kind, item_id)] = {"seq": seq, "kind": kind, "action": action, "id": item_id,
+                                       "metadata": json.loads(metadata) if metadata else None, "ts": ts}
+        return {"changes": list(latest.values()), "cursor": rows[-1][0] if rows else since, "more": more,
+                "reset": False}
+
+    def prune(self):
+        """Drop entries older than the retention period, remembering how far each user's were dropped."""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            floors = self._conn.execute(
+                "SELECT user_id, MAX(seq) FROM changes WHERE ts < ? GROUP BY user_id", (cutoff,)).fetchall()
+            if not floors:
+                return 0
+            self._conn.executemany(
+                "INSERT INTO change_floors (user_id, seq) VALUES (?, ?)"
+                " ON CONFLICT (user_id) DO UPDATE SET seq = MAX(seq, excluded.seq)", floors)
+            deleted = self._conn.execute("DELETE FROM changes WHERE ts < ?", (cutoff,)).rowcount
+            self._conn.commit()
+        logger.info("Pruned change feed", extra={"entries": deleted, "users": len(floors)})
+        return deleted
+
+    @contextmanager
+    def _waiting(self, user_id, wake):
+        with self._lock:
+            self._waiters.setdefault(user_id, set()).add(wake)
+        WAITERS.inc()
+        try:
+            yield
+        finally:
+            WAITERS.dec()
+            with self._lock:
+                waiters = self._waiters.get(user_id)
+                waiters.discard(wake)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def wait(self, user_id, since, timeout):
+        """
+        Block until the user has changes after ``since`` or ``timeout`` seconds pass.
+
+        Returns:
+            bool: True if there are changes to fetch.
+        """
+        user_id = str(user_id)
+        event = threading.Event()
+        with self._waiting(user_id, event.set):
+            # Registered before checking, so a change landing in between still wakes us.
+            if self.head(user_id) > since:
+                return True
+            event.wait(timeout)
+        return self.head(user_id) > since
+
+    async def wait_async(self, user_id, since, timeout):
+        """Async counterpart of wait(): waits on the event loop instead of blocking a thread."""
+        user_id = str(user_id)
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        with self._waiting(user_id, lambda: loop.call_soon_threadsafe(woken.set)):
+            if self.head(user_id) > since:
+                return True
+            try:
+                await asyncio.wait_for(woken.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.head(user_id) > since
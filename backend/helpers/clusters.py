@@ -0,0 +1,431 @@
+"""
+Background clustering of each user's library, for browsing by group.
+
+A LibraryClusters worker reads a user's stored embeddings for one modality in
+bulk and groups them with mini-batch k-means (about sqrt(n / 2) clusters, at
+most ORBIT_CLUSTER_MAX). Centroids, sizes, a label per cluster (its most common
+tag, else the title of the item nearest its centroid) and every item's cluster
+and distance to its centroid are persisted in sqlite (ORBIT_CLUSTERS_PATH), so
+/api/clusters serves grouped pages without touching the vectors.
+
+Writes are picked up from the write-event stream and applied off the request
+path: a new item is assigned to its nearest centroid, which moves towards it as
+in mini-batch k-means, and deleted items leave their cluster. Once the changes
+since a user's last fit reach ORBIT_CLUSTER_REFIT_FRACTION of their items (or a
+user first has ORBIT_CLUSTER_MIN_ITEMS items) the next sweep, every
+ORBIT_CLUSTER_INTERVAL_S, fits them afresh.
+
+Centroids also give coarse routing: nearest_clusters() ranks a user's clusters
+by distance to a query embedding without searching the items.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from helpers.item_fields import IGNORED_TITLES, KINDS
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY, REQUESTS_IN_FLIGHT, timed
+from helpers.tag_index import parse_tags
+
+logger = get_logger("clusters")
+
+CLUSTER_FITS = REGISTRY.counter(
+    "orbit_cluster_fits_total",
+    "Library clusterings computed by modality and outcome.",
+    ("kind", "outcome"),
+)
+CLUSTER_ASSIGNMENTS = REGISTRY.counter(
+    "orbit_cluster_assignments_total",
+    "Items assigned to an existing clustering as they were written.",
+    ("kind",),
+)
+
+
+def cluster_count(items, max_clusters):
+    """Clusters fitted for a library of ``items`` items."""
+    return min(max_clusters, max(2, int(round(math.sqrt(items / 2)))))
+
+
+def cluster_label(metadatas):
+    """
+    Name a cluster after its members.
+
+    Args:
+        metadatas (list): Member metadata, nearest to the centroid first.
+
+    Returns:
+        str or None: The most common tag (carried by two members or more), else the
+        title of the nearest titled member.
+    """
+    tags = Counter(tag for metadata in metadatas for tag in parse_tags((metadata or {}).get("tags")))
+    if tags:
+        tag, count = tags.most_common(1)[0]
+        if count >= 2 or len(metadatas) == 1:
+            return tag
+    for metadata in metadatas:
+        title = (metadata or {}).get("title")
+        if title and str(title).strip().lower() not in IGNORED_TITLES:
+            return title
+    return None
+
+
+def _squared_distances(vectors, centroids):
+    return np.maximum(np.einsum("ij,ij->i", vectors, vectors)[:, None] + np.einsum("ij,ij->i", centroids, centroids)
+                      - 2 * vectors @ centroids.T, 0)
+
+
+class LibraryClusters:
+    """Per-user, per-modality k-means clusterings, fitted in the background and kept current from write events."""
+
+    def __init__(self, path=None, collection_for=None, list_users=None, interval=None, min_items=None,
+                 max_clusters=None, refit_fraction=None, max_in_flight=None):
+        """
+        Args:
+            path (str, optional): Database file (ORBIT_CLUSTERS_PATH, default "clusters.db").
+            collection_for (Callable[[str, str], Collection]): Returns a user's collection for a kind.
+            list_users (Callable[[], Iterable[str]], optional): Users to consider on each sweep.
+            interval (float, optional): Seconds between sweeps (ORBIT_CLUSTER_INTERVAL_S,
+                default 600; 0 only fits on request).
+            min_items (int, optional): Smallest library that is clustered (ORBIT_CLUSTER_MIN_ITEMS, default 20).
+            max_clusters (int, optional): Most clusters per library (ORBIT_CLUSTER_MAX, default 24).
+            refit_fraction (float, optional): Changes, relative to the items at the last fit,
+                after which a library is fitted again (ORBIT_CLUSTER_REFIT_FRACTION, default 0.25).
+            max_in_flight (int, optional): Sweeps pause while more live requests than this are
+                in flight (ORBIT_CLUSTER_MAX_INFLIGHT, default 2).
+        """
+        self.path = path or os.getenv("ORBIT_CLUSTERS_PATH", "clusters.db")
+        self.collection_for = collection_for
+        self.list_users = list_users
+        self.interval = interval if interval is not None else float(os.getenv("ORBIT_CLUSTER_INTERVAL_S", "600"))
+        self.min_items = min_items or int(os.getenv("ORBIT_CLUSTER_MIN_ITEMS", "20"))
+        self.max_clusters = max_clusters or int(os.getenv("ORBIT_CLUSTER_MAX", "24"))
+        self.refit_fraction = refit_fraction or float(os.getenv("ORBIT_CLUSTER_REFIT_FRACTION", "0.25"))
+        self.max_in_flight = max_in_flight if max_in_flight is not None else int(
+            os.getenv("ORBIT_CLUSTER_MAX_INFLIGHT", "2"))
+        self._lock = threading.Lock()  # the event queue
+        self._db_lock = threading.Lock()
+        # Held while a clustering is fitted or updated, so events and fits apply in order.
+        self._fit_lock = threading.RLock()
+        self._events = {}  # (user, kind) -> {item id: latest action}
+        self._models = {}  # (user, kind) -> (centroids, sizes), loaded on first use
+        self._wake = threading.Event()
+        self._thread = None
+        self.run_status = {"state": "idle"}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS clusterings ("
+            " user_id TEXT, kind TEXT, clusters INTEGER NOT NULL, items INTEGER NOT NULL,"
+            " changes INTEGER NOT NULL, fitted_at REAL NOT NULL, PRIMARY KEY (user_id, kind));"
+            "CREATE TABLE IF NOT EXISTS cluster_centroids ("
+            " user_id TEXT, kind TEXT, cluster INTEGER, size INTEGER NOT NULL, label TEXT, centroid BLOB NOT NULL,"
+            " PRIMARY KEY (user_id, kind, cluster));"
+            "CREATE TABLE IF NOT EXISTS cluster_members ("
+            " user_id TEXT, kind TEXT, item_id TEXT, cluster INTEGER NOT NULL, distance REAL NOT NULL,"
+            " PRIMARY KEY (user_id, kind, item_id));"
+            "CREATE INDEX IF NOT EXISTS cluster_members_by_cluster"
+            " ON cluster_members (user_id, kind, cluster, distance);"
+        )
+        self._conn.commit()
+
+    # ---------------------------------------------------------------- fitting
+
+    def _load(self, collection, batch_size=1000):
+        ids, rows, metadatas = [], [], []
+        offset = 0
+        while True:
+            page = collection.get(offset=offset, limit=batch_size, include=["embeddings", "metadatas"])
+            if not page["ids"]:
+                break
+            ids.extend(page["ids"])
+            rows.append(np.asarray(page["embeddings"], dtype=np.float32))
+            metadatas.extend(page["metadatas"])
+            offset += len(page["ids"])
+        return ids, np.concatenate(rows) if rows else None, metadatas
+
+    def fit(self, user_id, kind):
+        """
+        Cluster one user's library of one modality from scratch and persist the result.
+
+        Returns:
+            int: Clusters fitted; 0 if the library is smaller than ``min_items``.
+        """
+        user_id = str(user_id)
+        with self._fit_lock:
+            started = time.perf_counter()
+            ids, vectors, metadatas = self._load(self.collection_for(kind, user_id))
+            if len(ids) < self.min_items:
+                self._store(user_id, kind, len(ids), None, None, [], [], [])
+                CLUSTER_FITS.inc(kind=kind, outcome="too_small")
+                return 0
+            clusters = cluster_count(len(ids), self.max_clusters)
+            with timed("cluster_fit", model=kind):
+                model = MiniBatchKMeans(n_clusters=clusters, batch_size=min(len(ids), 1024), n_init=3,
+                                        random_state=0)
+                assignments = model.fit_predict(vectors)
+            centroids = model.cluster_centers_.astype(np.float32)
+            distances = np.linalg.norm(vectors - centroids[assignments], axis=1)
+            sizes = np.bincount(assignments, minlength=clusters)
+            labels = []
+            for cluster in range(clusters):
+                members = np.flatnonzero(assignments == cluster)
+                members = members[np.argsort(distances[members])]
+                labels.append(cluster_label([metadatas[member] for member in members[:50]]))
+            self._store(user_id, kind, len(ids), centroids, sizes, labels,
+                        list(zip(ids, assignments.tolist(), distances.tolist())), ids)
+        CLUSTER_FITS.inc(kind=kind, outcome="fitted")
+        logger.info("Library clustered", extra={"user_id": user_id, "kind": kind, "items": len(ids),
+                                                "clusters": clusters,
+                                                "seconds": round(time.perf_counter() - started, 3)})
+        return clusters
+
+    def _store(self, user_id, kind, items, centroids, sizes, labels, members, ids):
+        with self._db_lock:
+            self._conn.execute("DELETE FROM cluster_centroids WHERE user_id = ? AND kind = ?", (user_id, kind))
+            self._conn.execute("DELETE FROM cluster_members WHERE user_id = ? AND kind = ?", (user_id, kind))
+            if centroids is not None:
+                self._conn.executemany(
+                    "INSERT INTO cluster_centroids (user_id, kind, cluster, size, label, centroid)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [(user_id, kind, cluster, int(sizes[cluster]), labels[cluster], centroids[cluster].tobytes())
+                     for cluster in range(len(centroids))])
+                self._conn.executemany(
+                    "INSERT INTO cluster_members (user_id, kind, item_id, cluster, distance) VALUES (?, ?, ?, ?, ?)",
+                    [(user_id, kind, item_id, cluster, distance) for item_id, cluster, distance in members])
+            self._conn.execute(
+                "INSERT OR REPLACE INTO clusterings (user_id, kind, clusters, items, changes, fitted_at)"
+                " VALUES (?, ?, ?, ?, 0, ?)",
+                (user_id, kind, 0 if centroids is None else len(centroids), items, time.time()))
+            self._conn.commit()
+        self._models[(user_id, kind)] = (centroids, sizes) if centroids is not None else None
+
+    def _model(self, user_id, kind):
+        key = (user_id, kind)
+        if key not in self._models:
+            with self._db_lock:
+                rows = self._conn.execute(
+                    "SELECT size, centroid FROM cluster_centroids WHERE user_id = ? AND kind = ? ORDER BY cluster",
+                    key).fetchall()
+            self._models[key] = (np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]),
+                                 np.array([size for size, _ in rows])) if rows else None
+        return self._models[key]
+
+    def invalidate(self, kind):
+        """Drop every clustering of a modality, e.g. after its encoder changed; the next sweep refits."""
+        with self._fit_lock:
+            with self._db_lock:
+                for table in ("clusterings", "cluster_centroids", "cluster_members"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE kind = ?", (kind,))
+                self._conn.commit()
+            for key in [key for key in self._models if key[1] == kind]:
+                del self._models[key]
+
+    # ------------------------------------------------------- incremental updates
+
+    def on_write(self, event):
+        """write_events subscriber queueing the change for the worker."""
+        if event.kind not in KINDS:
+            return
+        with self._lock:
+            self._events.setdefault((str(event.user_id), event.kind), {})[event.item_id] = event.action
+        self._wake.set()
+
+    def _drain(self):
+        with self._lock:
+            events, self._events = self._events, {}
+        for (user_id, kind), actions in events.items():
+            try:
+                self._apply(user_id, kind, actions)
+            except Exception as e:
+                logger.error("Failed to update clusters", extra={"user_id": user_id, "kind": kind, "error": str(e)})
+
+    def _apply(self, user_id, kind, actions):
+        with self._fit_lock:
+            model = self._model(user_id, kind)
+            if model is not None:
+                self._assign(user_id, kind, actions, *model)
+            with self._db_lock:
+                self._conn.execute("UPDATE clusterings SET changes = changes + ? WHERE user_id = ? AND kind = ?",
+                                   (len(actions), user_id, kind))
+                self._conn.commit()
+
+    def _assign(self, user_id, kind, actions, centroids, sizes):
+        ids = list(actions)
+        with self._db_lock:
+            previous = dict(self._conn.execute(
+                f"SELECT item_id, cluster FROM cluster_members WHERE user_id = ? AND kind = ?"
+                f" AND item_id IN ({','.join('?' * len(ids))})", (user_id, kind, *ids)).fetchall())
+        for cluster in previous.values():
+            sizes[cluster] -= 1
+        changed = [item_id for item_id, action in actions.items() if action != "delete"]
+        members = []
+        if changed:
+            found = self.collection_for(kind, user_id).get(ids=changed, include=["embeddings"])
+            if found["ids"]:
+                vectors = np.asarray(found["embeddings"], dtype=np.float32)
+                squared = _squared_distances(vectors, centroids)
+                assignments = squared.argmin(axis=1)
+                for item_id, vector, cluster, row in zip(found["ids"], vectors, assignments, squared):
+                    sizes[cluster] += 1
+                    if item_id not in previous:
+                        # New items pull their centroid towards them, as a mini-batch k-means step would.
+                        centroids[cluster] += (vector - centroids[cluster]) / sizes[cluster]
+                    members.append((user_id, kind, item_id, int(cluster), float(np.sqrt(row[cluster]))))
+                CLUSTER_ASSIGNMENTS.inc(len(members), kind=kind)
+        with self._db_lock:
+            self._conn.executemany("DELETE FROM cluster_members WHERE user_id = ? AND kind = ? AND item_id = ?",
+                                   [(user_id, kind, item_id) for item_id in ids])
+            self._conn.executemany(
+                "INSERT INTO cluster_members (user_id, kind, item_id, cluster, distance) VALUES (?, ?, ?, ?, ?)",
+                members)
+            self._conn.executemany(
+                "UPDATE cluster_centroids SET size = ?, centroid = ? WHERE user_id = ? AND kind = ? AND cluster = ?",
+                [(int(sizes[cluster]), centroids[cluster].tobytes(), user_id, kind, cluster)
+                 for cluster in range(len(centroids))])
+            self._conn.commit()
+
+    # ------------------------------------------------------------------ worker
+
+    def _needs_fit(self, user_id, kind):
+        with self._db_lock:
+            row = self._conn.execute("SELECT clusters, items, changes FROM clusterings WHERE user_id = ? AND kind = ?",
+                                     (user_id, kind)).fetchone()
+        if row is None:
+            return True
+        clusters, items, changes = row
+        if not clusters:
+            return changes > 0 and items + changes >= self.min_items
+        return changes >= self.refit_fraction * items
+
+    def sweep(self, users=None, kinds=KINDS, force=False):
+        """
+        Fit every library that is new or has changed enough since its last fit.
+
+        Args:
+            users (Iterable[str], optional): Users to consider; all of ``list_users()`` by default.
+            kinds (Iterable[str]): Modalities to consider.
+            force (bool): Refit even libraries that are up to date.
+
+        Returns:
+            int: Libraries fitted.
+        """
+        users = sorted(str(user) for user in (users if users is not None else self.list_users()))
+        fitted = 0
+        for user_id in users:
+            for kind in kinds:
+                if not force and not self._needs_fit(user_id, kind):
+                    continue
+                while REQUESTS_IN_FLIGHT.get() > self.max_in_flight:
+                    time.sleep(0.05)
+                try:
+                    self._drain()
+                    self.fit(user_id, kind)
+                    fitted += 1
+                except Exception as e:
+                    CLUSTER_FITS.inc(kind=kind, outcome="failed")
+                    logger.error("Failed to cluster library", extra={"user_id": user_id, "kind": kind,
+                                                                     "error": str(e)})
+        return fitted
+
+    def start(self):
+        """Apply write events and run periodic sweeps on a daemon thread."""
+        self._thread = threading.Thread(target=self._run, name="library-clusters", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        next_sweep = time.monotonic() + min(self.interval, 60) if self.interval > 0 else None
+        while True:
+            timeout = max(next_sweep - time.monotonic(), 0) if next_sweep is not None else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+            self._drain()
+            if next_sweep is not None and time.monotonic() >= next_sweep:
+                self.run_sweep()
+                next_sweep = time.monotonic() + self.interval
+
+    def run_sweep(self, users=None, kinds=KINDS, force=False):
+        """sweep() recording its progress in ``run_status``."""
+        self.run_status = {"state": "running", "started_at": time.time()}
+        try:
+            fitted = self.sweep(users, kinds, force)
+            self.run_status = {"state": "idle", "fitted": fitted, "finished_at": time.time()}
+        except Exception as e:
+            self.run_status = {"state": "failed", "error": str(e), "finished_at": time.time()}
+            logger.error("Cluster sweep failed", extra={"error": str(e)})
+
+    def start_sweep(self, users=None, kinds=KINDS, force=True):
+        """Run a sweep in a background thread now; returns False if one is already running."""
+        if self.run_status.get("state") == "running":
+            return False
+        self.run_status = {"state": "running", "started_at": time.time()}
+        threading.Thread(target=self.run_sweep, args=(users, kinds, force), name="library-clusters-sweep",
+                         daemon=True).start()
+        return True
+
+    # ------------------------------------------------------------------ reads
+
+    def clusters(self, user_id, kinds=KINDS):
+        """
+        A user's clusters, largest first.
+
+        Returns:
+            List[dict]: ``kind``, ``cluster``, ``label`` and ``size`` of each non-empty cluster.
+        """
+        kinds = list(kinds)
+        with self._db_lock:
+            rows = self._conn.execute(
+                f"SELECT kind, cluster, label, size FROM cluster_centroids WHERE user_id = ? AND size > 0"
+                f" AND kind IN ({','.join('?' * len(kinds))}) ORDER BY size DESC, kind, cluster",
+                (str(user_id), *kinds)).fetchall()
+        return [{"kind": kind, "cluster": cluster, "label": label, "size": size} for kind, cluster, label, size in rows]
+
+    def fitted_at(self, user_id):
+        """When each of a user's modalities was last fitted, ``{kind: epoch seconds}``."""
+        with self._db_lock:
+            return dict(self._conn.execute("SELECT kind, fitted_at FROM clusterings WHERE user_id = ?",
+                                           (str(user_id),)).fetchall())
+
+    def members(self, user_id, kind, cluster, offset=0, limit=20):
+        """Ids of a cluster's items, nearest to its centroid first."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT item_id FROM cluster_members WHERE user_id = ? AND kind = ? AND cluster = ?"
+                " ORDER BY distance, item_id LIMIT ? OFFSET ?", (str(user_id), kind, cluster, limit, offset)).fetchall()
+        return [item_id for item_id, in rows]
+
+    def previews(self, user_id, clusters, per_cluster=4):
+        """
+        The ``per_cluster`` items nearest each centroid.
+
+        Args:
+            user_id (str): Owner.
+            clusters (Iterable[Tuple[str, int]]): ``(kind, cluster)`` pairs to preview.
+            per_cluster (int): Items per cluster.
+
+        Returns:
+            dict: ``{(kind, cluster): [ids]}``.
+        """
+        return {(kind, cluster): self.members(user_id, kind, cluster, limit=per_cluster)
+                for kind, cluster in clusters}
+
+    def nearest_clusters(self, user_id, kind, vector, limit=None):
+        """
+        Rank a user's clusters of one modality by the distance of their centroids to ``vector``.
+
+        Returns:
+            List[Tuple[int, float]]: ``(cluster, distance)``, nearest first, empty clusters left out.
+        """
+        with self._fit_lock:
+            model = self._model(str(user_id), kind)
+            if model is None:
+                return []
+            centroids, sizes = model
+            squared = _squared_distances(np.asarray(vector, dtype=np.float32)[None, :], centroids)[0]
+        order = [cluster for cluster in np.argsort(squared) if sizes[cluster] > 0][:limit]
+        return [(int(cluster), float(np.sqrt(squared[cluster]))) for cluster in order]
@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+
+from helpers.logs import get_logger
+
+logger = get_logger("collection_aliases")
+
+
+class CollectionAliases:
+    """
+    Persistent mapping from logical collection names to physical Chroma collections.
+
+    Handlers always ask for a logical name such as ``text_collection_<user>``;
+    background jobs can build a replacement collection under another name and
+    repoint the alias in a single atomic file replace, so readers never see a
+    half-built or missing collection.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): JSON file holding the mapping
+                (ORBIT_COLLECTION_ALIASES, default "collection_aliases.json").
+        """
+        self.path = path or os.getenv("ORBIT_COLLECTION_ALIASES", "collection_aliases.json")
+        self._lock = threading.Lock()
+        self._aliases = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._aliases = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Failed to load collection aliases", extra={"path": self.path, "error": str(e)})
+
+    def resolve(self, name):
+        """Return the physical collection name for a logical one."""
+        return self._aliases.get(name, name)
+
+    def items(self):
+        with self._lock:
+            return dict(self._aliases)
+
+    def update(self, mapping):
+        """
+        Repoint several logical names at once and persist the result atomically.
+
+        Args:
+            mapping (dict): Logical name -> physical name. Mapping a name to itself
+                removes the alias.
+        """
+        with self._lock:
+            aliases = dict(self._aliases)
+            for name, target in mapping.items():
+                if name == target:
+                    aliases.pop(name, None)
+                else:
+                    aliases[name] = target
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(aliases, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            # Swap the dict reference last so concurrent resolve() calls see
+            # either the old or the new mapping, never a mix.
+            self._aliases = aliases
+
+
+ALIASES = CollectionAliases()
@@ -0,0 +1,456 @@
+"""
+HNSW parameters per modality and collection size, exact search for small
+collections, and a tool that tunes the parameters on a user's collection.
+
+Chroma fixes a collection's graph parameters (``hnsw:space``, ``hnsw:M``,
+``hnsw:construction_ef`` and ``hnsw:search_ef``) when the collection is
+created. HNSW_SETTINGS picks them per modality and size tier: the handlers
+create collections with the tier for an empty collection, and a rebuild (a
+re-index job, including a ``{"rebuild": true}`` one that keeps the stored
+embeddings) creates each replacement with the tier matching its size. The
+defaults below can be overridden per modality in ORBIT_HNSW_CONFIG (default
+"hnsw_params.json"):
+
+    {"image": {"space": "cosine", "exact_search_max": 2000,
+               "tiers": [{"max_items": 20000, "M": 16, "construction_ef": 100, "search_ef": 64},
+                         {"max_items": null, "M": 32, "construction_ef": 200, "search_ef": 128}]}}
+
+Collections of at most ``exact_search_max`` items are not searched through the
+graph at all: ExactSearch keeps their vectors in memory and scans them, which
+finds the true nearest neighbours and at that size is faster than a Chroma
+query.
+
+    python -m helpers.hnsw_params show
+    python -m helpers.hnsw_params tune --user <id> --kind text [--k 10] [--save]
+
+``tune`` measures recall@k against brute-force ground truth, and per-query
+latency, for the user's live collection and for a grid of parameters built
+over the same vectors, then recommends the cheapest setting that reaches the
+target recall (``--save`` writes it as the tier for the collection's size).
+Queries are stored vectors, each excluded from its own results.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from helpers.item_fields import KINDS
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY, timed
+
+logger = get_logger("hnsw_params")
+
+SPACES = ("l2", "ip", "cosine")
+GRAPH_PARAMS = ("M", "construction_ef", "search_ef")
+# What Chroma uses for collections created without HNSW metadata.
+CHROMA_DEFAULTS = {"M": 16, "construction_ef": 100, "search_ef": 100}
+# The first tier matches Chroma's own defaults, so new collections behave as before.
+DEFAULT_SETTINGS = {
+    "space": "l2",
+    "exact_search_max": 1000,
+    "tiers": [
+        {"max_items": 10000, "M": 16, "construction_ef": 100, "search_ef": 100},
+        {"max_items": 100000, "M": 24, "construction_ef": 200, "search_ef": 128},
+        {"max_items": None, "M": 32, "construction_ef": 256, "search_ef": 192},
+    ],
+}
+
+EXACT_SEARCHES = REGISTRY.counter(
+    "orbit_exact_searches_total",
+    "Searches answered by scanning a small collection's vectors instead of its HNSW graph.",
+    ("kind",),
+)
+EXACT_CACHE_BYTES = REGISTRY.gauge(
+    "orbit_exact_search_cache_bytes",
+    "Bytes of vectors held in memory for exact search.",
+)
+
+
+class HnswSettings:
+    """HNSW parameters and the exact-search threshold of each modality, with optional overrides from a file."""
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): JSON overrides (ORBIT_HNSW_CONFIG, default "hnsw_params.json").
+        """
+        self.path = path or os.getenv("ORBIT_HNSW_CONFIG", "hnsw_params.json")
+        self._lock = threading.Lock()
+        self._overrides = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._overrides = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Failed to load HNSW settings", extra={"path": self.path, "error": str(e)})
+
+    def settings(self, kind):
+        """The effective ``space``, ``exact_search_max`` and ``tiers`` of a modality."""
+        with self._lock:
+            settings = {**copy.deepcopy(DEFAULT_SETTINGS), **copy.deepcopy(self._overrides.get(kind, {}))}
+        settings["tiers"] = sorted(settings["tiers"], key=lambda tier: (tier.get("max_items") is None,
+                                                                        tier.get("max_items") or 0))
+        return settings
+
+    def space(self, kind):
+        space = self.settings(kind)["space"]
+        if space not in SPACES:
+            raise ValueError(f"Unsupported HNSW space for {kind}: {space}")
+        return space
+
+    def exact_search_max(self, kind):
+        return int(self.settings(kind)["exact_search_max"])
+
+    def tier(self, kind, items=0):
+        """The tier covering a collection of ``items`` items (the largest tier beyond the last bound)."""
+        tiers = self.settings(kind)["tiers"]
+        for tier in tiers:
+            if tier.get("max_items") is None or items <= tier["max_items"]:
+                return tier
+        return tiers[-1]
+
+    def collection_metadata(self, kind, items=0, base=None):
+        """
+        Collection metadata carrying the HNSW parameters for a collection of ``items`` items.
+
+        Args:
+            kind (str): "text", "image" or "audio".
+            items (int): Items the collection is built with; 0 for a new, empty one.
+            base (dict, optional): Existing collection metadata; its non-HNSW keys are kept.
+
+        Returns:
+            dict: Metadata to create the collection with.
+        """
+        tier = self.tier(kind, items)
+        metadata = {key: value for key, value in (base or {}).items() if not key.startswith("hnsw:")}
+        metadata["hnsw:space"] = self.space(kind)
+        for param in GRAPH_PARAMS:
+            if param in tier:
+                metadata[f"hnsw:{param}"] = int(tier[param])
+        return metadata
+
+    def set_tier(self, kind, items, params, exact_search_max=None):
+        """
+        Persist graph parameters for the tier covering ``items`` items.
+
+        Args:
+            kind (str): Modality.
+            items (int): A collection size inside the tier to change.
+            params (dict): ``M``, ``construction_ef`` and/or ``search_ef``.
+            exact_search_max (int, optional): New exact-search threshold of the modality.
+        """
+        with self._lock:
+            kind_settings = copy.deepcopy(self._overrides.get(kind, {}))
+        tiers = self.settings(kind)["tiers"]
+        tier = self.tier(kind, items)
+        position = tiers.index(tier)
+        tiers[position] = {**tier, **{param: int(params[param]) for param in GRAPH_PARAMS if param in params}}
+        kind_settings["tiers"] = tiers
+        if exact_search_max is not None:
+            kind_settings["exact_search_max"] = int(exact_search_max)
+        with self._lock:
+            overrides = {**self._overrides, kind: kind_settings}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(overrides, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self._overrides = overrides
+
+
+HNSW_SETTINGS = HnswSettings()
+
+
+def distances(vectors, query, space="l2"):
+    """Distances from ``query`` to each row of ``vectors`` in Chroma's conventions (squared L2, 1 - ip, 1 - cos)."""
+    dots = vectors @ query
+    if space == "ip":
+        return 1.0 - dots
+    if space == "cosine":
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        return 1.0 - dots / np.maximum(norms, 1e-12)
+    return np.einsum("ij,ij->i", vectors, vectors) + float(query @ query) - 2 * dots
+
+
+def _top_k(dist, k):
+    k = min(k, len(dist))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    candidates = np.argpartition(dist, k - 1)[:k]
+    return candidates[np.argsort(dist[candidates], kind="stable")]
+
+
+def _load_vectors(collection, batch_size=1000):
+    ids, rows = [], []
+    offset = 0
+    while True:
+        page = collection.get(offset=offset, limit=batch_size, include=["embeddings"])
+        if not page["ids"]:
+            break
+        ids.extend(page["ids"])
+        rows.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+    return ids, np.concatenate(rows) if rows else np.empty((0, 0), dtype=np.float32)
+
+
+class _Vectors:
+    __slots__ = ("name", "ids", "positions", "matrix", "space", "nbytes")
+
+    def __init__(self, name, ids, matrix, space):
+        self.name = name
+        self.ids = ids
+        self.positions = {item_id: position for position, item_id in enumerate(ids)}
+        self.matrix = matrix  # None: the collection is too large for exact search
+        self.space = space
+        self.nbytes = matrix.nbytes if matrix is not None else 0
+
+
+class ExactSearch:
+    """
+    Brute-force search over small collections, from vectors cached in memory.
+
+    A user's vectors for one modality are read from their collection on first
+    search and dropped on any write to it (wire ``on_write`` to the write-event
+    stream), so a scan never misses a change. Collections found to be larger
+    than the modality's ``exact_search_max`` are remembered as such until their
+    next write, and searched through HNSW as usual.
+    """
+
+    def __init__(self, settings=None, max_bytes=None):
+        """
+        Args:
+            settings (HnswSettings, optional): Thresholds per modality; HNSW_SETTINGS by default.
+            max_bytes (int, optional): Memory bound of the cached vectors, least recently
+                used users dropped first (ORBIT_EXACT_SEARCH_CACHE_MB, default 256 MiB).
+        """
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("ORBIT_EXACT_SEARCH_CACHE_MB", "256")) * 1024 * 1024)
+        self.settings = settings or HNSW_SETTINGS
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (kind, user) -> _Vectors
+        self._versions = {}  # (kind, user) -> writes seen, so a load that raced a write is not kept
+        self._bytes = 0
+
+    def on_write(self, event):
+        """write_events subscriber dropping the changed collection's vectors."""
+        key = (event.kind, str(event.user_id))
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._drop(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+            EXACT_CACHE_BYTES.set(self._bytes)
+
+    def _vectors(self, kind, user_id, collection, batch_size=1000):
+        key = (kind, str(user_id))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.name == collection.name:
+                self._entries.move_to_end(key)
+                return entry
+            version = self._versions.get(key, 0)
+        limit = self.settings.exact_search_max(kind)
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        if collection.count() > limit:
+            entry = _Vectors(collection.name, [], None, space)
+        else:
+            entry = _Vectors(collection.name, *_load_vectors(collection, batch_size), space)
+        with self._lock:
+            if self._versions.get(key, 0) == version and entry.nbytes <= self.max_bytes:
+                self._drop(key)
+                self._entries[key] = entry
+                self._bytes += entry.nbytes
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._entries)))
+                EXACT_CACHE_BYTES.set(self._bytes)
+        return entry
+
+    def covers(self, kind, user_id, collection):
+        """Whether the collection is small enough to be searched exactly (loading its vectors if so)."""
+        return self._vectors(kind, user_id, collection).matrix is not None
+
+    def search(self, kind, user_id, collection, query, k, where=None):
+        """
+        The ``k`` nearest items to ``query`` by exhaustive scan.
+
+        Args:
+            kind (str): Modality.
+            user_id (str): Owner.
+            collection: The user's collection of that modality.
+            query (Sequence[float]): Query embedding.
+            k (int): Results wanted.
+            where (dict, optional): Chroma metadata filter the results must match.
+
+        Returns:
+            (ids, distances) sorted by increasing distance.
+        """
+        entry = self._vectors(kind, user_id, collection)
+        if entry.matrix is None or not entry.ids:
+            return [], []
+        EXACT_SEARCHES.inc(kind=kind)
+        with timed("exact_search", model=kind):
+            dist = distances(entry.matrix, np.asarray(query, dtype=np.float32), entry.space)
+            if where:
+                allowed = np.zeros(len(entry.ids), dtype=bool)
+                positions = [entry.positions[item_id] for item_id in collection.get(where=where, include=[])["ids"]
+                             if item_id in entry.positions]
+                allowed[positions] = True
+                dist = np.where(allowed, dist, np.inf)
+                k = min(k, len(positions))
+            order = _top_k(dist, k)
+        return [entry.ids[position] for position in order], [float(dist[position]) for position in order]
+
+
+# -------------------------------------------------------------------------------- tuning
+
+def _latency(samples):
+    samples = np.asarray(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(samples, 50)), 3),
+            "p95_ms": round(float(np.percentile(samples, 95)), 3)}
+
+
+def _recall(found, truth):
+    return float(np.mean([len(set(result) & set(expected)) / len(expected)
+                          for result, expected in zip(found, truth) if expected]))
+
+
+def tune(collection, k=10, queries=200, target_recall=0.95, m_values=(16, 32), construction_efs=(100, 200),
+         search_efs=(16, 32, 64, 100, 128, 200, 256), seed=0):
+    """
+    Measure recall@k and latency of a collection's current index and of a parameter grid.
+
+    Args:
+        collection: The Chroma collection to tune.
+        k (int): Neighbours per query.
+        queries (int): Stored vectors sampled as queries.
+        target_recall (float): Recall the recommendation must reach.
+        m_values, construction_efs, search_efs (Sequence[int]): Grid of graph parameters.
+        seed (int): Sampling seed.
+
+    Returns:
+        dict: ``items``, ``space``, ``exact`` and ``current`` measurements, the ``grid``
+        and the ``recommendation``.
+    """
+    import hnswlib
+
+    ids, vectors = _load_vectors(collection)
+    items = len(ids)
+    metadata = collection.metadata or {}
+    space = metadata.get("hnsw:space", "l2")
+    report = {"items": items, "space": space, "k": k}
+    if items <= k:
+        report["recommendation"] = {"exact": True, "reason": "collection smaller than k"}
+        return report
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(items, size=min(queries, items), replace=False)
+
+    # Ground truth and the cost of answering by exhaustive scan.
+    truth, scan = [], []
+    for row in sample:
+        started = time.perf_counter()
+        dist = distances(vectors, vectors[row], space)
+        dist[row] = np.inf
+        truth.append(set(_top_k(dist, k).tolist()))
+        scan.append(time.perf_counter() - started)
+    report["exact"] = {"recall": 1.0, **_latency(scan)}
+
+    # The collection as it is served today.
+    positions = {item_id: position for position, item_id in enumerate(ids)}
+    found, elapsed = [], []
+    for row in sample:
+        started = time.perf_counter()
+        result = collection.query(query_embeddings=[vectors[row]], n_results=k + 1, include=[])
+        elapsed.append(time.perf_counter() - started)
+        found.append([positions[item_id] for item_id in result["ids"][0] if positions.get(item_id) != row][:k])
+    report["current"] = {**{param: metadata.get(f"hnsw:{param}", CHROMA_DEFAULTS[param]) for param in GRAPH_PARAMS},
+                         "recall": round(_recall(found, truth), 4), **_latency(elapsed)}
+
+    grid = []
+    for m in m_values:
+        for construction_ef in construction_efs:
+            index = hnswlib.Index(space=space, dim=vectors.shape[1])
+            index.init_index(max_elements=items, ef_construction=construction_ef, M=m)
+            started = time.perf_counter()
+            index.add_items(vectors, np.arange(items))
+            build_seconds = time.perf_counter() - started
+            index.set_num_threads(1)
+            for search_ef in search_efs:
+                index.set_ef(max(search_ef, k + 1))
+                found, elapsed = [], []
+                for row in sample:
+                    started = time.perf_counter()
+                    labels, _ = index.knn_query(vectors[row:row + 1], k=k + 1)
+                    elapsed.append(time.perf_counter() - started)
+                    found.append([label for label in labels[0].tolist() if label != row][:k])
+                grid.append({"M": m, "construction_ef": construction_ef, "search_ef": search_ef,
+                             "recall": round(_recall(found, truth), 4), "build_seconds": round(build_seconds, 3),
+                             **_latency(elapsed)})
+    report["grid"] = grid
+
+    passing = [entry for entry in grid if entry["recall"] >= target_recall]
+    if not passing:
+        best = max(grid, key=lambda entry: (entry["recall"], -entry["p50_ms"]))
+        report["recommendation"] = {**_params(best), "exact": False,
+                                    "reason": f"no setting reached recall {target_recall}; highest recall shown"}
+    else:
+        best = min(passing, key=lambda entry: (entry["p50_ms"], entry["M"], entry["construction_ef"]))
+        exact = report["exact"]["p50_ms"] <= best["p50_ms"]
+        report["recommendation"] = {**_params(best), "exact": exact,
+                                    "reason": "exhaustive scan is as fast as the graph" if exact else
+                                    f"fastest setting with recall >= {target_recall}"}
+    return report
+
+
+def _params(entry):
+    return {param: entry[param] for param in GRAPH_PARAMS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["show", "tune"])
+    parser.add_argument("--user", help="User whose collection to tune.")
+    parser.add_argument("--kind", choices=KINDS, default="text")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query (recall@k).")
+    parser.add_argument("--queries", type=int, default=200, help="Stored vectors sampled as queries.")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--m", type=int, nargs="+", default=[16, 32], help="M values to try.")
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[16, 32, 64, 100, 128, 200, 256])
+    parser.add_argument("--save", action="store_true",
+                        help="Write the recommended parameters as the tier for the collection's size.")
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        json.dump({kind: HNSW_SETTINGS.settings(kind) for kind in KINDS}, sys.stdout, indent=2)
+        print()
+        return
+    if not args.user:
+        parser.error("tune needs --user")
+    from helpers import shards
+    from helpers.collection_aliases import ALIASES
+    client = shards.ShardRouter().client()
+    collection = client.get_collection(ALIASES.resolve(f"{args.kind}_collection_{args.user}"))
+    report = tune(collection, k=args.k, queries=args.queries, target_recall=args.target_recall,
+                  m_values=args.m, construction_efs=args.construction_ef, search_efs=args.search_ef)
+    if args.save and "grid" in report:
+        recommendation = report["recommendation"]
+        exact_search_max = None
+        if recommendation["exact"]:
+            exact_search_max = max(report["items"], HNSW_SETTINGS.exact_search_max(args.kind))
+        HNSW_SETTINGS.set_tier(args.kind, report["items"], recommendation, exact_search_max=exact_search_max)
+        report["saved"] = {"path": HNSW_SETTINGS.path, **HNSW_SETTINGS.settings(args.kind)}
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Reduced-resolution image decoding for the CLIP encoder.
+
+OpenCLIP resizes every image so its short side is 224 px before embedding, so
+decoding a 48 MP phone photo at full resolution spends most of its CPU time and
+~150 MB of RAM on pixels that are thrown away. ReducedImageLoader is a drop-in
+for Chroma's ImageLoader that
+
+- asks the JPEG decoder for a 1/2, 1/4 or 1/8 scale image (draft mode), never
+  smaller than the model input, so the DCT does most of the downscaling;
+- shrinks whatever was decoded to the model input size straight away, so only
+  small arrays are handed to the encoder;
+- decodes batches in one bounded, long-lived thread pool; and
+- caps the memory in flight: a decode reserves its raw pixel size from a shared
+  budget before it starts, so a batch of huge PNGs (which have no draft mode)
+  is decoded a few at a time rather than all at once.
+
+Configuration: ORBIT_IMAGE_DECODE_SIZE (short side in px, default 224; set it
+to the model's input resolution), ORBIT_IMAGE_DECODE_WORKERS (default: up to 4)
+and ORBIT_IMAGE_DECODE_BUDGET_MB (default 256).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from chromadb.api.types import DataLoader
+from PIL import Image
+
+from helpers.metrics import REGISTRY, timed
+
+DECODED_PIXELS = REGISTRY.counter(
+    "orbit_image_decode_pixels_total",
+    "Pixels in stored images and pixels actually decoded for embedding.",
+    ("stage",),
+)
+
+
+def open_reduced(source, min_side, mode=None):
+    """
+    Open an image with its short side scaled down to about ``min_side`` pixels.
+
+    JPEGs are decoded at the smallest DCT scale that still covers ``min_side``;
+    other formats are decoded in full. Either way the result is then resized so
+    its short side is exactly ``min_side`` (images already smaller are kept).
+
+    Args:
+        source: File path or file object.
+        min_side (int): Target length of the short side in pixels.
+        mode (str, optional): Pixel mode to convert to, e.g. "L" or "RGB".
+
+    Returns:
+        PIL.Image.Image: The loaded, reduced image.
+    """
+    image = Image.open(source)
+    target = _target_size(image.size, min_side)
+    return _resize(_draft(image, target, mode), target, mode)
+
+
+def _target_size(size, min_side):
+    width, height = size
+    scale = min_side / min(width, height)
+    if scale >= 1:
+        return size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _draft(image, target, mode=None):
+    if target != image.size:
+        # Only JPEG implements draft(); it picks the largest 1/n scale no smaller than target.
+        image.draft(mode if mode in ("L", "RGB") else None, target)
+    return image
+
+
+def _resize(image, target, mode=None):
+    if mode is None and image.mode in ("1", "P"):
+        # Palette indices cannot be interpolated; resize the colours instead.
+        mode = "RGBA" if "transparency" in image.info else "RGB"
+    if mode and image.mode != mode:
+        image = image.convert(mode)
+    if image.size != target:
+        # reducing_gap lets Pillow box-reduce by an integer factor before the bicubic pass.
+        image = image.resize(target, Image.BICUBIC, reducing_gap=3.0)
+    else:
+        image.load()
+    return image
+
+
+class _ByteBudget:
+    """Counting semaphore over bytes; a request larger than the budget waits until it can run alone."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, amount):
+        amount = min(amount, self.limit)
+        with self._cond:
+            while self.used and self.used + amount > self.limit:
+                self._cond.wait()
+            self.used += amount
+        return amount
+
+    def release(self, amount):
+        with self._cond:
+            self.used -= amount
+            self._cond.notify_all()
+
+
+class ReducedImageLoader(DataLoader):
+    """
+    Chroma data loader that turns image URIs into arrays already shrunk to the model input size.
+
+    Args:
+        min_side (int, optional): Short side of the decoded images (ORBIT_IMAGE_DECODE_SIZE, default 224).
+        max_workers (int, optional): Decode threads for batches (ORBIT_IMAGE_DECODE_WORKERS,
+            default min(4, CPUs)).
+        budget_mb (int, optional): Raw pixel bytes that may be decoding at once across
+            all threads (ORBIT_IMAGE_DECODE_BUDGET_MB, default 256).
+    """
+
+    def __init__(self, min_side=None, max_workers=None, budget_mb=None):
+        self.min_side = int(min_side or os.getenv("ORBIT_IMAGE_DECODE_SIZE", "224"))
+        self.max_workers = int(max_workers or os.getenv("ORBIT_IMAGE_DECODE_WORKERS")
+                               or min(4, os.cpu_count() or 1))
+        budget_mb = int(budget_mb or os.getenv("ORBIT_IMAGE_DECODE_BUDGET_MB", "256"))
+        self._budget = _ByteBudget(budget_mb * 1024 * 1024)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image-decode")
+            return self._pool
+
+    def load(self, uri):
+        """
+        Decode one image file.
+
+        Args:
+            uri (str): Path of the image, or None.
+
+        Returns:
+            numpy.ndarray or None: Pixel array in the file's own mode, like Chroma's ImageLoader
+                (palette images are expanded to RGB or RGBA).
+        """
+        if uri is None:
+            return None
+        with timed("image_decode", model="reduced"):
+            with Image.open(uri) as image:
+                stored = image.size[0] * image.size[1]
+                target = _target_size(image.size, self.min_side)
+                image = _draft(image, target)
+                # The decoder allocates the draft size for JPEG and the full size otherwise.
+                decoded = image.size[0] * image.size[1]
+                reserved = self._budget.acquire(decoded * len(image.getbands()))
+                try:
+                    pixels = np.array(_resize(image, target))
+                finally:
+                    self._budget.release(reserved)
+        DECODED_PIXELS.inc(stored, stage="stored")
+        DECODED_PIXELS.inc(decoded, stage="decoded")
+        return pixels
+
+    def __call__(self, uris):
+        uris = list(uris)
+        if len(uris) <= 1 or self.max_workers <= 1:
+            return [self.load(uri) for uri in uris]
+        return list(self._executor().map(self.load, uris))
@@ -0,0 +1,307 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("index_residency")
+
+COLD_LOADS = REGISTRY.counter(
+    "orbit_index_cold_loads_total", "Vector segments loaded from disk.")
+EVICTIONS = REGISTRY.counter(
+    "orbit_index_evictions_total", "Vector segments evicted.")
+COLD_LOAD_SECONDS = REGISTRY.histogram(
+    "orbit_index_cold_load_seconds", "Time to load a cold collection's vector segment.")
+
+# Rough per-vector cost of an HNSW entry on top of the raw float32 vector:
+# graph links (M * 2 neighbours on layer 0, 4 bytes each) plus id/label maps.
+HNSW_LINK_BYTES = 16 * 2 * 4
+HNSW_ID_BYTES = 64
+
+
+class _ResidentIndex:
+    """Bookkeeping for one collection whose vector segment is loaded in memory."""
+
+    def __init__(self, collection, count, bytes_per_vector):
+        self.collection = collection
+        self.count = count
+        self.bytes_per_vector = bytes_per_vector
+        self.last_access = time.monotonic()
+
+    @property
+    def estimated_bytes(self):
+        return self.count * self.bytes_per_vector
+
+
+class IndexResidencyManager:
+    """
+    Tracks which per-user collections have their HNSW vector segment resident in
+    memory and evicts idle ones so that the total stays under a memory budget.
+
+    Chroma loads a collection's vector segment the first time it is queried and
+    keeps it until the process exits. This manager records the last access time
+    of every collection handed out by the wrapped client, loads cold collections
+    eagerly (so the cold-load cost is measured in one place), and releases the
+    least recently used segments through Chroma's segment cache once the
+    estimated footprint exceeds the budget or a collection has been idle too long.
+    """
+
+    def __init__(self, client=None, memory_budget_bytes=None, idle_seconds=None):
+        """
+        Args:
+            client (optional): Default ChromaDB client for wrap(). Collections from any local
+                client can be tracked, e.g. one per shard (helpers/shards.py).
+            memory_budget_bytes (int, optional): Upper bound on the estimated size
+                of resident vector segments. Defaults to ORBIT_INDEX_MEMORY_BUDGET_MB.
+            idle_seconds (float, optional): Collections not accessed for this long
+                are evicted regardless of the budget. Defaults to ORBIT_INDEX_IDLE_SECONDS.
+        """
+        if memory_budget_bytes is None:
+            memory_budget_bytes = int(os.getenv("ORBIT_INDEX_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024
+        if idle_seconds is None:
+            idle_seconds = float(os.getenv("ORBIT_INDEX_IDLE_SECONDS", "1800"))
+
+        self.client = client
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+
+        self._resident = OrderedDict()  # collection name -> _ResidentIndex, LRU first
+        self._lock = threading.RLock()
+        self._cold_load_seconds = deque(maxlen=1024)
+        self.cold_loads_total = 0
+        self.evictions_total = 0
+        self.eviction_failures_total = 0
+
+    def wrap(self, client=None):
+        """
+        Return a client proxy that reports every collection it hands out to this manager.
+
+        Args:
+            client: Client to wrap (defaults to the managed client).
+
+        Returns:
+            ResidencyTrackingClient: Drop-in replacement for the ChromaDB client.
+        """
+        return ResidencyTrackingClient(client or self.client, self)
+
+    def touch(self, collection):
+        """
+        Record an access to a collection, loading its vector segment if it is cold.
+
+        Args:
+            collection: ChromaDB collection about to be used. Collections of a
+                Chroma server are ignored; the server manages its own memory.
+        """
+        if not _is_local(collection):
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._resident.get(collection.name)
+        if entry is not None:
+            # Writes reach the collection through the tracking client, so re-counting on
+            # every access keeps the size estimate at most one write behind.
+            count = collection.count()
+            bytes_per_vector = entry.bytes_per_vector or (_bytes_per_vector(collection) if count else 0)
+            with self._lock:
+                entry.collection = collection
+                entry.count = count
+                entry.bytes_per_vector = bytes_per_vector
+                entry.last_access = now
+                if collection.name in self._resident:
+                    self._resident.move_to_end(collection.name)
+                self._evict_idle(now)
+                self._enforce_budget(keep=collection.name)
+            return
+
+        started = time.perf_counter()
+        count, bytes_per_vector = self._load(collection)
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.cold_loads_total += 1
+            self._cold_load_seconds.append(elapsed)
+            COLD_LOADS.inc()
+            COLD_LOAD_SECONDS.observe(elapsed)
+            self._resident[collection.name] = _ResidentIndex(collection, count, bytes_per_vector)
+            self._evict_idle(now)
+            self._enforce_budget(keep=collection.name)
+
+    def prewarm(self, collections):
+        """
+        Load a set of collections ahead of use (e.g. when a user authenticates).
+
+        Args:
+            collections (Iterable): ChromaDB collections to make resident.
+        """
+        for collection in collections:
+            try:
+                self.touch(collection)
+            except Exception as e:
+                logger.warning("Failed to prewarm collection", extra={"collection": collection.name, "error": str(e)})
+
+    def evict_idle(self):
+        """Evict every collection that has been idle for longer than ``idle_seconds``."""
+        with self._lock:
+            self._evict_idle(time.monotonic())
+
+    def forget(self, name):
+        """
+        Drop bookkeeping for a collection that was deleted or renamed.
+
+        Args:
+            name (str): Collection name.
+        """
+        with self._lock:
+            self._resident.pop(name, None)
+
+    def stats(self):
+        """
+        Return residency, eviction and cold-load latency metrics.
+
+        Returns:
+            dict: Aggregate counters; no collection names are included.
+        """
+        with self._lock:
+            latencies = sorted(self._cold_load_seconds)
+            resident_bytes = sum(entry.estimated_bytes for entry in self._resident.values())
+            return {
+                "resident_collections": len(self._resident),
+                "resident_bytes_estimate": resident_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "idle_seconds": self.idle_seconds,
+                "cold_loads_total": self.cold_loads_total,
+                "evictions_total": self.evictions_total,
+                "eviction_failures_total": self.eviction_failures_total,
+                "cold_load_seconds": {
+                    "p50": _percentile(latencies, 0.50),
+                    "p95": _percentile(latencies, 0.95),
+                    "max": latencies[-1] if latencies else 0.0,
+                },
+            }
+
+    def _load(self, collection):
+        """
+        Force the collection's vector segment into memory and estimate its size.
+
+        Fetching a single embedding makes Chroma open the persisted HNSW index.
+
+        Returns:
+            Tuple[int, int]: The number of vectors and the estimated bytes per vector.
+        """
+        count = collection.count()
+        if count == 0:
+            return 0, 0
+        return count, _bytes_per_vector(collection)
+
+    def _evict_idle(self, now):
+        if self.idle_seconds <= 0:
+            return
+        for name, entry in list(self._resident.items()):
+            if now - entry.last_access < self.idle_seconds:
+                # Entries are kept in LRU order, so everything after is newer.
+                break
+            self._evict(name)
+
+    def _enforce_budget(self, keep=None):
+        total = sum(entry.estimated_bytes for entry in self._resident.values())
+        for name in list(self._resident):
+            if total <= self.memory_budget_bytes:
+                break
+            if name == keep:
+                continue
+            estimated_bytes = self._resident[name].estimated_bytes
+            if self._evict(name):
+                total -= estimated_bytes
+
+    def _evict(self, name):
+        """
+        Release a collection's vector segment and drop its bookkeeping.
+
+        Returns:
+            bool: True if the segment was released. A collection whose release failed
+                stays tracked (and counted against the budget) so it is retried later.
+        """
+        entry = self._resident[name]
+        try:
+            _release_vector_segment(entry.collection)
+        except Exception as e:
+            self.eviction_failures_total += 1
+            logger.warning("Failed to evict collection", extra={"collection": name, "error": str(e)})
+            return False
+        del self._resident[name]
+        self.evictions_total += 1
+        EVICTIONS.inc()
+        return True
+
+
+class ResidencyTrackingClient:
+    """ChromaDB client proxy that reports collection accesses to an IndexResidencyManager."""
+
+    def __init__(self, client, residency):
+        self._client = client
+        self._residency = residency
+
+    def get_or_create_collection(self, *args, **kwargs):
+        collection = self._client.get_or_create_collection(*args, **kwargs)
+        self._residency.touch(collection)
+        return collection
+
+    def get_collection(self, *args, **kwargs):
+        collection = self._client.get_collection(*args, **kwargs)
+        self._residency.touch(collection)
+        return collection
+
+    def delete_collection(self, name, *args, **kwargs):
+        self._residency.forget(name)
+        return self._client.delete_collection(name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _is_local(collection):
+    # Collections of a PersistentClient talk to an in-process SegmentAPI; HttpClient ones have no segment manager.
+    return hasattr(getattr(collection, "_client", None), "_manager")
+
+
+def _release_vector_segment(collection):
+    """
+    Unload a collection's vector segment from Chroma's local segment manager.
+
+    This mirrors what Chroma's own LRU segment cache does on eviction: stop the
+    segment instance and drop the cached segment record. The instance is also
+    dropped from the manager's file handle cache, which would otherwise keep the
+    index alive. The next access reloads the persisted index from disk.
+    """
+    from chromadb.types import SegmentScope
+
+    manager = collection._client._manager
+    cache = manager.segment_cache[SegmentScope.VECTOR]
+    with manager._lock:
+        segment = cache.get(collection.id)
+        if segment is None:
+            return
+        if segment["id"] in manager._instances:
+            manager.callback_cache_evict(segment)
+        cache.pop(collection.id)
+        file_handles = getattr(manager, "_vector_instances_file_handle_cache", None)
+        if file_handles is not None:
+            file_handles.cache.pop(collection.id, None)
+        if segment["id"] in manager._instances:
+            raise RuntimeError(f"Vector segment {segment['id']} is still loaded after eviction")
+
+
+def _bytes_per_vector(collection):
+    sample = collection.get(limit=1, include=["embeddings"])
+    embeddings = sample.get("embeddings")
+    dimension = len(embeddings[0]) if embeddings is not None and len(embeddings) else 0
+    return dimension * 4 + HNSW_LINK_BYTES + HNSW_ID_BYTES
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
@@ -0,0 +1,271 @@
+"""
+Uniform, filterable item fields shared by all handlers.
+
+Every item carries a numeric ``created_at`` (Unix epoch seconds) and a
+normalized ``type`` so time-range and type filters can be pushed down into
+Chroma ``where`` clauses. Items saved before these fields existed are
+backfilled from their ISO ``timestamp`` (or the file's modification time):
+
+    python -m helpers.item_fields backfill [--chroma-path OrbitDB]
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from helpers.collection_aliases import ALIASES
+from helpers.logs import get_logger
+
+logger = get_logger("item_fields")
+
+KINDS = ("text", "image", "audio")
+COLLECTION_PREFIXES = {"text": "text_collection_", "image": "image_collection_", "audio": "audio_collection_"}
+# Per-user file folders of each modality, relative to the backend directory.
+DEFAULT_FOLDERS = {"text": "data/texts", "image": "data/images", "audio": "data/audio"}
+# Placeholder titles the handlers store when there is none.
+IGNORED_TITLES = {"untitled", ""}
+
+# Normalized item type -> the modality whose collection holds it.
+ITEM_TYPE_KINDS = {
+    "text": "text",
+    "youtube_video": "text",
+    "webpage": "text",
+    "image": "image",
+    "audio": "audio",
+}
+_TYPE_ALIASES = {"youtube": "youtube_video", "video": "youtube_video", "link": "webpage", "web": "webpage",
+                 "page": "webpage", "note": "text", "photo": "image", "sound": "audio"}
+_RELATIVE_TIME = re.compile(r"^(\d+(?:\.\d+)?)\s*([smhdw])$")
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def normalize_type(kind, value=None):
+    """
+    Normalize an item type, falling back to the modality.
+
+    Args:
+        kind (str): "text", "image" or "audio".
+        value (str, optional): Type supplied by the client, e.g. "YouTube_Video".
+
+    Returns:
+        str: One of ITEM_TYPE_KINDS, or the cleaned value if it is unknown.
+    """
+    value = str(value or "").strip().lower().replace("-", "_").replace(" ", "_")
+    value = _TYPE_ALIASES.get(value, value)
+    return value or kind
+
+
+def item_fields(kind, metadata=None, created_at=None):
+    """
+    Return the ``created_at`` and ``type`` fields for a new item.
+
+    Args:
+        kind (str): Modality of the item.
+        metadata (dict, optional): Metadata being stored; its ``type`` is normalized.
+        created_at (float, optional): Creation time; defaults to now.
+
+    Returns:
+        dict: ``{"created_at": int, "type": str}``.
+    """
+    return {
+        "created_at": int(created_at if created_at is not None else time.time()),
+        "type": normalize_type(kind, (metadata or {}).get("type")),
+    }
+
+
+def parse_time(value, now=None, granularity=None):
+    """
+    Parse a time filter value.
+
+    Accepts Unix epoch seconds, ISO 8601 dates or datetimes, and relative
+    durations such as ``30m``, ``24h``, ``7d`` or ``2w`` (meaning that long ago).
+
+    Args:
+        value (str): Raw value.
+        now (float, optional): Reference time for relative values.
+        granularity (int, optional): Round relative values down to a multiple of this
+            many seconds. Absolute values are returned as given.
+
+    Returns:
+        int or None: Epoch seconds, or None for an empty value.
+
+    Raises:
+        ValueError: If the value cannot be parsed.
+    """
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    relative = _RELATIVE_TIME.match(value.lower())
+    if relative:
+        now = time.time() if now is None else now
+        parsed = int(now - float(relative.group(1)) * _UNIT_SECONDS[relative.group(2)])
+        return parsed - parsed % granularity if granularity else parsed
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+
+def build_where(tags=None, since=None, until=None, item_types=None):
+    """
+    Combine tag, time-range and type filters into one Chroma ``where`` clause.
+
+    Args:
+        tags (Iterable[str], optional): Tags every item must carry.
+        since (int, optional): Minimum ``created_at`` (inclusive).
+        until (int, optional): Maximum ``created_at`` (inclusive).
+        item_types (Iterable[str], optional): Allowed normalized types.
+
+    Returns:
+        dict or None: The clause, or None when nothing is filtered.
+    """
+    # Imported here: tag_index takes KINDS from this module.
+    from helpers.tag_index import tag_where
+
+    clauses = []
+    tag_clause = tag_where(tags or [])
+    if tag_clause:
+        clauses.extend(tag_clause.get("$and", [tag_clause]))
+    if since is not None:
+        clauses.append({"created_at": {"$gte": int(since)}})
+    if until is not None:
+        clauses.append({"created_at": {"$lte": int(until)}})
+    if item_types:
+        item_types = sorted(set(item_types))
+        clauses.append({"type": item_types[0]} if len(item_types) == 1 else {"type": {"$in": item_types}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def kinds_for_types(kinds, item_types):
+    """Drop modalities that cannot hold any of the requested item types."""
+    if not item_types:
+        return list(kinds)
+    wanted = {ITEM_TYPE_KINDS.get(item_type) for item_type in item_types}
+    # Unknown types could live anywhere.
+    if None in wanted:
+        return list(kinds)
+    return [kind for kind in kinds if kind in wanted]
+
+
+def created_at_for(metadata):
+    """Best-effort creation time of a legacy item: its ISO timestamp, else its file's mtime."""
+    timestamp = metadata.get("timestamp")
+    if timestamp:
+        try:
+            return datetime.fromisoformat(str(timestamp)).timestamp()
+        except ValueError:
+            pass
+    path = metadata.get("file_path") or metadata.get("uri")
+    if path and os.path.exists(path):
+        return os.path.getmtime(path)
+    return time.time()
+
+
+def backfill_collection(collection, kind, batch_size=500):
+    """
+    Add ``created_at`` and a normalized ``type`` to items that lack them.
+
+    Args:
+        collection: Chroma collection.
+        kind (str): Modality of the collection.
+        batch_size (int): Items read and updated per page.
+
+    Returns:
+        int: Number of items updated.
+    """
+    updated, offset = 0, 0
+    while True:
+        page = collection.get(offset=offset, limit=batch_size, include=["metadatas"])
+        if not page["ids"]:
+            return updated
+        offset += len(page["ids"])
+        ids, metadatas = [], []
+        for item_id, metadata in zip(page["ids"], page["metadatas"]):
+            metadata = metadata or {}
+            item_type = normalize_type(kind, metadata.get("type"))
+            if isinstance(metadata.get("created_at"), (int, float)) and metadata.get("type") == item_type:
+                continue
+            fields = {"type": item_type}
+            if not isinstance(metadata.get("created_at"), (int, float)):
+                fields["created_at"] = int(created_at_for(metadata))
+            ids.append(item_id)
+            metadatas.append(fields)
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+            updated += len(ids)
+
+
+def backfill_all(client, batch_size=500):
+    """
+    Backfill every handler collection known to a Chroma client.
+
+    Args:
+        client: Chroma client.
+        batch_size (int): Items per page.
+
+    Returns:
+        dict: Items updated per kind.
+    """
+    counts = {kind: 0 for kind in COLLECTION_PREFIXES}
+    physical = set(ALIASES.items().values())
+    for entry in client.list_collections():
+        # Chroma 0.6 lists collection names (which raise on .name); older versions
+        # return Collection objects.
+        name = entry if isinstance(entry, str) else entry.name
+        kind = next((k for k, prefix in COLLECTION_PREFIXES.items() if name.startswith(prefix)), None)
+        # Skip collections that an alias has replaced (e.g. mid re-index).
+        if kind is None or (name != ALIASES.resolve(name) and name not in physical):
+            continue
+        counts[kind] += backfill_collection(client.get_collection(name), kind, batch_size)
+    return counts
+
+
+def start_backfill(client, marker_path=None):
+    """
+    Run backfill_all() once on a daemon thread, recording completion in a marker file.
+
+    Args:
+        client: Chroma client.
+        marker_path (str, optional): Marker file (ORBIT_ITEM_FIELDS_MARKER,
+            default "item_fields_backfill.done").
+
+    Returns:
+        threading.Thread or None: The worker, or None if the backfill already ran.
+    """
+    marker_path = marker_path or os.getenv("ORBIT_ITEM_FIELDS_MARKER", "item_fields_backfill.done")
+    if os.path.exists(marker_path):
+        return None
+
+    def run():
+        try:
+            counts = backfill_all(client)
+            with open(marker_path, "w", encoding="utf-8") as f:
+                f.write(f"{int(time.time())}\n")
+            logger.info("Item field backfill finished", extra={"updated": counts})
+        except Exception as e:
+            logger.error("Item field backfill failed", extra={"error": str(e)})
+
+    thread = threading.Thread(target=run, name="item-fields-backfill", daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("backfill",))
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    import chromadb
+
+    counts = backfill_all(chromadb.PersistentClient(path=args.chroma_path), args.batch_size)
+    logger.info("Item field backfill finished", extra={"updated": counts})
+
+
+if __name__ == "__main__":
+    main()
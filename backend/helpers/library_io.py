@@ -0,0 +1,374 @@
+"""
+Columnar export and import of a user's Orbit library.
+
+Items from the text, image and audio collections are streamed as Arrow record
+batches (one batch per page of one collection) with their ids, documents,
+metadata, stored embeddings and media references, optionally with the media
+bytes inline. Export never materialises the whole library; import writes the
+stored vectors straight back with upsert, so nothing is re-embedded.
+
+Imported files are untrusted: ids must be SHA-256 hex digests (what the
+handlers generate), every path is built on the server, and media is only
+imported from its inline bytes, or by digest when the same content is already
+in the blob store. Paths in the file are never kept.
+
+    python -m helpers.library_io export --user <id> --out library.parquet [--include-media]
+    python -m helpers.library_io import --user <id> --in library.parquet
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from helpers import write_events
+from helpers.blob_store import PATH_FIELDS, BlobStore
+from helpers.collection_aliases import ALIASES
+from helpers.hnsw_params import HNSW_SETTINGS
+from helpers.logs import get_logger
+from helpers.tag_index import tag_fields
+from helpers.item_fields import COLLECTION_PREFIXES, DEFAULT_FOLDERS, KINDS, created_at_for, normalize_type
+
+logger = get_logger("library_io")
+
+_ITEM_ID = re.compile(r"^[0-9a-f]{64}$")
+# Extensions imported media may be stored under; anything else gets the kind's default.
+MEDIA_EXTENSIONS = {
+    "image": (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp"),
+    "audio": (".wav", ".mp3", ".flac", ".ogg", ".m4a"),
+}
+
+SCHEMA = pa.schema([
+    pa.field("kind", pa.string(), nullable=False),
+    pa.field("id", pa.string(), nullable=False),
+    pa.field("document", pa.string()),
+    pa.field("metadata", pa.string()),  # JSON object
+    pa.field("embedding", pa.list_(pa.float32())),
+    pa.field("uri", pa.string()),
+    pa.field("media", pa.binary()),
+])
+
+
+def export_record_batches(collection_for, user_id, kinds=KINDS, batch_size=512, include_media=False):
+    """
+    Yield a user's items as Arrow record batches, one page of one collection at a time.
+
+    Args:
+        collection_for (Callable[[str, str], Collection]): Returns the user's collection for a kind.
+        user_id (str): Owner of the library.
+        kinds (Iterable[str]): Modalities to export.
+        batch_size (int): Items per record batch.
+        include_media (bool): Embed image/audio file bytes in the ``media`` column.
+
+    Yields:
+        pyarrow.RecordBatch: Batches conforming to SCHEMA.
+    """
+    for kind in kinds:
+        collection = collection_for(kind, user_id)
+        offset = 0
+        while True:
+            page = collection.get(
+                offset=offset,
+                limit=batch_size,
+                include=["documents", "metadatas", "embeddings", "uris"]
+            )
+            ids = page.get("ids") or []
+            if not ids:
+                break
+            offset += len(ids)
+
+            metadatas = page.get("metadatas") or [None] * len(ids)
+            documents = page.get("documents") or [None] * len(ids)
+            uris = page.get("uris") or [None] * len(ids)
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+
+            media_refs = [uri or (metadata or {}).get("file_path") or None
+                          for uri, metadata in zip(uris, metadatas)]
+            media = [None] * len(ids)
+            if include_media and kind != "text":
+                media = [_read_file(path) for path in media_refs]
+
+            dimension = embeddings.shape[1] if embeddings.ndim == 2 else 0
+            embedding_array = pa.ListArray.from_arrays(
+                pa.array(np.arange(len(ids) + 1, dtype=np.int32) * dimension),
+                pa.array(embeddings.reshape(-1), type=pa.float32()),
+            )
+            yield pa.RecordBatch.from_arrays([
+                pa.array([kind] * len(ids), pa.string()),
+                pa.array(ids, pa.string()),
+                pa.array(documents, pa.string()),
+                pa.array([json.dumps(metadata, ensure_ascii=False) if metadata is not None else None
+                          for metadata in metadatas], pa.string()),
+                embedding_array,
+                pa.array(media_refs, pa.string()),
+                pa.array(media, pa.binary()),
+            ], schema=SCHEMA)
+
+
+def _read_file(path):
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return None
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that buffers output until the caller drains it."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_export(batches, file_format="parquet"):
+    """
+    Serialize record batches incrementally, yielding bytes as each batch is written.
+
+    Args:
+        batches (Iterable[pyarrow.RecordBatch]): Output of export_record_batches().
+        file_format (str): "parquet" or "arrow" (Arrow IPC stream).
+
+    Yields:
+        bytes: Chunks of the encoded file.
+    """
+    sink = _ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, SCHEMA, compression="zstd")
+    elif file_format == "arrow":
+        writer = pa.ipc.new_stream(sink, SCHEMA)
+    else:
+        raise ValueError(f"Unsupported export format: {file_format}")
+    for batch in batches:
+        writer.write_batch(batch)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+
+def read_batches(source, batch_size=512):
+    """
+    Read record batches from a Parquet file or an Arrow IPC stream.
+
+    Args:
+        source: Path or binary file object; Parquet input must be seekable.
+        batch_size (int): Rows per batch when reading Parquet.
+
+    Yields:
+        pyarrow.RecordBatch
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from read_batches(f, batch_size)
+        return
+    magic = source.read(4)
+    source.seek(0)
+    if magic == b"PAR1":
+        yield from pq.ParquetFile(source).iter_batches(batch_size=batch_size)
+    else:
+        yield from pa.ipc.open_stream(source)
+
+
+def import_record_batches(batches, collection_for, folder_for, user_id, on_vectors=None, blob_store=None):
+    """
+    Load exported batches into a user's collections without re-embedding.
+
+    Text items get their JSON file rewritten under the user's text folder; image
+    and audio media carried inline is written (content-addressed) to the blob
+    store, or the user's folder without one, and the stored paths are updated.
+    Items already present are replaced.
+
+    Args:
+        batches (Iterable[pyarrow.RecordBatch]): Batches conforming to SCHEMA.
+        collection_for (Callable[[str, str], Collection]): Returns the user's collection for a kind.
+        folder_for (Callable[[str, str], str]): Returns the user's storage folder for a kind.
+        user_id (str): Owner to import into (may differ from the exporting user).
+        on_vectors (Callable, optional): Called as on_vectors(kind, ids, embeddings) after
+            each upsert, e.g. to mirror vectors into a compressed index.
+        blob_store (BlobStore, optional): Shared store for imported media.
+
+    Returns:
+        dict: Number of items imported per kind.
+
+    Raises:
+        ValueError: An id is not a SHA-256 hex digest.
+    """
+    counts = {kind: 0 for kind in KINDS}
+    for batch in batches:
+        columns = {name: batch.column(index) for index, name in enumerate(batch.schema.names)}
+        kinds = columns["kind"].to_pylist()
+        embedding_column = columns["embedding"]
+        flat = embedding_column.values.to_numpy(zero_copy_only=False)
+        offsets = embedding_column.offsets.to_numpy()
+        ids = columns["id"].to_pylist()
+        for item_id in ids:
+            if not isinstance(item_id, str) or not _ITEM_ID.match(item_id):
+                raise ValueError(f"Invalid item id: {str(item_id)[:80]!r}")
+        documents = columns["document"].to_pylist()
+        metadatas = columns["metadata"].to_pylist()
+        uris = columns["uri"].to_pylist()
+        media = columns["media"].to_pylist() if "media" in columns else [None] * len(ids)
+
+        by_kind = {}
+        for row, kind in enumerate(kinds):
+            by_kind.setdefault(kind, []).append(row)
+
+        for kind, rows in by_kind.items():
+            if kind not in KINDS:
+                logger.warning("Skipping rows of unknown kind", extra={"kind": kind})
+                continue
+            folder = folder_for(kind, user_id)
+            records = {row: _prepare_record(kind, folder, user_id, ids[row], documents[row],
+                                            metadatas[row], uris[row], media[row], blob_store) for row in rows}
+            skipped = [row for row, record in records.items() if record is None]
+            if skipped:
+                logger.warning("Skipping media rows without inline bytes", extra={
+                    "kind": kind, "user_id": user_id, "items": len(skipped)})
+                rows = [row for row in rows if records[row] is not None]
+                if not rows:
+                    continue
+            records = [records[row] for row in rows]
+            embeddings = np.stack([flat[offsets[row]:offsets[row + 1]] for row in rows]).astype(np.float32)
+            kwargs = {
+                "ids": [ids[row] for row in rows],
+                "embeddings": embeddings,
+                "metadatas": [metadata for metadata, _ in records],
+            }
+            if kind == "text":
+                kwargs["documents"] = [documents[row] or "" for row in rows]
+            else:
+                kwargs["uris"] = [uri or "" for _, uri in records]
+            with write_events.writing(kind):
+                collection_for(kind, user_id).upsert(**kwargs)
+                if on_vectors is not None:
+                    on_vectors(kind, kwargs["ids"], embeddings)
+                for item_id, metadata in zip(kwargs["ids"], kwargs["metadatas"]):
+                    write_events.publish(kind, "add", user_id, item_id, metadata)
+            counts[kind] += len(rows)
+    return counts
+
+
+def _media_extension(kind, uri):
+    extension = os.path.splitext(uri or "")[1].lower()
+    return extension if extension in MEDIA_EXTENSIONS[kind] else MEDIA_EXTENSIONS[kind][0]
+
+
+def _prepare_record(kind, folder, user_id, item_id, document, metadata_json, uri, media, blob_store=None):
+    """
+    Build the stored metadata and media path of one imported row.
+
+    Returns:
+        Tuple[dict, str] or None: Metadata and media path (None for text), or None for
+        a media row whose bytes are neither inline nor already in the blob store.
+    """
+    metadata = json.loads(metadata_json) if metadata_json else {}
+    metadata["user_id"] = user_id
+    metadata.update(tag_fields(metadata.get("tags")))
+    metadata["type"] = normalize_type(kind, metadata.get("type"))
+    if not isinstance(metadata.get("created_at"), (int, float)):
+        metadata["created_at"] = int(created_at_for(metadata))
+    if kind == "text":
+        file_path = os.path.join(folder, f"{item_id}.json")
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump({"content": document, "metadata": metadata}, f, ensure_ascii=False, indent=2)
+        metadata["file_path"] = file_path
+        return metadata, None
+
+    extension = _media_extension(kind, uri)
+    if media is not None and blob_store is not None:
+        _, path = blob_store.store_bytes(user_id, kind, item_id, media, extension)
+    elif media is not None:
+        path = os.path.join(folder, f"{hashlib.sha256(media).hexdigest()}{extension}")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(media)
+    else:
+        # Without bytes, only content this server already stores can be referenced,
+        # by the digest the exported blob path is named after.
+        digest = os.path.splitext(os.path.basename(uri or ""))[0]
+        stored = blob_store.reference(user_id, kind, item_id, digest) if (
+            blob_store is not None and _ITEM_ID.match(digest)) else None
+        if stored is None:
+            return None
+        path = stored[1]
+    metadata.pop("file_path", None)
+    metadata.pop("uri", None)
+    metadata[PATH_FIELDS[kind]] = path
+    return metadata, path
+
+
+def _cli_accessors(chroma_path):
+    import chromadb
+
+    client = chromadb.PersistentClient(path=chroma_path)
+
+    def collection_for(kind, user_id):
+        return client.get_or_create_collection(name=ALIASES.resolve(f"{COLLECTION_PREFIXES[kind]}{user_id}"),
+                                               metadata=HNSW_SETTINGS.collection_metadata(kind))
+
+    def folder_for(kind, user_id):
+        folder = os.path.join(DEFAULT_FOLDERS[kind], user_id)
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    return collection_for, folder_for
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("--user", required=True, help="User id to export from or import into.")
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    parser.add_argument("--out", help="Export destination.")
+    parser.add_argument("--in", dest="source", help="Import source.")
+    parser.add_argument("--format", choices=("parquet", "arrow"), default="parquet")
+    parser.add_argument("--include-media", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=512)
+    args = parser.parse_args(argv)
+
+    collection_for, folder_for = _cli_accessors(args.chroma_path)
+    if args.command == "export":
+        if not args.out:
+            parser.error("--out is required for export")
+        batches = export_record_batches(collection_for, args.user, batch_size=args.batch_size,
+                                        include_media=args.include_media)
+        with open(args.out, "wb") as f:
+            for chunk in stream_export(batches, args.format):
+                f.write(chunk)
+        logger.info("Export finished", extra={"user_id": args.user, "path": args.out})
+    else:
+        if not args.source:
+            parser.error("--in is required for import")
+        counts = import_record_batches(read_batches(args.source, args.batch_size),
+                                       collection_for, folder_for, args.user, blob_store=BlobStore())
+        logger.info("Import finished", extra={"user_id": args.user, "counts": counts})
+
+
+if __name__ == "__main__":
+    main()
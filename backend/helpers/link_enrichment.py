@@ -0,0 +1,172 @@
+"""
+Background enrichment of saved YouTube links.
+
+A saved link is indexed straight away with its URL as the content. The
+LinkEnricher then fetches the video's metadata on a worker thread and upgrades
+the item in place (same id) with the title, channel and duration. Metadata is
+kept in a persistent sqlite cache keyed by the normalized video id, and
+concurrent saves of the same video share a single fetch.
+"""
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY, timed
+from helpers.youtube import fetch_video_metadata, normalize_video_id
+
+logger = get_logger("link_enrichment")
+
+ENRICHMENT_TOTAL = REGISTRY.counter(
+    "orbit_link_enrichment_total",
+    "Link enrichment requests by outcome (cache_hit, coalesced, fetched, failed).",
+    ("outcome",),
+)
+
+
+class LinkMetadataCache:
+    """Persistent video id -> metadata map backed by sqlite."""
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): Database file (ORBIT_LINK_CACHE_PATH, default "link_metadata.db").
+        """
+        self.path = path or os.getenv("ORBIT_LINK_CACHE_PATH", "link_metadata.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS link_metadata ("
+            " video_id TEXT PRIMARY KEY, title TEXT, channel TEXT, duration INTEGER, fetched_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, video_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT title, channel, duration FROM link_metadata WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"video_id": video_id, "title": row[0], "channel": row[1], "duration": row[2]}
+
+    def put(self, video_id, metadata):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO link_metadata VALUES (?, ?, ?, ?, ?)",
+                (video_id, metadata["title"], metadata["channel"], metadata["duration"], time.time()),
+            )
+            self._conn.commit()
+
+
+def item_metadata(metadata):
+    """Map fetched video metadata onto the text item's metadata fields."""
+    return {
+        "title": metadata["title"],
+        "youtube_video_id": metadata["video_id"],
+        "youtube_channel": metadata["channel"],
+        "youtube_duration": metadata["duration"],
+        "enrichment": "done",
+    }
+
+
+class LinkEnricher:
+    """Fetches YouTube metadata off the request path and upgrades saved items in place."""
+
+    def __init__(self, text_handler, fetch=None, cache=None, workers=None):
+        """
+        Args:
+            text_handler (TextHandler): Handler whose items are upgraded.
+            fetch (Callable[[str], dict], optional): Returns title, channel and duration
+                for a URL; defaults to helpers.youtube.fetch_video_metadata.
+            cache (LinkMetadataCache, optional): Metadata cache.
+            workers (int, optional): Fetch threads (ORBIT_ENRICH_WORKERS, default 2).
+        """
+        self.text_handler = text_handler
+        self.fetch = fetch or fetch_video_metadata
+        self.cache = cache or LinkMetadataCache()
+        workers = workers or int(os.getenv("ORBIT_ENRICH_WORKERS", "2"))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="link-enrich")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._futures = set()
+
+    def lookup(self, url):
+        """
+        Return cached metadata for a URL, or None if it has not been fetched yet.
+
+        Args:
+            url (str): YouTube URL.
+
+        Returns:
+            dict or None: ``video_id``, ``title``, ``channel`` and ``duration``.
+        """
+        video_id = normalize_video_id(url)
+        if video_id is None:
+            return None
+        metadata = self.cache.get(video_id)
+        if metadata is not None:
+            ENRICHMENT_TOTAL.inc(outcome="cache_hit")
+        return metadata
+
+    def enrich(self, user_id, item_id, url):
+        """
+        Schedule an item for enrichment; concurrent requests for one video share a fetch.
+
+        Args:
+            user_id (str): Owner of the item.
+            item_id (str): Text item saved with the URL as its content.
+            url (str): YouTube URL.
+        """
+        video_id = normalize_video_id(url)
+        if video_id is None:
+            self._mark_failed(user_id, item_id, "no video id")
+            return
+        with self._lock:
+            waiters = self._inflight.get(video_id)
+            if waiters is not None:
+                waiters.append((user_id, item_id))
+                ENRICHMENT_TOTAL.inc(outcome="coalesced")
+                return
+            self._inflight[video_id] = [(user_id, item_id)]
+            future = self._executor.submit(self._run, video_id, url)
+            self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+    def drain(self, timeout=None):
+        """Block until every scheduled enrichment has finished."""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+
+    def _run(self, video_id, url):
+        metadata = self.cache.get(video_id)
+        error = None
+        if metadata is None:
+            try:
+                with timed("link_fetch", model="youtube"):
+                    fetched = self.fetch(url)
+                metadata = {"video_id": video_id, "title": fetched.get("title") or url,
+                            "channel": fetched.get("channel") or "", "duration": int(fetched.get("duration") or 0)}
+                self.cache.put(video_id, metadata)
+                ENRICHMENT_TOTAL.inc(outcome="fetched")
+            except Exception as e:
+                error = str(e)
+                ENRICHMENT_TOTAL.inc(outcome="failed")
+                logger.warning("Link enrichment failed", extra={"url": url, "error": error})
+        # The cache is written before waiters are released, so a save arriving
+        # now either joins this batch or finds the metadata in the cache.
+        with self._lock:
+            waiters = self._inflight.pop(video_id, [])
+        for user_id, item_id in waiters:
+            if metadata is None:
+                self._mark_failed(user_id, item_id, error)
+            else:
+                self.text_handler.update_text(user_id, item_id, new_content=metadata["title"],
+                                              new_metadata=item_metadata(metadata))
+
+    def _mark_failed(self, user_id, item_id, error):
+        self.text_handler.update_text(user_id, item_id, new_metadata={"enrichment": "failed"})
+        logger.info("Link left unenriched", extra={"item_id": item_id, "user_id": user_id, "error": error})
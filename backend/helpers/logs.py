@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+# Attributes every LogRecord carries; anything else came in through ``extra=``.
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_configured = False
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops a fraction of low-severity records so hot paths can log freely.
+
+    Records at WARNING and above are always kept.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+def configure_logging():
+    """
+    Install the JSON handler on the ``orbit`` logger hierarchy.
+
+    Level and sampling are read from ORBIT_LOG_LEVEL (default INFO),
+    ORBIT_LOG_DEBUG_SAMPLE_RATE (default 0.01) and ORBIT_LOG_INFO_SAMPLE_RATE
+    (default 1.0).
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter({
+        logging.DEBUG: float(os.getenv("ORBIT_LOG_DEBUG_SAMPLE_RATE", "0.01")),
+        logging.INFO: float(os.getenv("ORBIT_LOG_INFO_SAMPLE_RATE", "1.0")),
+    }))
+
+    root = logging.getLogger("orbit")
+    root.addHandler(handler)
+    root.setLevel(os.getenv("ORBIT_LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+
+
+def get_logger(name):
+    """
+    Return a structured logger under the ``orbit`` namespace.
+
+    Args:
+        name (str): Component name, e.g. "app" or "handlers.text".
+
+    Returns:
+        logging.Logger: Logger whose records are emitted as JSON lines.
+    """
+    configure_logging()
+    return logging.getLogger(f"orbit.{name}")
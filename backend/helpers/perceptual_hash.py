@@ -0,0 +1,379 @@
+"""
+Perceptual hashes for spotting near-duplicate images before they are embedded.
+
+SHA-256 ids only catch byte-identical files; the same screenshot saved as PNG
+and JPEG, or at another resolution, hashes differently but has (nearly) the
+same 64-bit perceptual hash. Every image stores its hash as an ``image_hash``
+metadata field (``"phash:<hex>"`` or ``"dhash:<hex>"``), and a per-user
+multi-index hash table answers "is there an image within Hamming distance r?"
+without scanning the library.
+
+The table splits each hash into four 16-bit chunks. Two hashes within distance
+r agree to within ``r // 4`` bits on at least one chunk (pigeonhole), so a
+lookup only probes the buckets of chunk values that close to the query's.
+
+Items saved before hashes were stored can be hashed, and a library's
+near-duplicate groups listed, from the command line:
+
+    python -m helpers.perceptual_hash report --user <id> [--backfill] [--threshold 6]
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from helpers.image_decode import open_reduced
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("perceptual_hash")
+
+HASH_FIELD = "image_hash"
+ALGORITHMS = ("phash", "dhash")
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+
+NEAR_DUPLICATES = REGISTRY.counter(
+    "orbit_near_duplicates_total",
+    "Images matched to a near-duplicate already in the library, by action taken.",
+    ("action",),
+)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def phash(image):
+    """
+    DCT-based perceptual hash: the signs of the 8x8 lowest frequencies against their median.
+
+    Args:
+        image (PIL.Image.Image): Image to hash.
+
+    Returns:
+        int: 64-bit hash.
+    """
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].flatten()
+    # The DC term only encodes overall brightness, so it is left out of the median.
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def dhash(image):
+    """
+    Difference hash: whether each pixel is brighter than its right neighbour on a 9x8 thumbnail.
+
+    Args:
+        image (PIL.Image.Image): Image to hash.
+
+    Returns:
+        int: 64-bit hash.
+    """
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hash_image(source, algorithm=None):
+    """
+    Hash an image given as bytes, a path or a PIL image.
+
+    Args:
+        source: Image bytes, file path or PIL image.
+        algorithm (str, optional): "phash" or "dhash" (ORBIT_IMAGE_HASH, default "phash").
+
+    Returns:
+        str: Stored form of the hash, ``"<algorithm>:<16 hex digits>"``.
+    """
+    algorithm = algorithm or os.getenv("ORBIT_IMAGE_HASH", "phash")
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown image hash algorithm: {algorithm}")
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    # Both hashes shrink to a 32x32 thumbnail at most, so there is no point decoding at full size.
+    image = source if isinstance(source, Image.Image) else open_reduced(source, 64, "L")
+    value = phash(image) if algorithm == "phash" else dhash(image)
+    return f"{algorithm}:{value:016x}"
+
+
+def parse_hash(stored):
+    """Split a stored hash into ``(algorithm, int)``, or None if it is missing or malformed."""
+    algorithm, _, digits = str(stored or "").partition(":")
+    if algorithm not in ALGORITHMS or len(digits) != HASH_BITS // 4:
+        return None
+    try:
+        return algorithm, int(digits, 16)
+    except ValueError:
+        return None
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def _masks(radius):
+    """All CHUNK_BITS-wide masks with at most ``radius`` bits set."""
+    masks = [0]
+    for flips in range(1, radius + 1):
+        for positions in itertools.combinations(range(CHUNK_BITS), flips):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+
+class MultiIndexHashTable:
+    """Hamming-radius search over 64-bit hashes using one bucket table per 16-bit chunk."""
+
+    def __init__(self):
+        self._tables = [{} for _ in range(CHUNKS)]
+        self._hashes = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def items(self):
+        """``(item_id, hash)`` pairs."""
+        return self._hashes.items()
+
+    @staticmethod
+    def _chunks(value):
+        return [(value >> (CHUNK_BITS * index)) & ((1 << CHUNK_BITS) - 1) for index in range(CHUNKS)]
+
+    def add(self, item_id, value):
+        self.remove(item_id)
+        self._hashes[item_id] = value
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            table.setdefault(chunk, set()).add(item_id)
+
+    def remove(self, item_id):
+        value = self._hashes.pop(item_id, None)
+        if value is None:
+            return
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(item_id)
+                if not bucket:
+                    del table[chunk]
+
+    def query(self, value, threshold):
+        """
+        Find every stored hash within a Hamming distance.
+
+        Args:
+            value (int): Query hash.
+            threshold (int): Maximum distance (inclusive).
+
+        Returns:
+            List[Tuple[int, str]]: ``(distance, item_id)`` pairs, closest first.
+        """
+        radius = threshold // CHUNKS
+        masks = self._masks.get(radius)
+        if masks is None:
+            masks = self._masks[radius] = _masks(radius)
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        matches = []
+        for item_id in candidates:
+            distance = hamming(value, self._hashes[item_id])
+            if distance <= threshold:
+                matches.append((distance, item_id))
+        matches.sort()
+        return matches
+
+
+class NearDuplicateIndex:
+    """Per-user perceptual-hash tables, built lazily from each user's image collection."""
+
+    def __init__(self, threshold=None, algorithm=None):
+        """
+        Args:
+            threshold (int, optional): Maximum Hamming distance of a near duplicate
+                (ORBIT_NEAR_DUPLICATE_DISTANCE, default 6).
+            algorithm (str, optional): Hash algorithm, see hash_image().
+        """
+        self.threshold = threshold if threshold is not None else int(
+            os.getenv("ORBIT_NEAR_DUPLICATE_DISTANCE", "6"))
+        self.algorithm = algorithm or os.getenv("ORBIT_IMAGE_HASH", "phash")
+        self._users = {}
+        self._unhashed = {}
+        self._lock = threading.Lock()
+
+    def hash(self, source):
+        return hash_image(source, self.algorithm)
+
+    def _table(self, user_id, collection, batch_size=1000):
+        user_id = str(user_id)
+        table = self._users.get(user_id)
+        if table is not None:
+            return table
+        table, unhashed, offset = MultiIndexHashTable(), set(), 0
+        while True:
+            page = collection.get(offset=offset, limit=batch_size, include=["metadatas"])
+            if not page["ids"]:
+                break
+            offset += len(page["ids"])
+            for item_id, metadata in zip(page["ids"], page["metadatas"]):
+                parsed = parse_hash((metadata or {}).get(HASH_FIELD))
+                if parsed is not None and parsed[0] == self.algorithm:
+                    table.add(item_id, parsed[1])
+                else:
+                    unhashed.add(item_id)
+        self._users[user_id] = table
+        self._unhashed[user_id] = unhashed
+        return table
+
+    def find(self, user_id, collection, stored_hash):
+        """
+        Return the closest near duplicate of a hash in a user's library.
+
+        Args:
+            user_id (str): Owner.
+            collection: The user's image collection, read once to build their table.
+            stored_hash (str): Hash from hash().
+
+        Returns:
+            Tuple[str, int] or None: ``(item_id, distance)`` of the closest match.
+        """
+        parsed = parse_hash(stored_hash)
+        if parsed is None:
+            return None
+        with self._lock:
+            matches = self._table(user_id, collection).query(parsed[1], self.threshold)
+        return (matches[0][1], matches[0][0]) if matches else None
+
+    def on_write(self, event):
+        """write_events subscriber keeping loaded tables in step with the image collections."""
+        if event.kind != "image":
+            return
+        user_id = str(event.user_id)
+        with self._lock:
+            table = self._users.get(user_id)
+            if table is None:
+                return
+            table.remove(event.item_id)
+            self._unhashed[user_id].discard(event.item_id)
+            if event.action == "delete":
+                return
+            parsed = parse_hash((event.metadata or {}).get(HASH_FIELD))
+            if parsed is not None and parsed[0] == self.algorithm:
+                table.add(event.item_id, parsed[1])
+            else:
+                self._unhashed[user_id].add(event.item_id)
+
+    def groups(self, user_id, collection):
+        """
+        Group a user's images into near-duplicate clusters.
+
+        Args:
+            user_id (str): Owner.
+            collection: The user's image collection.
+
+        Returns:
+            dict: ``groups`` (lists of item ids, largest first, singletons left out)
+            and the number of ``unhashed`` items that could not be compared.
+        """
+        with self._lock:
+            table = self._table(user_id, collection)
+            parent = {}
+
+            def find(item_id):
+                while parent.get(item_id, item_id) != item_id:
+                    item_id = parent[item_id]
+                return item_id
+
+            for item_id, value in table.items():
+                for _, other in table.query(value, self.threshold):
+                    root, other_root = find(item_id), find(other)
+                    if root != other_root:
+                        parent[other_root] = root
+            clusters = {}
+            for item_id, _ in table.items():
+                clusters.setdefault(find(item_id), []).append(item_id)
+            unhashed = len(self._unhashed[str(user_id)])
+        groups = sorted((sorted(ids) for ids in clusters.values() if len(ids) > 1), key=lambda ids: (-len(ids), ids))
+        return {"groups": groups, "unhashed": unhashed}
+
+    def backfill(self, user_id, collection, batch_size=200):
+        """
+        Hash a user's images that have no stored hash, reading their files.
+
+        Args:
+            user_id (str): Owner.
+            collection: The user's image collection.
+            batch_size (int): Items read and updated per page.
+
+        Returns:
+            int: Number of items hashed.
+        """
+        user_id = str(user_id)
+        hashed, offset = 0, 0
+        while True:
+            page = collection.get(offset=offset, limit=batch_size, include=["metadatas", "uris"])
+            if not page["ids"]:
+                break
+            offset += len(page["ids"])
+            ids, metadatas = [], []
+            for item_id, uri, metadata in zip(page["ids"], page["uris"] or [None] * len(page["ids"]),
+                                              page["metadatas"]):
+                metadata = metadata or {}
+                parsed = parse_hash(metadata.get(HASH_FIELD))
+                if parsed is not None and parsed[0] == self.algorithm:
+                    continue
+                path = uri or metadata.get("file_path")
+                try:
+                    value = self.hash(path)
+                except (OSError, ValueError, TypeError) as e:
+                    logger.warning("Could not hash image", extra={"item_id": item_id, "path": path, "error": str(e)})
+                    continue
+                ids.append(item_id)
+                metadatas.append({HASH_FIELD: value})
+            if ids:
+                collection.update(ids=ids, metadatas=metadatas)
+                hashed += len(ids)
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._unhashed.pop(user_id, None)
+        return hashed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("report",))
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    parser.add_argument("--threshold", type=int, help="Maximum Hamming distance of a near duplicate.")
+    parser.add_argument("--backfill", action="store_true", help="Hash images that have no stored hash first.")
+    args = parser.parse_args(argv)
+
+    from helpers.library_io import _cli_accessors
+
+    collection_for, _ = _cli_accessors(args.chroma_path)
+    collection = collection_for("image", args.user)
+    index = NearDuplicateIndex(threshold=args.threshold)
+    if args.backfill:
+        hashed = index.backfill(args.user, collection)
+        logger.info("Image hashes backfilled", extra={"user_id": args.user, "hashed": hashed})
+    print(json.dumps(index.groups(args.user, collection), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+from helpers.logs import get_logger
+
+logger = get_logger("profiling")
+
+PROFILE_HEADER = "X-Orbit-Profile"
+_PROFILE_ID = re.compile(r"^[0-9]{13}-[0-9a-f]{12}$")
+
+
+class RequestProfiler:
+    """
+    Opt-in cProfile capture for individual Flask requests.
+
+    A request is profiled when it carries the ``X-Orbit-Profile`` header set to
+    the admin token, or when it hits one of the sampled routes and wins the
+    ``sample_rate`` draw. Each capture is written as a ``.prof`` file (loadable
+    with pstats/snakeviz) plus a JSON sidecar with route, user and timings, into
+    a directory that is trimmed to the newest ``max_profiles`` captures.
+
+    When sampling is off and the header is absent the per-request cost is one
+    header lookup.
+    """
+
+    def __init__(self, directory=None, max_profiles=None, sample_rate=None, routes=None):
+        """
+        Args:
+            directory (str, optional): Where captures are stored (ORBIT_PROFILE_DIR, default "profiles").
+            max_profiles (int, optional): Ring buffer size (ORBIT_PROFILE_MAX, default 50).
+            sample_rate (float, optional): Fraction of sampled-route requests to profile
+                (ORBIT_PROFILE_SAMPLE_RATE, default 0).
+            routes (Iterable[str], optional): Routes eligible for sampling
+                (ORBIT_PROFILE_ROUTES, default "/api/search,/api/populate").
+        """
+        self.directory = directory or os.getenv("ORBIT_PROFILE_DIR", "profiles")
+        self.max_profiles = max_profiles or int(os.getenv("ORBIT_PROFILE_MAX", "50"))
+        if sample_rate is None:
+            sample_rate = float(os.getenv("ORBIT_PROFILE_SAMPLE_RATE", "0"))
+        self.sample_rate = sample_rate
+        if routes is None:
+            routes = os.getenv("ORBIT_PROFILE_ROUTES", "/api/search,/api/populate").split(",")
+        self.routes = {route.strip() for route in routes if route.strip()}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def init_app(self, app):
+        """Register the request hooks on a Flask app."""
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _trigger(self):
+        header = request.headers.get(PROFILE_HEADER)
+        if header is not None:
+            admin_token = os.getenv("ORBIT_ADMIN_TOKEN")
+            return "header" if admin_token and header == admin_token else None
+        if self.sample_rate > 0 and request.path in self.routes and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def _start(self):
+        trigger = self._trigger()
+        if trigger is None:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows one active profiler per process; this request runs unprofiled.
+            logger.info("Request not profiled, another profile is active", extra={"error": str(e)})
+            return
+        g.profile = (profiler, trigger, time.time(), time.perf_counter())
+
+    def _finish(self, response):
+        state = g.pop("profile", None)
+        if state is None:
+            return response
+        profiler, trigger, started_at, started = state
+        profiler.disable()
+        duration = time.perf_counter() - started
+        user = getattr(request, "user", None)
+        try:
+            profile_id = self._save(profiler, {
+                "route": request.url_rule.rule if request.url_rule else request.path,
+                "path": request.path,
+                "method": request.method,
+                "status": response.status_code,
+                "user_id": getattr(user, "id", None),
+                "trigger": trigger,
+                "started_at": started_at,
+                "duration_s": duration,
+            })
+            response.headers["X-Orbit-Profile-Id"] = profile_id
+        except Exception as e:
+            logger.warning("Failed to save request profile", extra={"error": str(e)})
+        return response
+
+    def _save(self, profiler, meta):
+        profile_id = f"{int(meta['started_at'] * 1000):013d}-{uuid.uuid4().hex[:12]}"
+        meta["id"] = profile_id
+        profiler.dump_stats(os.path.join(self.directory, f"{profile_id}.prof"))
+        with open(os.path.join(self.directory, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        self._trim()
+        logger.info("Captured request profile", extra=meta)
+        return profile_id
+
+    def _trim(self):
+        with self._lock:
+            ids = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".json"))
+            for stale in ids[:max(0, len(ids) - self.max_profiles)]:
+                for suffix in (".json", ".prof"):
+                    try:
+                        os.remove(os.path.join(self.directory, stale + suffix))
+                    except FileNotFoundError:
+                        pass
+
+    def list_profiles(self):
+        """
+        Return metadata for every stored capture, newest first.
+
+        Returns:
+            List[dict]: Sidecar metadata (id, route, user_id, duration_s, ...).
+        """
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def profile_path(self, profile_id):
+        """
+        Return the path of a stored ``.prof`` file.
+
+        Args:
+            profile_id (str): Capture identifier from list_profiles().
+
+        Returns:
+            str: Path to the file, or None if the id is malformed or unknown.
+        """
+        if not _PROFILE_ID.match(profile_id or ""):
+            return None
+        path = os.path.join(self.directory, f"{profile_id}.prof")
+        return path if os.path.exists(path) else None
+
+    def render_text(self, profile_id, sort="cumulative", limit=50):
+        """
+        Render a stored capture as a pstats text report.
+
+        Args:
+            profile_id (str): Capture identifier.
+            sort (str): pstats sort key.
+            limit (int): Number of rows to print.
+
+        Returns:
+            str: The report, or None if the capture does not exist.
+        """
+        path = self.profile_path(profile_id)
+        if path is None:
+            return None
+        buffer = io.StringIO()
+        stats = pstats.Stats(path, stream=buffer)
+        stats.sort_stats(sort).print_stats(limit)
+        return buffer.getvalue()
@@ -0,0 +1,138 @@
+import os
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+from helpers import metrics
+
+CACHE_LOOKUPS = metrics.REGISTRY.counter(
+    "orbit_query_cache_lookups_total",
+    "Query result cache lookups by outcome.",
+    ("cache", "outcome"),
+)
+CACHE_EVICTIONS = metrics.REGISTRY.counter(
+    "orbit_query_cache_evictions_total",
+    "Entries evicted from the query result cache to stay under its memory bound.",
+    ("cache",),
+)
+CACHE_BYTES = metrics.REGISTRY.gauge(
+    "orbit_query_cache_bytes",
+    "Bytes currently held by the query result cache.",
+    ("cache",),
+)
+
+
+def normalize_query(query):
+    """Canonicalize a query string so trivially different spellings share a cache entry."""
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+class QueryResultCache:
+    """
+    Memory-bounded LRU cache of serialized results, invalidated by write versions.
+
+    Every (user, modality) pair has a version counter that is bumped on each
+    add, update or delete. An entry remembers the versions of the modalities it
+    was computed from and is discarded on lookup if any of them has moved, so a
+    result is never served after a write that could have changed it. Callers
+    snapshot the versions *before* computing a result; a write that lands while
+    the result is being computed therefore makes the stored entry stale
+    immediately instead of caching an outdated answer.
+    """
+
+    def __init__(self, name="search", max_bytes=None):
+        """
+        Args:
+            name (str): Label used in metrics.
+            max_bytes (int, optional): Memory bound (ORBIT_QUERY_CACHE_MB, default 64 MiB).
+        """
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("ORBIT_QUERY_CACHE_MB", "64")) * 1024 * 1024)
+        self.name = name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (versions, value, size)
+        self._versions = defaultdict(int)  # (user_id, kind) -> counter
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def versions(self, user_id, kinds):
+        """
+        Snapshot the version counters for a user's modalities.
+
+        Args:
+            user_id (str): Owner of the data.
+            kinds (Iterable[str]): Modalities the result depends on.
+
+        Returns:
+            tuple: Opaque snapshot to pass to put().
+        """
+        user_id = str(user_id)
+        with self._lock:
+            return tuple((kind, self._versions[(user_id, kind)]) for kind in sorted(set(kinds)))
+
+    def bump(self, user_id, kind):
+        """Invalidate every cached result that depends on (user_id, kind)."""
+        with self._lock:
+            self._versions[(str(user_id), kind)] += 1
+
+    def on_write(self, event):
+        """write_events subscriber: bump the version of the modality that changed."""
+        self.bump(event.user_id, event.kind)
+
+    def get(self, key, user_id):
+        """
+        Look up a cached value.
+
+        Args:
+            key (tuple): Cache key, including the user id.
+            user_id (str): Owner, used to validate versions.
+
+        Returns:
+            The cached value, or None on a miss or a stale entry.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                CACHE_LOOKUPS.inc(cache=self.name, outcome="miss")
+                return None
+            versions, value, size = entry
+            if any(self._versions[(user_id, kind)] != version for kind, version in versions):
+                self._remove(key)
+                CACHE_LOOKUPS.inc(cache=self.name, outcome="stale")
+                return None
+            self._entries.move_to_end(key)
+            CACHE_LOOKUPS.inc(cache=self.name, outcome="hit")
+            return value
+
+    def put(self, key, versions, value, size):
+        """
+        Store a value computed under the given version snapshot.
+
+        Args:
+            key (tuple): Cache key.
+            versions (tuple): Snapshot from versions(), taken before computing value.
+            value: Value to cache.
+            size (int): Approximate size of value in bytes.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (versions, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                CACHE_EVICTIONS.inc(cache=self.name)
+            CACHE_BYTES.set(self._bytes, cache=self.name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            CACHE_BYTES.set(0, cache=self.name)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,511 @@
+"""
+Background re-embedding of every user's collections after an encoder upgrade.
+
+A ReindexJob walks each user's collection for one modality in pages, re-embeds
+the items from their stored sources (the text JSON files, image and audio
+files) with the new encoder and writes them into a shadow collection named
+``<collection>__v<generation>``. Progress is checkpointed after every page so
+an interrupted job resumes where it stopped. Writes that land while the job is
+running are replayed from the write-event stream, and a reconciliation pass
+compares id sets before the aliases are repointed for all users at once.
+
+The encoder spec that is live for each modality is persisted next to the
+checkpoint so the application builds the same encoders after a restart.
+
+Shadow collections are created with the HNSW parameters of the size tier they
+are filled to (see helpers/hnsw_params.py). A job without a spec is a rebuild:
+it copies the stored embeddings instead of re-embedding and keeps the encoder,
+which is how new HNSW parameters reach existing collections.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+from helpers import write_events
+from helpers.collection_aliases import ALIASES
+from helpers.hnsw_params import HNSW_SETTINGS
+from helpers.item_fields import COLLECTION_PREFIXES
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY, REQUESTS_IN_FLIGHT, timed
+
+logger = get_logger("reindex")
+
+ENCODER_SPECS_PATH = os.getenv("ORBIT_ENCODER_SPECS", "encoder_specs.json")
+
+REINDEX_ITEMS = REGISTRY.counter(
+    "orbit_reindex_items_total",
+    "Items processed by the re-embedding job by modality and outcome.",
+    ("kind", "outcome"),
+)
+REINDEX_THROTTLED_SECONDS = REGISTRY.counter(
+    "orbit_reindex_throttled_seconds_total",
+    "Time the re-embedding job spent waiting for live traffic to drain.",
+    ("kind",),
+)
+
+_GENERATION_SUFFIX = re.compile(r"__v(\d+)$")
+
+
+def build_encoder(kind, spec):
+    """
+    Construct the embedding function for a modality from a model spec.
+
+    Args:
+        kind (str): "text", "image" or "audio".
+        spec (dict): ``{"model": ...}`` plus ``"checkpoint"`` for OpenCLIP models.
+            ``{"model": "stub"}`` builds the deterministic benchmark stub.
+
+    Returns:
+        The embedding function the kind's handler expects.
+    """
+    model = spec.get("model")
+    if model == "stub":
+        from helpers.stub_encoders import StubTextEmbedding, StubImageEmbedding, StubAudioEmbedder
+        return {"text": StubTextEmbedding, "image": StubImageEmbedding, "audio": StubAudioEmbedder}[kind]()
+    if kind == "text":
+        from data_handlers.TextHandler import MPNetEmbedding
+        return MPNetEmbedding(model) if model else MPNetEmbedding()
+    if kind == "image":
+        from data_handlers.ImageHandler import TimedOpenCLIPEmbeddingFunction
+        options = {key: spec[key] for key in ("checkpoint", "device") if key in spec}
+        if model:
+            options["model_name"] = model
+        return TimedOpenCLIPEmbeddingFunction(**options)
+    if kind == "audio":
+        from data_handlers.AudioHandler import CLAPEmbedder
+        return CLAPEmbedder(model) if model else CLAPEmbedder()
+    raise ValueError(f"Unknown kind: {kind}")
+
+
+def load_encoder_specs(path=None):
+    """Return the persisted ``{kind: spec}`` mapping of encoders that are live."""
+    path = path or ENCODER_SPECS_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_encoder_spec(kind, spec, path=None):
+    path = path or ENCODER_SPECS_PATH
+    specs = load_encoder_specs(path)
+    specs[kind] = spec
+    _write_json(path, specs)
+
+
+def set_handler_encoder(kind, handler, encoder):
+    """Point a handler at a new embedding function."""
+    if kind == "text":
+        handler.embedding_model = encoder
+    elif kind == "image":
+        handler.embedding_function = encoder
+    else:
+        handler.embedder = encoder
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class ReindexJob:
+    """
+    Re-embeds one modality for every user into shadow collections, then swaps them in.
+
+    The job runs on a daemon thread. Its state lives in a JSON checkpoint so that
+    ``ReindexJob.resume()`` can pick up an interrupted run after a restart.
+    """
+
+    def __init__(self, client, kind, handler, spec, checkpoint_path=None, batch_size=None,
+                 max_in_flight=None, pause_seconds=None, on_swap=None, state=None):
+        """
+        Args:
+            client: Chroma client shared with the handlers.
+            kind (str): "text", "image" or "audio".
+            handler: The kind's handler; its encoder is replaced at swap time.
+            spec (dict or None): Model spec of the new encoder, see build_encoder(). None
+                rebuilds the collections from their stored embeddings with the current encoder.
+            checkpoint_path (str, optional): Progress file (ORBIT_REINDEX_CHECKPOINT,
+                default "reindex_checkpoint.json").
+            batch_size (int, optional): Items per page (ORBIT_REINDEX_BATCH_SIZE, default 64).
+            max_in_flight (int, optional): Pause while more live requests than this are
+                in flight (ORBIT_REINDEX_MAX_INFLIGHT, default 2).
+            pause_seconds (float, optional): Sleep between pages and while throttled
+                (ORBIT_REINDEX_PAUSE_S, default 0.05).
+            on_swap (Callable[[str, dict], None], optional): Called with the kind and the
+                ``{old_physical: new_physical}`` mapping right after the swap, e.g. to
+                invalidate caches.
+            state (dict, optional): Checkpoint contents to resume from.
+        """
+        if kind not in COLLECTION_PREFIXES:
+            raise ValueError(f"Unknown kind: {kind}")
+        self.client = client
+        self.kind = kind
+        self.handler = handler
+        self.spec = dict(spec) if spec is not None else None
+        self.checkpoint_path = checkpoint_path or os.getenv("ORBIT_REINDEX_CHECKPOINT", "reindex_checkpoint.json")
+        self.batch_size = batch_size or int(os.getenv("ORBIT_REINDEX_BATCH_SIZE", "64"))
+        self.max_in_flight = max_in_flight if max_in_flight is not None else int(
+            os.getenv("ORBIT_REINDEX_MAX_INFLIGHT", "2"))
+        self.pause_seconds = pause_seconds if pause_seconds is not None else float(
+            os.getenv("ORBIT_REINDEX_PAUSE_S", "0.05"))
+        self.on_swap = on_swap
+        self.state = state or {
+            "kind": kind,
+            "spec": self.spec,
+            "generation": self._next_generation(),
+            "status": "pending",
+            "users": {},
+            "processed": 0,
+            "skipped": 0,
+            "total": 0,
+            "started_at": time.time(),
+            "error": None,
+        }
+        self.encoder = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._recording = False
+        self._run_started = None
+        self._run_processed = 0
+
+    @classmethod
+    def resume(cls, client, handlers, checkpoint_path=None, **kwargs):
+        """
+        Rebuild an interrupted job from its checkpoint.
+
+        Args:
+            client: Chroma client.
+            handlers (dict): Kind -> handler.
+            checkpoint_path (str, optional): See __init__.
+
+        Returns:
+            ReindexJob or None: The job if the checkpoint describes an unfinished run.
+        """
+        checkpoint_path = checkpoint_path or os.getenv("ORBIT_REINDEX_CHECKPOINT", "reindex_checkpoint.json")
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("status") not in ("pending", "running"):
+            return None
+        kind = state["kind"]
+        return cls(client, kind, handlers[kind], state["spec"], checkpoint_path=checkpoint_path,
+                   state=state, **kwargs)
+
+    # ------------------------------------------------------------------ status
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self):
+        """
+        Return progress with throughput and ETA for the current run.
+
+        Returns:
+            dict: Status, counts, items per second and estimated seconds remaining.
+        """
+        with self._lock:
+            state = self.state
+            processed, total = state["processed"], state["total"]
+            rate = 0.0
+            if self._run_started is not None:
+                elapsed = time.time() - self._run_started
+                rate = self._run_processed / elapsed if elapsed > 0 else 0.0
+            remaining = max(total - processed, 0)
+            return {
+                "kind": self.kind,
+                "spec": self.spec,
+                "generation": state["generation"],
+                "status": state["status"],
+                "users": len(state["users"]),
+                "users_done": sum(1 for user in state["users"].values() if user["done"]),
+                "processed": processed,
+                "skipped": state["skipped"],
+                "total": total,
+                "items_per_second": rate,
+                "eta_seconds": remaining / rate if rate > 0 else None,
+                "error": state["error"],
+            }
+
+    # --------------------------------------------------------------- lifecycle
+
+    def start(self):
+        """Run the job on a daemon thread."""
+        if self.is_running():
+            raise RuntimeError("Re-index job already running")
+        self._thread = threading.Thread(target=self.run, name=f"reindex-{self.kind}", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        write_events.subscribe(self._on_write)
+        self._recording = True
+        self._run_started = time.time()
+        self._run_processed = 0
+        try:
+            self.encoder = build_encoder(self.kind, self.spec) if self.spec is not None else None
+            self._set_status("running")
+            self._discover_users()
+            while True:
+                for user_id in sorted(self.state["users"]):
+                    if not self.state["users"][user_id]["done"]:
+                        self._copy_user(user_id)
+                # Users who signed up while the job ran get picked up before the swap.
+                if not self._discover_users():
+                    break
+            for user_id in sorted(self.state["users"]):
+                self._reconcile(user_id)
+            self._swap()
+            self._set_status("completed")
+            logger.info("Re-index finished", extra={"kind": self.kind, "processed": self.state["processed"],
+                                                    "skipped": self.state["skipped"]})
+        except Exception as e:
+            logger.error("Re-index failed", extra={"kind": self.kind, "error": str(e)})
+            with self._lock:
+                self.state["error"] = str(e)
+            self._set_status("failed")
+        finally:
+            self._recording = False
+            write_events.unsubscribe(self._on_write)
+
+    def _set_status(self, status):
+        with self._lock:
+            self.state["status"] = status
+        self._checkpoint()
+
+    def _checkpoint(self):
+        with self._lock:
+            _write_json(self.checkpoint_path, self.state)
+
+    # --------------------------------------------------------------- planning
+
+    def _next_generation(self):
+        generations = [int(match.group(1)) for target in ALIASES.items().values()
+                       if (match := _GENERATION_SUFFIX.search(target))]
+        return max(generations, default=1) + 1
+
+    def _logical_name(self, user_id):
+        return f"{COLLECTION_PREFIXES[self.kind]}{user_id}"
+
+    def _shadow_name(self, user_id):
+        return f"{self._logical_name(user_id)}__v{self.state['generation']}"
+
+    def _list_user_ids(self):
+        prefix = COLLECTION_PREFIXES[self.kind]
+        user_ids = set()
+        # Chroma 0.6 lists collection names (which raise on .name); older versions
+        # return Collection objects.
+        for entry in self.client.list_collections():
+            name = entry if isinstance(entry, str) else entry.name
+            if name.startswith(prefix):
+                user_ids.add(_GENERATION_SUFFIX.sub("", name[len(prefix):]))
+        return user_ids
+
+    def _discover_users(self):
+        """Add users not yet in the plan; returns True if any were found."""
+        new_users = self._list_user_ids() - set(self.state["users"])
+        for user_id in new_users:
+            source = self._source_collection(user_id)
+            with self._lock:
+                self.state["users"][user_id] = {"offset": 0, "done": False}
+                self.state["total"] += source.count()
+        if new_users:
+            self._checkpoint()
+        return bool(new_users)
+
+    # ---------------------------------------------------------------- copying
+
+    def _source_collection(self, user_id):
+        return self.client.get_collection(ALIASES.resolve(self._logical_name(user_id)))
+
+    def _shadow_collection(self, user_id, source):
+        metadata = HNSW_SETTINGS.collection_metadata(self.kind, source.count(), base=source.metadata)
+        return self.client.get_or_create_collection(name=self._shadow_name(user_id), metadata=metadata)
+
+    @property
+    def _include(self):
+        include = ["documents", "metadatas", "uris"]
+        return include + ["embeddings"] if self.spec is None else include
+
+    def _copy_user(self, user_id):
+        source = self._source_collection(user_id)
+        shadow = self._shadow_collection(user_id, source)
+        progress = self.state["users"][user_id]
+        while True:
+            self._throttle()
+            page = source.get(offset=progress["offset"], limit=self.batch_size,
+                              include=self._include)
+            if not page["ids"]:
+                break
+            self._write_items(shadow, page)
+            with self._lock:
+                progress["offset"] += len(page["ids"])
+            self._checkpoint()
+            time.sleep(self.pause_seconds)
+        with self._lock:
+            progress["done"] = True
+        self._checkpoint()
+
+    def _write_items(self, shadow, page):
+        ids, embeddings, metadatas, documents, uris = [], [], [], [], []
+        sources = self._embed_sources(page)
+        for row, embedding in enumerate(sources):
+            if embedding is None:
+                continue
+            ids.append(page["ids"][row])
+            embeddings.append(embedding)
+            metadatas.append(page["metadatas"][row])
+            documents.append((page.get("documents") or [None] * len(page["ids"]))[row])
+            uris.append((page.get("uris") or [None] * len(page["ids"]))[row])
+        skipped = len(page["ids"]) - len(ids)
+        if ids:
+            kwargs = {"ids": ids, "embeddings": embeddings, "metadatas": metadatas}
+            if self.kind == "text":
+                kwargs["documents"] = [document or "" for document in documents]
+            else:
+                kwargs["uris"] = [uri or (metadata or {}).get("file_path") or ""
+                                  for uri, metadata in zip(uris, metadatas)]
+            with timed("collection_add", model=f"reindex_{self.kind}"):
+                shadow.upsert(**kwargs)
+        REINDEX_ITEMS.inc(len(ids), kind=self.kind, outcome="embedded" if self.spec is not None else "copied")
+        if skipped:
+            REINDEX_ITEMS.inc(skipped, kind=self.kind, outcome="skipped")
+        with self._lock:
+            self.state["processed"] += len(page["ids"])
+            self.state["skipped"] += skipped
+            self._run_processed += len(page["ids"])
+
+    def _embed_sources(self, page):
+        """
+        Re-embed a page from its stored sources; None marks items whose source is gone.
+
+        A rebuild returns the stored embeddings instead.
+        """
+        ids = page["ids"]
+        if self.spec is None:
+            return list(page["embeddings"])
+        metadatas = page.get("metadatas") or [None] * len(ids)
+        if self.kind == "text":
+            documents = page.get("documents") or [None] * len(ids)
+            texts = [_read_text_source(metadata or {}, document) for metadata, document in zip(metadatas, documents)]
+            present = [row for row, text in enumerate(texts) if text is not None]
+            embedded = self.encoder([texts[row] for row in present]) if present else []
+        else:
+            uris = page.get("uris") or [None] * len(ids)
+            paths = [uri or (metadata or {}).get("file_path") or (metadata or {}).get("uri")
+                     for uri, metadata in zip(uris, metadatas)]
+            present = [row for row, path in enumerate(paths) if path and os.path.exists(path)]
+            if self.kind == "image":
+                images = self.handler.data_loader([paths[row] for row in present]) if present else []
+                embedded = self.encoder(images) if present else []
+            else:
+                loaded = self.handler.audio_loader([paths[row] for row in present]) if present else []
+                keep = [index for index, item in enumerate(loaded) if item is not None]
+                present = [present[index] for index in keep]
+                with timed("embed", model=f"reindex_{self.kind}"):
+                    embedded = [self.encoder._encode_audio(loaded[index]["waveform"]) for index in keep]
+        embeddings = [None] * len(ids)
+        for row, embedding in zip(present, embedded):
+            embeddings[row] = embedding
+        return embeddings
+
+    def _throttle(self):
+        waited = 0.0
+        while REQUESTS_IN_FLIGHT.get() > self.max_in_flight:
+            time.sleep(self.pause_seconds)
+            waited += self.pause_seconds
+        if waited:
+            REINDEX_THROTTLED_SECONDS.inc(waited, kind=self.kind)
+
+    # ---------------------------------------------------- reconcile and swap
+
+    def _on_write(self, event):
+        if event.kind != self.kind or not self._recording:
+            return
+        with self._lock:
+            self._pending[(event.user_id, event.item_id)] = event.action
+
+    def _drain_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def _apply_pending(self, pending, sources, shadows):
+        by_user = {}
+        for (user_id, item_id), action in pending.items():
+            by_user.setdefault(user_id, {})[item_id] = action
+        for user_id, actions in by_user.items():
+            if user_id not in self.state["users"]:
+                continue
+            source = sources.get(user_id) or self._source_collection(user_id)
+            shadow = shadows.get(user_id) or self._shadow_collection(user_id, source)
+            deleted = [item_id for item_id, action in actions.items() if action == "delete"]
+            changed = [item_id for item_id, action in actions.items() if action != "delete"]
+            if deleted:
+                shadow.delete(ids=deleted)
+            if changed:
+                page = source.get(ids=changed, include=self._include)
+                if page["ids"]:
+                    self._write_items(shadow, page)
+
+    def _reconcile(self, user_id):
+        """Bring a user's shadow collection in line with the live one before the swap."""
+        source = self._source_collection(user_id)
+        shadow = self._shadow_collection(user_id, source)
+        self._apply_pending(self._drain_pending(), {user_id: source}, {user_id: shadow})
+        live_ids = set(source.get(include=[])["ids"])
+        shadow_ids = set(shadow.get(include=[])["ids"])
+        stale = sorted(shadow_ids - live_ids)
+        missing = sorted(live_ids - shadow_ids)
+        if stale:
+            shadow.delete(ids=stale)
+        for start in range(0, len(missing), self.batch_size):
+            page = source.get(ids=missing[start:start + self.batch_size], include=self._include)
+            self._write_items(shadow, page)
+        if stale or missing:
+            logger.info("Reconciled shadow collection", extra={"kind": self.kind, "user_id": user_id,
+                                                               "stale": len(stale), "missing": len(missing)})
+
+    def _swap(self):
+        # Writes are held off while the aliases and the encoder change, so none
+        # resolves the old collection and then lands after it was replaced, and
+        # none embeds with the old encoder into a new collection.
+        with write_events.gate(self.kind).exclusive():
+            old_names = {user_id: ALIASES.resolve(self._logical_name(user_id)) for user_id in self.state["users"]}
+            with self._lock:
+                self._recording = False
+                pending, self._pending = self._pending, {}
+            ALIASES.update({self._logical_name(user_id): self._shadow_name(user_id)
+                            for user_id in self.state["users"]})
+            if self.spec is not None:
+                set_handler_encoder(self.kind, self.handler, self.encoder)
+                save_encoder_spec(self.kind, self.spec)
+                if getattr(self.handler, "compressed_index", None) is not None:
+                    self.handler.compressed_index.reset()
+
+            # Writes that reached the old collections between the last reconcile and
+            # the swap are replayed into the new ones before the old ones are dropped.
+            sources = {user_id: self.client.get_collection(name) for user_id, name in old_names.items()}
+            self._apply_pending(pending, sources, {})
+        mapping = {old_names[user_id]: self._shadow_name(user_id) for user_id in self.state["users"]}
+        if self.on_swap is not None:
+            self.on_swap(self.kind, mapping)
+        for name in old_names.values():
+            try:
+                self.client.delete_collection(name)
+            except Exception as e:
+                logger.warning("Failed to drop old collection", extra={"collection": name, "error": str(e)})
+
+
+def _read_text_source(metadata, document):
+    file_path = metadata.get("file_path")
+    if file_path and os.path.exists(file_path):
+        with open(file_path, encoding="utf-8") as f:
+            return json.load(f).get("content", document)
+    return document
@@ -0,0 +1,545 @@
+"""
+User-sharded Chroma storage.
+
+Every user's collections (``text_collection_<user>``, ``image_collection_<user>``,
+``audio_collection_<user>`` and their re-index shadows) live together on one
+shard: a local Chroma directory or a Chroma server. Shards are configured with
+ORBIT_CHROMA_SHARDS, a comma-separated list of ``name=target`` entries where the
+target is a path or an ``http(s)://host:port`` URL:
+
+    ORBIT_CHROMA_SHARDS="a=OrbitDB,b=http://10.0.0.2:8000,c=http://10.0.0.3:8000"
+
+Without it there is one shard, ``default``, at ORBIT_CHROMA_PATH.
+
+New users are placed by rendezvous hashing of their id over the shard names, so
+adding a shard only claims the new users that hash to it. Placements are then
+pinned in a small sqlite map (ORBIT_SHARD_MAP), and a user only changes shard
+when they are moved. Users whose data predates the map are found by scanning
+the shards once. ShardedClient is a drop-in for the Chroma client that routes
+every collection call to its user's shard, so the handlers and maintenance jobs
+work unchanged.
+
+Moves are online. The user's collections are copied with their embeddings, so
+nothing is re-encoded, while reads keep going to the source. Writes made during
+the copy are tracked by id. A short per-user write lock then covers replaying
+them and flipping the pin; after that the source copies are dropped. This
+relies on the writes going through this process's router, so moves run inside
+the app (POST /api/admin/shards/move or /rebalance). Run the command line tool
+only while the app is stopped:
+
+    python -m helpers.shards status
+    python -m helpers.shards move --user <id> --to b
+    python -m helpers.shards rebalance [--dry-run] [--limit 10]
+    python -m helpers.shards serve --count 3 --base-port 8001 --root data/shards
+
+``serve`` starts one local ``chroma run`` process per shard, for trying out (or
+testing) a multi-process layout on one machine, and prints the matching
+ORBIT_CHROMA_SHARDS value.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("shards")
+
+# Handler collections and their re-index shadows (see helpers/reindex.py) are named after their user.
+COLLECTION_NAME = re.compile(r"^(?:text|image|audio)_collection_(?P<user>.+?)(?:__v\d+)?$")
+WRITE_METHODS = ("add", "upsert", "update", "delete")
+TIMED_METHODS = ("query", "get", "count", "peek") + WRITE_METHODS
+
+SHARD_SECONDS = REGISTRY.histogram(
+    "orbit_shard_request_seconds",
+    "Latency of Chroma calls by shard and operation.",
+    ("shard", "op"),
+)
+SHARD_ERRORS = REGISTRY.counter(
+    "orbit_shard_errors_total",
+    "Failed Chroma calls by shard and operation.",
+    ("shard", "op"),
+)
+SHARD_UP = REGISTRY.gauge(
+    "orbit_shard_up",
+    "1 if the shard answered its last heartbeat.",
+    ("shard",),
+)
+SHARD_HEARTBEAT_SECONDS = REGISTRY.gauge(
+    "orbit_shard_heartbeat_seconds",
+    "Round trip of the shard's last heartbeat.",
+    ("shard",),
+)
+SHARD_USERS = REGISTRY.gauge(
+    "orbit_shard_users",
+    "Users pinned to each shard.",
+    ("shard",),
+)
+SHARD_MOVES = REGISTRY.counter(
+    "orbit_shard_moves_total",
+    "User moves between shards by outcome.",
+    ("outcome",),
+)
+
+
+def parse_shards(spec=None, default_path=None):
+    """
+    Parse a shard list.
+
+    Args:
+        spec (str, optional): ``name=target`` entries separated by commas (ORBIT_CHROMA_SHARDS).
+            Entries without a name are called s0, s1, ...
+        default_path (str, optional): Path of the single default shard when ``spec`` is empty
+            (ORBIT_CHROMA_PATH, default "OrbitDB").
+
+    Returns:
+        OrderedDict: shard name -> target.
+    """
+    spec = os.getenv("ORBIT_CHROMA_SHARDS", "") if spec is None else spec
+    shards = OrderedDict()
+    for index, entry in enumerate(part.strip() for part in spec.split(",")):
+        if not entry:
+            continue
+        name, _, target = entry.partition("=") if "=" in entry.split("://")[0] else ("", "", entry)
+        shards[name.strip() or f"s{index}"] = target.strip()
+    if not shards:
+        shards["default"] = default_path or os.getenv("ORBIT_CHROMA_PATH", "OrbitDB")
+    return shards
+
+
+def user_of(collection_name):
+    """The user a handler collection belongs to, or None for other collections."""
+    match = COLLECTION_NAME.match(collection_name)
+    return match.group("user") if match else None
+
+
+class Shard:
+    """One Chroma instance: a local persistent directory or a server, connected on first use."""
+
+    def __init__(self, name, target, wrap=None):
+        self.name = name
+        self.target = target
+        self.local = not target.startswith(("http://", "https://"))
+        self._wrap = wrap
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import chromadb
+
+                if self.local:
+                    client = chromadb.PersistentClient(path=self.target)
+                else:
+                    url = urlparse(self.target)
+                    client = chromadb.HttpClient(host=url.hostname, port=url.port or 8000,
+                                                 ssl=url.scheme == "https")
+                self._client = self._wrap(self, client) if self._wrap else client
+            return self._client
+
+    def collection_names(self):
+        return [entry if isinstance(entry, str) else entry.name for entry in self.client.list_collections()]
+
+    def call(self, op, fn, *args, **kwargs):
+        """Run a Chroma call against this shard, recording its latency and failures."""
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            SHARD_ERRORS.inc(shard=self.name, op=op)
+            raise
+        finally:
+            SHARD_SECONDS.observe(time.perf_counter() - started, shard=self.name, op=op)
+
+
+class _Move:
+    """An in-progress move: writes to the user's collections are serialized with the flip and recorded."""
+
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.dirty = {}  # collection name -> ids written during the copy
+        self.resync = set()  # collections written without ids (delete by where), copied again in full
+
+    def record(self, name, ids):
+        if ids is None:
+            self.resync.add(name)
+        else:
+            self.dirty.setdefault(name, set()).update([ids] if isinstance(ids, str) else ids)
+
+
+class ShardRouter:
+    """
+    Maps users to shards and moves them between shards.
+
+    Args:
+        shards (Mapping, optional): shard name -> target, see parse_shards().
+        map_path (str, optional): sqlite file pinning users to shards (ORBIT_SHARD_MAP, default "shard_map.db").
+        wrap (Callable[[Shard, client], client], optional): Applied to each shard's client when
+            it connects, e.g. to track index residency of local shards.
+    """
+
+    def __init__(self, shards=None, map_path=None, wrap=None):
+        shards = parse_shards() if shards is None else shards
+        self.shards = OrderedDict((name, Shard(name, target, wrap)) for name, target in shards.items())
+        self.default = next(iter(self.shards.values()))
+        self.map_path = map_path or os.getenv("ORBIT_SHARD_MAP", "shard_map.db")
+        self._db = sqlite3.connect(self.map_path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS placements (user_id TEXT PRIMARY KEY, shard TEXT NOT NULL)")
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._placements = dict(self._db.execute("SELECT user_id, shard FROM placements"))
+        self._scanned = False
+        self._user_locks = {}
+        self._moves = {}
+        self.move_status = {"state": "idle"}
+
+    # -- placement -------------------------------------------------------------------------
+
+    def hashed_shard(self, user_id):
+        """The shard rendezvous hashing picks for a user among the configured shards."""
+        return max(self.shards, key=lambda name: hashlib.sha256(f"{name}\0{user_id}".encode("utf-8")).digest())
+
+    def _pin(self, user_id, shard):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO placements (user_id, shard) VALUES (?, ?)", (user_id, shard))
+            self._db.commit()
+            self._placements[user_id] = shard
+
+    def _scan(self):
+        """Pin users whose collections already exist on a shard (data older than the placement map)."""
+        found = {}
+        for shard in self.shards.values():
+            try:
+                names = shard.collection_names()
+            except Exception as e:
+                logger.warning("Shard scan failed", extra={"shard": shard.name, "error": str(e)})
+                continue
+            for name in names:
+                user_id = user_of(name)
+                if user_id is not None and user_id not in self._placements:
+                    found.setdefault(user_id, shard.name)
+        for user_id, shard in found.items():
+            self._pin(user_id, shard)
+        self._scanned = True
+        if found:
+            logger.info("Pinned existing users to shards", extra={"users": len(found)})
+
+    def shard_for(self, user_id):
+        """Name of the shard holding a user's collections; new users are hashed and pinned."""
+        user_id = str(user_id)
+        shard = self._placements.get(user_id)
+        if shard is None and not self._scanned:
+            self._scan()
+            shard = self._placements.get(user_id)
+        if shard is None:
+            shard = self.hashed_shard(user_id)
+            self._pin(user_id, shard)
+        if shard not in self.shards:
+            raise KeyError(f"User {user_id} is pinned to unknown shard {shard}")
+        return shard
+
+    def shard_of_collection(self, name):
+        user_id = user_of(name)
+        return self.shards[self.shard_for(user_id)] if user_id is not None else self.default
+
+    def user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(str(user_id), threading.RLock())
+
+    def client(self):
+        """A Chroma client facade routing every collection to its user's shard."""
+        return ShardedClient(self)
+
+    # -- health ----------------------------------------------------------------------------
+
+    def health(self):
+        """Heartbeat every shard and refresh the shard gauges."""
+        report = {}
+        users = {}
+        for shard in self._placements.values():
+            users[shard] = users.get(shard, 0) + 1
+        for shard in self.shards.values():
+            started = time.perf_counter()
+            try:
+                shard.client.heartbeat()
+                up, error = True, None
+            except Exception as e:
+                up, error = False, str(e)
+            elapsed = time.perf_counter() - started
+            SHARD_UP.set(1 if up else 0, shard=shard.name)
+            SHARD_HEARTBEAT_SECONDS.set(elapsed, shard=shard.name)
+            SHARD_USERS.set(users.get(shard.name, 0), shard=shard.name)
+            report[shard.name] = {"target": shard.target, "up": up, "heartbeat_seconds": round(elapsed, 4),
+                                  "users": users.get(shard.name, 0), "error": error}
+        return report
+
+    # -- moves -----------------------------------------------------------------------------
+
+    def _user_collections(self, shard, user_id):
+        return [name for name in shard.collection_names() if user_of(name) == user_id]
+
+    def _copy(self, source, target, name, ids=None, batch_size=500):
+        """Copy a collection (or some of its ids) from one shard to another, embeddings included."""
+        src = source.client.get_collection(name)
+        dst = target.client.get_or_create_collection(name=name, metadata=src.metadata)
+        include = ["embeddings", "documents", "metadatas", "uris"]
+        copied = 0
+        if ids is not None:
+            ids = sorted(ids)
+            batches = (src.get(ids=ids[offset:offset + batch_size], include=include)
+                       for offset in range(0, len(ids), batch_size))
+            present = set()
+            for batch in batches:
+                copied += self._upsert(target, dst, batch)
+                present.update(batch["ids"])
+            gone = [item_id for item_id in ids if item_id not in present]
+            if gone:
+                target.call("delete", dst.delete, ids=gone)
+            return copied
+        offset = 0
+        while True:
+            batch = source.call("get", src.get, offset=offset, limit=batch_size, include=include)
+            if not batch["ids"]:
+                return copied
+            copied += self._upsert(target, dst, batch)
+            offset += len(batch["ids"])
+
+    def _upsert(self, target, collection, batch):
+        if not batch["ids"]:
+            return 0
+        uris = batch.get("uris")
+        target.call("upsert", collection.upsert, ids=batch["ids"], embeddings=batch["embeddings"],
+                    documents=batch.get("documents"), metadatas=batch.get("metadatas"),
+                    uris=uris if uris and any(uris) else None)
+        return len(batch["ids"])
+
+    def move_user(self, user_id, target, batch_size=500):
+        """
+        Move a user's collections to another shard while the app keeps serving them.
+
+        Args:
+            user_id (str): User to move.
+            target (str): Destination shard name.
+            batch_size (int): Items copied per call.
+
+        Returns:
+            dict: Source, target and items copied per collection.
+        """
+        user_id = str(user_id)
+        if target not in self.shards:
+            raise KeyError(f"Unknown shard {target}")
+        source_name = self.shard_for(user_id)
+        if source_name == target:
+            return {"user_id": user_id, "source": source_name, "target": target, "copied": {}}
+        source, destination = self.shards[source_name], self.shards[target]
+        lock = self.user_lock(user_id)
+        move = _Move(source_name, target)
+        # Registering under the user's write lock means every later write sees the move.
+        with lock:
+            if user_id in self._moves:
+                raise RuntimeError(f"User {user_id} is already being moved")
+            self._moves[user_id] = move
+        copied = {}
+        try:
+            for name in self._user_collections(source, user_id):
+                copied[name] = self._copy(source, destination, name, batch_size=batch_size)
+            with lock:
+                # Writes are held off while the ones made during the copy are replayed and the pin flips.
+                remaining = self._user_collections(source, user_id)
+                for name in set(copied) - set(remaining):
+                    # Dropped on the source meanwhile (e.g. a re-index swap).
+                    destination.client.delete_collection(name)
+                    del copied[name]
+                for name in remaining:
+                    if name not in copied or name in move.resync:
+                        copied[name] = self._copy(source, destination, name, batch_size=batch_size)
+                    elif move.dirty.get(name):
+                        self._copy(source, destination, name, ids=move.dirty[name], batch_size=batch_size)
+                self._pin(user_id, target)
+                del self._moves[user_id]
+        except Exception:
+            with lock:
+                self._moves.pop(user_id, None)
+            SHARD_MOVES.inc(outcome="failed")
+            raise
+        for name in copied:
+            try:
+                source.client.delete_collection(name)
+            except Exception as e:
+                logger.warning("Could not drop moved collection from source shard",
+                               extra={"shard": source_name, "collection": name, "error": str(e)})
+        SHARD_MOVES.inc(outcome="moved")
+        logger.info("User moved to shard", extra={"user_id": user_id, "source": source_name, "target": target,
+                                                    "items": sum(copied.values())})
+        return {"user_id": user_id, "source": source_name, "target": target, "copied": copied}
+
+    def rebalance_plan(self):
+        """Users pinned somewhere other than where hashing over the current shards would place them."""
+        if not self._scanned:
+            self._scan()
+        return [{"user_id": user_id, "source": shard, "target": self.hashed_shard(user_id)}
+                for user_id, shard in sorted(self._placements.items()) if shard != self.hashed_shard(user_id)]
+
+    def rebalance(self, limit=None, dry_run=False):
+        """Move users to their hashed shard, one at a time; progress is kept in ``move_status``."""
+        plan = self.rebalance_plan()[:limit] if limit else self.rebalance_plan()
+        if dry_run:
+            return {"planned": plan}
+        self.move_status = {"state": "running", "planned": len(plan), "moved": 0, "failed": []}
+        for entry in plan:
+            self.move_status["current"] = entry
+            try:
+                self.move_user(entry["user_id"], entry["target"])
+                self.move_status["moved"] += 1
+            except Exception as e:
+                logger.error("Shard move failed", extra={**entry, "error": str(e)})
+                self.move_status["failed"].append({**entry, "error": str(e)})
+        self.move_status.pop("current", None)
+        self.move_status["state"] = "done"
+        return self.move_status
+
+    def start_rebalance(self, limit=None):
+        """Run rebalance() in a background thread; returns False if one is already running."""
+        if self.move_status.get("state") == "running":
+            return False
+        self.move_status = {"state": "running"}
+        threading.Thread(target=self.rebalance, kwargs={"limit": limit}, name="shard-rebalance",
+                         daemon=True).start()
+        return True
+
+
+class _ShardCollection:
+    """Collection proxy that times calls per shard and coordinates writes with in-progress moves."""
+
+    def __init__(self, router, shard, collection, user_id, reopen):
+        self._router = router
+        self._shard = shard
+        self._collection = collection
+        self._user_id = user_id
+        self._reopen = reopen
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in WRITE_METHODS and self._user_id is not None:
+            return lambda *args, **kwargs: self._write(name, *args, **kwargs)
+        if name in TIMED_METHODS:
+            return lambda *args, **kwargs: self._shard.call(name, attribute, *args, **kwargs)
+        return attribute
+
+    def _write(self, op, *args, **kwargs):
+        with self._router.user_lock(self._user_id):
+            current = self._router.shard_for(self._user_id)
+            if current != self._shard.name:
+                # The user was moved after this collection was handed out; open it again, embedding
+                # function and all, on the new shard.
+                self._shard = self._router.shards[current]
+                self._collection = self._reopen(self._shard)
+            result = self._shard.call(op, getattr(self._collection, op), *args, **kwargs)
+            move = self._router._moves.get(self._user_id)
+            if move is not None:
+                move.record(self._collection.name, kwargs.get("ids", args[0] if args else None))
+            return result
+
+
+class ShardedClient:
+    """Chroma client facade: collection calls go to the collection's user's shard."""
+
+    def __init__(self, router):
+        self._router = router
+
+    def _open(self, op, name, *args, **kwargs):
+        shard = self._router.shard_of_collection(name)
+        collection = shard.call(op, getattr(shard.client, op), name, *args, **kwargs)
+        # After a move the collection exists on the new shard, so a created one is reopened with get_or_create.
+        reopen_op = "get_collection" if op == "get_collection" else "get_or_create_collection"
+        return _ShardCollection(self._router, shard, collection, user_of(name),
+                                lambda to: getattr(to.client, reopen_op)(name, *args, **kwargs))
+
+    def get_or_create_collection(self, name, *args, **kwargs):
+        return self._open("get_or_create_collection", name, *args, **kwargs)
+
+    def get_collection(self, name, *args, **kwargs):
+        return self._open("get_collection", name, *args, **kwargs)
+
+    def create_collection(self, name, *args, **kwargs):
+        return self._open("create_collection", name, *args, **kwargs)
+
+    def delete_collection(self, name, *args, **kwargs):
+        shard = self._router.shard_of_collection(name)
+        return shard.call("delete_collection", shard.client.delete_collection, name, *args, **kwargs)
+
+    def list_collections(self, *args, **kwargs):
+        names = []
+        for shard in self._router.shards.values():
+            names.extend(shard.call("list_collections", shard.collection_names))
+        return names
+
+    def heartbeat(self):
+        return min(shard.client.heartbeat() for shard in self._router.shards.values())
+
+    def __getattr__(self, name):
+        return getattr(self._router.default.client, name)
+
+
+def serve(count, base_port, root, host="127.0.0.1"):
+    """Start one ``chroma run`` process per shard and wait on them; prints the ORBIT_CHROMA_SHARDS value."""
+    processes = []
+    targets = []
+    for index in range(count):
+        path = os.path.join(root, f"shard{index}")
+        os.makedirs(path, exist_ok=True)
+        port = base_port + index
+        processes.append(subprocess.Popen(["chroma", "run", "--path", path, "--host", host, "--port", str(port)],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        targets.append(f"shard{index}=http://{host}:{port}")
+    print(f"ORBIT_CHROMA_SHARDS={','.join(targets)}", flush=True)
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "move", "rebalance", "serve"])
+    parser.add_argument("--user", help="User to move.")
+    parser.add_argument("--to", help="Destination shard for move.")
+    parser.add_argument("--limit", type=int, help="Move at most this many users.")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the moves rebalance would make.")
+    parser.add_argument("--count", type=int, default=2, help="Shard servers to start (serve).")
+    parser.add_argument("--base-port", type=int, default=8001)
+    parser.add_argument("--root", default=os.path.join("data", "shards"))
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.count, args.base_port, args.root)
+        return
+    router = ShardRouter()
+    if args.command == "status":
+        result = {"shards": router.health(), "rebalance": router.rebalance_plan()}
+    elif args.command == "move":
+        if not args.user or not args.to:
+            parser.error("move needs --user and --to")
+        result = router.move_user(args.user, args.to)
+    else:
+        result = router.rebalance(limit=args.limit, dry_run=args.dry_run)
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
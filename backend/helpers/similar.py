@@ -0,0 +1,92 @@
+"""
+"More like this" lookups from stored vectors.
+
+An item's embedding is already in its collection, so neighbours are found by
+querying with that vector directly: no file is reloaded and no encoder runs.
+Collections whose encoders share an embedding space can be queried with the
+same vector, e.g. image and text collections both encoded with CLIP.
+
+Encoders are grouped into spaces by their model spec (see
+helpers/reindex.build_encoder). A spec may name its space explicitly with a
+``"space"`` key when two modalities are deliberately encoded into one space.
+"""
+from helpers.metrics import timed
+from data_handlers.CompressedIndex import query_result
+
+# Fields returned for neighbours of each modality, matching the search endpoints.
+INCLUDE = {"text": ["documents", "metadatas"], "image": ["uris", "metadatas"], "audio": ["metadatas", "uris"]}
+DEFAULT_MODELS = {"text": "mpnet", "image": "openclip", "audio": "clap"}
+
+
+def embedding_space(kind, spec=None):
+    """
+    Name the embedding space a modality's encoder produces.
+
+    Args:
+        kind (str): "text", "image" or "audio".
+        spec (dict, optional): Encoder spec, see reindex.build_encoder(); None means
+            the handler's default encoder.
+
+    Returns:
+        str: Space name; vectors are only comparable within one space.
+    """
+    spec = spec or {}
+    if spec.get("space"):
+        return str(spec["space"])
+    model = spec.get("model") or DEFAULT_MODELS[kind]
+    if model == "stub":
+        return f"stub:{kind}"
+    if kind == "image":
+        return ":".join(str(part) for part in ("openclip", model, spec.get("checkpoint", "")))
+    return f"{DEFAULT_MODELS[kind]}:{model}"
+
+
+def stored_embedding(collection, item_id):
+    """
+    Return an item's stored embedding.
+
+    Args:
+        collection: Chroma collection holding the item.
+        item_id (str): Item identifier.
+
+    Returns:
+        list or None: The vector, or None if the item does not exist.
+    """
+    with timed("collection_get", model="similar"):
+        result = collection.get(ids=[item_id], include=["embeddings"])
+    if not result["ids"] or result["embeddings"] is None or len(result["embeddings"]) == 0:
+        return None
+    return [float(value) for value in result["embeddings"][0]]
+
+
+def neighbours(handler, kind, user_id, vector, n_results=10, where=None, exclude=()):
+    """
+    Find the items of one modality nearest to a vector.
+
+    Args:
+        handler: The modality's handler (for its collection and compressed index).
+        kind (str): "text", "image" or "audio".
+        user_id (str): Owner of the collection.
+        vector (list): Query vector from the same embedding space.
+        n_results (int): Number of neighbours.
+        where (dict, optional): Chroma metadata filter applied before the vector search.
+        exclude (Iterable[str]): Ids to leave out, e.g. the item itself.
+
+    Returns:
+        dict: Results shaped like ``collection.query()`` output.
+    """
+    exclude = set(exclude)
+    collection = handler._get_user_collection(user_id)
+    if handler.compressed_index is not None:
+        index = handler.compressed_index.for_user(user_id, collection)
+        allowed = collection.get(where=where, include=[])["ids"] if where else None
+        ids, distances = index.search(vector, n_results, exclude=exclude, allowed=allowed)
+        return query_result(collection, ids, distances, INCLUDE[kind])
+    with timed("collection_query", model=f"similar_{kind}"):
+        results = collection.query(query_embeddings=[vector], n_results=n_results + len(exclude), where=where,
+                                   include=INCLUDE[kind] + ["distances"])
+    keep = [index for index, item_id in enumerate(results["ids"][0]) if item_id not in exclude][:n_results]
+    for field in ["ids", "distances"] + INCLUDE[kind]:
+        if results.get(field):
+            results[field] = [[results[field][0][index] for index in keep]]
+    return results
@@ -0,0 +1,453 @@
+"""
+Background garbage collection and consistency checking for stored media.
+
+Files under ``data/`` and records in Chroma drift apart over time: deletes
+that failed half-way leave files without items, files removed by hand leave
+items pointing at nothing, and crashed writes leave temp files behind. A
+StorageGC pass streams through every user in turn and finds
+
+* ``dangling`` items whose file (text JSON sidecar, image or audio) is gone;
+* ``orphaned`` files in a user's folders that no item references;
+* ``stale_refs``: blob-store references held for items that no longer exist
+  (references younger than ORBIT_GC_TEMP_MAX_AGE_S may be mid-save and are left);
+* ``temp`` files left by interrupted writes (older than ORBIT_GC_TEMP_MAX_AGE_S);
+* unreferenced or orphaned blobs, via BlobStore.check().
+
+Findings are always reported; with ``repair`` they are also fixed: text
+sidecars are rewritten from the stored document, media items are repointed at
+their blob when it still exists and deleted otherwise, and stray files and
+references are removed. Only users with a collection on the client are
+cleaned: users found only under ``data/`` may live on another shard, and a
+collection that cannot be read skips the user until the next pass.
+
+All file and item work is charged against an I/O budget (ORBIT_GC_IOPS
+operations per second) and progress is checkpointed after each user, so an
+interrupted pass resumes with the next user:
+
+    python -m helpers.storage_gc run [--repair] [--iops 200] [--restart]
+    python -m helpers.storage_gc status
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from chromadb.errors import InvalidCollectionException, NotFoundError
+
+from helpers import write_events
+from helpers.blob_store import PATH_FIELDS, TEMP_PREFIX, TMP_DIR
+from helpers.collection_aliases import ALIASES
+from helpers.item_fields import COLLECTION_PREFIXES, DEFAULT_FOLDERS
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY
+
+logger = get_logger("storage_gc")
+
+FINDINGS = ("dangling", "orphaned", "stale_refs", "temp", "blobs")
+# Example paths or ids kept per finding in the report.
+SAMPLE_SIZE = 50
+
+GC_FINDINGS = REGISTRY.counter(
+    "orbit_gc_findings_total",
+    "Storage inconsistencies found by the garbage collector, by finding.",
+    ("finding",),
+)
+GC_REPAIRS = REGISTRY.counter(
+    "orbit_gc_repairs_total",
+    "Storage inconsistencies repaired by the garbage collector, by finding.",
+    ("finding",),
+)
+GC_THROTTLED_SECONDS = REGISTRY.counter(
+    "orbit_gc_throttled_seconds_total",
+    "Time the garbage collector slept to stay within its I/O budget.",
+)
+
+
+class IOBudget:
+    """Token bucket limiting file and item operations per second."""
+
+    def __init__(self, ops_per_second):
+        self.rate = float(ops_per_second)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+
+    def spend(self, ops=1):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= ops
+        if self.tokens < 0:
+            wait = -self.tokens / self.rate
+            GC_THROTTLED_SECONDS.inc(wait)
+            time.sleep(wait)
+
+
+def _write_json(path, payload):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _new_state(repair):
+    return {
+        "status": "pending",
+        "repair": repair,
+        "users_done": [],
+        "users_failed": [],
+        "found": {finding: 0 for finding in FINDINGS},
+        "repaired": {finding: 0 for finding in FINDINGS},
+        "samples": {finding: [] for finding in FINDINGS},
+        "started_at": time.time(),
+        "finished_at": None,
+        "error": None,
+    }
+
+
+class StorageGC:
+    """
+    One garbage-collection pass over every user's collections and folders.
+
+    The pass runs on a daemon thread (start()) or inline (run()). Its state
+    lives in a JSON checkpoint so ``StorageGC.resume()`` continues an
+    interrupted pass after a restart.
+    """
+
+    def __init__(self, client, blob_store=None, folders=None, state_path=None, repair=False, iops=None,
+                 temp_max_age=None, delete_item=None, batch_size=200, state=None):
+        """
+        Args:
+            client: Chroma client.
+            blob_store (BlobStore, optional): Shared media store to check as well.
+            folders (dict, optional): Kind -> base folder of per-user files.
+            state_path (str, optional): Checkpoint file (ORBIT_GC_STATE, default "storage_gc.json").
+            repair (bool): Fix what is found instead of only reporting it.
+            iops (float, optional): Operations per second (ORBIT_GC_IOPS, default 200; 0 is unlimited).
+            temp_max_age (float, optional): Age in seconds after which temp files count
+                as stray (ORBIT_GC_TEMP_MAX_AGE_S, default 3600).
+            delete_item (Callable[[str, str, str], None], optional): Deletes a dangling
+                item as ``delete_item(kind, user_id, item_id)``; defaults to deleting it
+                from its collection and publishing a write event.
+            batch_size (int): Items read per page.
+            state (dict, optional): Checkpoint contents to resume from.
+        """
+        self.client = client
+        self.blob_store = blob_store
+        self.folders = folders or DEFAULT_FOLDERS
+        self.state_path = state_path or os.getenv("ORBIT_GC_STATE", "storage_gc.json")
+        self.iops = iops if iops is not None else float(os.getenv("ORBIT_GC_IOPS", "200"))
+        self.temp_max_age = temp_max_age if temp_max_age is not None else float(
+            os.getenv("ORBIT_GC_TEMP_MAX_AGE_S", "3600"))
+        self.delete_item = delete_item or self._delete_item
+        self.batch_size = batch_size
+        self.state = state or _new_state(repair)
+        self.repair = self.state["repair"]
+        self.budget = IOBudget(self.iops)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @classmethod
+    def resume(cls, client, state_path=None, **kwargs):
+        """
+        Rebuild an interrupted pass from its checkpoint.
+
+        Returns:
+            StorageGC or None: The pass if the checkpoint describes an unfinished run.
+        """
+        state_path = state_path or os.getenv("ORBIT_GC_STATE", "storage_gc.json")
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("status") not in ("pending", "running"):
+            return None
+        return cls(client, state_path=state_path, state=state, **kwargs)
+
+    @staticmethod
+    def last_report(state_path=None):
+        """Return the checkpoint of the most recent pass, or None."""
+        state_path = state_path or os.getenv("ORBIT_GC_STATE", "storage_gc.json")
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    # --------------------------------------------------------------- lifecycle
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self):
+        with self._lock:
+            return json.loads(json.dumps(self.state))
+
+    def start(self):
+        """Run the pass on a daemon thread."""
+        if self.is_running():
+            raise RuntimeError("Storage GC already running")
+        self._thread = threading.Thread(target=self.run, name="storage-gc", daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        try:
+            self._set_status("running")
+            listed = self._listed_users()
+            for user_id in self._discover_users(listed):
+                if user_id in self.state["users_done"]:
+                    continue
+                try:
+                    self._check_user(user_id, user_id in listed)
+                except Exception as e:
+                    # Left out of users_done: the next pass checks the user again.
+                    logger.error("Storage GC skipped user", extra={"user_id": user_id, "error": str(e)})
+                    with self._lock:
+                        self.state.setdefault("users_failed", []).append(user_id)
+                    self._checkpoint()
+                    continue
+                with self._lock:
+                    self.state["users_done"].append(user_id)
+                self._checkpoint()
+            self._check_blobs()
+            with self._lock:
+                self.state["finished_at"] = time.time()
+            self._set_status("completed")
+            logger.info("Storage GC finished", extra={"repair": self.repair, "found": self.state["found"],
+                                                      "repaired": self.state["repaired"]})
+        except Exception as e:
+            logger.error("Storage GC failed", extra={"error": str(e)})
+            with self._lock:
+                self.state["error"] = str(e)
+            self._set_status("failed")
+        return self.status()
+
+    def _set_status(self, status):
+        with self._lock:
+            self.state["status"] = status
+        self._checkpoint()
+
+    def _checkpoint(self):
+        with self._lock:
+            _write_json(self.state_path, self.state)
+
+    def _record(self, finding, detail, repaired=False):
+        GC_FINDINGS.inc(finding=finding)
+        with self._lock:
+            self.state["found"][finding] += 1
+            if len(self.state["samples"][finding]) < SAMPLE_SIZE:
+                self.state["samples"][finding].append(detail)
+            if repaired:
+                self.state["repaired"][finding] += 1
+        if repaired:
+            GC_REPAIRS.inc(finding=finding)
+
+    # ---------------------------------------------------------------- discovery
+
+    def _listed_users(self):
+        """Users with a collection on this client."""
+        user_ids = set()
+        # Chroma 0.6 lists collection names (which raise on .name); older versions
+        # return Collection objects.
+        logical = {physical: name for name, physical in ALIASES.items().items()}
+        for entry in self.client.list_collections():
+            name = entry if isinstance(entry, str) else entry.name
+            name = logical.get(name, name)
+            for prefix in COLLECTION_PREFIXES.values():
+                if name.startswith(prefix) and "__v" not in name:
+                    user_ids.add(name[len(prefix):])
+        return user_ids
+
+    def _discover_users(self, listed):
+        """Users with a collection or a folder, in a stable order for resumption."""
+        user_ids = set(listed)
+        for base in self.folders.values():
+            if os.path.isdir(base):
+                user_ids.update(entry.name for entry in os.scandir(base) if entry.is_dir())
+        return sorted(user_ids)
+
+    def _collection(self, kind, user_id):
+        """The user's collection of a kind, or None if it does not exist. Other errors propagate."""
+        name = ALIASES.resolve(f"{COLLECTION_PREFIXES[kind]}{user_id}")
+        try:
+            return self.client.get_collection(name)
+        except (InvalidCollectionException, NotFoundError):
+            return None
+
+    # --------------------------------------------------------------- per user
+
+    def _check_user(self, user_id, listed=True):
+        """
+        Check one user's items, then their folders and blob references.
+
+        Every collection is read in full before any file or reference is
+        judged, and a collection that cannot be read (anything but "does not
+        exist") aborts the user's check. Folders and references are only
+        checked for ``listed`` users, who have a collection on this client: a
+        user found only under ``data/`` may live on another shard.
+        """
+        referenced = set()
+        seen = {kind: set() for kind in COLLECTION_PREFIXES}
+        for kind in COLLECTION_PREFIXES:
+            collection = self._collection(kind, user_id)
+            if collection is not None:
+                self._check_collection(kind, user_id, collection, referenced, seen[kind])
+        if not listed:
+            return
+        for kind, base in self.folders.items():
+            self._check_folder(os.path.join(base, user_id), referenced)
+        if self.blob_store is None:
+            return
+        now = time.time()
+        for kind, item_id, digest, created_at in self.blob_store.refs_for(user_id):
+            # Media is stored before its item is added, so a young reference may
+            # belong to a save that has not reached Chroma yet.
+            if item_id in seen.get(kind, ()) or (created_at is not None and now - created_at < self.temp_max_age):
+                continue
+            self.budget.spend()
+            if self._item_exists(kind, user_id, item_id):
+                continue
+            repaired = self.repair and self.blob_store.release(user_id, kind, item_id)
+            self._record("stale_refs", f"{user_id}/{kind}/{item_id}", repaired)
+
+    def _item_exists(self, kind, user_id, item_id):
+        collection = self._collection(kind, user_id)
+        return collection is not None and bool(collection.get(ids=[item_id], include=[])["ids"])
+
+    def _check_collection(self, kind, user_id, collection, referenced, seen):
+        offset = 0
+        while True:
+            self.budget.spend()
+            page = collection.get(offset=offset, limit=self.batch_size,
+                                  include=["metadatas", "uris", "documents"])
+            if not page["ids"]:
+                return
+            offset += len(page["ids"])
+            deleted = 0
+            uris = page.get("uris") or [None] * len(page["ids"])
+            documents = page.get("documents") or [None] * len(page["ids"])
+            for item_id, uri, document, metadata in zip(page["ids"], uris, documents, page["metadatas"]):
+                seen.add(item_id)
+                metadata = metadata or {}
+                path = metadata.get("file_path") if kind == "text" else (
+                    uri or metadata.get(PATH_FIELDS[kind]) or metadata.get("file_path"))
+                if not path:
+                    continue
+                self.budget.spend()
+                if os.path.exists(path):
+                    referenced.add(os.path.abspath(path))
+                    continue
+                outcome = self._repair_dangling(kind, user_id, collection, item_id, path, document, metadata,
+                                                referenced)
+                self._record("dangling", f"{user_id}/{kind}/{item_id}", outcome is not None)
+                deleted += outcome == "deleted"
+            # Deleted items shift the following pages back.
+            offset -= deleted
+
+    def _repair_dangling(self, kind, user_id, collection, item_id, path, document, metadata, referenced):
+        """
+        Fix an item whose file is missing.
+
+        Returns:
+            str or None: "rewritten", "repointed" or "deleted", or None when not repairing.
+        """
+        if not self.repair:
+            return None
+        if kind == "text":
+            # The document is stored in Chroma; only the JSON sidecar is lost.
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"content": document, "metadata": metadata}, f, ensure_ascii=False, indent=2)
+            referenced.add(os.path.abspath(path))
+            return "rewritten"
+        blob = self.blob_store.lookup(user_id, kind, item_id) if self.blob_store is not None else None
+        if blob is not None and os.path.exists(blob[1]):
+            collection.update(ids=[item_id], uris=[blob[1]], metadatas=[{PATH_FIELDS[kind]: blob[1]}])
+            referenced.add(os.path.abspath(blob[1]))
+            return "repointed"
+        self.delete_item(kind, user_id, item_id)
+        return "deleted"
+
+    def _delete_item(self, kind, user_id, item_id):
+        with write_events.writing(kind):
+            collection = self._collection(kind, user_id)
+            if collection is not None:
+                collection.delete(ids=[item_id])
+            if self.blob_store is not None:
+                self.blob_store.release(user_id, kind, item_id)
+            write_events.publish(kind, "delete", user_id, item_id)
+
+    def _check_folder(self, folder, referenced, temp_only=False):
+        """
+        Report stray files in one folder.
+
+        Files younger than temp_max_age are skipped: they may belong to a write
+        whose item has not reached Chroma yet.
+        """
+        if not os.path.isdir(folder):
+            return
+        now = time.time()
+        for entry in os.scandir(folder):
+            self.budget.spend()
+            if not entry.is_file() or now - entry.stat().st_mtime < self.temp_max_age:
+                continue
+            path = os.path.abspath(entry.path)
+            if temp_only or entry.name.startswith(TEMP_PREFIX):
+                self._remove("temp", path)
+            elif path not in referenced:
+                self._remove("orphaned", path)
+
+    def _remove(self, finding, path):
+        repaired = False
+        if self.repair:
+            try:
+                os.remove(path)
+                repaired = True
+            except FileNotFoundError:
+                repaired = True
+            except OSError as e:
+                logger.warning("Failed to remove file", extra={"path": path, "error": str(e)})
+        self._record(finding, path, repaired)
+
+    # ------------------------------------------------------------------ blobs
+
+    def _check_blobs(self):
+        if self.blob_store is None:
+            return
+        self._check_folder(os.path.join(self.blob_store.root, TMP_DIR), referenced=set(), temp_only=True)
+        self.budget.spend(max(self.blob_store.stats()["blobs"], 1))
+        report = self.blob_store.check(repair=self.repair)
+        for problem in ("missing", "orphaned", "unreferenced", "dangling"):
+            for detail in report[problem]:
+                self._record("blobs", f"{problem}:{detail}", self.repair)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("run", "status"))
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    parser.add_argument("--repair", action="store_true", help="Fix what is found instead of only reporting it.")
+    parser.add_argument("--iops", type=float, help="Operations per second (0 is unlimited).")
+    parser.add_argument("--restart", action="store_true", help="Ignore an unfinished pass and start over.")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        print(json.dumps(StorageGC.last_report(), indent=2))
+        return
+
+    import chromadb
+
+    from helpers.blob_store import BlobStore
+
+    client = chromadb.PersistentClient(path=args.chroma_path)
+    options = {"blob_store": BlobStore(), "iops": args.iops}
+    gc = None if args.restart else StorageGC.resume(client, **options)
+    if gc is None:
+        gc = StorageGC(client, repair=args.repair, **options)
+    print(json.dumps(gc.run(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
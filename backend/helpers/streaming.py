@@ -0,0 +1,139 @@
+"""
+Streaming NDJSON responses for search results and library pages.
+
+The JSON responses of /api/search and /api/populate are built whole, with
+every image inlined as a base64 data URI, before the first byte is sent. With
+``?stream=1`` (or ``Accept: application/x-ndjson``) they are instead written as
+newline-delimited JSON, one orjson-encoded object per result, each flushed as
+soon as it is ready. An image's data URI is base64-encoded from disk a chunk at
+a time inside its line, so neither memory nor time to first result grows with
+the page size. Each line's ``event`` key says what it is.
+
+Every stream ends with a ``{"event": "done", ...}`` line; a stream without one
+was cut off. A modality whose search fails yields a ``{"event": "error"}`` line
+and the stream carries on with the others.
+"""
+import base64
+import os
+
+import orjson
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+# A multiple of 3, so every chunk encodes to base64 without padding.
+MEDIA_CHUNK_BYTES = 3 * 16 * 1024
+
+_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def wants_stream(args, accept=""):
+    """Whether a request asked for NDJSON, via ``stream`` query parameter or Accept header."""
+    return args.get("stream", "").lower() in ("1", "true", "yes", "ndjson") or NDJSON_MIMETYPE in (accept or "")
+
+
+def _default(value):
+    # Anything orjson cannot encode natively (e.g. sets, Paths) degrades to a string, like the metadata sanitizer.
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def dumps_line(obj):
+    """Encode one NDJSON line."""
+    return orjson.dumps(obj, default=_default, option=_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+
+
+def item_lines(obj, media_path=None, field="data"):
+    """
+    Yield one NDJSON line in pieces, with a file inlined as a data URI under ``field``.
+
+    The object is written first and the file is then read and base64-encoded
+    MEDIA_CHUNK_BYTES at a time, so a large image is never held in memory whole.
+
+    Args:
+        obj (dict): The item, without ``field``.
+        media_path (str, optional): Image to inline. None leaves ``field`` out; a path
+            that does not exist gives ``null``, like the JSON responses.
+        field (str): Key of the data URI.
+
+    Yields:
+        bytes: Pieces of the line, ending with a newline.
+    """
+    if media_path is None:
+        yield dumps_line(obj)
+        return
+    if not os.path.exists(media_path):
+        yield dumps_line({**obj, field: None})
+        return
+    head = orjson.dumps(obj, default=_default, option=_OPTIONS)
+    separator = b"," if len(head) > 2 else b""
+    extension = os.path.splitext(media_path)[1][1:]
+    yield head[:-1] + separator + orjson.dumps(field) + b':"' + f"data:image/{extension};base64,".encode("ascii")
+    with open(media_path, "rb") as f:
+        while chunk := f.read(MEDIA_CHUNK_BYTES):
+            yield base64.b64encode(chunk)
+    yield b'"}\n'
+
+
+def search_items(kind, results):
+    """
+    Flatten one modality's ``collection.query()`` output into per-result dicts.
+
+    Yields:
+        tuple: ``(item, media_path)``; media_path is the image file for image results, else None.
+    """
+    if not results or not results.get("ids"):
+        return
+    columns = {field: (results.get(field) or [[]])[0] for field in ("distances", "documents", "metadatas", "uris")}
+    for rank, item_id in enumerate(results["ids"][0]):
+        item = {"event": "result", "kind": kind, "rank": rank, "id": item_id}
+        for field, key in (("distances", "distance"), ("documents", "document"), ("metadatas", "metadata"),
+                           ("uris", "uri")):
+            if rank < len(columns[field]):
+                item[key] = columns[field][rank]
+        yield item, (item.get("uri") or "") if kind == "image" else None
+
+
+def search_stream(kinds, run_search, on_error=None):
+    """
+    NDJSON search results, one modality at a time, each result written as soon as its search returns.
+
+    Args:
+        kinds (list): Modalities to search, in output order.
+        run_search (Callable[[str], dict]): Runs one modality's search (without media attached).
+        on_error (Callable[[str, Exception], None], optional): Called when a modality's search fails.
+
+    Yields:
+        bytes: NDJSON pieces.
+    """
+    counts = {}
+    for kind in kinds:
+        try:
+            results = run_search(kind)
+        except Exception as e:
+            if on_error is not None:
+                on_error(kind, e)
+            yield dumps_line({"event": "error", "kind": kind, "message": str(e)})
+            continue
+        counts[kind] = 0
+        for item, media_path in search_items(kind, results):
+            yield from item_lines(item, media_path)
+            counts[kind] += 1
+    yield dumps_line({"event": "done", "counts": counts})
+
+
+def page_stream(page, items):
+    """
+    NDJSON library page: a ``page`` event with the pagination fields, then one ``item`` event per item.
+
+    Args:
+        page (dict): Pagination fields of the JSON response (status, total_count, page, ...).
+        items (list): Page items; image items carry their file under "uri" and are inlined as "data".
+
+    Yields:
+        bytes: NDJSON pieces.
+    """
+    yield dumps_line({"event": "page", **page})
+    for item in items:
+        media_path = (item.get("uri") or "") if item.get("type") == "image" else None
+        yield from item_lines({"event": "item", **item}, media_path)
+    yield dumps_line({"event": "done", "count": len(items)})
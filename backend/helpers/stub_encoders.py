@@ -0,0 +1,74 @@
+"""
+Deterministic stand-ins for the MPNet, OpenCLIP and CLAP encoders.
+
+They map every input to a pseudo-random unit vector seeded by a hash of the
+input, so identical inputs always embed identically and no model is loaded.
+Used by the benchmark suite (and ORBIT_STUB_ENCODERS=1) to measure storage and
+index costs in isolation from model inference.
+"""
+import hashlib
+
+import numpy as np
+from chromadb.api.types import EmbeddingFunction
+
+from helpers.metrics import timed
+
+TEXT_DIMENSION = 768
+CLIP_DIMENSION = 512
+CLAP_DIMENSION = 512
+
+
+def _hash_bytes(item):
+    if isinstance(item, str):
+        return item.encode("utf-8")
+    if isinstance(item, dict) and "waveform" in item:
+        item = item["waveform"]
+    if hasattr(item, "numpy"):
+        item = item.numpy()
+    if isinstance(item, np.ndarray):
+        return np.ascontiguousarray(item).tobytes()
+    return repr(item).encode("utf-8")
+
+
+def _unit_vector(item, dimension):
+    seed = int.from_bytes(hashlib.sha256(_hash_bytes(item)).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class _StubEmbedding(EmbeddingFunction):
+    dimension = 0
+    model = "stub"
+
+    def __call__(self, input):
+        if isinstance(input, str):
+            input = [input]
+        with timed("embed", model=self.model):
+            return [None if item is None else _unit_vector(item, self.dimension) for item in input]
+
+
+class StubTextEmbedding(_StubEmbedding):
+    """Drop-in replacement for MPNetEmbedding (768-d)."""
+
+    dimension = TEXT_DIMENSION
+    model = "stub_mpnet"
+
+
+class StubImageEmbedding(_StubEmbedding):
+    """Drop-in replacement for the OpenCLIP embedding function (512-d)."""
+
+    dimension = CLIP_DIMENSION
+    model = "stub_openclip"
+
+
+class StubAudioEmbedder(_StubEmbedding):
+    """Drop-in replacement for CLAPEmbedder (512-d); accepts waveforms or query strings."""
+
+    dimension = CLAP_DIMENSION
+    model = "stub_clap"
+
+    def _encode_audio(self, audio):
+        return _unit_vector(audio, self.dimension)
+
+    def _encode_text(self, text):
+        return _unit_vector(text, self.dimension)
@@ -0,0 +1,306 @@
+"""
+Per-user search-as-you-type suggestions.
+
+Completions come from a user's item titles, tags and YouTube channels (read
+from item metadata) and from the searches they submit, ranked by how often
+each occurs (searches count double). They are served from memory without
+running a model or calling Chroma, in well under a millisecond.
+
+Each user's phrases are indexed under every word they contain (up to
+MAX_WORD_STARTS), so "brown" completes "The Quick Brown Fox". The keys are kept
+in one sorted list, a flattened trie in which a prefix's completions are a
+contiguous slice found by bisection, like the tag autocomplete in
+helpers/tag_index.py. The best completions of each prefix asked for are cached
+and re-ranked in place as phrases are added or counted again.
+
+The index is maintained from the write-event stream and built from the user's
+collections on first access; submitted searches are kept in sqlite
+(ORBIT_SUGGEST_PATH), at most ORBIT_SUGGEST_MAX_QUERIES per user.
+"""
+import bisect
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+from helpers.item_fields import IGNORED_TITLES, KINDS
+from helpers.logs import get_logger
+from helpers.tag_index import parse_tags
+
+logger = get_logger("suggest_index")
+
+TITLE = "title"
+TAG = "tag"
+CHANNEL = "channel"
+QUERY = "query"
+# Ranking weight of one occurrence of each source.
+SOURCE_WEIGHTS = {QUERY: 2.0, TAG: 1.5, TITLE: 1.0, CHANNEL: 1.0}
+MAX_WORD_STARTS = 8
+MAX_KEY_CHARS = 64
+MAX_PHRASE_CHARS = 200
+# Completions kept per cached prefix; also the most one lookup returns.
+TOP_K = 16
+MAX_CACHED_PREFIXES = 4096
+
+
+def normalize(text):
+    """Lowercase and collapse whitespace, the form phrases and prefixes are matched in."""
+    return " ".join(str(text).split()).lower()
+
+
+def _keys(phrase):
+    """Index keys of a normalized phrase: the phrase from each of its first words onwards."""
+    words = phrase.split(" ")
+    return {" ".join(words[start:])[:MAX_KEY_CHARS] for start in range(min(len(words), MAX_WORD_STARTS))}
+
+
+def _rank(entry):
+    return (-entry.count * SOURCE_WEIGHTS[entry.source], len(entry.text), entry.text)
+
+
+class _Entry:
+    __slots__ = ("id", "source", "text", "count", "keys")
+
+    def __init__(self, entry_id, source, text):
+        self.id = entry_id
+        self.source = source
+        self.text = text
+        self.count = 0
+        self.keys = _keys(normalize(text))
+
+
+class _UserSuggestions:
+    def __init__(self):
+        self.keys = []  # sorted (key, entry id); a prefix's completions are one contiguous slice
+        self.entries = {}  # (source, normalized text) -> _Entry
+        self.by_id = {}
+        self.items = {}  # (kind, item id) -> [(source, text)] the item contributed
+        self.top = {}  # prefix -> its best entries, kept current by _rerank()
+        self.loading = False  # while True, keys are appended and sorted once by loaded()
+        self._next_id = 0
+
+    def loaded(self):
+        self.keys.sort()
+        self.loading = False
+
+    def add(self, source, text, count=1):
+        text = " ".join(str(text).split())[:MAX_PHRASE_CHARS]
+        phrase = normalize(text)
+        if not phrase:
+            return
+        entry = self.entries.get((source, phrase))
+        if entry is None:
+            entry = self.entries[(source, phrase)] = _Entry(self._next_id, source, text)
+            self.by_id[entry.id] = entry
+            self._next_id += 1
+            for key in entry.keys:
+                if self.loading:
+                    self.keys.append((key, entry.id))
+                else:
+                    bisect.insort(self.keys, (key, entry.id))
+        entry.count += count
+        self._rerank(entry, grew=count > 0)
+        if entry.count <= 0:
+            del self.entries[(source, phrase)]
+            del self.by_id[entry.id]
+            for key in entry.keys:
+                del self.keys[bisect.bisect_left(self.keys, (key, entry.id))]
+
+    def _rerank(self, entry, grew):
+        """Bring the cached completions of every prefix of the entry's keys up to date."""
+        for key in entry.keys:
+            for end in range(1, len(key) + 1):
+                top = self.top.get(key[:end])
+                if top is None:
+                    continue
+                if not grew:
+                    if entry in top:
+                        # An entry outside the cached best may now outrank it; recompute on next use.
+                        del self.top[key[:end]]
+                elif entry in top or len(top) < TOP_K or _rank(entry) < _rank(top[-1]):
+                    if entry not in top:
+                        top.append(entry)
+                    top.sort(key=_rank)
+                    del top[TOP_K:]
+
+    def set_item(self, kind, item_id, terms):
+        """Replace what one item contributes with ``terms``, a list of (source, text)."""
+        for source, text in self.items.pop((kind, item_id), ()):
+            self.add(source, text, -1)
+        for source, text in terms:
+            self.add(source, text)
+        if terms:
+            self.items[(kind, item_id)] = terms
+
+    def complete(self, prefix, limit):
+        key = normalize(prefix)[:MAX_KEY_CHARS]
+        top = self.top.get(key)
+        if top is None:
+            start = bisect.bisect_left(self.keys, (key,))
+            end = bisect.bisect_left(self.keys, (key + "\U0010ffff",), start)
+            ids = {entry_id for _, entry_id in self.keys[start:end]}
+            top = heapq.nsmallest(TOP_K, (self.by_id[entry_id] for entry_id in ids), key=_rank)
+            if len(self.top) >= MAX_CACHED_PREFIXES:
+                self.top.clear()
+            self.top[key] = top
+        return top[:limit]
+
+
+def item_terms(metadata):
+    """The (source, text) completions an item contributes: its title, tags and YouTube channel."""
+    metadata = metadata or {}
+    terms = []
+    title = metadata.get("title")
+    if title and normalize(title) not in IGNORED_TITLES:
+        terms.append((TITLE, title))
+    terms.extend((TAG, tag) for tag in parse_tags(metadata.get("tags")))
+    if metadata.get("youtube_channel"):
+        terms.append((CHANNEL, metadata["youtube_channel"]))
+    return terms
+
+
+class SuggestIndex:
+    """Completion indexes per user, built from the collections and kept current from write events."""
+
+    def __init__(self, path=None, collection_for=None, max_queries=None):
+        """
+        Args:
+            path (str, optional): Database of submitted searches (ORBIT_SUGGEST_PATH, default "suggest.db").
+            collection_for (Callable[[str, str], Collection], optional): Returns a user's
+                collection for a kind; needed to build a user's index on first access.
+            max_queries (int, optional): Searches remembered per user, most recent kept
+                (ORBIT_SUGGEST_MAX_QUERIES, default 500).
+        """
+        self.path = path or os.getenv("ORBIT_SUGGEST_PATH", "suggest.db")
+        self.collection_for = collection_for
+        self.max_queries = max_queries or int(os.getenv("ORBIT_SUGGEST_MAX_QUERIES", "500"))
+        # Guards the in-memory indexes only, so lookups never wait on sqlite or on a user's index being built.
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._build_locks = {}
+        self._users = {}
+        self._pending = {}  # user -> write events that arrived while their index was being built
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS suggest_queries ("
+            " user_id TEXT, query TEXT, count INTEGER NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (user_id, query))"
+        )
+        self._conn.commit()
+
+    def is_loaded(self, user_id):
+        """Whether the user's index is in memory, i.e. suggest() will not read the collections."""
+        return str(user_id) in self._users
+
+    def _user(self, user_id):
+        state = self._users.get(user_id)
+        if state is not None:
+            return state
+        with self._lock:
+            build_lock = self._build_locks.setdefault(user_id, threading.Lock())
+        with build_lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                return state
+            with self._lock:
+                self._pending[user_id] = []
+            try:
+                state = self._build(user_id)
+            finally:
+                with self._lock:
+                    pending = self._pending.pop(user_id)
+            with self._lock:
+                for event in pending:
+                    self._apply(state, event)
+                self._users[user_id] = state
+                del self._build_locks[user_id]
+            return state
+
+    def _build(self, user_id, batch_size=500):
+        started = time.perf_counter()
+        state = _UserSuggestions()
+        state.loading = True
+        if self.collection_for is not None:
+            for kind in KINDS:
+                collection = self.collection_for(kind, user_id)
+                offset = 0
+                while True:
+                    page = collection.get(offset=offset, limit=batch_size, include=["metadatas"])
+                    if not page["ids"]:
+                        break
+                    offset += len(page["ids"])
+                    for item_id, metadata in zip(page["ids"], page["metadatas"]):
+                        state.set_item(kind, item_id, item_terms(metadata))
+        with self._db_lock:
+            queries = self._conn.execute(
+                "SELECT query, count FROM suggest_queries WHERE user_id = ?", (user_id,)).fetchall()
+        for query, count in queries:
+            state.add(QUERY, query, count)
+        state.loaded()
+        logger.info("Suggestion index built", extra={"user_id": user_id, "phrases": len(state.entries),
+                                                     "seconds": round(time.perf_counter() - started, 3)})
+        return state
+
+    @staticmethod
+    def _apply(state, event):
+        if event.action == "delete":
+            state.set_item(event.kind, event.item_id, [])
+        elif event.metadata is not None:
+            state.set_item(event.kind, event.item_id, item_terms(event.metadata))
+
+    def on_write(self, event):
+        """write_events subscriber keeping loaded indexes in step with the collections."""
+        if event.kind not in KINDS:
+            return
+        with self._lock:
+            if event.user_id in self._pending:
+                self._pending[event.user_id].append(event)
+            elif event.user_id in self._users:
+                self._apply(self._users[event.user_id], event)
+            # Otherwise the index is built from the collections, change included, on first access.
+
+    def record_query(self, user_id, query):
+        """Remember a submitted search so it is suggested again."""
+        user_id, query = str(user_id), " ".join(str(query).split())[:MAX_PHRASE_CHARS]
+        if not query:
+            return
+        with self._db_lock:
+            row = self._conn.execute("SELECT query FROM suggest_queries WHERE user_id = ? AND lower(query) = ?",
+                                     (user_id, normalize(query))).fetchone()
+            query = row[0] if row else query
+            self._conn.execute(
+                "INSERT INTO suggest_queries (user_id, query, count, last_used) VALUES (?, ?, 1, ?)"
+                " ON CONFLICT (user_id, query) DO UPDATE SET count = count + 1, last_used = excluded.last_used",
+                (user_id, query, time.time()))
+            evicted = self._conn.execute(
+                "SELECT query, count FROM suggest_queries WHERE user_id = ? ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                (user_id, self.max_queries)).fetchall()
+            self._conn.executemany("DELETE FROM suggest_queries WHERE user_id = ? AND query = ?",
+                                   [(user_id, old) for old, _ in evicted])
+            self._conn.commit()
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.add(QUERY, query)
+                for old, count in evicted:
+                    state.add(QUERY, old, -count)
+
+    def suggest(self, user_id, prefix, limit=8):
+        """
+        Complete a typed prefix.
+
+        Args:
+            user_id (str): Owner.
+            prefix (str): What the user has typed so far.
+            limit (int): Completions returned at most (up to TOP_K).
+
+        Returns:
+            List[dict]: ``text`` and ``type`` (title, tag, channel or query), best first.
+        """
+        if not normalize(prefix):
+            return []
+        state = self._user(str(user_id))
+        with self._lock:
+            return [{"text": entry.text, "type": entry.source}
+                    for entry in state.complete(prefix, min(limit, TOP_K))]
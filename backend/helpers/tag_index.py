@@ -0,0 +1,324 @@
+"""
+Per-user tag index across the text, image and audio collections.
+
+Item metadata stores tags as a JSON-encoded string, which Chroma cannot filter
+on. Two structures make tags usable:
+
+* every item also carries one boolean ``tag__<tag>`` metadata field per tag,
+  so searches can pre-filter with a ``where`` clause before the ANN step;
+* a TagIndex keeps tag -> item id postings per user (persisted in sqlite and
+  maintained from the write-event stream), which answers facet counts and
+  prefix autocomplete without scanning the collections and lets listings fetch
+  exactly the tagged items.
+
+Users whose index has never been built are backfilled from their collections
+on first access; the backfill also adds the ``tag__`` fields to items saved
+before they existed.
+
+    python -m helpers.tag_index rebuild --user <id>
+"""
+import argparse
+import bisect
+import json
+import os
+import sqlite3
+import threading
+
+from helpers.item_fields import KINDS
+from helpers.logs import get_logger
+
+logger = get_logger("tag_index")
+
+TAG_FIELD_PREFIX = "tag__"
+
+
+def normalize_tag(tag):
+    """Lowercase a tag and collapse internal whitespace."""
+    return " ".join(str(tag).split()).lower()
+
+
+def parse_tags(value):
+    """
+    Turn a stored or submitted tags value into a list of normalized tags.
+
+    Args:
+        value: A list of tags, its JSON encoding (as stored in metadata), a
+            comma-separated string, or None.
+
+    Returns:
+        List[str]: Unique normalized tags in their original order.
+    """
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = value.split(",")
+        value = decoded if isinstance(decoded, list) else [decoded]
+    tags = []
+    for tag in value:
+        tag = normalize_tag(tag) if tag is not None else ""
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def tag_fields(tags):
+    """Return the boolean ``tag__<tag>`` metadata fields for a tags value."""
+    return {TAG_FIELD_PREFIX + tag: True for tag in parse_tags(tags)}
+
+
+def retag_metadata(metadata):
+    """
+    Reset an item's ``tag__`` fields to match its ``tags`` value in place.
+
+    Fields for removed tags are set to False rather than dropped, because
+    Chroma merges metadata on update.
+    """
+    for key in list(metadata):
+        if key.startswith(TAG_FIELD_PREFIX):
+            metadata[key] = False
+    metadata.update(tag_fields(metadata.get("tags")))
+    return metadata
+
+
+def tag_where(tags):
+    """
+    Build a Chroma ``where`` clause matching items that carry every given tag.
+
+    Args:
+        tags (Iterable[str]): Tags to require.
+
+    Returns:
+        dict or None: The clause, or None when no tags are given.
+    """
+    clauses = [{TAG_FIELD_PREFIX + tag: True} for tag in parse_tags(list(tags))]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class _UserTags:
+    def __init__(self):
+        self.postings = {}   # tag -> {kind -> set(item ids)}
+        self.items = {}      # (kind, item id) -> set(tags)
+        self.counts = {}     # tag -> number of items
+        self.sorted_tags = []
+
+    def add(self, kind, item_id, tag):
+        kinds = self.postings.setdefault(tag, {})
+        ids = kinds.setdefault(kind, set())
+        if item_id in ids:
+            return
+        ids.add(item_id)
+        self.items.setdefault((kind, item_id), set()).add(tag)
+        if tag not in self.counts:
+            bisect.insort(self.sorted_tags, tag)
+        self.counts[tag] = self.counts.get(tag, 0) + 1
+
+    def remove(self, kind, item_id, tag):
+        ids = self.postings.get(tag, {}).get(kind)
+        if not ids or item_id not in ids:
+            return
+        ids.discard(item_id)
+        item_tags = self.items.get((kind, item_id))
+        if item_tags is not None:
+            item_tags.discard(tag)
+            if not item_tags:
+                del self.items[(kind, item_id)]
+        self.counts[tag] -= 1
+        if not self.counts[tag]:
+            del self.counts[tag]
+            del self.postings[tag]
+            del self.sorted_tags[bisect.bisect_left(self.sorted_tags, tag)]
+
+
+class TagIndex:
+    """Tag postings per user, persisted in sqlite and mirrored in memory."""
+
+    def __init__(self, path=None, collection_for=None):
+        """
+        Args:
+            path (str, optional): Database file (ORBIT_TAG_INDEX_PATH, default "tag_index.db").
+            collection_for (Callable[[str, str], Collection], optional): Returns a user's
+                collection for a kind; needed to backfill users on first access.
+        """
+        self.path = path or os.getenv("ORBIT_TAG_INDEX_PATH", "tag_index.db")
+        self.collection_for = collection_for
+        self._lock = threading.RLock()
+        self._users = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS tag_postings ("
+            " user_id TEXT, kind TEXT, item_id TEXT, tag TEXT, PRIMARY KEY (user_id, kind, item_id, tag));"
+            "CREATE INDEX IF NOT EXISTS tag_postings_by_tag ON tag_postings (user_id, tag);"
+            "CREATE TABLE IF NOT EXISTS tag_users (user_id TEXT PRIMARY KEY);"
+        )
+        self._conn.commit()
+
+    def _user(self, user_id):
+        user_id = str(user_id)
+        state = self._users.get(user_id)
+        if state is not None:
+            return state
+        built = self._conn.execute("SELECT 1 FROM tag_users WHERE user_id = ?", (user_id,)).fetchone()
+        if not built and self.collection_for is not None:
+            return self.rebuild(user_id)
+        state = self._users[user_id] = _UserTags()
+        for kind, item_id, tag in self._conn.execute(
+                "SELECT kind, item_id, tag FROM tag_postings WHERE user_id = ?", (user_id,)):
+            state.add(kind, item_id, tag)
+        return state
+
+    def set_item_tags(self, user_id, kind, item_id, tags):
+        """
+        Replace the tags recorded for one item.
+
+        Args:
+            user_id (str): Owner of the item.
+            kind (str): "text", "image" or "audio".
+            item_id (str): Item identifier.
+            tags: Tags value, see parse_tags().
+        """
+        user_id = str(user_id)
+        tags = set(parse_tags(tags))
+        with self._lock:
+            state = self._user(user_id)
+            current = set(state.items.get((kind, item_id), ()))
+            for tag in current - tags:
+                state.remove(kind, item_id, tag)
+            for tag in tags - current:
+                state.add(kind, item_id, tag)
+            self._conn.executemany(
+                "DELETE FROM tag_postings WHERE user_id = ? AND kind = ? AND item_id = ? AND tag = ?",
+                [(user_id, kind, item_id, tag) for tag in current - tags],
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tag_postings VALUES (?, ?, ?, ?)",
+                [(user_id, kind, item_id, tag) for tag in tags - current],
+            )
+            self._conn.commit()
+
+    def remove_item(self, user_id, kind, item_id):
+        self.set_item_tags(user_id, kind, item_id, [])
+
+    def on_write(self, event):
+        """write_events subscriber keeping postings in step with the collections."""
+        if event.kind not in KINDS:
+            return
+        if event.action == "delete":
+            self.remove_item(event.user_id, event.kind, event.item_id)
+        elif event.metadata is not None:
+            self.set_item_tags(event.user_id, event.kind, event.item_id, event.metadata.get("tags"))
+
+    def postings(self, user_id, tags, kinds=KINDS):
+        """
+        Return the ids of a user's items that carry every given tag.
+
+        Args:
+            user_id (str): Owner.
+            tags (Iterable[str]): Required tags.
+            kinds (Iterable[str]): Modalities to include.
+
+        Returns:
+            dict: Kind -> set of item ids.
+        """
+        tags = parse_tags(list(tags))
+        with self._lock:
+            state = self._user(user_id)
+            result = {}
+            for kind in kinds:
+                # Intersect starting from the rarest tag.
+                id_sets = sorted((state.postings.get(tag, {}).get(kind, set()) for tag in tags), key=len)
+                result[kind] = set(id_sets[0]).intersection(*id_sets[1:]) if id_sets else set()
+            return result
+
+    def counts(self, user_id, prefix="", limit=20):
+        """
+        Facet counts for a user's tags, optionally restricted to a prefix.
+
+        Args:
+            user_id (str): Owner.
+            prefix (str): Only tags starting with this (normalized) prefix.
+            limit (int): Maximum number of tags returned, most used first.
+
+        Returns:
+            List[dict]: ``tag``, total ``count`` and per-kind ``kinds`` counts.
+        """
+        prefix = normalize_tag(prefix) if prefix else ""
+        with self._lock:
+            state = self._user(user_id)
+            start = bisect.bisect_left(state.sorted_tags, prefix)
+            matches = []
+            for tag in state.sorted_tags[start:]:
+                if not tag.startswith(prefix):
+                    break
+                matches.append(tag)
+            matches.sort(key=lambda tag: (-state.counts[tag], tag))
+            return [{
+                "tag": tag,
+                "count": state.counts[tag],
+                "kinds": {kind: len(ids) for kind, ids in state.postings[tag].items() if ids},
+            } for tag in matches[:limit]]
+
+    def rebuild(self, user_id, batch_size=500):
+        """
+        Rebuild a user's postings from their collections and backfill ``tag__`` fields.
+
+        Args:
+            user_id (str): Owner.
+            batch_size (int): Items read per page.
+
+        Returns:
+            _UserTags: The rebuilt in-memory state.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            state = _UserTags()
+            rows = []
+            for kind in KINDS:
+                collection = self.collection_for(kind, user_id)
+                offset = 0
+                while True:
+                    page = collection.get(offset=offset, limit=batch_size, include=["metadatas"])
+                    if not page["ids"]:
+                        break
+                    offset += len(page["ids"])
+                    stale_ids, stale_metadatas = [], []
+                    for item_id, metadata in zip(page["ids"], page["metadatas"]):
+                        metadata = metadata or {}
+                        for tag in parse_tags(metadata.get("tags")):
+                            state.add(kind, item_id, tag)
+                            rows.append((user_id, kind, item_id, tag))
+                        fields = tag_fields(metadata.get("tags"))
+                        if any(metadata.get(key) is not True for key in fields):
+                            stale_ids.append(item_id)
+                            stale_metadatas.append(fields)
+                    if stale_ids:
+                        collection.update(ids=stale_ids, metadatas=stale_metadatas)
+            self._conn.execute("DELETE FROM tag_postings WHERE user_id = ?", (user_id,))
+            self._conn.executemany("INSERT OR IGNORE INTO tag_postings VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR IGNORE INTO tag_users VALUES (?)", (user_id,))
+            self._conn.commit()
+            self._users[user_id] = state
+            logger.info("Tag index rebuilt", extra={"user_id": user_id, "tags": len(state.counts),
+                                                    "postings": len(rows)})
+            return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=("rebuild",))
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--chroma-path", default=os.getenv("ORBIT_CHROMA_PATH", "OrbitDB"))
+    args = parser.parse_args(argv)
+
+    from helpers.library_io import _cli_accessors
+
+    collection_for, _ = _cli_accessors(args.chroma_path)
+    TagIndex(collection_for=collection_for).rebuild(args.user)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+"""
+Webpage ingestion for saved links that are not YouTube videos.
+
+Pages are fetched on a background asyncio loop through one pooled aiohttp
+session with a per-host connection limit, a response size cap and conditional
+GETs against a sqlite page cache (ETag / Last-Modified). The readable text is
+extracted from the HTML, split into overlapping chunks and added to the user's
+text collection in one batch via TextHandler.add_texts. Re-saving a page that
+changed replaces its old chunks. Chunk ids hash the page URL with the chunk
+text, so a chunk shared by two pages is stored once per page and replacing
+one page's chunks never touches the other's.
+
+Links come from users, so every connection is checked before it is made: the
+session's resolver drops addresses that are not globally routable (loopback,
+private, link-local, reserved, ...), IP-literal hosts are checked directly,
+and redirects are followed by hand so each hop is checked the same way.
+ORBIT_WEB_BLOCKED_NETWORKS adds networks to the blocklist and
+ORBIT_WEB_ALLOWED_NETWORKS exempts some (comma-separated CIDRs), e.g.
+``127.0.0.1/32`` for the local fixture server in benchmarks/http_fixtures.py.
+"""
+import asyncio
+import hashlib
+import ipaddress
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from yarl import URL
+
+from helpers import admission
+from helpers.logs import get_logger
+from helpers.metrics import REGISTRY, timed
+
+logger = get_logger("web_ingest")
+
+WEB_FETCH_TOTAL = REGISTRY.counter(
+    "orbit_web_fetch_total",
+    "Webpage fetches by outcome (fetched, not_modified, too_large, unsupported_type, blocked, error).",
+    ("outcome",),
+)
+
+_SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "nav", "footer", "header", "aside", "form"}
+_BLOCK_TAGS = {"p", "div", "section", "article", "main", "br", "li", "ul", "ol", "tr", "table",
+               "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "figcaption", "dd", "dt"}
+_TEXT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class _ReadableTextParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ""
+        self._in_title = False
+        self._skip_depth = 0
+        self._parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "title":
+            self._in_title = True
+        elif tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag == "title":
+            self._in_title = False
+        elif tag in _BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth:
+            self._parts.append(data)
+
+    def text(self):
+        lines = (re.sub(r"\s+", " ", line).strip() for line in "".join(self._parts).split("\n"))
+        return "\n".join(line for line in lines if line)
+
+
+def extract_text(html):
+    """
+    Extract the title and readable text from an HTML document.
+
+    Scripts, styles and page chrome (nav, header, footer, aside, forms) are dropped;
+    block elements become line breaks.
+
+    Args:
+        html (str): HTML source.
+
+    Returns:
+        Tuple[str, str]: The page title and its text, one paragraph per line.
+    """
+    parser = _ReadableTextParser()
+    parser.feed(html)
+    parser.close()
+    return re.sub(r"\s+", " ", parser.title).strip(), parser.text()
+
+
+def chunk_text(text, max_chars=None, overlap=None):
+    """
+    Split text into chunks of at most ``max_chars``, breaking between paragraphs
+    where possible and carrying ``overlap`` characters of context into the next chunk.
+
+    Args:
+        text (str): Text with one paragraph per line.
+        max_chars (int, optional): Chunk size (ORBIT_WEB_CHUNK_CHARS, default 1500).
+        overlap (int, optional): Characters repeated between chunks (ORBIT_WEB_CHUNK_OVERLAP, default 200).
+
+    Returns:
+        List[str]: Chunks in document order.
+    """
+    max_chars = max_chars or int(os.getenv("ORBIT_WEB_CHUNK_CHARS", "1500"))
+    overlap = overlap if overlap is not None else int(os.getenv("ORBIT_WEB_CHUNK_OVERLAP", "200"))
+    chunks, current = [], ""
+    for paragraph in text.split("\n"):
+        # Paragraphs longer than a chunk are hard-split on whitespace.
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            pieces = paragraph[:cut], paragraph[cut:].lstrip()
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(pieces[0])
+            paragraph = pieces[1]
+        if current and len(current) + 1 + len(paragraph) > max_chars:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap else ""
+            current = tail[tail.find(" ") + 1:] if " " in tail else tail
+            if len(current) + 1 + len(paragraph) > max_chars:
+                current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current.strip():
+        chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _chunk_id(url, chunk):
+    # Scoped to the page so that its stale-chunk cleanup only ever sees its own chunks.
+    return hashlib.sha256(f"{url}\n{chunk}".encode("utf-8")).hexdigest()
+
+
+class PageCache:
+    """sqlite cache of fetched pages and their validators for conditional GETs."""
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): Database file (ORBIT_WEB_CACHE_PATH, default "web_pages.db").
+        """
+        self.path = path or os.getenv("ORBIT_WEB_CACHE_PATH", "web_pages.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS web_pages ("
+            " url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, title TEXT, text TEXT, fetched_at REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified, title, text FROM web_pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "title": row[2], "text": row[3]}
+
+    def put(self, url, etag, last_modified, title, text):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO web_pages VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, title, text, time.time()),
+            )
+            self._conn.commit()
+
+
+class PageTooLarge(Exception):
+    pass
+
+
+class UnsupportedContent(Exception):
+    pass
+
+
+class BlockedAddress(Exception):
+    """The URL points at an address webpage ingestion may not connect to."""
+
+
+def _networks(value):
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in (value or "").split(",") if part.strip()]
+
+
+class AddressPolicy:
+    """Which IP addresses pages may be fetched from: globally routable ones, minus a blocklist, plus exemptions."""
+
+    def __init__(self, blocked=None, allowed=None):
+        """
+        Args:
+            blocked (Iterable[str], optional): Extra networks to refuse (ORBIT_WEB_BLOCKED_NETWORKS).
+            allowed (Iterable[str], optional): Networks allowed even though they are not
+                globally routable (ORBIT_WEB_ALLOWED_NETWORKS).
+        """
+        self.blocked = _networks(",".join(blocked) if blocked is not None else os.getenv("ORBIT_WEB_BLOCKED_NETWORKS"))
+        self.allowed = _networks(",".join(allowed) if allowed is not None else os.getenv("ORBIT_WEB_ALLOWED_NETWORKS"))
+
+    def permits(self, address):
+        ip = ipaddress.ip_address(str(address).split("%", 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if any(ip in network for network in self.allowed):
+            return True
+        if any(ip in network for network in self.blocked):
+            return False
+        return ip.is_global and not ip.is_multicast
+
+    def check_url(self, url):
+        """
+        Refuse URLs that are not http(s) or whose host is a refused IP literal.
+
+        Host names are checked when they are resolved (see _CheckedResolver).
+
+        Raises:
+            BlockedAddress: The URL may not be fetched.
+        """
+        parts = urlsplit(str(url))
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise BlockedAddress(f"Unsupported URL: {url}")
+        try:
+            literal = ipaddress.ip_address(parts.hostname.split("%", 1)[0])
+        except ValueError:
+            return
+        if not self.permits(literal):
+            raise BlockedAddress(f"Blocked address: {parts.hostname}")
+
+
+class _CheckedResolver(AbstractResolver):
+    """Resolves through aiohttp's default resolver and drops addresses the policy refuses."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self._resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = [entry for entry in await self._resolver.resolve(host, port, family)
+                 if self.policy.permits(entry["host"])]
+        if not hosts:
+            raise BlockedAddress(f"{host} resolves to a blocked address")
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+class WebIngestor:
+    """
+    Fetches pages on a background event loop and indexes them as text chunks.
+
+    ``submit()`` is safe to call from request threads and returns a
+    concurrent.futures.Future resolving to the list of chunk ids.
+    """
+
+    def __init__(self, text_handler, cache=None, max_bytes=None, per_host=None, max_connections=None,
+                 timeout=None, max_redirects=None, address_policy=None, admission_control=None,
+                 admission_retries=None):
+        """
+        Args:
+            text_handler (TextHandler): Handler the chunks are added through.
+            cache (PageCache, optional): Page cache.
+            max_bytes (int, optional): Largest response body accepted
+                (ORBIT_WEB_MAX_BYTES, default 2 MiB).
+            per_host (int, optional): Concurrent connections per host (ORBIT_WEB_PER_HOST, default 4).
+            max_connections (int, optional): Pool size (ORBIT_WEB_MAX_CONNECTIONS, default 32).
+            timeout (float, optional): Total seconds per fetch (ORBIT_WEB_TIMEOUT_S, default 20).
+            max_redirects (int, optional): Redirects followed per fetch (ORBIT_WEB_MAX_REDIRECTS, default 5).
+            address_policy (AddressPolicy, optional): Addresses pages may be fetched from.
+            admission_control (AdmissionController, optional): Chunks are embedded holding an
+                ingestion slot of the text encoder, so searches go first.
+            admission_retries (int, optional): Times a page whose slot request was turned
+                away is retried, after the suggested delay (ORBIT_WEB_ADMISSION_RETRIES, default 3).
+        """
+        self.text_handler = text_handler
+        self.cache = cache or PageCache()
+        self.max_bytes = max_bytes or int(os.getenv("ORBIT_WEB_MAX_BYTES", str(2 * 1024 * 1024)))
+        self.per_host = per_host or int(os.getenv("ORBIT_WEB_PER_HOST", "4"))
+        self.max_connections = max_connections or int(os.getenv("ORBIT_WEB_MAX_CONNECTIONS", "32"))
+        self.timeout = timeout or float(os.getenv("ORBIT_WEB_TIMEOUT_S", "20"))
+        self.max_redirects = max_redirects if max_redirects is not None else int(
+            os.getenv("ORBIT_WEB_MAX_REDIRECTS", "5"))
+        self.address_policy = address_policy or AddressPolicy()
+        self.admission_control = admission_control
+        self.admission_retries = admission_retries if admission_retries is not None else int(
+            os.getenv("ORBIT_WEB_ADMISSION_RETRIES", "3"))
+        self._loop = None
+        self._session = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                thread = threading.Thread(target=self._run_loop, name="web-ingest", daemon=True)
+                thread.start()
+                self._started.wait()
+        return self._loop
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._started.set()
+        self._loop.run_forever()
+
+    async def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host,
+                                             ttl_dns_cache=300, resolver=_CheckedResolver(self.address_policy))
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": "Orbit/1.0 (+webpage ingestion)"},
+            )
+        return self._session
+
+    def submit(self, user_id, url, meta=None):
+        """
+        Queue a page for ingestion.
+
+        Args:
+            user_id (str): Owner of the saved link.
+            url (str): Page URL.
+            meta (dict, optional): Extra metadata for every chunk (tags, email, ...).
+
+        Returns:
+            concurrent.futures.Future: Resolves to the chunk ids (empty on failure).
+        """
+        return asyncio.run_coroutine_threadsafe(self.ingest(user_id, url, meta), self._ensure_loop())
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def fetch(self, url):
+        """
+        Fetch a page, revalidating against the cache.
+
+        Args:
+            url (str): Page URL.
+
+        Returns:
+            Tuple[str, str, bool]: Title, readable text, and whether the page changed
+            since it was last cached.
+
+        Raises:
+            PageTooLarge: The body exceeds max_bytes.
+            UnsupportedContent: The response is not HTML or plain text.
+            BlockedAddress: The URL, or a redirect, points at a refused address.
+            aiohttp.ClientError: On network or HTTP errors, or too many redirects.
+        """
+        cached = self.cache.get(url)
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        session = await self._get_session()
+        with timed("web_fetch", model="webpage"):
+            target = url
+            # Redirects are followed here rather than by aiohttp so every hop is checked.
+            for _ in range(self.max_redirects + 1):
+                self.address_policy.check_url(target)
+                async with session.get(target, headers=headers, allow_redirects=False) as response:
+                    if response.status in _REDIRECT_STATUSES and response.headers.get("Location"):
+                        target = str(response.url.join(URL(response.headers["Location"])))
+                        continue
+                    if response.status == 304 and cached:
+                        WEB_FETCH_TOTAL.inc(outcome="not_modified")
+                        return cached["title"], cached["text"], False
+                    response.raise_for_status()
+                    content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                    if content_type and content_type not in _TEXT_TYPES:
+                        WEB_FETCH_TOTAL.inc(outcome="unsupported_type")
+                        raise UnsupportedContent(f"Unsupported content type: {content_type}")
+                    if (response.content_length or 0) > self.max_bytes:
+                        WEB_FETCH_TOTAL.inc(outcome="too_large")
+                        raise PageTooLarge(f"Page is {response.content_length} bytes")
+                    body = bytearray()
+                    async for block in response.content.iter_chunked(64 * 1024):
+                        body.extend(block)
+                        if len(body) > self.max_bytes:
+                            WEB_FETCH_TOTAL.inc(outcome="too_large")
+                            raise PageTooLarge(f"Page exceeds {self.max_bytes} bytes")
+                    charset = response.charset or "utf-8"
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    break
+            else:
+                raise aiohttp.ClientError(f"More than {self.max_redirects} redirects")
+        html = body.decode(charset, errors="replace")
+        with timed("extract", model="webpage"):
+            if content_type == "text/plain":
+                title, text = "", html
+            else:
+                title, text = extract_text(html)
+        self.cache.put(url, etag, last_modified, title, text)
+        WEB_FETCH_TOTAL.inc(outcome="fetched")
+        return title, text, True
+
+    async def ingest(self, user_id, url, meta=None):
+        try:
+            title, text, _ = await self.fetch(url)
+        except Exception as e:
+            if isinstance(e, BlockedAddress):
+                WEB_FETCH_TOTAL.inc(outcome="blocked")
+            elif not isinstance(e, (PageTooLarge, UnsupportedContent)):
+                WEB_FETCH_TOTAL.inc(outcome="error")
+            logger.warning("Webpage fetch failed", extra={"url": url, "user_id": user_id, "error": str(e)})
+            return []
+        chunks = chunk_text(text)
+        if not chunks:
+            logger.info("Webpage has no readable text", extra={"url": url, "user_id": user_id})
+            return []
+        metas = [
+            dict(meta or {}, title=title or url, source_url=url, type="webpage",
+                 chunk_index=index, chunk_count=len(chunks))
+            for index in range(len(chunks))
+        ]
+        # Embedding is CPU-bound; keep it off the event loop.
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.admission_retries + 1):
+            try:
+                return await loop.run_in_executor(None, self._index_chunks, user_id, url, chunks, metas)
+            except admission.Overloaded as e:
+                if attempt == self.admission_retries:
+                    logger.warning("Webpage not indexed, text encoder overloaded",
+                                   extra={"url": url, "user_id": user_id, "reason": e.reason})
+                    return []
+                await asyncio.sleep(e.retry_after)
+
+    def _index_chunks(self, user_id, url, chunks, metas):
+        chunk_ids = [_chunk_id(url, chunk) for chunk in chunks]
+        if self.admission_control is not None:
+            with self.admission_control.slot("text", admission.INGEST, user_id):
+                ids = self.text_handler.add_texts(user_id, chunks, metas, ids=chunk_ids)
+        else:
+            ids = self.text_handler.add_texts(user_id, chunks, metas, ids=chunk_ids)
+        if ids:
+            # Drop chunks from an earlier version of the page.
+            collection = self.text_handler._get_user_collection(user_id)
+            previous = collection.get(where={"$and": [{"source_url": url}, {"type": "webpage"}]}, include=[])
+            for stale_id in set(previous["ids"]) - set(ids):
+                self.text_handler.delete_text(user_id, stale_id)
+        logger.info("Webpage ingested", extra={"url": url, "user_id": user_id, "chunks": len(ids)})
+        return ids
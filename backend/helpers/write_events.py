@@ -0,0 +1,141 @@
+import functools
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from helpers.logs import get_logger
+
+logger = get_logger("write_events")
+
+
+@dataclass
+class WriteEvent:
+    """A change to one stored item, published by the data handlers."""
+    kind: str  # "text", "image" or "audio"
+    action: str  # "add", "update" or "delete"
+    user_id: str
+    item_id: str
+    metadata: Optional[Dict[str, Any]] = field(default=None)
+
+
+_subscribers: List[Callable[[WriteEvent], None]] = []
+_lock = threading.Lock()
+
+
+def subscribe(callback: Callable[[WriteEvent], None]) -> None:
+    """
+    Register a callback invoked synchronously after every add, update or delete.
+
+    Args:
+        callback: Receives the WriteEvent. Exceptions are logged and swallowed so a
+            failing subscriber cannot break a write.
+    """
+    with _lock:
+        _subscribers.append(callback)
+
+
+def unsubscribe(callback: Callable[[WriteEvent], None]) -> None:
+    """Remove a previously registered callback."""
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+
+def publish(kind: str, action: str, user_id: Any, item_id: str,
+            metadata: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Notify subscribers that an item changed.
+
+    Args:
+        kind: Modality of the item ("text", "image", "audio").
+        action: "add", "update" or "delete".
+        user_id: Owner of the item.
+        item_id: Item identifier within the user's collection.
+        metadata: Stored metadata after the change, if known.
+    """
+    event = WriteEvent(kind=kind, action=action, user_id=str(user_id), item_id=item_id, metadata=metadata)
+    with _lock:
+        subscribers = list(_subscribers)
+    for callback in subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.warning("Write event subscriber failed", extra={"kind": kind, "action": action, "error": str(e)})
+
+
+class WriteGate:
+    """
+    Shared/exclusive gate over one modality's writes.
+
+    A write holds it shared from resolving its collection until its event is
+    published, so writes run concurrently with each other. A re-index swap
+    holds it exclusively while it repoints the collections and swaps the
+    encoder, so no write straddles the swap. A thread already inside a write
+    may enter again (e.g. a handler method calling another).
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._writers = 0
+        self._exclusive = False
+        self._local = threading.local()
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        depth = getattr(self._local, "depth", 0)
+        if not depth:
+            with self._cond:
+                while self._exclusive:
+                    self._cond.wait()
+                self._writers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if not depth:
+                with self._cond:
+                    self._writers -= 1
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            # New writes wait from here on; the ones in progress are let finish.
+            self._exclusive = True
+            while self._writers:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+_gates: Dict[str, WriteGate] = {}
+
+
+def gate(kind: str) -> WriteGate:
+    """The write gate of a modality."""
+    with _lock:
+        return _gates.setdefault(kind, WriteGate())
+
+
+def writing(kind: str):
+    """Context manager holding a modality's write gate shared for one write."""
+    return gate(kind).writing()
+
+
+def gated(kind: str) -> Callable:
+    """Decorator running a handler's write method inside its modality's write gate."""
+    def decorate(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with writing(kind):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -1,5 +1,75 @@
+import os
+from urllib.parse import parse_qs, urlparse
+
+import requests
 from pytube import YouTube
 
+YOUTUBE_HOSTS = ("youtube.com", "youtu.be", "youtube-nocookie.com")
+
+
+def is_youtube_url(url):
+    """Return True if the URL points at a YouTube host."""
+    host = (urlparse(url).hostname or "").lower()
+    return any(host == name or host.endswith("." + name) for name in YOUTUBE_HOSTS)
+
+
+def normalize_video_id(url):
+    """
+    Extract the video id from the common YouTube URL shapes.
+
+    Handles watch?v=, youtu.be/<id>, /shorts/<id>, /embed/<id> and /live/<id>.
+
+    Args:
+        url (str): YouTube URL.
+
+    Returns:
+        str or None: The 11-character video id, or None if the URL has none.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    if host.endswith("youtu.be"):
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    else:
+        candidate = parse_qs(parsed.query).get("v", [""])[0]
+        if not candidate:
+            parts = [part for part in parsed.path.split("/") if part]
+            if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+                candidate = parts[1]
+    return candidate or None
+
+
+def fetch_video_metadata(url, timeout=10):
+    """
+    Fetch a video's title, channel and duration.
+
+    When ORBIT_YOUTUBE_OEMBED_URL is set the metadata comes from that oEmbed
+    endpoint (which lets a local stub server stand in for YouTube); otherwise
+    pytube is used.
+
+    Args:
+        url (str): YouTube URL.
+        timeout (float): Request timeout in seconds for the oEmbed endpoint.
+
+    Returns:
+        dict: ``title``, ``channel`` and ``duration`` (seconds, 0 if unknown).
+    """
+    oembed_url = os.getenv("ORBIT_YOUTUBE_OEMBED_URL")
+    if oembed_url:
+        response = requests.get(oembed_url, params={"url": url, "format": "json"}, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        return {
+            "title": data.get("title") or "",
+            "channel": data.get("author_name") or "",
+            "duration": int(data.get("duration") or 0),
+        }
+    try:
+        yt = YouTube(url)
+        return {"title": yt.title, "channel": yt.author or "", "duration": int(yt.length or 0)}
+    except Exception as e:
+        raise Exception(f"Error extracting metadata with pytube: {e}")
+
+
 def get_youtube_title(url):
     """
     Given a YouTube URL, use pytube to extract and return the video title.
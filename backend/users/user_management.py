@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 import uuid
+import os
 
 db = SQLAlchemy()
 
@@ -46,7 +47,7 @@ def init_db(app):
         app: Flask application instance
     """
     # Configure SQLAlchemy
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///orbit.db'  # Can be changed to PostgreSQL in production
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('ORBIT_DATABASE_URI', 'sqlite:///orbit.db')  # Can be changed to PostgreSQL in production
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
     # Initialize SQLAlchemy with app
@@ -1,17 +1,47 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import { Search, X } from 'lucide-react';
+import { fetchSuggestions } from './api';
 
 const SearchBar = ({ onSearch }) => {
   const [query, setQuery] = useState('');
   const [isSearching, setIsSearching] = useState(false);
   // Use an array for the selected filters.
   const [selectedFilters, setSelectedFilters] = useState(['Everything']);
+  // Completions for what has been typed so far; the full search only runs on submit.
+  const [suggestions, setSuggestions] = useState([]);
+  const [highlighted, setHighlighted] = useState(-1);
+  const [showSuggestions, setShowSuggestions] = useState(false);
 
   // The available filters.
   const filters = ['Everything', 'Image', 'Text'];
 
-  const handleSearch = async () => {
-    if (!query.trim()) return;
+  useEffect(() => {
+    if (!query.trim()) {
+      setSuggestions([]);
+      return undefined;
+    }
+    const controller = new AbortController();
+    // A short pause between keystrokes before asking, and stale answers are dropped.
+    const timer = setTimeout(async () => {
+      try {
+        const data = await fetchSuggestions(query, controller.signal);
+        setSuggestions(data.suggestions.filter(s => s.text.toLowerCase() !== query.trim().toLowerCase()));
+        setHighlighted(-1);
+      } catch {
+        if (!controller.signal.aborted) {
+          setSuggestions([]);
+        }
+      }
+    }, 80);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [query]);
+
+  const handleSearch = async (text = query) => {
+    if (!text.trim()) return;
+    setShowSuggestions(false);
     setIsSearching(true);
 
     try {
@@ -24,7 +54,7 @@ const SearchBar = ({ onSearch }) => {
       }
 
       const queryParams = new URLSearchParams({
-        query: query.trim(),
+        query: text.trim(),
         types: types.join(',')
       });
 
@@ -75,16 +105,36 @@ const SearchBar = ({ onSearch }) => {
 
   const handleInputChange = (e) => {
     setQuery(e.target.value);
+    setShowSuggestions(true);
+  };
+
+  const pickSuggestion = (suggestion) => {
+    setQuery(suggestion.text);
+    handleSearch(suggestion.text);
   };
 
-  const handleKeyPress = (e) => {
-    if (e.key === 'Enter') {
-      handleSearch();
+  const handleKeyDown = (e) => {
+    const open = showSuggestions && suggestions.length > 0;
+    if (e.key === 'ArrowDown' && open) {
+      e.preventDefault();
+      setHighlighted((highlighted + 1) % suggestions.length);
+    } else if (e.key === 'ArrowUp' && open) {
+      e.preventDefault();
+      setHighlighted((highlighted - 1 + suggestions.length) % suggestions.length);
+    } else if (e.key === 'Escape') {
+      setShowSuggestions(false);
+    } else if (e.key === 'Enter') {
+      if (open && highlighted >= 0 && highlighted < suggestions.length) {
+        pickSuggestion(suggestions[highlighted]);
+      } else {
+        handleSearch();
+      }
     }
   };
 
   const handleClear = () => {
     setQuery('');
+    setSuggestions([]);
     onSearch([]);
   };
 
@@ -122,7 +172,8 @@ const SearchBar = ({ onSearch }) => {
             type="text"
             value={query}
             onChange={handleInputChange}
-            onKeyPress={handleKeyPress}
+            onKeyDown={handleKeyDown}
+            onBlur={() => setShowSuggestions(false)}
             placeholder="Search your orbit..."
             className="w-full px-6 py-4 text-lg bg-white/10 border border-white/20 rounded-lg 
                        focus:outline-none focus:ring-2 focus:ring-purple-500 focus:border-transparent
@@ -137,6 +188,27 @@ const SearchBar = ({ onSearch }) => {
               <X className="w-5 h-5" />
             </button>
           )}
+          {showSuggestions && suggestions.length > 0 && (
+            <ul className="absolute z-10 left-0 right-0 mt-1 bg-gray-900/95 border border-white/20 rounded-lg
+                           overflow-hidden">
+              {suggestions.map((suggestion, index) => (
+                <li
+                  key={`${suggestion.type}:${suggestion.text}`}
+                  onMouseDown={(e) => {
+                    // Keeps the focus in the input.
+                    e.preventDefault();
+                    pickSuggestion(suggestion);
+                  }}
+                  onMouseEnter={() => setHighlighted(index)}
+                  className={`flex justify-between px-6 py-2 cursor-pointer text-white
+                              ${index === highlighted ? 'bg-white/20' : ''}`}
+                >
+                  <span>{suggestion.text}</span>
+                  <span className="text-sm text-white/50">{suggestion.type}</span>
+                </li>
+              ))}
+            </ul>
+          )}
         </div>
       </div>
 
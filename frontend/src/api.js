@@ -8,4 +8,31 @@ export async function fetchTextDisplayPage(page, pageSize) {
     }
     return response.json();
   }
-  
\ No newline at end of file
+
+// Long-polls the change feed: resolves with the changes after `since` as soon as
+// there are any, or with none once `wait` seconds have passed.
+export async function fetchChanges(since, wait = 25, signal) {
+    const response = await fetch(`http://localhost:3030/api/changes?since=${since}&wait=${wait}`, {
+      method: 'GET',
+      credentials: 'include',
+      signal,
+    });
+    if (!response.ok) {
+      throw new Error('Network response was not ok');
+    }
+    return response.json();
+  }
+
+// Completions for a partly typed query; cheap enough to call on every keystroke.
+export async function fetchSuggestions(prefix, signal) {
+    const params = new URLSearchParams({ prefix, limit: '8' });
+    const response = await fetch(`http://localhost:3030/api/suggest?${params}`, {
+      method: 'GET',
+      credentials: 'include',
+      signal,
+    });
+    if (!response.ok) {
+      throw new Error('Network response was not ok');
+    }
+    return response.json();
+  }
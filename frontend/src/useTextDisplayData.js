@@ -1,5 +1,24 @@
-import { useState, useCallback } from 'react';
-import { fetchTextDisplayPage } from './api';
+import { useState, useCallback, useEffect } from 'react';
+import { fetchTextDisplayPage, fetchChanges } from './api';
+
+// Applies change-feed entries to the loaded items: deletes drop an item,
+// updates replace it in place and adds go to the front.
+function applyChanges(items, changes) {
+  let next = items;
+  for (const change of changes) {
+    const index = next.findIndex(item => item.id === change.id && item.type === change.kind);
+    if (change.action === 'delete' || !change.item) {
+      if (index !== -1) {
+        next = next.filter((_, i) => i !== index);
+      }
+    } else if (index !== -1) {
+      next = next.map((item, i) => (i === index ? change.item : item));
+    } else {
+      next = [change.item, ...next];
+    }
+  }
+  return next;
+}
 
 export default function useTextDisplayData(initialPage = 1, pageSize = 5) {
   const [items, setItems] = useState([]);
@@ -7,6 +26,8 @@ export default function useTextDisplayData(initialPage = 1, pageSize = 5) {
   const [totalCount, setTotalCount] = useState(0);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
+  // Change-feed cursor of the first page; later changes are pulled from /api/changes.
+  const [cursor, setCursor] = useState(null);
 
   const fetchPage = useCallback(async (pageNum) => {
     setLoading(true);
@@ -14,11 +35,17 @@ export default function useTextDisplayData(initialPage = 1, pageSize = 5) {
       const data = await fetchTextDisplayPage(pageNum, pageSize);
       setTotalCount(data.total_count);
       setPage(data.page);
-      // Append new items to the existing list.
+      // Append new items to the existing list, skipping any a change already added.
       setItems(prevItems => {
-        // Optionally, you can add extra properties (e.g. positions) here.
-        return pageNum === 1 ? data.items : [...prevItems, ...data.items];
+        if (pageNum === 1) {
+          return data.items;
+        }
+        const seen = new Set(prevItems.map(item => `${item.type}:${item.id}`));
+        return [...prevItems, ...data.items.filter(item => !seen.has(`${item.type}:${item.id}`))];
       });
+      if (pageNum === 1) {
+        setCursor(data.cursor ?? null);
+      }
     } catch (err) {
       setError(err.message);
     } finally {
@@ -26,5 +53,40 @@ export default function useTextDisplayData(initialPage = 1, pageSize = 5) {
     }
   }, [pageSize]);
 
+  // Keep the loaded items current by long-polling the change feed.
+  useEffect(() => {
+    if (cursor === null) {
+      return undefined;
+    }
+    const controller = new AbortController();
+    (async () => {
+      let since = cursor;
+      while (!controller.signal.aborted) {
+        try {
+          const data = await fetchChanges(since, 25, controller.signal);
+          if (data.reset) {
+            // Too far behind to catch up: reload, which restarts syncing from a fresh cursor.
+            fetchPage(1);
+            return;
+          }
+          if (data.changes.length) {
+            const delta = data.changes.filter(change => change.action === 'add').length
+              - data.changes.filter(change => change.action === 'delete').length;
+            setItems(prevItems => applyChanges(prevItems, data.changes));
+            setTotalCount(count => Math.max(0, count + delta));
+          }
+          since = data.cursor;
+        } catch {
+          if (controller.signal.aborted) {
+            return;
+          }
+          // Back off before retrying after a network error.
+          await new Promise(resolve => setTimeout(resolve, 5000));
+        }
+      }
+    })();
+    return () => controller.abort();
+  }, [cursor, fetchPage]);
+
   return { items, page, totalCount, loading, error, fetchPage };
 }